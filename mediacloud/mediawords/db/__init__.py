@@ -1,4 +1,10 @@
+from typing import List, Union
+
 from mediawords.db.handler import DatabaseHandler
+from mediawords.db.instrumentation.instrumentation import enable_query_instrumentation, \
+    install_query_stats_dump_handlers
+from mediawords.db.pool.pool import DatabaseHandlerPool, PooledDatabaseHandler
+from mediawords.db.routing.routing import DatabaseReplica, RoutingDatabaseHandler
 from mediawords.test.db import using_test_database
 
 from mediawords.util.config import get_config as py_get_config
@@ -13,16 +19,15 @@ class McConnectToDBException(Exception):
     pass
 
 
-def connect_to_db(label: str = None, do_not_check_schema_version: bool = False) -> DatabaseHandler:
-    """Connect to PostgreSQL."""
+# Connection pools; (label, do_not_check_schema_version, use_replicas) -> DatabaseHandlerPool
+__POOLS = {}
 
-    label = decode_object_from_bytes_if_needed(label)
+# Whether query instrumentation has been set up from the configuration
+__query_instrumentation_configured = False
 
-    # If this is Catalyst::Test run, force the label to the test database
-    if using_test_database():
-        label = 'test'
 
-    config = py_get_config()
+def __database_settings(config: dict, label: str = None) -> dict:
+    """Return connection settings for the database labeled "label" (or the default one)."""
 
     if 'database' not in config:
         raise McConnectToDBException("No database connections are configured")
@@ -51,21 +56,116 @@ def connect_to_db(label: str = None, do_not_check_schema_version: bool = False)
     if 'host' not in settings or 'db' not in settings:
         raise McConnectToDBException("Settings are incomplete ('db' and 'host' must both be set).")
 
+    return settings
+
+
+def __reset_session(db: DatabaseHandler) -> None:
+    """Reset session variables that might have been changed by the previous user of the connection."""
+
+    # Reset the session variable in case the database connection is being reused due to pooling
+    db.query("""
+        DO $$
+        BEGIN
+        PERFORM enable_story_triggers();
+        EXCEPTION
+        WHEN undefined_function THEN
+            -- This exception will be raised if the database is uninitialized at this point.
+            -- So, don't emit any kind of error because of an non-existent function.
+            NULL;
+        WHEN OTHERS THEN
+            -- Forward the exception
+            RAISE;
+        END
+        $$;
+    """)
+
+
+def __configure_query_instrumentation(config: dict) -> None:
+    """Enable query timing instrumentation (once per process) if it's enabled in the configuration."""
+    global __query_instrumentation_configured
+
+    if __query_instrumentation_configured:
+        return
+    __query_instrumentation_configured = True
+
+    mediawords_config = config['mediawords']
+    if str(mediawords_config.get('db_query_instrumentation', 'no')).lower() not in {'yes', 'true', '1'}:
+        return
+
+    slow_query_threshold = mediawords_config.get('db_slow_query_threshold', None)
+    if slow_query_threshold is not None:
+        slow_query_threshold = float(slow_query_threshold)
+
+    enable_query_instrumentation(slow_query_threshold=slow_query_threshold)
+    install_query_stats_dump_handlers(top_n=int(mediawords_config.get('db_query_stats_top_n', 20)))
+
+
+def __replica_settings(settings: dict) -> List[dict]:
+    """Return connection settings of database's read replicas; unset ones are taken from the primary's settings."""
+
+    replicas = []
+    for replica in settings.get('replicas', None) or []:
+        replica_settings = dict(settings)
+        replica_settings.pop('replicas', None)
+        replica_settings.update(replica)
+        replicas.append(replica_settings)
+    return replicas
+
+
+def __create_database_handler(config: dict,
+                              settings: dict,
+                              do_not_check_schema_version: bool,
+                              use_replicas: bool = False) -> DatabaseHandler:
+    """Connect to PostgreSQL using the settings, set up the session.
+
+    If "use_replicas" is True and the database has read replicas configured, return a RoutingDatabaseHandler which
+    sends reads to the replicas."""
+
+    __configure_query_instrumentation(config)
+
     host = settings['host']
     port = int(settings['port'])
     username = settings['user']
     password = settings['pass']
     database = settings['db']
 
+    replicas = []
+    if use_replicas:
+        for replica_settings in __replica_settings(settings):
+            replicas.append(DatabaseReplica(
+                # Default argument binds the current settings to the lambda
+                connect=lambda s=replica_settings: __create_database_handler(
+                    config=config,
+                    settings=s,
+                    # Schema version gets checked on the primary
+                    do_not_check_schema_version=True,
+                ),
+                name='%s:%d' % (replica_settings['host'], int(replica_settings['port'])),
+            ))
+
     try:
-        ret = DatabaseHandler(
-            host=host,
-            port=port,
-            username=username,
-            password=password,
-            database=database,
-            do_not_check_schema_version=do_not_check_schema_version
-        )
+        if len(replicas) > 0:
+            mediawords_config = config['mediawords']
+            ret = RoutingDatabaseHandler(
+                host=host,
+                port=port,
+                username=username,
+                password=password,
+                database=database,
+                replicas=replicas,
+                max_lag=float(mediawords_config.get('db_replica_max_lag', 30)),
+                lag_check_interval=float(mediawords_config.get('db_replica_lag_check_interval', 5)),
+                do_not_check_schema_version=do_not_check_schema_version
+            )
+        else:
+            ret = DatabaseHandler(
+                host=host,
+                port=port,
+                username=username,
+                password=password,
+                database=database,
+                do_not_check_schema_version=do_not_check_schema_version
+            )
     except Exception as ex:
         raise McConnectToDBException(
             "Unable to connect to database %(username)s@%(host)s:%(port)d/%(database)s: %(exception)s" % {
@@ -84,21 +184,145 @@ def connect_to_db(label: str = None, do_not_check_schema_version: bool = False)
 
         ret.query('SET statement_timeout TO %(db_statement_timeout)s' % {'db_statement_timeout': db_statement_timeout})
 
-    # Reset the session variable in case the database connection is being reused due to pooling
-    ret.query("""
-        DO $$
-        BEGIN
-        PERFORM enable_story_triggers();
-        EXCEPTION
-        WHEN undefined_function THEN
-            -- This exception will be raised if the database is uninitialized at this point.
-            -- So, don't emit any kind of error because of an non-existent function.
-            NULL;
-        WHEN OTHERS THEN
-            -- Forward the exception
-            RAISE;
-        END
-        $$;
-    """)
+    if str(config['mediawords'].get('db_prepared_statements', 'no')).lower() in {'yes', 'true', '1'}:
+        ret.enable_prepared_statements(
+            threshold=int(config['mediawords'].get('db_prepared_statement_threshold', 5)),
+            max_size=int(config['mediawords'].get('db_prepared_statement_cache_size', 100)),
+        )
+
+    __reset_session(ret)
 
     return ret
+
+
+def connection_pool(label: str = None,
+                    do_not_check_schema_version: bool = False,
+                    use_replicas: bool = False) -> DatabaseHandlerPool:
+    """Return (process-wide) connection pool for the database labeled "label" (or the default one)."""
+
+    label = decode_object_from_bytes_if_needed(label)
+
+    # If this is Catalyst::Test run, force the label to the test database
+    if using_test_database():
+        label = 'test'
+
+    config = py_get_config()
+    settings = __database_settings(config=config, label=label)
+
+    pool_key = (settings['label'], bool(do_not_check_schema_version), bool(use_replicas),)
+    if pool_key not in __POOLS:
+        mediawords_config = config['mediawords']
+
+        __POOLS[pool_key] = DatabaseHandlerPool(
+            connect=lambda: __create_database_handler(
+                config=config,
+                settings=settings,
+                do_not_check_schema_version=do_not_check_schema_version,
+                use_replicas=use_replicas,
+            ),
+            reset=__reset_session,
+            max_size=int(mediawords_config.get('db_pool_max_size', 8)),
+            max_age=int(mediawords_config.get('db_pool_max_age', 60 * 60)),
+            checkout_timeout=int(mediawords_config.get('db_pool_checkout_timeout', 60)),
+        )
+
+    return __POOLS[pool_key]
+
+
+def connect_to_db(label: str = None,
+                  do_not_check_schema_version: bool = False,
+                  pooled: bool = False,
+                  use_replicas: bool = False) -> Union[DatabaseHandler, PooledDatabaseHandler]:
+    """Connect to PostgreSQL.
+
+    If "pooled" is True, the handler gets checked out from a per-process connection pool and its disconnect() returns
+    it back to the pool instead of closing the connection (see PooledDatabaseHandler).
+
+    If "use_replicas" is True and the database has "replicas" configured, the returned handler sends select(),
+    find_by_id(), query_paged_hashes() and read_only_query() to the least lagged read replica (see
+    mediawords.db.routing). Replicas might not have replayed what other connections have just written, so only
+    read-heavy users (web API, topic analytics) should ask for replicas."""
+
+    label = decode_object_from_bytes_if_needed(label)
+
+    if pooled:
+        return connection_pool(
+            label=label,
+            do_not_check_schema_version=do_not_check_schema_version,
+            use_replicas=use_replicas,
+        ).checkout()
+
+    # If this is Catalyst::Test run, force the label to the test database
+    if using_test_database():
+        label = 'test'
+
+    config = py_get_config()
+    settings = __database_settings(config=config, label=label)
+
+    return __create_database_handler(
+        config=config,
+        settings=settings,
+        do_not_check_schema_version=do_not_check_schema_version,
+        use_replicas=use_replicas,
+    )
+
+
+async def connect_to_db_async(label: str = None,
+                              do_not_check_schema_version: bool = False,
+                              min_size: int = None,
+                              max_size: int = None) -> 'AsyncDatabaseHandler':
+    """Connect to PostgreSQL asynchronously, return handler backed by a pool of "min_size" to "max_size" connections
+    (by default, "db_async_pool_min_size" and "db_async_pool_max_size" from the configuration).
+
+    Handler has to be disconnect()ed when no longer needed to close the pool's connections."""
+
+    # Imported here so that importing "mediawords.db" (e.g. from Perl) doesn't load asyncpg and asyncio
+    from mediawords.db.async_handler import AsyncDatabaseHandler
+
+    label = decode_object_from_bytes_if_needed(label)
+
+    # If this is Catalyst::Test run, force the label to the test database
+    if using_test_database():
+        label = 'test'
+
+    config = py_get_config()
+    settings = __database_settings(config=config, label=label)
+
+    __configure_query_instrumentation(config)
+
+    mediawords_config = config['mediawords']
+    if min_size is None:
+        min_size = int(mediawords_config.get('db_async_pool_min_size', 1))
+    if max_size is None:
+        max_size = int(mediawords_config.get('db_async_pool_max_size', 10))
+
+    server_settings = {}
+    if 'db_statement_timeout' in mediawords_config:
+        server_settings['statement_timeout'] = str(mediawords_config['db_statement_timeout'])
+
+    host = settings['host']
+    port = int(settings['port'])
+    username = settings['user']
+    database = settings['db']
+
+    try:
+        return await AsyncDatabaseHandler.connect(
+            host=host,
+            port=port,
+            username=username,
+            password=settings['pass'],
+            database=database,
+            min_size=min_size,
+            max_size=max_size,
+            server_settings=server_settings,
+            do_not_check_schema_version=do_not_check_schema_version,
+        )
+    except Exception as ex:
+        raise McConnectToDBException(
+            "Unable to connect to database %(username)s@%(host)s:%(port)d/%(database)s: %(exception)s" % {
+                'username': username,
+                'host': host,
+                'port': port,
+                'database': database,
+                'exception': str(ex)
+            })
@@ -0,0 +1,735 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Union
+
+import asyncpg
+
+from mediawords.db.copy.async_copy_from import AsyncCopyFrom
+from mediawords.db.exceptions.handler import *
+from mediawords.db.exceptions.result import McDatabaseResultException
+from mediawords.db.instrumentation.instrumentation import query_instrumentation_enabled, record_query
+from mediawords.db.result.async_result import AsyncDatabaseResult
+from mediawords.db.schema.cache import cached_target_schema_version, schema_version_check_is_cached, \
+    cache_schema_version_check, cached_schema_metadata, cache_schema_metadata
+from mediawords.db.schema.metadata import DatabaseSchemaMetadata, schema_metadata_query
+from mediawords.db.statement.placeholders import psycopg2_to_numbered_placeholders, numbered_placeholder_values, \
+    expand_tuple_parameters
+
+from mediawords.util.config import get_config as py_get_config
+from mediawords.util.log import create_logger
+from mediawords.util.paths import mc_sql_schema_path
+from mediawords.util.perl import convert_dbd_pg_arguments_to_psycopg2_format, decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+
+class AsyncDatabaseHandler(object):
+    """Asynchronous PostgreSQL middleware with the interface of DatabaseHandler, built on asyncpg.
+
+    Handler returned by connect() is backed by a connection pool: each query gets run on a connection checked out from
+    the pool for the duration of the query, so a single handler can be used by many concurrently running coroutines:
+
+        db = await connect_to_db_async()
+        stories = await asyncio.gather(*[db.find_by_id('stories', stories_id) for stories_id in stories_ids])
+
+    Transactions need a connection of their own, so they're run on a handler bound to a single connection:
+
+        async with db.transaction() as tx_db:
+            await tx_db.create('media', {...})
+
+    Methods mirror those of DatabaseHandler but have to be awaited; queries accept the same psycopg2-style (or
+    DBD::Pg-style) query parameters. Unlike psycopg2, asyncpg doesn't convert strings to column types, so parameters
+    have to be of the matching Python types (e.g. datetime.date for DATE columns)."""
+
+    # Environment variable which, when set, will make us ignore the schema version
+    __IGNORE_SCHEMA_VERSION_ENV_VARIABLE = 'MEDIACLOUD_IGNORE_DB_SCHEMA_VERSION'
+
+    # For how long (in seconds) a successful schema version check stays valid in the on-disk cache
+    __SCHEMA_VERSION_CHECK_CACHE_MAX_AGE = 60 * 10
+
+    # Process-wide cache of schema metadata; database ("host:port/name") -> (target schema version, metadata)
+    __schema_metadata = {}
+
+    # asyncpg connection pool
+    __pool = None
+
+    # Whether this handler has created the pool (and so should close it on disconnect())
+    __owns_pool = False
+
+    # asyncpg connection this handler is bound to (None if queries get run on connections from the pool)
+    __connection = None
+
+    # asyncpg transaction started with begin() (None if not in transaction)
+    __transaction = None
+
+    # Database identifier for schema caches ("host:port/name")
+    __database_key = None
+
+    # Lock for loading schema metadata only once when many coroutines need it at the same time
+    __schema_metadata_lock = None
+
+    def __init__(self,
+                 pool: asyncpg.pool.Pool,
+                 database_key: str,
+                 connection: asyncpg.Connection = None,
+                 schema_metadata_lock: asyncio.Lock = None):
+        """Constructor; use connect() to connect to PostgreSQL."""
+        self.__pool = pool
+        self.__owns_pool = False
+        self.__database_key = database_key
+        self.__connection = connection
+        self.__transaction = None
+        self.__schema_metadata_lock = schema_metadata_lock if schema_metadata_lock is not None else asyncio.Lock()
+
+    @staticmethod
+    async def connect(host: str,
+                      port: int,
+                      username: str,
+                      password: str,
+                      database: str,
+                      min_size: int = 1,
+                      max_size: int = 10,
+                      server_settings: Dict[str, str] = None,
+                      do_not_check_schema_version: bool = False) -> 'AsyncDatabaseHandler':
+        """Create a pool of "min_size" to "max_size" connections to PostgreSQL, return a handler using it."""
+
+        host = decode_object_from_bytes_if_needed(host)
+        # noinspection PyTypeChecker
+        port = int(decode_object_from_bytes_if_needed(port))
+        username = decode_object_from_bytes_if_needed(username)
+        password = decode_object_from_bytes_if_needed(password)
+        database = decode_object_from_bytes_if_needed(database)
+
+        if not (host and username and password and database):
+            raise McConnectException("Database connection credentials are not set.")
+
+        if not port:
+            port = 5432
+
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise McConnectException("Invalid pool size: min. %d, max. %d" % (min_size, max_size))
+
+        try:
+            pool = await asyncpg.create_pool(host=host,
+                                             port=port,
+                                             user=username,
+                                             password=password,
+                                             database=database,
+                                             min_size=min_size,
+                                             max_size=max_size,
+                                             server_settings=server_settings)
+        except Exception as ex:
+            raise McConnectException("Unable to create connection pool: %s" % str(ex))
+
+        db = AsyncDatabaseHandler(pool=pool, database_key='%s:%d/%s' % (host, port, database))
+        db.__owns_pool = True
+
+        if not do_not_check_schema_version:
+            try:
+                if not await db.__check_schema_version():
+                    raise McConnectException("Database schema is not up-to-date.")
+            except Exception:
+                await db.disconnect()
+                raise
+
+        return db
+
+    async def disconnect(self) -> None:
+        """Close the connection pool (or release the connection back to the pool if this is a handler returned by
+        acquire())."""
+        if self.__connection is not None:
+            await self.release()
+        elif self.__owns_pool and self.__pool is not None:
+            await self.__pool.close()
+            self.__pool = None
+
+    async def acquire(self) -> 'AsyncDatabaseHandler':
+        """Check out a connection from the pool, return a handler bound to it.
+
+        The returned handler is to be used by a single coroutine at a time; release() it when done."""
+        if self.__pool is None:
+            raise McDatabaseHandlerException("Connection pool is closed.")
+
+        connection = await self.__pool.acquire()
+        return AsyncDatabaseHandler(pool=self.__pool,
+                                    database_key=self.__database_key,
+                                    connection=connection,
+                                    schema_metadata_lock=self.__schema_metadata_lock)
+
+    async def release(self) -> None:
+        """Release connection of a handler returned by acquire() back to the pool, rolling back unfinished
+        transaction."""
+        if self.__connection is None:
+            raise McDatabaseHandlerException("Handler isn't bound to a connection.")
+
+        try:
+            if self.in_transaction():
+                log.warning("Releasing connection with unfinished transaction, rolling back.")
+                await self.rollback()
+        finally:
+            connection = self.__connection
+            self.__connection = None
+            await self.__pool.release(connection)
+
+    def dbh(self) -> None:
+        raise McDatabaseHandlerException("Please don't use internal database handler directly")
+
+    @staticmethod
+    def __schema_version_cache_dir() -> str:
+        """Return directory for caching target schema version and schema version checks."""
+        config = py_get_config()
+        return os.path.join(config['mediawords']['data_dir'], 'cache', 'db_schema_version')
+
+    def __target_schema_version(self) -> int:
+        """Return schema version from mediawords.sql (cached on disk until mediawords.sql changes)."""
+        return cached_target_schema_version(schema_path=mc_sql_schema_path(),
+                                            cache_dir=self.__schema_version_cache_dir())
+
+    async def __check_schema_version(self) -> bool:
+        """Return True if the database schema is up-to-date (or it doesn't matter)."""
+
+        target_schema_version = self.__target_schema_version()
+        if not target_schema_version:
+            raise McSchemaIsUpToDateException("Invalid target schema version.")
+
+        if schema_version_check_is_cached(cache_dir=self.__schema_version_cache_dir(),
+                                          database=self.__database_key,
+                                          target_schema_version=target_schema_version,
+                                          max_age=self.__SCHEMA_VERSION_CHECK_CACHE_MAX_AGE):
+            return True
+
+        # Check if the database is empty
+        db_vars_table_exists = len((await self.query("""
+            -- noinspection SqlResolve
+            SELECT *
+            FROM information_schema.tables
+            WHERE table_name = 'database_variables'
+        """)).flat()) > 0
+        if not db_vars_table_exists:
+            log.info(
+                "Database table 'database_variables' does not exist, probably the database is empty at this point.")
+            return True
+
+        (current_schema_version,) = (await self.query("""
+            SELECT value AS schema_version
+            FROM database_variables
+            WHERE name = 'database-schema-version'
+            LIMIT 1
+        """)).flat()
+        current_schema_version = int(current_schema_version)
+        if current_schema_version == 0:
+            raise McSchemaIsUpToDateException("Current schema version is 0")
+
+        if current_schema_version == target_schema_version:
+            cache_schema_version_check(cache_dir=self.__schema_version_cache_dir(),
+                                       database=self.__database_key,
+                                       target_schema_version=target_schema_version)
+            return True
+
+        config = py_get_config()
+        if config['mediawords'].get('ignore_schema_version', False) and \
+                self.__IGNORE_SCHEMA_VERSION_ENV_VARIABLE in os.environ:
+            log.warning("Database schema version is %d while mediawords.sql's is %d, but %s is set so continuing." % (
+                current_schema_version, target_schema_version, self.__IGNORE_SCHEMA_VERSION_ENV_VARIABLE,
+            ))
+            return True
+
+        log.warning(
+            "Database schema version is %d while mediawords.sql's is %d; please upgrade the database schema." % (
+                current_schema_version, target_schema_version,
+            ))
+        return False
+
+    @staticmethod
+    async def __execute(connection: asyncpg.Connection, query: str, args: List[Any]) -> AsyncDatabaseResult:
+        """Execute the query with "$N" placeholders on the connection."""
+        try:
+            statement = await connection.prepare(query)
+        except asyncpg.PostgresSyntaxError:
+            if len(args) > 0:
+                raise
+
+            # Multiple statements can't be prepared but can be run using the simple query protocol
+            status = await connection.execute(query)
+            return AsyncDatabaseResult(records=[], columns=[], status=status)
+
+        records = await statement.fetch(*args)
+        columns = [attribute.name for attribute in statement.get_attributes()]
+
+        return AsyncDatabaseResult(records=records, columns=columns, status=statement.get_statusmsg())
+
+    async def query(self, *query_params) -> AsyncDatabaseResult:
+        """Run the query, return instance of AsyncDatabaseResult for accessing the result.
+
+        Accepts the same parameters as DatabaseHandler's query(), e.g.:
+
+            await db.query('SELECT * FROM foo WHERE bar = %(bar)s AND baz = %(baz)s', {'bar': bar, 'baz': baz})
+        """
+
+        # MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
+        query_params = convert_dbd_pg_arguments_to_psycopg2_format(*query_params)
+
+        if len(query_params) == 0:
+            raise McQueryException("Query is unset.")
+        if len(query_params) > 2:
+            raise McQueryException("query() accepts at most 2 parameters.")
+
+        query = query_params[0]
+        params = query_params[1] if len(query_params) == 2 else ()
+
+        try:
+            query, params = expand_tuple_parameters(query=query, params=params)
+            numbered_query, param_names, _ = psycopg2_to_numbered_placeholders(query=query,
+                                                                               params=params,
+                                                                               unescape_percentage_signs=False)
+            args = numbered_placeholder_values(params=params, param_names=param_names)
+        except Exception as ex:
+            raise McDatabaseResultException('Invalid query: %(exception)s; query: %(query)s' % {
+                'exception': str(ex),
+                'query': str(query_params),
+            })
+
+        log.debug("Running query: %s" % str(query_params))
+
+        start_time = time.time()
+
+        try:
+            if self.__connection is not None:
+                result = await self.__execute(connection=self.__connection, query=numbered_query, args=args)
+            else:
+                if self.__pool is None:
+                    raise McDatabaseHandlerException("Connection pool is closed.")
+                async with self.__pool.acquire() as connection:
+                    result = await self.__execute(connection=connection, query=numbered_query, args=args)
+
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, asyncpg.DataError) as ex:
+            raise McDatabaseResultException('Query failed: %(exception)s; query: %(query)s' % {
+                'exception': str(ex),
+                'query': str(query_params),
+            })
+
+        if query_instrumentation_enabled():
+            record_query(query=query, duration=time.time() - start_time, rows=result.rows())
+
+        return result
+
+    async def schema_metadata(self) -> DatabaseSchemaMetadata:
+        """Return metadata (primary keys, columns, foreign keys) of the database's tables.
+
+        Metadata gets loaded with a single catalog query and is shared between all async handlers of the process
+        connected to the same database."""
+
+        try:
+            schema_version = self.__target_schema_version()
+        except Exception as ex:
+            log.warning("Unable to determine target schema version: %s" % str(ex))
+            schema_version = None
+
+        cached = self.__schema_metadata.get(self.__database_key, None)
+        if cached is not None and cached[0] == schema_version:
+            return cached[1]
+
+        async with self.__schema_metadata_lock:
+
+            # Some other coroutine might have loaded it while we were waiting for the lock
+            cached = self.__schema_metadata.get(self.__database_key, None)
+            if cached is not None and cached[0] == schema_version:
+                return cached[1]
+
+            config = py_get_config()
+            disk_cache = config['mediawords'].get('db_schema_metadata_disk_cache', 'no')
+            disk_cache = str(disk_cache).lower() in {'yes', 'true', '1'} and schema_version is not None
+
+            metadata = None
+            if disk_cache:
+                metadata_dict = cached_schema_metadata(cache_dir=self.__schema_version_cache_dir(),
+                                                       database=self.__database_key,
+                                                       schema_version=schema_version)
+                if metadata_dict is not None:
+                    metadata = DatabaseSchemaMetadata.from_dict(metadata_dict)
+
+            if metadata is None:
+                log.debug("Loading schema metadata of %s..." % self.__database_key)
+                metadata = DatabaseSchemaMetadata()
+                metadata.add_tables((await self.query(schema_metadata_query())).hashes())
+
+                if disk_cache:
+                    cache_schema_metadata(cache_dir=self.__schema_version_cache_dir(),
+                                          database=self.__database_key,
+                                          schema_version=schema_version,
+                                          metadata=metadata.to_dict())
+
+            self.__schema_metadata[self.__database_key] = (schema_version, metadata,)
+
+        return metadata
+
+    async def __table_metadata(self, table: str) -> Union[DatabaseSchemaMetadata, None]:
+        """Return schema metadata which includes the table, or None if the table doesn't exist."""
+
+        metadata = await self.schema_metadata()
+        if metadata.has_table(table):
+            return metadata
+
+        # Table created after the metadata was loaded, or a temporary table
+        rows = (await self.query(schema_metadata_query(single_table=True), {'table_name': table})).hashes()
+        if len(rows) == 0:
+            return None
+
+        if rows[0]['is_temporary']:
+            # Temporary tables are specific to the session, so don't cache them process-wide
+            metadata = DatabaseSchemaMetadata()
+
+        metadata.add_tables(rows)
+
+        # Table might have been found under a different name, e.g. "Table" instead of "table"
+        if not metadata.has_table(table):
+            return None
+
+        return metadata
+
+    async def primary_key_column(self, table: str) -> str:
+        """Get the primary key column for the table."""
+
+        table = decode_object_from_bytes_if_needed(table)
+
+        metadata = await self.__table_metadata(table)
+        if metadata is None:
+            raise McPrimaryKeyColumnException("Table '%s' was not found" % table)
+
+        primary_key_column = metadata.primary_key_columns(table)
+        if primary_key_column is None or len(primary_key_column) == 0:
+            raise McPrimaryKeyColumnException("Primary key for table '%s' was not found" % table)
+        if len(primary_key_column) > 1:
+            raise McPrimaryKeyColumnException(
+                "More than one primary key column was found for table '%(table)s': %(primary_key_columns)s" % {
+                    'table': table,
+                    'primary_key_columns': str(primary_key_column)
+                })
+
+        return primary_key_column[0]
+
+    async def find_by_id(self, table: str, object_id: int) -> Union[Dict[str, Any], None]:
+        """Do an ID lookup on the table and return a single row match if found."""
+
+        # noinspection PyTypeChecker
+        object_id = int(decode_object_from_bytes_if_needed(object_id))
+        table = decode_object_from_bytes_if_needed(table)
+
+        primary_key_column = await self.primary_key_column(table)
+
+        # Python substitution
+        find_by_id_query = "SELECT * FROM %(table)s WHERE %(id_column)s" % {
+            "table": table,
+            "id_column": primary_key_column,
+        }
+
+        # asyncpg substitution
+        result = await self.query(find_by_id_query + " = %(id_value)s", {'id_value': object_id})
+        if result.rows() > 1:
+            raise McFindByIDException("More than one row was found for ID '%d' from table '%s'" % (object_id, table))
+        elif result.rows() == 1:
+            return result.hash()
+        else:
+            return None
+
+    async def require_by_id(self, table: str, object_id: int) -> Dict[str, Any]:
+        """find_by_id() or raise exception if not found."""
+
+        # noinspection PyTypeChecker
+        object_id = int(decode_object_from_bytes_if_needed(object_id))
+        table = decode_object_from_bytes_if_needed(table)
+
+        row = await self.find_by_id(table, object_id)
+        if row is None:
+            raise McRequireByIDException("Unable to find ID '%d' in table '%s'" % (object_id, table))
+        return row
+
+    async def update_by_id(self, table: str, object_id: int, update_hash: dict) -> Union[Dict[str, Any], None]:
+        """Update the row in the table with the given ID. Ignore any fields that start with '_'."""
+
+        # noinspection PyTypeChecker
+        object_id = int(decode_object_from_bytes_if_needed(object_id))
+        table = decode_object_from_bytes_if_needed(table)
+        update_hash = decode_object_from_bytes_if_needed(update_hash)
+
+        update_hash = {k: v for k, v in update_hash.items() if not k.startswith("_")}
+
+        if len(update_hash) == 0:
+            raise McUpdateByIDException("Hash to UPDATE is empty.")
+
+        primary_key_column = await self.primary_key_column(table)
+
+        keys = []
+        for key in update_hash.keys():
+            keys.append(key + " = %(" + key + ")s")  # "%(key)s" to be resolved by query(), not Python
+
+        update_hash['__object_id'] = object_id
+
+        sql = "UPDATE %s " % table
+        sql += "SET %s " % ", ".join(keys)
+        sql += "WHERE %s = " % primary_key_column
+        sql += "%(__object_id)s "  # "%(__object_id)s" to be resolved by query(), not Python
+        sql += "RETURNING *"
+
+        try:
+            updated_rows = (await self.query(sql, update_hash)).hashes()
+        except Exception as ex:
+            raise McUpdateByIDException("Update to UPDATE hash '%s': %s" % (str(update_hash), str(ex)))
+
+        if len(updated_rows) > 1:
+            raise McUpdateByIDException("More than one row was updated for ID '%d' in table '%s'" % (object_id, table))
+        elif len(updated_rows) == 1:
+            return updated_rows[0]
+        else:
+            return None
+
+    async def delete_by_id(self, table: str, object_id: int) -> None:
+        """Delete the row in the table with the given ID."""
+
+        # noinspection PyTypeChecker
+        object_id = int(decode_object_from_bytes_if_needed(object_id))
+        table = decode_object_from_bytes_if_needed(table)
+
+        primary_key_column = await self.primary_key_column(table)
+
+        sql = "DELETE FROM %s " % table
+        sql += "WHERE %s = " % primary_key_column
+        sql += "%(__object_id)s"  # "%(object_id)s" to be resolved by query(), not Python
+
+        await self.query(sql, {"__object_id": object_id})
+
+    async def insert(self, table: str, insert_hash: dict) -> Dict[str, Any]:
+        """Alias for create()."""
+        return await self.create(table=table, insert_hash=insert_hash)
+
+    async def create(self, table: str, insert_hash: dict) -> Dict[str, Any]:
+        """Insert a row into the database for the given table with the given hash values and return the created row."""
+
+        table = decode_object_from_bytes_if_needed(table)
+        insert_hash = decode_object_from_bytes_if_needed(insert_hash)
+
+        if len(insert_hash) == 0:
+            raise McCreateException("Hash to INSERT is empty")
+
+        keys = list(insert_hash.keys())
+        values = ["%(" + key + ")s" for key in keys]  # "%(key)s" to be resolved by query(), not Python
+
+        sql = "INSERT INTO %s " % table
+        sql += "(%s) " % ", ".join(keys)
+        sql += "VALUES (%s) " % ", ".join(values)
+        sql += "RETURNING *"
+
+        try:
+            inserted_row = (await self.query(sql, insert_hash)).hash()
+        except Exception as ex:
+            raise McCreateException("Unable to INSERT into '%(table)s' data '%(data)s': %(exception)s" % {
+                'table': table,
+                'data': str(insert_hash),
+                'exception': str(ex),
+            })
+
+        if inserted_row is None:
+            raise McCreateException("Last inserted row was not found")
+
+        return inserted_row
+
+    async def select(self, table: str, what_to_select: str, condition_hash: dict = None) -> AsyncDatabaseResult:
+        """SELECT chosen columns from the table that match given conditions."""
+
+        table = decode_object_from_bytes_if_needed(table)
+        what_to_select = decode_object_from_bytes_if_needed(what_to_select)
+        condition_hash = decode_object_from_bytes_if_needed(condition_hash)
+
+        if condition_hash is None:
+            condition_hash = {}
+
+        sql_conditions = []
+        for key in condition_hash.keys():
+            sql_conditions.append(key + " = %(" + key + ")s")  # "%(key)s" to be resolved by query(), not Python
+
+        sql = "SELECT %s " % what_to_select
+        sql += "FROM %s " % table
+        if len(sql_conditions) > 0:
+            sql += "WHERE %s" % " AND ".join(sql_conditions)
+
+        return await self.query(sql, condition_hash)
+
+    async def find_or_create(self, table: str, insert_hash: dict) -> Dict[str, Any]:
+        """Select a single row from the database matching the hash or insert a row with the hash values and return the
+        inserted row as a hash."""
+
+        table = decode_object_from_bytes_if_needed(table)
+        insert_hash = decode_object_from_bytes_if_needed(insert_hash)
+
+        if len(insert_hash) == 0:
+            raise McFindOrCreateException("Hash to INSERT or SELECT is empty")
+
+        keys = list(insert_hash.keys())
+        values = ["%(" + key + ")s" for key in keys]  # "%(key)s" to be resolved by query(), not Python
+        conditions = [key + " = %(" + key + ")s" for key in keys]
+
+        # Same single statement as DatabaseHandler's find_or_create()
+        sql = """
+            WITH existing_row AS (
+                SELECT *
+                FROM %(table)s
+                WHERE %(conditions)s
+                LIMIT 1
+            ),
+            inserted_row AS (
+                INSERT INTO %(table)s (%(keys)s)
+                    SELECT %(values)s
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_row)
+                ON CONFLICT DO NOTHING
+                RETURNING *
+            )
+            SELECT * FROM existing_row
+            UNION ALL
+            SELECT * FROM inserted_row
+        """ % {
+            'table': table,
+            'conditions': " AND ".join(conditions),
+            'keys': ", ".join(keys),
+            'values': ", ".join(values),
+        }
+
+        try:
+            row = (await self.query(sql, insert_hash)).hash()
+        except Exception as ex:
+            raise McFindOrCreateException("Unable to find or create row in '%(table)s' with data '%(data)s': %(ex)s" % {
+                'table': table,
+                'data': str(insert_hash),
+                'ex': str(ex),
+            })
+
+        if row is not None:
+            return row
+
+        # Row got inserted by a concurrent transaction after this statement's snapshot was taken
+        row = (await self.select(table=table, what_to_select='*', condition_hash=insert_hash)).hash()
+        if row is None:
+            raise McFindOrCreateException(
+                "Row with data '%s' conflicts with an existing row in '%s' but doesn't match it" % (
+                    str(insert_hash), table,
+                ))
+
+        return row
+
+    def in_transaction(self) -> bool:
+        """Return True if we're within a manually started transaction."""
+        return self.__transaction is not None
+
+    async def begin(self) -> None:
+        """Begin a transaction; only handlers returned by acquire() can do that."""
+        if self.__connection is None:
+            raise McBeginException("Transactions have to be run on a handler returned by acquire() or transaction().")
+        if self.in_transaction():
+            raise McBeginException("Already in transaction, can't BEGIN.")
+
+        transaction = self.__connection.transaction()
+        await transaction.start()
+        self.__transaction = transaction
+
+    async def begin_work(self) -> None:
+        """Begin a transaction."""
+        return await self.begin()
+
+    async def commit(self) -> None:
+        """Commit a transaction."""
+        if not self.in_transaction():
+            log.debug("Not in transaction, nothing to COMMIT.")
+        else:
+            transaction = self.__transaction
+            self.__transaction = None
+            await transaction.commit()
+
+    async def rollback(self) -> None:
+        """Rollback a transaction."""
+        if not self.in_transaction():
+            log.warning("Not in transaction, nothing to ROLLBACK.")
+        else:
+            transaction = self.__transaction
+            self.__transaction = None
+            await transaction.rollback()
+
+    def transaction(self) -> '_AsyncTransaction':
+        """Return asynchronous context manager which runs a transaction on a connection of its own (or on the handler's
+        connection if it's bound to one), e.g.:
+
+            async with db.transaction() as tx_db:
+                await tx_db.query(...)
+
+        The transaction gets committed on exit or rolled back if an exception gets raised."""
+        return _AsyncTransaction(db=self, acquire=self.__connection is None)
+
+    async def copy_from(self, sql: str, binary_types: List[str] = None) -> AsyncCopyFrom:
+        """Return COPY FROM helper for "COPY table [(columns)] FROM STDIN [WITH (options)]" SQL.
+
+        Unless the handler is bound to a connection, COPY gets a connection from the pool of its own which gets
+        released after end()."""
+
+        sql = decode_object_from_bytes_if_needed(sql)
+
+        if self.__connection is not None:
+            return AsyncCopyFrom(connection=self.__connection, sql=sql, binary_types=binary_types)
+
+        if self.__pool is None:
+            raise McDatabaseHandlerException("Connection pool is closed.")
+
+        pool = self.__pool
+        connection = await pool.acquire()
+
+        async def __release() -> None:
+            await pool.release(connection)
+
+        try:
+            return AsyncCopyFrom(connection=connection, sql=sql, binary_types=binary_types, release=__release)
+        except Exception:
+            await __release()
+            raise
+
+
+class _AsyncTransaction(object):
+    """Asynchronous context manager returned by AsyncDatabaseHandler's transaction()."""
+
+    # Handler that transaction() was called on
+    __db = None
+
+    # Handler bound to the transaction's connection
+    __tx_db = None
+
+    # Whether to acquire a connection from the pool for the transaction (and release it afterwards)
+    __acquire = False
+
+    def __init__(self, db: AsyncDatabaseHandler, acquire: bool):
+        self.__db = db
+        self.__acquire = acquire
+
+    async def __aenter__(self) -> AsyncDatabaseHandler:
+        if self.__acquire:
+            self.__tx_db = await self.__db.acquire()
+        else:
+            self.__tx_db = self.__db
+
+        try:
+            await self.__tx_db.begin()
+        except Exception:
+            if self.__acquire:
+                await self.__tx_db.release()
+            raise
+
+        return self.__tx_db
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> bool:
+        try:
+            if exc_type is None:
+                await self.__tx_db.commit()
+            else:
+                await self.__tx_db.rollback()
+        finally:
+            if self.__acquire:
+                await self.__tx_db.release()
+
+        # Don't suppress the exception
+        return False
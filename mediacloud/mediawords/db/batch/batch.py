@@ -0,0 +1,268 @@
+import collections
+import json
+import re
+from typing import Any, Dict, List, Union
+
+from mediawords.db.exceptions.handler import McDatabaseHandlerException
+from mediawords.db.statement.placeholders import prefix_placeholders
+from mediawords.util.log import create_logger
+from mediawords.util.perl import convert_dbd_pg_arguments_to_psycopg2_format, decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+# Statements that can be used as a CTE
+_BATCHABLE_QUERY_REGEX = re.compile(
+    r'^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(?:SELECT|INSERT|UPDATE|DELETE|WITH|VALUES|TABLE)\b',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+class McDatabaseBatchException(McDatabaseHandlerException):
+    """Batch exception."""
+    pass
+
+
+class DatabaseBatchResult(object):
+    """Result of a query queued in a batch.
+
+    Has DatabaseResult's row accessors; if the batch hasn't been executed yet when any of them gets called, the batch
+    gets executed first."""
+
+    # Batch that the query was queued in
+    __batch = None
+
+    # Rows (dictionaries) which haven't been read yet; None until the batch gets executed
+    __rows = None
+
+    # Number of rows returned by the query
+    __row_count = -1
+
+    # Exception to raise when reading rows if the batch has failed
+    __exception = None
+
+    def __init__(self, batch: 'DatabaseBatch'):
+        self.__batch = batch
+        self.__rows = None
+        self.__row_count = -1
+        self.__exception = None
+
+    def _set_rows(self, rows: List[Dict[str, Any]]) -> None:
+        self.__rows = collections.deque(rows)
+        self.__row_count = len(rows)
+
+    def _set_exception(self, exception: Exception) -> None:
+        self.__exception = exception
+
+    def done(self) -> bool:
+        """Return True if the batch has been executed."""
+        return self.__rows is not None or self.__exception is not None
+
+    def __wait(self) -> None:
+        if not self.done():
+            self.__batch.execute()
+        if self.__exception is not None:
+            raise McDatabaseBatchException("Batch has failed: %s" % str(self.__exception))
+
+    def columns(self) -> List[str]:
+        """Return a list of column names (empty list if the query didn't return any rows)."""
+        self.__wait()
+        if len(self.__rows) == 0:
+            return []
+        return list(self.__rows[0].keys())
+
+    def rows(self) -> int:
+        """Return the number of rows returned by the query."""
+        self.__wait()
+        return self.__row_count
+
+    def array(self) -> Union[List[Any], None]:
+        """Return a list of a single row."""
+        self.__wait()
+        if len(self.__rows) == 0:
+            return None
+        return list(self.__rows.popleft().values())
+
+    def hash(self) -> Union[Dict[str, Any], None]:
+        """Return a dict of a single row, keyed by column name"""
+        self.__wait()
+        if len(self.__rows) == 0:
+            return None
+        return dict(self.__rows.popleft())
+
+    def flat(self) -> List[Any]:
+        """Return a flattened list of all returned (remaining) rows."""
+        return [value for row in self.hashes() for value in row.values()]
+
+    def hashes(self) -> List[Dict[str, Any]]:
+        """Return a list of dicts of all returned (remaining) rows, keyed by column name."""
+        self.__wait()
+        rows = [dict(row) for row in self.__rows]
+        self.__rows.clear()
+        return rows
+
+
+class DatabaseBatch(object):
+    """Queue of independent queries to be sent to PostgreSQL in a single round trip.
+
+    Usage:
+
+        with db.batch() as batch:
+            results = [batch.find_by_id('stories', stories_id) for stories_id in stories_ids]
+        stories = [result.hash() for result in results]
+
+    (or call execute() instead of using the context manager). Queued queries get merged into a single statement, each
+    query becoming a CTE of it, so N lookups cost a single network round trip instead of N. Queries thus see the same
+    snapshot of the database and can't depend on each other's changes; data-modifying queries have to have a RETURNING
+    clause.
+
+    Rows are shipped back as JSON, so values come back as their JSON representations: dates and timestamps are ISO 8601
+    strings (like DBD::Pg returns them), numerics are floats, and JSON columns get decoded."""
+
+    # Database handler to run the batch on
+    __db = None
+
+    # Max. number of queries in a single statement; larger batches get split into several statements
+    __max_queries = None
+
+    # Queued queries; list of (query, parameters, result) tuples
+    __queue = None
+
+    def __init__(self, db: 'DatabaseHandler', max_queries: int = 500):
+        self.__db = db
+        self.__max_queries = max(1, max_queries)
+        self.__queue = []
+
+    def __enter__(self) -> 'DatabaseBatch':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        if exc_type is None:
+            self.execute()
+        else:
+            self.__fail(exc_val if exc_val is not None else McDatabaseBatchException("Batch was aborted"))
+
+        # Don't suppress the exception
+        return False
+
+    def __len__(self) -> int:
+        return len(self.__queue)
+
+    def query(self, *query_params) -> DatabaseBatchResult:
+        """Queue the query; accepts the same parameters as handler's query()."""
+
+        # MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
+        query_params = convert_dbd_pg_arguments_to_psycopg2_format(*query_params)
+
+        if len(query_params) == 0:
+            raise McDatabaseBatchException("Query is unset.")
+        if len(query_params) > 2:
+            raise McDatabaseBatchException("query() accepts at most 2 parameters.")
+
+        query = query_params[0].strip().rstrip(';')
+        params = query_params[1] if len(query_params) == 2 else None
+
+        if not _BATCHABLE_QUERY_REGEX.match(query):
+            raise McDatabaseBatchException("Only SELECT, INSERT, UPDATE, DELETE, WITH and VALUES can be batched: %s" %
+                                           query)
+
+        result = DatabaseBatchResult(batch=self)
+        self.__queue.append((query, params, result,))
+        return result
+
+    def find_by_id(self, table: str, object_id: int) -> DatabaseBatchResult:
+        """Queue ID lookup on the table; result's hash() returns the row or None if it wasn't found."""
+
+        # noinspection PyTypeChecker
+        object_id = int(decode_object_from_bytes_if_needed(object_id))
+        table = decode_object_from_bytes_if_needed(table)
+
+        primary_key_column = self.__db.primary_key_column(table)
+
+        # Python substitution
+        find_by_id_query = "SELECT * FROM %(table)s WHERE %(id_column)s" % {
+            "table": table,
+            "id_column": primary_key_column,
+        }
+
+        # psycopg2 substitution
+        return self.query(find_by_id_query + " = %(id_value)s", {'id_value': object_id})
+
+    def select(self, table: str, what_to_select: str, condition_hash: dict = None) -> DatabaseBatchResult:
+        """Queue SELECT of chosen columns from the table that match given conditions."""
+
+        table = decode_object_from_bytes_if_needed(table)
+        what_to_select = decode_object_from_bytes_if_needed(what_to_select)
+        condition_hash = decode_object_from_bytes_if_needed(condition_hash)
+
+        if condition_hash is None:
+            condition_hash = {}
+
+        sql_conditions = []
+        for key in condition_hash.keys():
+            sql_conditions.append(key + " = %(" + key + ")s")  # "%(key)s" to be resolved by psycopg2, not Python
+
+        sql = "SELECT %s " % what_to_select
+        sql += "FROM %s " % table
+        if len(sql_conditions) > 0:
+            sql += "WHERE %s" % " AND ".join(sql_conditions)
+
+        return self.query(sql, condition_hash)
+
+    def execute(self) -> None:
+        """Send all queued queries to PostgreSQL, set their results."""
+
+        while len(self.__queue) > 0:
+            chunk = self.__queue[:self.__max_queries]
+            self.__queue = self.__queue[self.__max_queries:]
+
+            try:
+                self.__execute_chunk(chunk)
+            except Exception as ex:
+                for _, _, result in chunk:
+                    result._set_exception(ex)
+                self.__fail(ex)
+                raise McDatabaseBatchException("Batch has failed: %s" % str(ex))
+
+    def __fail(self, exception: Exception) -> None:
+        """Fail all queued queries with the exception."""
+        for _, _, result in self.__queue:
+            result._set_exception(exception)
+        self.__queue = []
+
+    def __execute_chunk(self, chunk: List[tuple]) -> None:
+        """Run queued queries as a single statement."""
+
+        ctes = []
+        selects = []
+        params = {}
+
+        for index, (query, query_params, _) in enumerate(chunk):
+            prefixed_query, prefixed_params = prefix_placeholders(query=query,
+                                                                  params=query_params,
+                                                                  prefix='mc_batch_%d_' % index)
+            params.update(prefixed_params)
+
+            # Newline before the closing parenthesis as the query might end with a comment
+            ctes.append("mc_batch_%(index)d AS (\n%(query)s\n)" % {'index': index, 'query': prefixed_query})
+            selects.append(
+                "SELECT %(index)d AS batch_index, (SELECT json_agg(mc_batch_%(index)d) FROM mc_batch_%(index)d) AS rows"
+                % {'index': index}
+            )
+
+        sql = "WITH %s\n%s" % (",\n".join(ctes), "\nUNION ALL\n".join(selects))
+
+        log.debug("Running batch of %d queries" % len(chunk))
+
+        batch_rows = self.__db.query(sql, params).hashes()
+        if len(batch_rows) != len(chunk):
+            raise McDatabaseBatchException("Expected %d results, got %d" % (len(chunk), len(batch_rows)))
+
+        for batch_row in batch_rows:
+            rows = batch_row['rows']
+            if rows is None:
+                rows = []
+            elif isinstance(rows, str):
+                # JSON values don't get decoded automatically (see handler's connect())
+                rows = json.loads(rows, object_pairs_hook=collections.OrderedDict)
+
+            chunk[batch_row['batch_index']][2]._set_rows(rows)
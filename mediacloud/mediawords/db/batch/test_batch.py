@@ -0,0 +1,103 @@
+import pytest
+
+from mediawords.db import connect_to_db
+from mediawords.db.batch.batch import *
+
+
+def __create_test_table(db) -> None:
+    db.query("DROP TABLE IF EXISTS test_batch")
+    db.query("""
+        CREATE TABLE test_batch (
+            test_batch_id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            created DATE NOT NULL DEFAULT '2017-01-01'
+        )
+    """)
+    db.query("INSERT INTO test_batch (name) SELECT 'name ' || x FROM generate_series(1, 10) AS x")
+
+
+def test_batch():
+    db = connect_to_db(label='test')
+    __create_test_table(db)
+
+    with db.batch() as batch:
+        found = [batch.find_by_id('test_batch', test_batch_id) for test_batch_id in range(1, 12)]
+        selected = batch.select('test_batch', 'name', {'test_batch_id': 3})
+        dbd_pg = batch.query("SELECT name FROM test_batch WHERE name LIKE ? ORDER BY test_batch_id", 'name 1%')
+        positional = batch.query("SELECT COUNT(*) AS count FROM test_batch WHERE test_batch_id > %s", (5,))
+        tuple_param = batch.query("SELECT name FROM test_batch WHERE test_batch_id IN %(ids)s", {'ids': (4,)})
+        inserted = batch.query("INSERT INTO test_batch (name) VALUES (%(name)s) RETURNING *", {'name': 'new'})
+        literal_percentage = batch.query("SELECT '100%' AS percentage;")
+
+        assert not found[0].done()
+        assert len(batch) == 17
+
+    assert found[0].done()
+    rows = [result.hash() for result in found[:10]]
+    assert [row['name'] for row in rows] == ['name %d' % x for x in range(1, 11)]
+    assert found[0].hash() is None
+    assert found[10].rows() == 0
+    assert found[10].hash() is None
+    assert found[1].columns() == []  # all rows have been read
+
+    # Dates come back as strings
+    assert rows[2]['created'] == '2017-01-01'
+
+    assert selected.hashes() == [{'name': 'name 3'}]
+    assert dbd_pg.flat() == ['name 1', 'name 10']
+    assert positional.hash() == {'count': 5}
+    assert tuple_param.flat() == ['name 4']
+    assert inserted.hash()['test_batch_id'] == 11
+    assert literal_percentage.flat() == ['100%']
+
+    db.query("DROP TABLE test_batch")
+    db.disconnect()
+
+
+def test_batch_split_and_lazy_execute():
+    db = connect_to_db(label='test')
+    __create_test_table(db)
+
+    batch = db.batch(max_queries=3)
+    results = [batch.query("SELECT %(x)s::INT AS x", {'x': x}) for x in range(10)]
+
+    # Accessing the result executes the batch
+    assert results[9].flat() == [9]
+    assert [result.flat() for result in results[:9]] == [[x] for x in range(9)]
+    assert len(batch) == 0
+
+    db.query("DROP TABLE test_batch")
+    db.disconnect()
+
+
+def test_batch_errors():
+    db = connect_to_db(label='test')
+    __create_test_table(db)
+
+    batch = db.batch()
+
+    with pytest.raises(McDatabaseBatchException):
+        batch.query("CREATE TABLE foo (bar INT)")
+
+    first = batch.query("SELECT 1")
+    second = batch.query("SELECT * FROM nonexistent_table")
+
+    with pytest.raises(McDatabaseBatchException):
+        batch.execute()
+
+    with pytest.raises(McDatabaseBatchException):
+        first.hash()
+    with pytest.raises(McDatabaseBatchException):
+        second.hash()
+
+    # Exception within the context manager fails queued queries
+    with pytest.raises(ValueError):
+        with db.batch() as batch:
+            result = batch.query("SELECT 1")
+            raise ValueError("Abort")
+    assert result.done()
+    with pytest.raises(McDatabaseBatchException):
+        result.hash()
+
+    db.query("DROP TABLE test_batch")
+    db.disconnect()
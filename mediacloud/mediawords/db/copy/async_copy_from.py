@@ -0,0 +1,244 @@
+import asyncio
+import re
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+from mediawords.db.copy.copy_from import (McCopyFromException, binary_copy_types, copy_binary_row, copy_text_line,
+                                          _BINARY_COPY_HEADER, _BINARY_COPY_TRAILER)
+from mediawords.util.log import create_logger
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+# "COPY table [(column, ...)] FROM STDIN [[WITH] (option value, ...) | legacy options]"
+_COPY_FROM_STDIN_REGEX = re.compile(
+    r'^\s*COPY\s+(?P<table>[\w."]+)\s*(?:\((?P<columns>[^)]*)\))?\s*FROM\s+STDIN\s*'
+    r'(?:WITH\s*)?(?:\((?P<options>[^)]*)\)|(?P<legacy_options>[\w\s]*))\s*;?\s*$',
+    re.IGNORECASE | re.DOTALL
+)
+
+# COPY options that asyncpg's copy_to_table() accepts as keyword arguments
+_COPY_OPTIONS = {'format', 'oids', 'freeze', 'delimiter', 'null', 'header', 'quote', 'escape', 'encoding'}
+
+# Pre-9.0 COPY options without values
+_LEGACY_COPY_OPTIONS = {
+    'binary': ('format', 'binary'),
+    'csv': ('format', 'csv'),
+    'header': ('header', True),
+}
+
+
+def _parse_copy_from_sql(sql: str) -> Dict[str, Any]:
+    """Parse "COPY ... FROM STDIN" statement into copy_to_table() arguments."""
+
+    match = _COPY_FROM_STDIN_REGEX.match(sql)
+    if not match:
+        raise McCopyFromException("Only 'COPY table [(columns)] FROM STDIN [WITH (options)]' is supported: %s" % sql)
+
+    arguments = {}
+
+    table = match.group('table')
+    if '.' in table:
+        arguments['schema_name'], table = table.split('.', 1)
+    arguments['table_name'] = table.strip('"')
+
+    if match.group('columns'):
+        arguments['columns'] = [column.strip().strip('"') for column in match.group('columns').split(',')]
+
+    if match.group('options'):
+        for option in match.group('options').split(','):
+            parts = option.strip().split(None, 1)
+            name = parts[0].lower()
+            if name not in _COPY_OPTIONS:
+                raise McCopyFromException("Unsupported COPY option '%s': %s" % (name, sql))
+            if len(parts) == 1:
+                value = True
+            else:
+                value = parts[1].strip()
+                if value.startswith("'") and value.endswith("'"):
+                    value = value[1:-1].replace("''", "'")
+                elif value.lower() in {'true', 'on'}:
+                    value = True
+                elif value.lower() in {'false', 'off'}:
+                    value = False
+                else:
+                    value = value.lower()
+            arguments[name] = value
+
+    elif match.group('legacy_options'):
+        for option in match.group('legacy_options').split():
+            if option.lower() not in _LEGACY_COPY_OPTIONS:
+                raise McCopyFromException("Unsupported COPY option '%s': %s" % (option, sql))
+            name, value = _LEGACY_COPY_OPTIONS[option.lower()]
+            arguments[name] = value
+
+    return arguments
+
+
+class _AsyncCopyFromChunkReader(object):
+    """Asynchronous iterable for copy_to_table() to read chunks from a bounded queue."""
+
+    # Queue of "bytes" chunks; None marks the end of data
+    __queue = None
+
+    def __init__(self, chunk_queue: asyncio.Queue):
+        self.__queue = chunk_queue
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.__queue.get()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+
+class AsyncCopyFrom(object):
+    """COPY FROM helper for AsyncDatabaseHandler.
+
+    Mirrors CopyFrom's interface, except that put_line(), put_rows() and end() are coroutines. Lines get buffered in
+    memory and shipped to PostgreSQL in chunks through a bounded queue, so memory usage stays constant and put_line()
+    waits if PostgreSQL can't keep up.
+
+    The connection is reserved for COPY until end() returns."""
+
+    # Chunk size to COPY FROM
+    __COPY_CHUNK_SIZE = 100 * 1024
+
+    # Max. number of chunks waiting to be sent
+    __COPY_QUEUE_SIZE = 8
+
+    # Seconds to wait for a free slot in the queue before checking whether COPY is still running
+    __COPY_QUEUE_PUT_TIMEOUT = 1
+
+    # asyncpg connection
+    __connection = None
+
+    # copy_to_table() arguments parsed out of the SQL
+    __copy_arguments = None
+
+    # Coroutine function to call after COPY is done (to release the connection back to the pool)
+    __release = None
+
+    # Normalized column types for binary COPY (None for text COPY)
+    __binary_types = None
+
+    # Parts of the current (not yet full) chunk
+    __buffer = None
+    __buffer_size = 0
+
+    # Queue of chunks to be read by copy_to_table(), and the task running it
+    __queue = None
+    __task = None
+
+    def __init__(self, connection: Any, sql: str, binary_types: List[str] = None, release: Callable = None):
+
+        sql = decode_object_from_bytes_if_needed(sql)
+        binary_types = decode_object_from_bytes_if_needed(binary_types)
+
+        if sql is None:
+            raise McCopyFromException("SQL is None.")
+        if len(sql) == 0:
+            raise McCopyFromException("SQL is empty.")
+
+        self.__connection = connection
+        self.__copy_arguments = _parse_copy_from_sql(sql)
+        self.__release = release
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__queue = None
+        self.__task = None
+
+        if binary_types is not None:
+            if self.__copy_arguments.get('format', None) != 'binary':
+                raise McCopyFromException("Binary column types are set but SQL doesn't use BINARY format: %s" % sql)
+            self.__binary_types = binary_copy_types(binary_types)
+            self.__buffer.append(_BINARY_COPY_HEADER)
+            self.__buffer_size = len(_BINARY_COPY_HEADER)
+        else:
+            self.__binary_types = None
+
+    async def __enqueue(self, chunk: Union[bytes, None]) -> None:
+        """Add chunk (or the end of data marker) to the queue, starting COPY if it's not running yet."""
+
+        if self.__task is None:
+            self.__queue = asyncio.Queue(maxsize=self.__COPY_QUEUE_SIZE)
+            self.__task = asyncio.ensure_future(self.__connection.copy_to_table(
+                source=_AsyncCopyFromChunkReader(chunk_queue=self.__queue),
+                **self.__copy_arguments
+            ))
+
+        while True:
+            if self.__task.done():
+                await self.__finish()
+                raise McCopyFromException('COPY FROM query has stopped before the end of data.')
+            try:
+                await asyncio.wait_for(self.__queue.put(chunk), timeout=self.__COPY_QUEUE_PUT_TIMEOUT)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+    async def __finish(self) -> None:
+        """Wait for COPY to finish, release the connection."""
+        try:
+            if self.__task is not None:
+                await self.__task
+        except Exception as ex:
+            raise McCopyFromException('COPY FROM query failed: %s' % str(ex))
+        finally:
+            self.__task = None
+            if self.__release is not None:
+                release = self.__release
+                self.__release = None
+                await release()
+
+    async def __write(self, data: bytes) -> None:
+        """Add data to the current chunk, ship the chunk if it's full."""
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+
+        if self.__buffer_size >= self.__COPY_CHUNK_SIZE:
+            chunk = b''.join(self.__buffer)
+            self.__buffer = []
+            self.__buffer_size = 0
+            await self.__enqueue(chunk)
+
+    async def put_line(self, line: str) -> None:
+        """Write line."""
+
+        if self.__binary_types is not None:
+            raise McCopyFromException("Use put_rows() for binary COPY FROM.")
+
+        line = decode_object_from_bytes_if_needed(line)
+
+        line = line.rstrip('\n')
+        await self.__write(("%s\n" % line).encode('utf-8'))
+
+    async def put_rows(self, rows: Iterable[Iterable[Any]]) -> None:
+        """Write rows (lists / tuples of Python values), encoding them into COPY's TEXT (or BINARY) format.
+
+        TEXT format only works with COPY's default delimiter and NULL string, not with CSV."""
+
+        for row in rows:
+            if self.__binary_types is not None:
+                # Not decoding "bytes" as those might be BYTEA values
+                await self.__write(copy_binary_row(values=row, types=self.__binary_types))
+            else:
+                row = decode_object_from_bytes_if_needed(row)
+                await self.__write(("%s\n" % copy_text_line(row)).encode('utf-8'))
+
+    async def end(self) -> None:
+        """Stop writing (and wait for COPY FROM to finish)."""
+
+        if self.__binary_types is not None:
+            self.__buffer.append(_BINARY_COPY_TRAILER)
+
+        chunk = b''.join(self.__buffer)
+        self.__buffer = []
+        self.__buffer_size = 0
+
+        if len(chunk) > 0:
+            await self.__enqueue(chunk)
+        await self.__enqueue(None)
+
+        await self.__finish()
@@ -1,4 +1,9 @@
-import tempfile
+import io
+import queue
+import re
+import struct
+import threading
+from typing import Any, Iterable, List, Union
 
 import psycopg2
 from psycopg2.extras import DictCursor
@@ -14,29 +19,158 @@ class McCopyFromException(McDatabaseHandlerException):
     pass
 
 
-# FIXME writes everything to a temporary file first, does the actual copying in end()
+def __copy_text_value(value: Any) -> str:
+    """Encode a single value into COPY's TEXT format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+
+def copy_text_line(values: Iterable[Any]) -> str:
+    """Encode a row of Python values into a line of COPY's TEXT format (without the trailing newline)."""
+    return '\t'.join(__copy_text_value(value) for value in values)
+
+
+# Binary COPY header: signature, flags field, header extension area length
+_BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+
+# Binary COPY trailer: field count of -1
+_BINARY_COPY_TRAILER = struct.pack('!h', -1)
+
+# Column type -> binary encoder of a non-NULL value
+_BINARY_ENCODERS = {
+    'bool': lambda value: struct.pack('!?', bool(value)),
+    'int2': lambda value: struct.pack('!h', int(value)),
+    'int4': lambda value: struct.pack('!i', int(value)),
+    'int8': lambda value: struct.pack('!q', int(value)),
+    'float4': lambda value: struct.pack('!f', float(value)),
+    'float8': lambda value: struct.pack('!d', float(value)),
+    'text': lambda value: value if isinstance(value, bytes) else str(value).encode('utf-8'),
+    'bytea': lambda value: bytes(value),
+}
+
+# Type aliases
+_BINARY_TYPE_ALIASES = {
+    'boolean': 'bool',
+    'smallint': 'int2',
+    'int': 'int4',
+    'integer': 'int4',
+    'bigint': 'int8',
+    'real': 'float4',
+    'double precision': 'float8',
+    'varchar': 'text',
+    'character varying': 'text',
+}
+
+
+def binary_copy_types(types: List[str]) -> List[str]:
+    """Normalize column types for binary COPY; raise McCopyFromException on unsupported ones."""
+    normalized_types = []
+    for column_type in types:
+        column_type = column_type.lower().strip()
+        column_type = _BINARY_TYPE_ALIASES.get(column_type, column_type)
+        if column_type not in _BINARY_ENCODERS:
+            raise McCopyFromException("Type '%s' is not supported by binary COPY FROM." % column_type)
+        normalized_types.append(column_type)
+    return normalized_types
+
+
+def copy_binary_row(values: Iterable[Any], types: List[str]) -> bytes:
+    """Encode a row of Python values into a tuple of COPY's BINARY format; "types" must be normalized."""
+    values = list(values)
+    if len(values) != len(types):
+        raise McCopyFromException("Expected %d values, got %d: %s" % (len(types), len(values), str(values)))
+
+    encoded = [struct.pack('!h', len(values))]
+    for x in range(len(values)):
+        if values[x] is None:
+            encoded.append(struct.pack('!i', -1))
+        else:
+            data = _BINARY_ENCODERS[types[x]](values[x])
+            encoded.append(struct.pack('!i', len(data)))
+            encoded.append(data)
+    return b''.join(encoded)
+
+
+class _CopyFromChunkReader(object):
+    """File-like object for copy_expert() to read chunks from a bounded queue."""
+
+    # Queue of "bytes" chunks; None marks the end of data
+    __queue = None
+
+    # Set after reading the end of data marker
+    __eof = False
+
+    def __init__(self, chunk_queue: queue.Queue):
+        self.__queue = chunk_queue
+        self.__eof = False
+
+    # noinspection PyUnusedLocal
+    def read(self, size: int = -1) -> bytes:
+        if self.__eof:
+            return b''
+        chunk = self.__queue.get()
+        if chunk is None:
+            self.__eof = True
+            return b''
+        return chunk
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+
 class CopyFrom(object):
-    """COPY FROM helper."""
+    """COPY FROM helper.
+
+    Lines get buffered in memory and shipped to PostgreSQL in chunks: once the first chunk fills up, COPY gets started
+    in a background thread which reads chunks from a bounded queue, so memory usage stays constant and put_line()
+    blocks if PostgreSQL can't keep up. Small COPYs that fit into a single chunk are run in end() without starting a
+    thread.
+
+    While COPY is in progress (i.e. until end()), the database handler must not be used for anything else.
+
+    If "binary_types" (a list of column types, e.g. ['int8', 'float8', 'text']) is set, COPY is run in BINARY format
+    (the SQL has to say "WITH (FORMAT binary)"), and rows are to be written with put_rows()."""
 
     # Chunk size to COPY FROM
     __COPY_CHUNK_SIZE = 100 * 1024
 
+    # Max. number of chunks waiting to be sent
+    __COPY_QUEUE_SIZE = 8
+
+    # Seconds to wait for a free slot in the queue before checking whether COPY is still running
+    __COPY_QUEUE_PUT_TIMEOUT = 1
+
     # SQL to run
     __sql = None
 
     # Database cursor
     __cursor = None
 
-    # Temporary file buffer
-    __temp_file_buffer = None
+    # Normalized column types for binary COPY (None for text COPY)
+    __binary_types = None
+
+    # Parts of the current (not yet full) chunk
+    __buffer = None
+    __buffer_size = 0
 
-    def __init__(self, cursor: DictCursor, sql: str):
+    # Queue of chunks to be read by copy_expert(), background thread running it, and its exception (if any)
+    __queue = None
+    __thread = None
+    __thread_exception = None
+
+    def __init__(self, cursor: DictCursor, sql: str, binary_types: List[str] = None):
 
         sql = decode_object_from_bytes_if_needed(sql)
+        binary_types = decode_object_from_bytes_if_needed(binary_types)
 
-        self.__start_copy_from(cursor=cursor, sql=sql)
+        self.__start_copy_from(cursor=cursor, sql=sql, binary_types=binary_types)
 
-    def __start_copy_from(self, cursor: DictCursor, sql: str) -> None:
+    def __start_copy_from(self, cursor: DictCursor, sql: str, binary_types: List[str] = None) -> None:
         """Start COPY FROM."""
 
         sql = decode_object_from_bytes_if_needed(sql)
@@ -48,26 +182,127 @@ class CopyFrom(object):
 
         self.__sql = sql
         self.__cursor = cursor
-        self.__temp_file_buffer = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__queue = None
+        self.__thread = None
+        self.__thread_exception = None
+
+        if binary_types is not None:
+            if not re.search(r'\bbinary\b', sql, flags=re.I):
+                raise McCopyFromException("Binary column types are set but SQL doesn't use BINARY format: %s" % sql)
+            self.__binary_types = binary_copy_types(binary_types)
+            self.__write(_BINARY_COPY_HEADER)
+        else:
+            self.__binary_types = None
+
+    def __run_copy_expert(self, chunk_reader: Any) -> None:
+        """Run COPY FROM reading data from "chunk_reader" (in a background thread)."""
+        try:
+            self.__cursor.copy_expert(sql=self.__sql, file=chunk_reader, size=self.__COPY_CHUNK_SIZE)
+        except psycopg2.Warning as ex:
+            log.warning('Warning while running COPY FROM query: %s' % str(ex))
+        except Exception as ex:
+            self.__thread_exception = ex
+
+            # Unblock the writer
+            while True:
+                try:
+                    self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def __enqueue(self, chunk: Union[bytes, None]) -> None:
+        """Add chunk (or the end of data marker) to the queue, starting COPY if it's not running yet."""
+
+        if self.__thread is None:
+            self.__queue = queue.Queue(maxsize=self.__COPY_QUEUE_SIZE)
+            self.__thread = threading.Thread(
+                target=self.__run_copy_expert,
+                args=(_CopyFromChunkReader(chunk_queue=self.__queue),),
+                name='copy_from',
+                daemon=True,
+            )
+            self.__thread.start()
+
+        while True:
+            if self.__thread_exception is not None:
+                raise McCopyFromException('COPY FROM query failed: %s' % str(self.__thread_exception))
+            if not self.__thread.is_alive():
+                raise McCopyFromException('COPY FROM query has stopped before the end of data.')
+            try:
+                self.__queue.put(chunk, timeout=self.__COPY_QUEUE_PUT_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+
+    def __write(self, data: bytes) -> None:
+        """Add data to the current chunk, ship the chunk if it's full."""
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+
+        if self.__buffer_size >= self.__COPY_CHUNK_SIZE:
+            chunk = b''.join(self.__buffer)
+            self.__buffer = []
+            self.__buffer_size = 0
+            self.__enqueue(chunk)
 
     def put_line(self, line: str) -> None:
         """Write line."""
 
+        if self.__binary_types is not None:
+            raise McCopyFromException("Use put_rows() for binary COPY FROM.")
+
         line = decode_object_from_bytes_if_needed(line)
 
         line = line.rstrip('\n')
         try:
-            self.__temp_file_buffer.write("%s\n" % line)
+            self.__write(("%s\n" % line).encode('utf-8'))
+        except McCopyFromException:
+            raise
         except Exception as ex:
             raise McCopyFromException("Error write writing line '%s': %s" % (line, str(ex)))
 
+    def put_rows(self, rows: Iterable[Iterable[Any]]) -> None:
+        """Write rows (lists / tuples of Python values), encoding them into COPY's TEXT (or BINARY) format.
+
+        TEXT format only works with COPY's default delimiter and NULL string, not with CSV. In TEXT format, "bytes"
+        values get decoded as UTF-8 strings (as they come from Perl), so BYTEA columns need BINARY format."""
+
+        for row in rows:
+            if self.__binary_types is not None:
+                # Not decoding "bytes" as those might be BYTEA values
+                self.__write(copy_binary_row(values=row, types=self.__binary_types))
+            else:
+                row = decode_object_from_bytes_if_needed(row)
+                self.__write(("%s\n" % copy_text_line(row)).encode('utf-8'))
+
     def end(self) -> None:
-        """Stop writing (and run the actual COPY FROM)."""
-        try:
-            self.__temp_file_buffer.seek(0)
-            self.__cursor.copy_expert(sql=self.__sql, file=self.__temp_file_buffer, size=self.__COPY_CHUNK_SIZE)
-            self.__temp_file_buffer.close()
-        except psycopg2.Warning as ex:
-            log.warning('Warning while running COPY FROM query: %s' % str(ex))
-        except Exception as ex:
-            raise McCopyFromException('COPY FROM query failed: %s' % str(ex))
+        """Stop writing (and wait for COPY FROM to finish)."""
+
+        if self.__binary_types is not None:
+            self.__buffer.append(_BINARY_COPY_TRAILER)
+
+        chunk = b''.join(self.__buffer)
+        self.__buffer = []
+        self.__buffer_size = 0
+
+        if self.__thread is None:
+            # Everything fit into a single chunk, no need for a separate thread
+            try:
+                self.__cursor.copy_expert(sql=self.__sql, file=io.BytesIO(chunk), size=self.__COPY_CHUNK_SIZE)
+            except psycopg2.Warning as ex:
+                log.warning('Warning while running COPY FROM query: %s' % str(ex))
+            except Exception as ex:
+                raise McCopyFromException('COPY FROM query failed: %s' % str(ex))
+
+        else:
+            if len(chunk) > 0:
+                self.__enqueue(chunk)
+            self.__enqueue(None)
+
+            self.__thread.join()
+            self.__thread = None
+
+            if self.__thread_exception is not None:
+                raise McCopyFromException('COPY FROM query failed: %s' % str(self.__thread_exception))
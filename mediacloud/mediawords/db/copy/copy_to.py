@@ -1,5 +1,10 @@
-import tempfile
-from typing import Union
+import collections
+import datetime
+import queue
+import re
+import struct
+import threading
+from typing import Any, Callable, Generator, Iterator, List, Tuple, Union
 
 import psycopg2
 from psycopg2.extras import DictCursor
@@ -15,12 +20,256 @@ class McCopyToException(McDatabaseHandlerException):
     pass
 
 
-# FIXME reads everything to a temporary file in a constructor, gives back line by line afterwards
+# Chunk size to COPY TO
+_COPY_TO_CHUNK_SIZE = 100 * 1024
+
+
+def stream_copy_to(cursor: DictCursor, sql: str, file: Any) -> int:
+    """Run "COPY ... TO STDOUT" SQL, writing its output to a file-like object chunk by chunk as it arrives; return the
+    number of rows copied.
+
+    "str" chunks get written to text files (io.TextIOBase), "bytes" chunks to others."""
+
+    sql = decode_object_from_bytes_if_needed(sql)
+
+    if sql is None or len(sql) == 0:
+        raise McCopyToException("SQL is unset.")
+
+    try:
+        cursor.copy_expert(sql=sql, file=file, size=_COPY_TO_CHUNK_SIZE)
+    except psycopg2.Warning as ex:
+        log.warning('Warning while running COPY TO query: %s' % str(ex))
+    except Exception as ex:
+        raise McCopyToException('COPY TO query failed: %s' % str(ex))
+
+    return cursor.rowcount
+
+
+# Binary COPY signature
+_BINARY_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# PostgreSQL's epoch for dates and timestamps
+_POSTGRES_EPOCH_DATE = datetime.date(2000, 1, 1)
+_POSTGRES_EPOCH_TIMESTAMP = datetime.datetime(2000, 1, 1)
+_POSTGRES_EPOCH_TIMESTAMPTZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Binary representations of "infinity" and "-infinity" timestamps and dates
+_TIMESTAMP_INFINITY = 2 ** 63 - 1
+_TIMESTAMP_MINUS_INFINITY = -2 ** 63
+_DATE_INFINITY = 2 ** 31 - 1
+_DATE_MINUS_INFINITY = -2 ** 31
+
+
+def __timestamp_from_microseconds(microseconds: int, epoch: datetime.datetime) -> datetime.datetime:
+    """Convert binary timestamp (microseconds since PostgreSQL's epoch); infinities become datetime.max / .min."""
+    if microseconds == _TIMESTAMP_INFINITY:
+        return datetime.datetime.max.replace(tzinfo=epoch.tzinfo)
+    if microseconds == _TIMESTAMP_MINUS_INFINITY:
+        return datetime.datetime.min.replace(tzinfo=epoch.tzinfo)
+    return epoch + datetime.timedelta(microseconds=microseconds)
+
+
+def __date_from_days(days: int) -> datetime.date:
+    """Convert binary date (days since PostgreSQL's epoch); infinities become date.max / .min."""
+    if days == _DATE_INFINITY:
+        return datetime.date.max
+    if days == _DATE_MINUS_INFINITY:
+        return datetime.date.min
+    return _POSTGRES_EPOCH_DATE + datetime.timedelta(days=days)
+
+
+# Fixed width column type -> (struct format of the binary value, converter of the unpacked value or None)
+_BINARY_FIXED_WIDTH_TYPES = {
+    'bool': ('?', None),
+    'int2': ('h', None),
+    'int4': ('i', None),
+    'int8': ('q', None),
+    'float4': ('f', None),
+    'float8': ('d', None),
+    'date': ('i', lambda value: __date_from_days(value)),
+    'timestamp': ('q', lambda value: __timestamp_from_microseconds(value, _POSTGRES_EPOCH_TIMESTAMP)),
+    'timestamptz': ('q', lambda value: __timestamp_from_microseconds(value, _POSTGRES_EPOCH_TIMESTAMPTZ)),
+}
+
+
+def __fixed_width_decoder(value_format: str, converter: Union[Callable[[Any], Any], None]) -> Callable:
+    unpack_from = struct.Struct('!' + value_format).unpack_from
+    if converter is None:
+        return lambda data, offset, length: unpack_from(data, offset)[0]
+    return lambda data, offset, length: converter(unpack_from(data, offset)[0])
+
+
+# Column type -> binary decoder of a non-NULL value, called with (data, offset, length)
+_BINARY_DECODERS = {
+    'text': lambda data, offset, length: data[offset:offset + length].decode('utf-8'),
+    'bytea': lambda data, offset, length: bytes(data[offset:offset + length]),
+}
+for (_fixed_width_type, (_value_format, _converter)) in _BINARY_FIXED_WIDTH_TYPES.items():
+    _BINARY_DECODERS[_fixed_width_type] = __fixed_width_decoder(_value_format, _converter)
+
+# Type aliases
+_BINARY_TYPE_ALIASES = {
+    'boolean': 'bool',
+    'smallint': 'int2',
+    'int': 'int4',
+    'integer': 'int4',
+    'bigint': 'int8',
+    'real': 'float4',
+    'double precision': 'float8',
+    'varchar': 'text',
+    'character varying': 'text',
+    'timestamp without time zone': 'timestamp',
+    'timestamp with time zone': 'timestamptz',
+}
+
+# Backslash sequences of COPY's TEXT format
+_COPY_TEXT_ESCAPE_REGEX = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.DOTALL)
+_COPY_TEXT_ESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+
+
+def __unescape_copy_text_match(match: Any) -> str:
+    (octal, hexadecimal, character) = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8))
+    if hexadecimal is not None:
+        return chr(int(hexadecimal, 16))
+    return _COPY_TEXT_ESCAPES.get(character, character)
+
+
+def copy_text_row(line: str) -> Tuple[Union[str, None], ...]:
+    """Decode a line of COPY's TEXT format (without the trailing newline) into a tuple of strings and Nones.
+
+    Only works with COPY's default delimiter and NULL string, not with CSV."""
+
+    # Fast path for lines without NULLs or escaped characters
+    if '\\' not in line:
+        return tuple(line.split('\t'))
+
+    values = []
+    for value in line.split('\t'):
+        if value == '\\N':
+            values.append(None)
+        elif '\\' in value:
+            values.append(_COPY_TEXT_ESCAPE_REGEX.sub(__unescape_copy_text_match, value))
+        else:
+            values.append(value)
+    return tuple(values)
+
+
+def binary_copy_to_types(types: List[str]) -> List[str]:
+    """Normalize column types for binary COPY TO; raise McCopyToException on unsupported ones."""
+    normalized_types = []
+    for column_type in types:
+        column_type = column_type.lower().strip()
+        column_type = _BINARY_TYPE_ALIASES.get(column_type, column_type)
+        if column_type not in _BINARY_DECODERS:
+            raise McCopyToException("Type '%s' is not supported by binary COPY TO." % column_type)
+        normalized_types.append(column_type)
+    return normalized_types
+
+
+def _iter_fixed_width_tuples(data: bytearray,
+                              offset: int,
+                              tuple_struct: struct.Struct,
+                              column_count: int,
+                              lengths: Tuple[int, ...],
+                              converters: List[Tuple[int, Callable[[Any], Any]]]) -> Generator:
+    """Unpack consecutive binary COPY tuples of fixed width columns starting at "offset", yield them as rows until a
+    tuple with NULLs (or the end of complete tuples) is reached; return the offset of the first tuple not decoded."""
+
+    tuple_count = (len(data) - offset) // tuple_struct.size
+    if tuple_count == 0:
+        return offset
+
+    # Buffer has to be released before the caller can resize "data"
+    view = memoryview(data)[offset:offset + tuple_count * tuple_struct.size]
+    tuples = tuple_struct.iter_unpack(view)
+    try:
+        for values in tuples:
+            if values[0] != column_count or values[1::2] != lengths:
+                break
+            offset += tuple_struct.size
+            if len(converters) == 0:
+                yield values[2::2]
+            else:
+                row = list(values[2::2])
+                for index, converter in converters:
+                    row[index] = converter(row[index])
+                yield tuple(row)
+    finally:
+        del tuples
+        view.release()
+
+    return offset
+
+
+class _CopyToChunkWriter(object):
+    """File-like object for copy_expert() to write COPY data to, batching it into chunks on a bounded queue."""
+
+    # Queue of "bytes" chunks
+    __queue = None
+
+    # Chunk size
+    __chunk_size = None
+
+    # Parts of the current (not yet full) chunk
+    __buffer = None
+    __buffer_size = 0
+
+    # Set when the reader is no longer interested in data
+    __discard = None
+
+    def __init__(self, chunk_queue: queue.Queue, chunk_size: int, discard: threading.Event):
+        self.__queue = chunk_queue
+        self.__chunk_size = chunk_size
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__discard = discard
+
+    def write(self, data: bytes) -> int:
+        # copy_expert() writes every row separately
+        if not self.__discard.is_set():
+            self.__buffer.append(data)
+            self.__buffer_size += len(data)
+            if self.__buffer_size >= self.__chunk_size:
+                self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if len(self.__buffer) > 0:
+            chunk = b''.join(self.__buffer)
+            self.__buffer = []
+            self.__buffer_size = 0
+            if not self.__discard.is_set():
+                self.__queue.put(chunk)
+
+
 class CopyTo(object):
-    """COPY TO helper. Implements iterator methods too."""
+    """COPY TO helper. Implements iterator methods too.
+
+    COPY gets run in a background thread which batches its output into chunks and passes them through a bounded queue,
+    so the output never gets materialized as a whole: memory usage stays constant, and COPY waits for the reader if
+    it's falling behind. Errors in the SQL get raised by the constructor.
+
+    While COPY is in progress (i.e. until all the data has been read or end() has been called), the database handler
+    must not be used for anything else.
+
+    Read raw lines with get_line() (or iterate over the object), or rows decoded into tuples with iter_rows(). If
+    "binary_types" (a list of column types, e.g. ['int8', 'float8', 'timestamp']) is set, COPY is expected to be run in
+    BINARY format (the SQL has to say "WITH (FORMAT binary)"), and only iter_rows() is available."""
 
-    # Chunk size to COPY TO
-    __COPY_CHUNK_SIZE = 100 * 1024
+    # Chunk size to COPY TO; larger chunks mean less switching between the COPY thread and the reader
+    __COPY_CHUNK_SIZE = 1024 * 1024
+
+    # Max. number of chunks waiting to be read
+    __COPY_QUEUE_SIZE = 8
 
     # SQL to run
     __sql = None
@@ -28,16 +277,37 @@ class CopyTo(object):
     # Database cursor
     __cursor = None
 
-    # Temporary file buffer
-    __temp_file_buffer = None
+    # Normalized column types for binary COPY (None for text COPY)
+    __binary_types = None
+
+    # Queue of chunks written by copy_expert(), background thread running it, its exception (if any), and event that
+    # makes it discard the rest of the data
+    __queue = None
+    __thread = None
+    __thread_exception = None
+    __discard = None
+
+    # Chunks read from the queue but not yet processed
+    __pending_chunks = None
+
+    # True if the end of data has been read from the queue
+    __finished = False
+
+    # Number of rows copied (available after the end of data)
+    __row_count = -1
+
+    # Text COPY: decoded lines (without newlines) which haven't been read yet, and the incomplete last line
+    __lines = None
+    __partial_line = None
 
-    def __init__(self, cursor: DictCursor, sql: str):
+    def __init__(self, cursor: DictCursor, sql: str, binary_types: List[str] = None):
 
         sql = decode_object_from_bytes_if_needed(sql)
+        binary_types = decode_object_from_bytes_if_needed(binary_types)
 
-        self.__start_copy_to(cursor=cursor, sql=sql)
+        self.__start_copy_to(cursor=cursor, sql=sql, binary_types=binary_types)
 
-    def __start_copy_to(self, cursor: DictCursor, sql: str) -> None:
+    def __start_copy_to(self, cursor: DictCursor, sql: str, binary_types: List[str] = None) -> None:
         """Start COPY TO."""
 
         sql = decode_object_from_bytes_if_needed(sql)
@@ -47,29 +317,227 @@ class CopyTo(object):
         if len(sql) == '':
             raise McDatabaseHandlerException("SQL is empty.")
 
+        if binary_types is not None:
+            if not re.search(r'\bbinary\b', sql, flags=re.I):
+                raise McCopyToException("Binary column types are set but SQL doesn't use BINARY format: %s" % sql)
+            self.__binary_types = binary_copy_to_types(binary_types)
+        else:
+            self.__binary_types = None
+
         self.__sql = sql
         self.__cursor = cursor
-        self.__temp_file_buffer = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.__pending_chunks = collections.deque()
+        self.__finished = False
+        self.__row_count = -1
+        self.__lines = collections.deque()
+        self.__partial_line = b''
+
+        self.__queue = queue.Queue(maxsize=self.__COPY_QUEUE_SIZE)
+        self.__thread_exception = None
+        self.__discard = threading.Event()
+        chunk_writer = _CopyToChunkWriter(chunk_queue=self.__queue,
+                                          chunk_size=self.__COPY_CHUNK_SIZE,
+                                          discard=self.__discard)
+        self.__thread = threading.Thread(
+            target=self.__run_copy_expert,
+            args=(chunk_writer,),
+            name='copy_to',
+            daemon=True,
+        )
+        self.__thread.start()
 
+        # Wait for the first chunk so that invalid SQL fails right away
+        chunk = self.__dequeue()
+        if chunk is not None:
+            self.__pending_chunks.append(chunk)
+
+    def __run_copy_expert(self, chunk_writer: _CopyToChunkWriter) -> None:
+        """Run COPY TO writing data to "chunk_writer" (in a background thread)."""
         try:
-            self.__cursor.copy_expert(sql=self.__sql, file=self.__temp_file_buffer, size=self.__COPY_CHUNK_SIZE)
-            self.__temp_file_buffer.seek(0)
+            self.__cursor.copy_expert(sql=self.__sql, file=chunk_writer, size=self.__COPY_CHUNK_SIZE)
+            chunk_writer.flush()
+            self.__row_count = self.__cursor.rowcount
         except psycopg2.Warning as ex:
             log.warning('Warning while running COPY TO query: %s' % str(ex))
         except Exception as ex:
-            raise McCopyToException('COPY TO query failed: %s' % str(ex))
+            self.__thread_exception = ex
+        finally:
+            # End of data marker
+            self.__queue.put(None)
+
+    def __dequeue(self) -> Union[bytes, None]:
+        """Read the next chunk from the queue; return None at the end of data."""
+        if self.__finished:
+            return None
+
+        chunk = self.__queue.get()
+        if chunk is None:
+            self.__finished = True
+            self.__thread.join()
+            if self.__thread_exception is not None:
+                raise McCopyToException('COPY TO query failed: %s' % str(self.__thread_exception))
+        return chunk
+
+    def __next_chunk(self) -> Union[bytes, None]:
+        """Return the next chunk; return None at the end of data."""
+        if len(self.__pending_chunks) > 0:
+            return self.__pending_chunks.popleft()
+        return self.__dequeue()
+
+    def __read_lines(self) -> bool:
+        """Decode the next chunk into lines; return False at the end of data."""
+        chunk = self.__next_chunk()
+        if chunk is None:
+            if len(self.__partial_line) > 0:
+                self.__lines.append(self.__partial_line.decode('utf-8'))
+                self.__partial_line = b''
+                return True
+            return False
+
+        data = self.__partial_line + chunk
+        last_newline = data.rfind(b'\n')
+        if last_newline == -1:
+            self.__partial_line = data
+        else:
+            self.__lines.extend(data[:last_newline].decode('utf-8').split('\n'))
+            self.__partial_line = data[last_newline + 1:]
+        return True
 
     def get_line(self) -> Union[str, None]:
         """Read line."""
-        line = self.__temp_file_buffer.readline()
-        if line != '':
-            return line
-        else:
-            return None
+        if self.__binary_types is not None:
+            raise McCopyToException("Use iter_rows() for binary COPY TO.")
+
+        while len(self.__lines) == 0:
+            if not self.__read_lines():
+                return None
+        return self.__lines.popleft() + '\n'
+
+    def iter_rows(self) -> Iterator[Tuple[Any, ...]]:
+        """Iterate over rows decoded into tuples.
+
+        Values of text COPY are strings (or None for NULLs), and it only works with COPY's default delimiter and NULL
+        string, not with CSV. Values of binary COPY are decoded into Python objects of their types ("timestamptz"
+        values into UTC datetimes)."""
+
+        if self.__binary_types is not None:
+            yield from self.__iter_binary_rows()
+            return
+
+        while True:
+            while len(self.__lines) > 0:
+                yield copy_text_row(self.__lines.popleft())
+            if not self.__read_lines():
+                return
+
+    def __iter_binary_rows(self) -> Iterator[Tuple[Any, ...]]:
+        """Iterate over rows decoded from binary COPY."""
+
+        decoders = [_BINARY_DECODERS[column_type] for column_type in self.__binary_types]
+        column_count = len(decoders)
+        unpack_field_count = struct.Struct('!h').unpack_from
+        unpack_length = struct.Struct('!i').unpack_from
+
+        # Tuples of fixed width columns without NULLs get unpacked in one go
+        fixed_width_tuple = None
+        fixed_width_lengths = None
+        converters = []
+        if all(column_type in _BINARY_FIXED_WIDTH_TYPES for column_type in self.__binary_types):
+            value_formats = [_BINARY_FIXED_WIDTH_TYPES[column_type][0] for column_type in self.__binary_types]
+            fixed_width_tuple = struct.Struct('!h' + ''.join('i' + value_format for value_format in value_formats))
+            fixed_width_lengths = tuple(struct.calcsize('!' + value_format) for value_format in value_formats)
+            converters = [
+                (index, _BINARY_FIXED_WIDTH_TYPES[column_type][1])
+                for index, column_type in enumerate(self.__binary_types)
+                if _BINARY_FIXED_WIDTH_TYPES[column_type][1] is not None
+            ]
+
+        data = bytearray()
+        offset = 0
+        header_read = False
+
+        while True:
+            chunk = self.__next_chunk()
+            if chunk is None:
+                raise McCopyToException("Binary COPY data is truncated.")
+
+            del data[:offset]
+            data += chunk
+            offset = 0
+            data_length = len(data)
+
+            if not header_read:
+                header_length = len(_BINARY_COPY_SIGNATURE) + 8
+                if data_length < header_length:
+                    continue
+                if bytes(data[:len(_BINARY_COPY_SIGNATURE)]) != _BINARY_COPY_SIGNATURE:
+                    raise McCopyToException("Invalid binary COPY signature.")
+                (_, extension_length) = struct.unpack_from('!ii', data, len(_BINARY_COPY_SIGNATURE))
+                if data_length < header_length + extension_length:
+                    continue
+                offset = header_length + extension_length
+                header_read = True
+
+            while data_length - offset >= 2:
+
+                if fixed_width_tuple is not None:
+                    offset = yield from _iter_fixed_width_tuples(data=data,
+                                                                  offset=offset,
+                                                                  tuple_struct=fixed_width_tuple,
+                                                                  column_count=column_count,
+                                                                  lengths=fixed_width_lengths,
+                                                                  converters=converters)
+                    if data_length - offset < 2:
+                        break
+
+                (field_count,) = unpack_field_count(data, offset)
+                if field_count == -1:
+                    # Trailer; read the end of data marker
+                    while self.__next_chunk() is not None:
+                        pass
+                    return
+
+                if field_count != column_count:
+                    raise McCopyToException(
+                        "Expected %d columns, got %d; are binary types set right?" % (column_count, field_count)
+                    )
+
+                position = offset + 2
+                values = []
+                for decoder in decoders:
+                    if data_length - position < 4:
+                        break
+                    (length,) = unpack_length(data, position)
+                    position += 4
+                    if length == -1:
+                        values.append(None)
+                        continue
+                    if data_length - position < length:
+                        break
+                    values.append(decoder(data, position, length))
+                    position += length
+
+                if len(values) < column_count:
+                    # Incomplete tuple, wait for the next chunk
+                    break
+
+                offset = position
+                yield tuple(values)
+
+    def rows(self) -> int:
+        """Return the number of rows copied, or -1 if COPY hasn't finished yet."""
+        return self.__row_count
 
     def end(self) -> None:
-        """Stop reading."""
-        self.__temp_file_buffer.close()
+        """Stop reading; if not all of the data has been read, wait for COPY to finish discarding the rest."""
+        if not self.__finished:
+            self.__discard.set()
+            self.__pending_chunks.clear()
+            while self.__dequeue() is not None:
+                pass
+        self.__pending_chunks.clear()
+        self.__lines.clear()
+        self.__partial_line = b''
 
     def __iter__(self):
         return self
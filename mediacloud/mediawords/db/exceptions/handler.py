@@ -48,6 +48,16 @@ class McCreateException(McDatabaseHandlerException):
     pass
 
 
+class McCreateManyException(McDatabaseHandlerException):
+    """create_many() exception."""
+    pass
+
+
+class McUpsertManyException(McDatabaseHandlerException):
+    """upsert_many() exception."""
+    pass
+
+
 class McFindOrCreateException(McDatabaseHandlerException):
     """find_or_create() exception."""
     pass
@@ -1,77 +1,113 @@
-import csv
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Union
 
+from mediawords.db import connect_to_db
+from mediawords.db.export.parallel_export import SnapshotWorkerConnections, export_tables_to_directory
 from mediawords.db.handler import DatabaseHandler
 from mediawords.util.log import create_logger
 
 log = create_logger(__name__)
 
+# Tables needed for running a backup crawler, in the order of their import
+_BACKUP_CRAWLER_TABLES = ['tag_sets', 'media', 'feeds', 'tags', 'media_tags_map', 'feeds_tags_map']
+
 
 class McValidateTableForeignKeysException(Exception):
     """__validate_table_foreign_keys() exception."""
     pass
 
 
+# Max. number of rows violating foreign keys to report per table
+_MAX_FOREIGN_KEY_VIOLATIONS = 100
+
+
 # noinspection SqlResolve
-def __validate_table_foreign_keys(db: DatabaseHandler, table: str) -> None:
+def __validate_table_foreign_keys(db: DatabaseHandler,
+                                  table: str,
+                                  max_violations: int = _MAX_FOREIGN_KEY_VIOLATIONS) -> None:
     """Validate all table's foreign keys; raise McValidateTableForeignKeysException if any of the keys are invalid.
 
+    All foreign keys get checked in a single pass over the table, with every row probing referenced tables' (unique)
+    indexes with NOT EXISTS; the scan stops after finding "max_violations" distinct violating keys.
+
     If table's constraints aren't right, SQL would be pretty much invalid."""
 
-    foreign_keys = db.query("""
-        SELECT
-            tc.constraint_name,
-            tc.table_schema,
-            tc.table_name,
-            kcu.column_name,
-            ccu.table_schema AS foreign_table_schema,
-            ccu.table_name AS foreign_table_name,
-            ccu.column_name AS foreign_column_name
-
-        FROM information_schema.table_constraints AS tc
-            JOIN information_schema.key_column_usage AS kcu
-                ON tc.constraint_name = kcu.constraint_name
-            JOIN information_schema.constraint_column_usage AS ccu
-                ON ccu.constraint_name = tc.constraint_name
-        WHERE constraint_type = 'FOREIGN KEY'
-          AND tc.table_schema = 'public'
-          AND tc.table_name = %(table)s
-    """, {'table': table}).hashes()
+    # Foreign keys come from the handler's (process-wide) schema metadata cache
+    foreign_keys = db.foreign_keys(table='public.%s' % table)
+    if len(foreign_keys) == 0:
+        log.info("Table '%s' doesn't have any foreign keys." % table)
+        return
+
+    log.info("Validating %d foreign keys for table '%s'..." % (len(foreign_keys), table))
+
+    columns = []
+    violation_conditions = []
+    for index, foreign_key in enumerate(foreign_keys):
+        for column in foreign_key['columns']:
+            if column not in columns:
+                columns.append(column)
+
+        # MATCH SIMPLE: rows with NULLs in any of the key's columns don't get checked
+        violation_conditions.append("""
+            (%(not_null_condition)s AND NOT EXISTS (
+                SELECT 1
+                FROM %(foreign_table_schema)s.%(foreign_table_name)s AS b
+                WHERE %(join_condition)s
+            )) AS mc_violates_%(index)d
+        """ % {
+            'not_null_condition': ' AND '.join(['a.%s IS NOT NULL' % column for column in foreign_key['columns']]),
+            'foreign_table_schema': foreign_key['foreign_table_schema'],
+            'foreign_table_name': foreign_key['foreign_table_name'],
+            'join_condition': ' AND '.join([
+                'b.%s = a.%s' % (foreign_column, column)
+                for column, foreign_column in zip(foreign_key['columns'], foreign_key['foreign_columns'])
+            ]),
+            'index': index,
+        })
+
+    sql = """
+        SELECT DISTINCT *
+        FROM (
+            SELECT %(columns)s,
+                   %(violation_conditions)s
+            FROM public.%(table_name)s AS a
+
+            -- Don't let the planner pull the subquery up and evaluate the probes twice, in SELECT and in WHERE
+            OFFSET 0
+        ) AS checked_rows
+        WHERE %(any_violation)s
+        LIMIT %(max_violations)d
+    """ % {
+        'columns': ', '.join(['a.%s' % column for column in columns]),
+        'violation_conditions': ', '.join(violation_conditions),
+        'table_name': table,
+        'any_violation': ' OR '.join(['mc_violates_%d' % index for index in range(len(foreign_keys))]),
+        'max_violations': max_violations,
+    }
+
+    violating_rows = db.query(sql).hashes()
 
     foreign_key_errors = []
 
-    for foreign_key in foreign_keys:
+    for index, foreign_key in enumerate(foreign_keys):
         constraint_name = foreign_key['constraint_name']
 
-        log.info("Validating foreign key '%s' for table '%s'..." % (constraint_name, table))
-
-        sql = """
-            SELECT DISTINCT a.%(column_name)s
-            FROM %(table_schema)s.%(table_name)s AS a
-                LEFT JOIN %(foreign_table_schema)s.%(foreign_table_name)s AS b
-                    ON a.%(column_name)s = b.%(foreign_column_name)s
-            WHERE a.%(column_name)s IS NOT NULL
-              AND b.%(foreign_column_name)s IS NULL
-            ORDER BY a.%(column_name)s
-        """ % {
-            'column_name': foreign_key['column_name'],
-            'table_schema': foreign_key['table_schema'],
-            'table_name': table,
-            'foreign_table_schema': foreign_key['foreign_table_schema'],
-            'foreign_table_name': foreign_key['foreign_table_name'],
-            'foreign_column_name': foreign_key['foreign_column_name'],
-        }
-
-        unreferenced_rows = db.query(sql).flat()
+        unreferenced_keys = set()
+        for row in violating_rows:
+            if row['mc_violates_%d' % index]:
+                unreferenced_keys.add(tuple(row[column] for column in foreign_key['columns']))
+        unreferenced_rows = [', '.join([str(value) for value in key]) for key in sorted(unreferenced_keys)]
 
         if len(unreferenced_rows) > 0:
             error = """
                 Table '%(table)s' has unreferenced rows for constraint '%(constraint_name)s':
-                %(unreferenced_rows)s; SQL: %(sql)s
+                %(unreferenced_rows)s%(truncated)s; SQL: %(sql)s
             """ % {
                 'table': table,
                 'constraint_name': constraint_name,
-                'unreferenced_rows': ', '.join(unreferenced_rows),
+                'unreferenced_rows': '; '.join(unreferenced_rows),
+                'truncated': '; ...' if len(violating_rows) >= max_violations else '',
                 'sql': sql,
             }
             foreign_key_errors.append(error)
@@ -91,7 +127,7 @@ def __validate_table_foreign_keys(db: DatabaseHandler, table: str) -> None:
 def __print_table_csv_to_stdout(db: DatabaseHandler, table: str) -> None:
     """Print table dump to STDOUT."""
 
-    column_names = db.query("SELECT * FROM %s LIMIT 0" % table).columns()
+    column_names = list(db.table_columns(table=table).keys())
     primary_key_column = db.primary_key_column(table=table)
 
     print("""
@@ -101,33 +137,26 @@ def __print_table_csv_to_stdout(db: DatabaseHandler, table: str) -> None:
 
     """ % {'table': table})
 
-    # Python's "csv" module doesn't bother to differentiate between empty strings and "None" values:
-    #
-    # http://stackoverflow.com/a/11379550/200603
-    #
-    # ...so we're exporting the table in "TEXT" format with a cumbersome "\\N" (two-backslashes-N) mark for NULL values.
-    print("COPY %(table)s (%(column_names)s) FROM STDIN WITH (FORMAT TEXT, NULL '\\\\N');" % {
+    print("COPY %(table)s (%(column_names)s) FROM STDIN WITH (FORMAT TEXT);" % {
         'table': table,
         'column_names': ', '.join(column_names),
     })
 
-    csv_writer = csv.writer(sys.stdout, delimiter="\t", escapechar="\\", quoting=csv.QUOTE_NONE)
-
-    res = db.query("SELECT * FROM %(table)s ORDER BY %(primary_key_column)s" % {
+    # Let PostgreSQL serialize the rows in COPY's own TEXT format and stream them straight to STDOUT
+    copy_sql = """
+        COPY (
+            SELECT %(column_names)s
+            FROM %(table)s
+            ORDER BY %(primary_key_column)s
+        ) TO STDOUT WITH (FORMAT TEXT)
+    """ % {
+        'column_names': ', '.join(column_names),
         'table': table,
         'primary_key_column': primary_key_column,
-    })
+    }
+    db.copy_to_file(sql=copy_sql, file=sys.stdout)
 
-    postgresql_null_value = '\\N'
-    postgresql_end_of_data = '\.'
-    while True:
-        row = res.array()
-        if row is None:
-            break
-        else:
-            csv_writer.writerow([postgresql_null_value if val is None else val for val in row])
-
-    print(postgresql_end_of_data)
+    print('\\.')
 
     print("""
 
@@ -148,28 +177,43 @@ class McPrintExportedTablesToBackupCrawlerException(Exception):
     pass
 
 
-# noinspection SqlResolve
-def print_exported_tables_to_backup_crawler(db: DatabaseHandler) -> None:
-    """Export tables by printing their SQL dump to STDOUT."""
+def __validate_foreign_keys(db: DatabaseHandler,
+                            tables: List[str],
+                            jobs: int = 1,
+                            workers: SnapshotWorkerConnections = None) -> None:
+    """Validate foreign keys of all tables; raise McPrintExportedTablesToBackupCrawlerException if any are invalid.
 
-    # Tables to export
-    tables = ['tag_sets', 'media', 'feeds', 'tags', 'media_tags_map', 'feeds_tags_map']
+    If "jobs" is more than 1 and "workers" are set, tables get validated concurrently on worker threads' connections
+    which share the snapshot of "db"'s transaction, so the data that gets validated is the data that gets exported."""
 
-    db.begin()
+    if workers is None:
+        jobs = 1
 
     log.info("Validating foreign keys...")
-    foreign_key_errors = []
 
+    # Load foreign keys into the schema metadata cache before the workers get to read it
     for table in tables:
-        log.info("Validating foreign keys for table '%s'..." % table)
+        db.foreign_keys(table='public.%s' % table)
 
-        # Aggregate errors into array to be able to print a one huge complaint
+    def __validate_table(table_to_validate: str) -> Union[str, None]:
+        """Validate table's foreign keys on its own connection; return error message or None."""
+        table_db = workers.db() if jobs > 1 else db
         try:
-            __validate_table_foreign_keys(db=db, table=table)
+            __validate_table_foreign_keys(db=table_db, table=table_to_validate)
         except McValidateTableForeignKeysException as ex:
             error = str(ex)
-            log.warning("Validating foreign key for table '%s' failed: %s" % (table, error))
-            foreign_key_errors.append(error)
+            log.warning("Validating foreign key for table '%s' failed: %s" % (table_to_validate, error))
+            return error
+        return None
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            errors = list(executor.map(__validate_table, tables))
+    else:
+        errors = [__validate_table(table) for table in tables]
+
+    # Aggregate errors into array to be able to print a one huge complaint
+    foreign_key_errors = [error for error in errors if error is not None]
 
     if len(foreign_key_errors):
         raise McPrintExportedTablesToBackupCrawlerException(
@@ -179,6 +223,30 @@ def print_exported_tables_to_backup_crawler(db: DatabaseHandler) -> None:
 
     log.info("Done validating foreign keys.")
 
+
+# noinspection SqlResolve
+def print_exported_tables_to_backup_crawler(db: DatabaseHandler,
+                                            validation_jobs: int = 4,
+                                            connect: Callable[[], DatabaseHandler] = connect_to_db) -> None:
+    """Export tables by printing their SQL dump to STDOUT.
+
+    Foreign keys of "validation_jobs" tables get validated concurrently on connections made with "connect" which share
+    the export's snapshot."""
+
+    tables = _BACKUP_CRAWLER_TABLES
+
+    # Validate and export all tables from the same snapshot
+    db.begin(isolation='repeatable read')
+
+    if validation_jobs > 1:
+        workers = SnapshotWorkerConnections(connect=connect, snapshot_id=SnapshotWorkerConnections.export_snapshot(db))
+        try:
+            __validate_foreign_keys(db=db, tables=tables, jobs=validation_jobs, workers=workers)
+        finally:
+            workers.close()
+    else:
+        __validate_foreign_keys(db=db, tables=tables)
+
     print("""
 --
 -- This is a dataset needed for running a backup crawler.
@@ -241,3 +309,28 @@ SET CONSTRAINTS ALL IMMEDIATE;
 
 COMMIT;
     """)
+
+
+def export_tables_to_backup_crawler_directory(db: DatabaseHandler,
+                                              directory: str,
+                                              compression: str = 'zstd',
+                                              jobs: int = 4,
+                                              resume: bool = False,
+                                              connect: Callable[[], DatabaseHandler] = connect_to_db) -> Dict[str, Any]:
+    """Export tables needed for running a backup crawler into a directory of compressed COPY files, exporting tables in
+    parallel; return the manifest.
+
+    See export_tables_to_directory() for the directory's layout and the meaning of the parameters. Foreign keys get
+    validated in the export's snapshot."""
+
+    def __validate(export_db: DatabaseHandler, workers: SnapshotWorkerConnections) -> None:
+        __validate_foreign_keys(db=export_db, tables=_BACKUP_CRAWLER_TABLES, jobs=jobs, workers=workers)
+
+    return export_tables_to_directory(db=db,
+                                      tables=_BACKUP_CRAWLER_TABLES,
+                                      directory=directory,
+                                      compression=compression,
+                                      jobs=jobs,
+                                      resume=resume,
+                                      connect=connect,
+                                      before_export=__validate)
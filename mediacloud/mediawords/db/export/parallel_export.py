@@ -0,0 +1,344 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+import zstandard
+
+from mediawords.db import connect_to_db
+from mediawords.db.handler import DatabaseHandler
+from mediawords.util.log import create_logger
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+# Manifest file name in the export directory
+_MANIFEST_FILENAME = 'manifest.json'
+
+# Manifest format version
+_MANIFEST_VERSION = 1
+
+# Compression -> table data file extension
+_COMPRESSION_EXTENSIONS = {
+    'gzip': 'gz',
+    'zstd': 'zst',
+}
+
+# Compression levels; both are the libraries' defaults which are a sensible speed / size tradeoff for COPY data
+_GZIP_COMPRESSION_LEVEL = 6
+_ZSTD_COMPRESSION_LEVEL = 3
+
+
+class McExportTablesToDirectoryException(Exception):
+    """export_tables_to_directory() exception."""
+    pass
+
+
+class SnapshotWorkerConnections(object):
+    """Worker threads' connections which all share a snapshot exported by some other transaction.
+
+    Every thread gets a single connection (made with "connect" on the thread's first call to db()) which imports the
+    snapshot in a REPEATABLE READ transaction, so all workers see the same data as the exporting transaction. Snapshot
+    can only be imported into a connection to the same database, so connecting to some other database fails instead of
+    silently reading other data."""
+
+    # Callback which creates a new database handler
+    __connect = None
+
+    # Exported snapshot ID
+    __snapshot_id = None
+
+    # Connections of all threads, and a lock guarding the list
+    __dbs = None
+    __lock = None
+
+    # Thread's connection
+    __thread_state = None
+
+    def __init__(self, connect: Callable[[], DatabaseHandler], snapshot_id: str):
+        self.__connect = connect
+        self.__snapshot_id = snapshot_id
+        self.__dbs = []
+        self.__lock = threading.Lock()
+        self.__thread_state = threading.local()
+
+    @staticmethod
+    def export_snapshot(db: DatabaseHandler) -> str:
+        """Export snapshot of the handler's (REPEATABLE READ) transaction; return snapshot ID."""
+        return db.query("SELECT pg_export_snapshot()").flat()[0]
+
+    def snapshot_id(self) -> str:
+        """Return shared snapshot ID."""
+        return self.__snapshot_id
+
+    def db(self) -> DatabaseHandler:
+        """Return calling thread's connection, importing the snapshot on the first call."""
+        if getattr(self.__thread_state, 'db', None) is None:
+            worker_db = self.__connect()
+            with self.__lock:
+                self.__dbs.append(worker_db)
+            worker_db.begin(isolation='repeatable read')
+            worker_db.query("SET TRANSACTION SNAPSHOT %(snapshot_id)s", {'snapshot_id': self.__snapshot_id})
+            self.__thread_state.db = worker_db
+        return self.__thread_state.db
+
+    def close(self) -> None:
+        """Roll back and close all threads' connections."""
+        with self.__lock:
+            dbs = self.__dbs
+            self.__dbs = []
+        for worker_db in dbs:
+            try:
+                worker_db.rollback()
+            finally:
+                worker_db.disconnect()
+
+
+class _HashingWriter(object):
+    """File-like object which counts and hashes the bytes written through it."""
+
+    # Underlying file
+    __file = None
+
+    # SHA-256 of the data written so far
+    __sha256 = None
+
+    # Number of bytes written so far
+    __size = 0
+
+    def __init__(self, file: Any):
+        self.__file = file
+        self.__sha256 = hashlib.sha256()
+        self.__size = 0
+
+    def write(self, data: bytes) -> int:
+        self.__sha256.update(data)
+        self.__size += len(data)
+        return self.__file.write(data)
+
+    def flush(self) -> None:
+        self.__file.flush()
+
+    def size(self) -> int:
+        return self.__size
+
+    def sha256(self) -> str:
+        return self.__sha256.hexdigest()
+
+
+def __read_manifest(directory: str) -> Dict[str, Any]:
+    """Read export directory's manifest; return None if it doesn't exist."""
+    path = os.path.join(directory, _MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def __write_manifest(directory: str, manifest: Dict[str, Any]) -> None:
+    """Write export directory's manifest atomically."""
+    path = os.path.join(directory, _MANIFEST_FILENAME)
+    temp_path = path + '.partial'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def __table_is_exported(directory: str, table_manifest: Dict[str, Any]) -> bool:
+    """Return True if table's data file from the manifest exists and is complete."""
+    if table_manifest.get('status', None) != 'done':
+        return False
+    path = os.path.join(directory, table_manifest['file'])
+    return os.path.isfile(path) and os.path.getsize(path) == table_manifest['bytes']
+
+
+def __export_table(db: DatabaseHandler, directory: str, table: str, compression: str) -> Dict[str, Any]:
+    """Stream table's COPY TO output into a compressed file; return table's manifest entry."""
+
+    column_names = list(db.table_columns(table=table).keys())
+    primary_key_column = db.primary_key_column(table=table)
+
+    filename = '%s.copy.%s' % (table, _COMPRESSION_EXTENSIONS[compression])
+    path = os.path.join(directory, filename)
+    temp_path = path + '.partial'
+
+    copy_sql = """
+        COPY (
+            SELECT %(column_names)s
+            FROM %(table)s
+            ORDER BY %(primary_key_column)s
+        ) TO STDOUT WITH (FORMAT TEXT)
+    """ % {
+        'column_names': ', '.join(column_names),
+        'table': table,
+        'primary_key_column': primary_key_column,
+    }
+
+    log.info("Exporting table '%s' to '%s'..." % (table, path))
+
+    try:
+        with open(temp_path, 'wb') as raw_file:
+            hashing_file = _HashingWriter(file=raw_file)
+
+            if compression == 'zstd':
+                compressor = zstandard.ZstdCompressor(level=_ZSTD_COMPRESSION_LEVEL)
+                with compressor.stream_writer(hashing_file) as compressed_file:
+                    row_count = db.copy_to_file(sql=copy_sql, file=compressed_file)
+            else:
+                with gzip.GzipFile(filename=table, mode='wb', compresslevel=_GZIP_COMPRESSION_LEVEL,
+                                   fileobj=hashing_file) as compressed_file:
+                    row_count = db.copy_to_file(sql=copy_sql, file=compressed_file)
+
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+
+    except Exception as ex:
+        if os.path.isfile(temp_path):
+            os.unlink(temp_path)
+        raise ex
+
+    os.replace(temp_path, path)
+
+    log.info("Exported %d rows of table '%s'." % (row_count, table))
+
+    return {
+        'status': 'done',
+        'file': filename,
+        'columns': column_names,
+        'primary_key_column': primary_key_column,
+        'rows': row_count,
+        'bytes': hashing_file.size(),
+        'sha256': hashing_file.sha256(),
+        'exported_at': datetime.datetime.utcnow().isoformat() + 'Z',
+    }
+
+
+def __tables_by_size(db: DatabaseHandler, tables: List[str]) -> List[str]:
+    """Return tables ordered by their size, largest first, so that the biggest ones don't end up being exported last."""
+    sizes = db.query("""
+        SELECT table_name, COALESCE(pg_total_relation_size(to_regclass(table_name)), 0) AS size
+        FROM UNNEST(%(tables)s::TEXT[]) AS table_name
+    """, {'tables': tables}).hashes()
+    sizes = {row['table_name']: row['size'] for row in sizes}
+    return sorted(tables, key=lambda table: sizes[table], reverse=True)
+
+
+def export_tables_to_directory(db: DatabaseHandler,
+                               tables: List[str],
+                               directory: str,
+                               compression: str = 'zstd',
+                               jobs: int = 4,
+                               resume: bool = False,
+                               connect: Callable[[], DatabaseHandler] = connect_to_db,
+                               before_export: Callable[[DatabaseHandler, SnapshotWorkerConnections], None] = None) \
+        -> Dict[str, Any]:
+    """Export tables' data into compressed COPY TEXT files in a directory; return the manifest.
+
+    Tables get exported in parallel by "jobs" worker connections (made with "connect") which all share the snapshot
+    exported by "db", so the export is consistent as if all tables were dumped in a single transaction. Every table's
+    COPY TO output gets streamed through a gzip or zstd compressor into "<table>.copy.<gz|zst>".
+
+    "manifest.json" in the directory lists exported tables with their columns, row counts, file sizes and checksums; it
+    gets rewritten after every table. If "resume" is True, tables that the manifest lists as completely exported get
+    skipped, and only the rest gets exported (in a new snapshot).
+
+    If set, "before_export" gets called with "db" and the worker connections before exporting any tables, e.g. to
+    validate the data that is about to get exported in the same snapshot."""
+
+    tables = decode_object_from_bytes_if_needed(tables)
+    directory = decode_object_from_bytes_if_needed(directory)
+    compression = decode_object_from_bytes_if_needed(compression)
+
+    if compression not in _COMPRESSION_EXTENSIONS:
+        raise McExportTablesToDirectoryException("Unsupported compression '%s'." % compression)
+    if len(tables) == 0:
+        raise McExportTablesToDirectoryException("No tables to export.")
+    jobs = max(1, int(jobs))
+
+    os.makedirs(directory, exist_ok=True)
+
+    manifest = __read_manifest(directory) if resume else None
+    if manifest is not None:
+        if manifest.get('version', None) != _MANIFEST_VERSION:
+            raise McExportTablesToDirectoryException("Unsupported manifest version in '%s'." % directory)
+        if manifest['compression'] != compression:
+            raise McExportTablesToDirectoryException(
+                "Export in '%s' was compressed with '%s', not '%s'." % (directory, manifest['compression'], compression)
+            )
+    else:
+        manifest = {
+            'version': _MANIFEST_VERSION,
+            'compression': compression,
+            'format': 'text',
+            'tables': {},
+        }
+    manifest['table_order'] = tables
+
+    pending_tables = []
+    for table in tables:
+        if table in manifest['tables'] and __table_is_exported(directory, manifest['tables'][table]):
+            log.info("Table '%s' has already been exported, skipping." % table)
+        else:
+            manifest['tables'].pop(table, None)
+            pending_tables.append(table)
+
+    __write_manifest(directory, manifest)
+
+    if len(pending_tables) == 0:
+        log.info("All tables have already been exported.")
+        return manifest
+
+    # Keep the transaction open until the workers are done so that the snapshot stays valid
+    db.begin(isolation='repeatable read')
+    try:
+        snapshot_id = SnapshotWorkerConnections.export_snapshot(db)
+        log.info("Exporting %d tables in %d jobs using snapshot '%s'..." % (len(pending_tables), jobs, snapshot_id))
+
+        workers = SnapshotWorkerConnections(connect=connect, snapshot_id=snapshot_id)
+
+        manifest_lock = threading.Lock()
+
+        def __export(table_to_export: str) -> None:
+            table_manifest = __export_table(db=workers.db(),
+                                            directory=directory,
+                                            table=table_to_export,
+                                            compression=compression)
+            table_manifest['snapshot'] = snapshot_id
+            with manifest_lock:
+                manifest['tables'][table_to_export] = table_manifest
+                __write_manifest(directory, manifest)
+
+        failed_tables = {}
+        try:
+            if before_export is not None:
+                before_export(db, workers)
+
+            pending_tables = __tables_by_size(db=db, tables=pending_tables)
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {table: executor.submit(__export, table) for table in pending_tables}
+                for table, future in futures.items():
+                    exception = future.exception()
+                    if exception is not None:
+                        log.error("Exporting table '%s' failed: %s" % (table, str(exception)))
+                        failed_tables[table] = str(exception)
+        finally:
+            workers.close()
+
+    finally:
+        db.rollback()
+
+    if len(failed_tables) > 0:
+        raise McExportTablesToDirectoryException(
+            "Failed to export tables (rerun with resume to retry only them): %s" % str(failed_tables)
+        )
+
+    log.info("Done exporting tables to '%s'." % directory)
+
+    return manifest
@@ -1,5 +1,10 @@
+import os
+import tempfile
 from io import StringIO
 
+import pytest
+
+import mediawords.db.export.export_tables
 from mediawords.db import connect_to_db
 from mediawords.db.export.export_tables import *
 
@@ -24,3 +29,88 @@ def test_print_exported_tables_to_backup_crawler():
 
     sql_dump = captured_stdout.getvalue()
     assert 'COPY media' in sql_dump
+
+
+def test_export_tables_to_backup_crawler_directory():
+    db = connect_to_db()
+
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = export_tables_to_backup_crawler_directory(db=db, directory=directory, jobs=2, compression='gzip')
+        assert manifest['table_order'][:2] == ['tag_sets', 'media']
+        assert os.path.isfile(os.path.join(directory, manifest['tables']['media']['file']))
+
+
+def test_validate_foreign_keys():
+    db = connect_to_db(label='test')
+
+    db.query("DROP TABLE IF EXISTS test_fk_children, test_fk_parents")
+    db.query("""
+        CREATE TABLE test_fk_parents (
+            test_fk_parents_id INT PRIMARY KEY,
+            code TEXT NOT NULL,
+            UNIQUE (test_fk_parents_id, code)
+        );
+        CREATE TABLE test_fk_children (
+            test_fk_children_id SERIAL PRIMARY KEY,
+            parent_id INT NULL,
+            other_parent_id INT NULL,
+            other_parent_code TEXT NULL
+        );
+        INSERT INTO test_fk_parents (test_fk_parents_id, code) SELECT x, 'code ' || x FROM generate_series(1, 10) AS x;
+        INSERT INTO test_fk_children (parent_id, other_parent_id, other_parent_code)
+            SELECT x, x, 'code ' || x FROM generate_series(1, 10) AS x;
+        INSERT INTO test_fk_children (parent_id, other_parent_id, other_parent_code) VALUES
+            (NULL, NULL, NULL), (11, 1, 'code 1'), (11, 1, 'code 1'), (1, 2, 'code 3'), (12, 5, NULL);
+        ALTER TABLE test_fk_children
+            ADD CONSTRAINT test_fk_children_parent_fkey
+                FOREIGN KEY (parent_id) REFERENCES test_fk_parents (test_fk_parents_id) NOT VALID,
+            ADD CONSTRAINT test_fk_children_other_parent_fkey
+                FOREIGN KEY (other_parent_id, other_parent_code)
+                REFERENCES test_fk_parents (test_fk_parents_id, code) NOT VALID;
+    """)
+
+    validate_table_foreign_keys = getattr(mediawords.db.export.export_tables, '__validate_table_foreign_keys')
+    validate_foreign_keys = getattr(mediawords.db.export.export_tables, '__validate_foreign_keys')
+
+    validate_table_foreign_keys(db=db, table='test_fk_parents')
+
+    with pytest.raises(McValidateTableForeignKeysException) as ex:
+        validate_table_foreign_keys(db=db, table='test_fk_children')
+    error = str(ex.value)
+    assert "'test_fk_children_parent_fkey':\n                11; 12;" in error
+    assert "'test_fk_children_other_parent_fkey':\n                2, code 3;" in error
+
+    # Capped number of violations
+    with pytest.raises(McValidateTableForeignKeysException) as ex:
+        validate_table_foreign_keys(db=db, table='test_fk_children', max_violations=1)
+    assert '; ...' in str(ex.value)
+
+    # Concurrent validation of several tables in the snapshot of "db"'s transaction
+    db.begin(isolation='repeatable read')
+    workers = SnapshotWorkerConnections(connect=lambda: connect_to_db(label='test'),
+                                        snapshot_id=SnapshotWorkerConnections.export_snapshot(db))
+
+    # Changes committed after the snapshot don't get seen by the workers
+    other_db = connect_to_db(label='test')
+    other_db.query("DELETE FROM test_fk_children WHERE parent_id > 10 OR other_parent_code = 'code 3'")
+    other_db.disconnect()
+
+    try:
+        with pytest.raises(McPrintExportedTablesToBackupCrawlerException) as ex:
+            validate_foreign_keys(db=db, tables=['test_fk_parents', 'test_fk_children'], jobs=2, workers=workers)
+        assert 'test_fk_children_parent_fkey' in str(ex.value)
+    finally:
+        workers.close()
+        db.rollback()
+
+    db.begin(isolation='repeatable read')
+    workers = SnapshotWorkerConnections(connect=lambda: connect_to_db(label='test'),
+                                        snapshot_id=SnapshotWorkerConnections.export_snapshot(db))
+    try:
+        validate_foreign_keys(db=db, tables=['test_fk_parents', 'test_fk_children'], jobs=2, workers=workers)
+    finally:
+        workers.close()
+        db.rollback()
+
+    db.query("DROP TABLE test_fk_children, test_fk_parents")
+    db.disconnect()
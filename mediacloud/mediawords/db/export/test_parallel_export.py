@@ -0,0 +1,132 @@
+import gzip
+import json
+import os
+import tempfile
+
+import pytest
+import zstandard
+
+from mediawords.db import connect_to_db
+from mediawords.db.export.parallel_export import *
+
+_TEST_TABLES = ['test_export_a', 'test_export_b', 'test_export_c']
+
+
+def __connect():
+    return connect_to_db(label='test')
+
+
+def __create_test_tables(db) -> None:
+    for table in _TEST_TABLES:
+        db.query("DROP TABLE IF EXISTS %s" % table)
+        db.query("""
+            CREATE TABLE %(table)s (
+                %(table)s_id SERIAL PRIMARY KEY,
+                name TEXT NULL,
+                value INT NOT NULL
+            )
+        """ % {'table': table})
+        db.query("""
+            INSERT INTO %s (name, value)
+            SELECT CASE WHEN x %% 10 = 0 THEN NULL ELSE E'name\\t' || x END, x
+            FROM generate_series(1, 1000) AS x
+        """ % table)
+
+
+def __drop_test_tables(db) -> None:
+    for table in _TEST_TABLES:
+        db.query("DROP TABLE IF EXISTS %s" % table)
+
+
+def __decompress(path: str) -> bytes:
+    if path.endswith('.zst'):
+        with open(path, 'rb') as f:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(f.read())
+    else:
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+
+
+def test_export_tables_to_directory():
+    db = __connect()
+    __create_test_tables(db)
+
+    for compression in ['zstd', 'gzip']:
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = export_tables_to_directory(db=db,
+                                                  tables=_TEST_TABLES,
+                                                  directory=directory,
+                                                  compression=compression,
+                                                  jobs=2,
+                                                  connect=__connect)
+
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                assert json.load(f) == manifest
+
+            assert manifest['table_order'] == _TEST_TABLES
+            for table in _TEST_TABLES:
+                table_manifest = manifest['tables'][table]
+                assert table_manifest['rows'] == 1000
+                assert table_manifest['columns'] == ['%s_id' % table, 'name', 'value']
+
+                path = os.path.join(directory, table_manifest['file'])
+                assert os.path.getsize(path) == table_manifest['bytes']
+
+                lines = __decompress(path).decode('utf-8').splitlines()
+                assert len(lines) == 1000
+                assert lines[0] == '1\tname\\t1\t1'
+                assert lines[9] == '10\t\\N\t10'
+
+            # Coordinator's transaction got closed
+            assert not db.in_transaction()
+
+    __drop_test_tables(db)
+    db.disconnect()
+
+
+def test_export_tables_to_directory_resume():
+    db = __connect()
+    __create_test_tables(db)
+
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = export_tables_to_directory(db=db, tables=_TEST_TABLES, directory=directory, connect=__connect)
+        first_export = {table: dict(table_manifest) for table, table_manifest in manifest['tables'].items()}
+
+        # Truncated file gets exported again
+        truncated_path = os.path.join(directory, first_export['test_export_b']['file'])
+        with open(truncated_path, 'r+b') as f:
+            f.truncate(10)
+
+        db.query("INSERT INTO test_export_b (name, value) VALUES ('new', 1001)")
+
+        manifest = export_tables_to_directory(db=db,
+                                              tables=_TEST_TABLES,
+                                              directory=directory,
+                                              resume=True,
+                                              connect=__connect)
+        assert manifest['tables']['test_export_a'] == first_export['test_export_a']
+        assert manifest['tables']['test_export_c'] == first_export['test_export_c']
+        assert manifest['tables']['test_export_b']['rows'] == 1001
+
+        # Compression can't be changed when resuming
+        with pytest.raises(McExportTablesToDirectoryException):
+            export_tables_to_directory(db=db,
+                                       tables=_TEST_TABLES,
+                                       directory=directory,
+                                       compression='gzip',
+                                       resume=True,
+                                       connect=__connect)
+
+        # Failed table gets left out of the manifest
+        with pytest.raises(McExportTablesToDirectoryException):
+            export_tables_to_directory(db=db,
+                                       tables=_TEST_TABLES + ['nonexistent_table'],
+                                       directory=directory,
+                                       resume=True,
+                                       connect=__connect)
+
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            assert 'nonexistent_table' not in json.load(f)['tables']
+
+    __drop_test_tables(db)
+    db.disconnect()
@@ -1,3 +1,4 @@
+import io
 import os
 import re
 from typing import Callable, Union, List, Dict, Any
@@ -6,13 +7,19 @@ import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import adapt as psycopg2_adapt
 
+from mediawords.db.batch.batch import DatabaseBatch
 from mediawords.db.copy.copy_from import CopyFrom
-from mediawords.db.copy.copy_to import CopyTo
+from mediawords.db.copy.copy_to import CopyTo, stream_copy_to
 from mediawords.db.exceptions.handler import *
+from mediawords.db.statement.cache import DatabasePreparedStatementCache
 from mediawords.db.statement.statement import DatabaseStatement
 from mediawords.db.pages.pages import DatabasePages
-from mediawords.db.result.result import DatabaseResult
-from mediawords.db.schema.version import schema_version_from_lines
+from mediawords.db.result.columnar import binary_copy_supported_types, binary_copy_to_columns
+from mediawords.db.result.result import DatabaseResult, _double_percentage_signs
+from mediawords.db.schema.cache import cached_target_schema_version, schema_version_check_is_cached, \
+    cache_schema_version_check, cached_schema_metadata, cache_schema_metadata
+from mediawords.db.schema.metadata import DatabaseSchemaMetadata, schema_metadata_query
+from mediawords.db.transaction.transaction import DatabaseTransaction
 
 from mediawords.util.config import get_config as py_get_config  # MC_REWRITE_TO_PYTHON: rename back to get_config()
 from mediawords.util.log import create_logger
@@ -39,11 +46,49 @@ class DatabaseHandler(object):
     # Min. "deadlock_timeout" to not cause problems under load (in seconds)
     __MIN_DEADLOCK_TIMEOUT = 5
 
-    # cache of table primary key columns
-    __primary_key_columns = {}
+    # Min. number of rows for create_many() / upsert_many() to use COPY instead of multi-row INSERTs
+    __BULK_COPY_THRESHOLD = 1000
 
-    # PIDs for which the schema version has been checked
-    __schema_version_check_pids = {}
+    # Max. number of rows in a single multi-row INSERT of create_many() / upsert_many()
+    __BULK_INSERT_PAGE_SIZE = 1000
+
+    # Max. number of IDs for attach_child_query() to pass as a BIGINT[] parameter instead of a temporary table
+    __ATTACH_CHILD_QUERY_ARRAY_THRESHOLD = 1000
+
+    # Min. number of IDs for get_temporary_ids_table() to ANALYZE the temporary table
+    __TEMPORARY_IDS_TABLE_ANALYZE_THRESHOLD = 1000
+
+    # Queries which query_columns_as_arrays() can run as binary COPY TO
+    __COPYABLE_QUERY_REGEX = re.compile(
+        r'^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(?:SELECT|WITH|VALUES|TABLE)\b',
+        re.IGNORECASE | re.DOTALL
+    )
+
+    # Process-wide cache of schema metadata; database ("host:port/name") -> (target schema version, metadata)
+    __schema_metadata = {}
+
+    # Databases ("host:port/name") which had their schema changed by this process, so on-disk metadata cache is stale
+    __schema_changed_databases = {}
+
+    # Queries that might change the schema metadata (creating temporary tables and indexes, and dropping handler's own
+    # "_tmp_*" temporary tables, e.g. upsert_many()'s staging tables, doesn't)
+    __SCHEMA_CHANGING_QUERY_REGEX = re.compile(
+        r'^\s*(?:'
+        r'ALTER'
+        r'|DROP(?!\s+TABLE\s+(?:IF\s+EXISTS\s+)?_tmp_\w+\s*;?\s*$)'
+        r'|CREATE(?!\s+(?:(?:GLOBAL|LOCAL)\s+)?TEMP(?:ORARY)?\s|\s+(?:UNIQUE\s+)?INDEX\s)'
+        r')\b',
+        re.IGNORECASE
+    )
+
+    # Queries that might undo schema changes made within the transaction
+    __ROLLBACK_QUERY_REGEX = re.compile(r'^\s*(?:ROLLBACK|ABORT)\b', re.IGNORECASE)
+
+    # For how long (in seconds) a successful schema version check stays valid in the on-disk cache
+    __SCHEMA_VERSION_CHECK_CACHE_MAX_AGE = 60 * 10
+
+    # Databases ("host:port/name") for which the schema version has been checked by this process or its parent
+    __schema_version_checked_databases = {}
 
     # Whether or not to print PostgreSQL warnings
     __print_warnings = True
@@ -51,13 +96,37 @@ class DatabaseHandler(object):
     # "Double percentage sign" marker (see handler's quote() for explanation)
     __double_percentage_sign_marker = "<DOUBLE PERCENTAGE SIGN: " + random_string(length=16) + ">"
 
+    # Transaction isolation levels supported by begin()
+    __ISOLATION_LEVELS = {'READ UNCOMMITTED', 'READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE'}
+
     # Debugging variable to test whether we're in a transaction
     __in_manual_transaction = False
 
+    # Metadata of tables that were not in the process-wide schema metadata (temporary tables, tables created later)
+    __table_metadata_cache = None
+
+    # True if the schema has been changed within the current transaction
+    __schema_changed_in_transaction = False
+
+    # Temporary IDs tables created within the current transaction; (ordered, IDs) -> table name
+    __temporary_ids_tables = None
+
+    # Savepoints of the current transaction; list of (savepoint name, temporary IDs tables' keys at the savepoint)
+    __savepoints = None
+
+    # Database identifier for schema version check caches ("host:port/name")
+    __database_key = None
+
     # Pyscopg2 instance and cursor
     __conn = None
     __db = None
 
+    # Cache of server-side prepared statements for hot queries (None if disabled)
+    __statement_cache = None
+
+    # Callback to call on disconnect() instead of closing the connection (set by connection pool)
+    __release_callback = None
+
     def __init__(self,
                  host: str,
                  port: int,
@@ -99,18 +168,22 @@ class DatabaseHandler(object):
         password = decode_object_from_bytes_if_needed(password)
         database = decode_object_from_bytes_if_needed(database)
 
-        # If the user didn't clearly (via 'true' or 'false') state whether or not
-        # to check schema version, check it once per PID
-        pid = os.getpid()
-
         if not (host and username and password and database):
             raise McConnectException("Database connection credentials are not set.")
 
         if not port:
             port = 5432
 
+        self.__database_key = '%s:%d/%s' % (host, port, database)
+
+        # If the user didn't clearly (via 'true' or 'false') state whether or not to check schema version, check it
+        # once per database; forked children inherit parent's checks, and checks done by other processes get reused
+        # from the on-disk cache
         if not do_not_check_schema_version:
-            if pid in self.__schema_version_check_pids:
+            if self.__database_key in self.__schema_version_checked_databases:
+                do_not_check_schema_version = True
+            elif self.__schema_version_check_is_cached():
+                log.debug("Schema version of %s has been checked recently, skipping" % self.__database_key)
                 do_not_check_schema_version = True
             else:
                 do_not_check_schema_version = False
@@ -141,8 +214,8 @@ class DatabaseHandler(object):
                 # too old on every run, and that's supposedly a good thing.
                 raise McConnectException("Database schema is not up-to-date.")
 
-        # If schema is not up-to-date, connect() dies and we don't get to set PID here
-        self.__schema_version_check_pids[pid] = True
+        # If schema is not up-to-date, connect() dies and we don't get to mark the database as checked here
+        self.__schema_version_checked_databases[self.__database_key] = True
 
         # Check deadlock_timeout
         (deadlock_timeout,) = self.query("SHOW deadlock_timeout").flat()
@@ -155,12 +228,20 @@ class DatabaseHandler(object):
                         self.__MIN_DEADLOCK_TIMEOUT)
 
     def disconnect(self) -> None:
-        """Disconnect from the database."""
+        """Disconnect from the database (or return the handler to the connection pool if it came from one)."""
+        if self.__release_callback is not None:
+            self.__release_callback(self)
+            return
+
         self.__db.close()
         self.__db = None
 
         self.__conn.close()
-        self.__db = None
+        self.__conn = None
+
+    def set_release_callback(self, release_callback: Union[Callable[['DatabaseHandler'], None], None]) -> None:
+        """Set callback to be called by disconnect() instead of closing the connection; None to reset."""
+        self.__release_callback = release_callback
 
     # noinspection PyMethodMayBeStatic
     def dbh(self) -> None:
@@ -213,6 +294,30 @@ class DatabaseHandler(object):
             })
             return False
 
+    @staticmethod
+    def __schema_version_cache_dir() -> str:
+        """Return directory for caching target schema version and schema version checks."""
+        config = py_get_config()
+        return os.path.join(config['mediawords']['data_dir'], 'cache', 'db_schema_version')
+
+    def __target_schema_version(self) -> int:
+        """Return schema version from mediawords.sql (cached on disk until mediawords.sql changes)."""
+        return cached_target_schema_version(schema_path=mc_sql_schema_path(),
+                                            cache_dir=self.__schema_version_cache_dir())
+
+    def __schema_version_check_is_cached(self) -> bool:
+        """Return True if some process has found the database schema to be up-to-date recently."""
+        try:
+            target_schema_version = self.__target_schema_version()
+        except Exception as ex:
+            log.warning("Unable to determine target schema version: %s" % str(ex))
+            return False
+
+        return schema_version_check_is_cached(cache_dir=self.__schema_version_cache_dir(),
+                                              database=self.__database_key,
+                                              target_schema_version=target_schema_version,
+                                              max_age=self.__SCHEMA_VERSION_CHECK_CACHE_MAX_AGE)
+
     def schema_is_up_to_date(self) -> bool:
         """Checks if the database schema is up-to-date"""
 
@@ -240,8 +345,7 @@ class DatabaseHandler(object):
             raise McSchemaIsUpToDateException("Current schema version is 0")
 
         # Target schema version
-        sql = open(mc_sql_schema_path(), 'r').read()
-        target_schema_version = schema_version_from_lines(sql)
+        target_schema_version = self.__target_schema_version()
         if not target_schema_version:
             raise McSchemaIsUpToDateException("Invalid target schema version.")
 
@@ -250,6 +354,9 @@ class DatabaseHandler(object):
             return self.__should_continue_with_outdated_schema(current_schema_version, target_schema_version)
         else:
             # Things are fine at this point.
+            cache_schema_version_check(cache_dir=self.__schema_version_cache_dir(),
+                                       database=self.__database_key,
+                                       target_schema_version=target_schema_version)
             return True
 
     def query(self, *query_params) -> DatabaseResult:
@@ -279,10 +386,115 @@ class DatabaseHandler(object):
         if len(query_params) > 2:
             raise McQueryException("psycopg2's execute() accepts at most 2 parameters.")
 
+        if self.__SCHEMA_CHANGING_QUERY_REGEX.match(query_params[0]):
+            self.__schema_changed()
+            if self.in_transaction():
+                self.__schema_changed_in_transaction = True
+        elif self.__schema_changed_in_transaction and self.__ROLLBACK_QUERY_REGEX.match(query_params[0]):
+            # Schema metadata that got loaded after the change might have been rolled back with it
+            self.__schema_changed()
+
         return DatabaseResult(cursor=self.__db,
                               query_args=query_params,
                               double_percentage_sign_marker=self.__double_percentage_sign_marker,
-                              print_warnings=self.__print_warnings)
+                              print_warnings=self.__print_warnings,
+                              statement_cache=self.__statement_cache)
+
+    def query_stream(self, *query_params, itersize: int = 2000) -> DatabaseResult:
+        """Run the query on a server-side cursor, return instance of DatabaseResult for reading the result lazily.
+
+        Accepts the same query parameters as query(). Use iter_hashes() / iter_arrays() of the returned result to
+        iterate over rows; those are fetched from the server "itersize" rows at a time. The cursor gets closed when the
+        iterator is exhausted, closed or garbage collected, or when result's close() gets called.
+
+        The cursor is declared WITH HOLD so that it could be used outside of a transaction too; note that in such case
+        PostgreSQL materializes the whole result on the server side, so it's better to stream within begin() /
+        commit()."""
+
+        # MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
+        query_params = convert_dbd_pg_arguments_to_psycopg2_format(*query_params)
+
+        if len(query_params) == 0:
+            raise McQueryException("Query is unset.")
+        if len(query_params) > 2:
+            raise McQueryException("psycopg2's execute() accepts at most 2 parameters.")
+        if itersize < 1:
+            raise McQueryException("'itersize' must be 1 or bigger.")
+
+        cursor_name = 'mc_stream_%s' % random_string(length=16).lower()
+        cursor = self.__conn.cursor(name=cursor_name, cursor_factory=psycopg2.extras.DictCursor, withhold=True)
+        cursor.itersize = itersize
+
+        return DatabaseResult(cursor=cursor,
+                              query_args=query_params,
+                              double_percentage_sign_marker=self.__double_percentage_sign_marker,
+                              print_warnings=self.__print_warnings,
+                              owns_cursor=True)
+
+    def read_only_query(self, *query_params) -> DatabaseResult:
+        """Run the query which doesn't write anything, return instance of DatabaseResult for accessing the result.
+
+        Accepts the same query parameters as query(). Handlers connected to read replicas (see
+        mediawords.db.routing) might run such queries on one of the replicas; this one just runs the query."""
+        return self.query(*query_params)
+
+    def batch(self, max_queries: int = 500) -> DatabaseBatch:
+        """Return batch for sending many independent queries to PostgreSQL in a single round trip, e.g.:
+
+            with db.batch() as batch:
+                results = [batch.find_by_id('stories', stories_id) for stories_id in stories_ids]
+            stories = [result.hash() for result in results]
+
+        See DatabaseBatch for limitations."""
+        return DatabaseBatch(db=self, max_queries=max_queries)
+
+    def query_columns_as_arrays(self, *query_params, use_numpy: bool = False) -> Dict[str, Any]:
+        """Run the query, return its result as a dictionary of column names and column values.
+
+        Accepts the same query parameters as query(); see DatabaseResult's columns_as_arrays() for the returned columns.
+
+        If all of the columns are of integer, floating point, boolean or string types, the result gets fetched with
+        binary COPY TO and decoded straight into column arrays (in a single vectorized pass for numeric columns without
+        NULLs) without creating an object for every row."""
+
+        # MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
+        query_params = convert_dbd_pg_arguments_to_psycopg2_format(*query_params)
+
+        if len(query_params) == 0:
+            raise McQueryException("Query is unset.")
+        if len(query_params) > 2:
+            raise McQueryException("psycopg2's execute() accepts at most 2 parameters.")
+
+        query = query_params[0].strip().rstrip(';')
+        params = query_params[1] if len(query_params) == 2 else {}
+
+        if not self.__COPYABLE_QUERY_REGEX.match(query):
+            return self.query(*query_params).columns_as_arrays(use_numpy=use_numpy)
+
+        # Find out column names and types without fetching any rows
+        description_query = "SELECT * FROM (\n%s\n) AS columns_query LIMIT 0" % query
+        names = self.query(description_query, params).columns()
+        type_oids = [desc[1] for desc in self.__db.description]
+
+        if not binary_copy_supported_types(type_oids):
+            return self.query(*query_params).columns_as_arrays(use_numpy=use_numpy)
+
+        try:
+            query = _double_percentage_signs(query, self.__double_percentage_sign_marker)
+            query = self.__db.mogrify(query, params).decode('utf-8')
+
+            buffer = io.BytesIO()
+            self.__db.copy_expert(sql="COPY (\n%s\n) TO STDOUT WITH (FORMAT binary)" % query, file=buffer)
+
+        except psycopg2.Error as ex:
+            raise McQueryException("Query failed: %s; query: %s" % (str(ex), str(query_params)))
+
+        builder = binary_copy_to_columns(data=buffer.getbuffer(),
+                                         names=names,
+                                         type_oids=type_oids,
+                                         row_count=self.__db.rowcount)
+
+        return builder.columns(use_numpy=use_numpy)
 
     def prepare(self, sql: str) -> DatabaseStatement:
         """Return a prepared statement."""
@@ -293,7 +505,27 @@ class DatabaseHandler(object):
 
         return DatabaseStatement(cursor=self.__db,
                                  sql=sql,
-                                 double_percentage_sign_marker=self.__double_percentage_sign_marker)
+                                 double_percentage_sign_marker=self.__double_percentage_sign_marker,
+                                 statement_cache=self.__statement_cache)
+
+    def enable_prepared_statements(self, threshold: int = 5, max_size: int = 100) -> None:
+        """Transparently run parameterized queries that got executed "threshold" times as server-side prepared
+        statements, keeping at most "max_size" least recently used statements prepared on this connection."""
+        if self.__statement_cache is not None:
+            self.__statement_cache.deallocate_all(cursor=self.__db)
+        self.__statement_cache = DatabasePreparedStatementCache(threshold=int(threshold), max_size=int(max_size))
+
+    def disable_prepared_statements(self) -> None:
+        """Stop using (and DEALLOCATE) server-side prepared statements."""
+        if self.__statement_cache is not None:
+            self.__statement_cache.deallocate_all(cursor=self.__db)
+            self.__statement_cache = None
+
+    def prepared_statement_stats(self) -> Union[Dict[str, int], None]:
+        """Return prepared statement cache counters, or None if prepared statements are not enabled."""
+        if self.__statement_cache is None:
+            return None
+        return self.__statement_cache.stats()
 
     def __get_current_work_mem(self) -> str:
         current_work_mem = self.query("SHOW work_mem").flat()[0]
@@ -353,36 +585,137 @@ class DatabaseHandler(object):
         if exception is not None:
             raise exception  # pass further
 
+    def schema_metadata(self) -> DatabaseSchemaMetadata:
+        """Return metadata (primary keys, columns, foreign keys) of the database's tables.
+
+        Metadata gets loaded with a single catalog query and is shared between all handlers of the process connected
+        to the same database; if "db_schema_metadata_disk_cache" is enabled in the configuration, it gets persisted to
+        disk too so that new processes don't have to query the catalog. Metadata gets reloaded when the target schema
+        version (from mediawords.sql) changes, and after DDL statements (CREATE, ALTER, DROP) get run through any of
+        the process' handlers.
+
+        Returned metadata is shared, so it's not to be modified."""
+
+        try:
+            schema_version = self.__target_schema_version()
+        except Exception as ex:
+            log.warning("Unable to determine target schema version: %s" % str(ex))
+            schema_version = None
+
+        cached = self.__schema_metadata.get(self.__database_key, None)
+        if cached is not None and cached[0] == schema_version:
+            return cached[1]
+
+        config = py_get_config()
+        disk_cache = config['mediawords'].get('db_schema_metadata_disk_cache', 'no')
+        disk_cache = str(disk_cache).lower() in {'yes', 'true', '1'} and schema_version is not None
+
+        # Schema on disk would be stale after this process has changed it
+        disk_cache = disk_cache and self.__database_key not in self.__schema_changed_databases
+
+        metadata = None
+        if disk_cache:
+            metadata_dict = cached_schema_metadata(cache_dir=self.__schema_version_cache_dir(),
+                                                   database=self.__database_key,
+                                                   schema_version=schema_version)
+            if metadata_dict is not None:
+                metadata = DatabaseSchemaMetadata.from_dict(metadata_dict)
+
+        if metadata is None:
+            log.debug("Loading schema metadata of %s..." % self.__database_key)
+            metadata = DatabaseSchemaMetadata()
+            metadata.add_tables(self.query(schema_metadata_query()).hashes())
+
+            if disk_cache:
+                cache_schema_metadata(cache_dir=self.__schema_version_cache_dir(),
+                                      database=self.__database_key,
+                                      schema_version=schema_version,
+                                      metadata=metadata.to_dict())
+
+        self.__schema_metadata[self.__database_key] = (schema_version, metadata,)
+
+        return metadata
+
+    def __schema_changed(self) -> None:
+        """Invalidate schema metadata after a DDL statement."""
+        self.__schema_metadata.pop(self.__database_key, None)
+        self.__schema_changed_databases[self.__database_key] = True
+        self.__table_metadata_cache = None
+
+    def __table_metadata(self, table: str) -> Union[DatabaseSchemaMetadata, None]:
+        """Return schema metadata which includes the table, or None if the table doesn't exist."""
+
+        metadata = self.schema_metadata()
+        if metadata.has_table(table):
+            return metadata
+
+        # Table created after the metadata was loaded, or a temporary table; cache it in the handler's own metadata so
+        # that the shared one doesn't get modified
+        if self.__table_metadata_cache is None:
+            self.__table_metadata_cache = DatabaseSchemaMetadata()
+        metadata = self.__table_metadata_cache
+        if metadata.has_table(table):
+            return metadata
+
+        rows = self.query(schema_metadata_query(single_table=True), {'table_name': table}).hashes()
+        if len(rows) == 0:
+            return None
+
+        if rows[0]['is_temporary']:
+            # Temporary tables might get dropped at the end of the transaction, so don't cache them
+            metadata = DatabaseSchemaMetadata()
+
+        metadata.add_tables(rows)
+
+        # Table might have been found under a different name, e.g. "Table" instead of "table"
+        if not metadata.has_table(table):
+            return None
+
+        return metadata
+
     def primary_key_column(self, table: str) -> str:
         """Get the primary key column for the table."""
 
         table = decode_object_from_bytes_if_needed(table)
 
-        if table not in self.__primary_key_columns:
-            # noinspection SqlResolve,SqlCheckUsingColumns
-            primary_key_column = self.query("""
-                SELECT column_name
-                FROM information_schema.table_constraints
-                     JOIN information_schema.key_column_usage
-                         USING (constraint_catalog, constraint_schema, constraint_name,
-                                table_catalog, table_schema, table_name)
-                WHERE constraint_type = 'PRIMARY KEY'
-                  AND table_name = %(table_name)s
-                ORDER BY ordinal_position
-            """, {'table_name': table}).flat()
-            if primary_key_column is None or len(primary_key_column) == 0:
-                raise McPrimaryKeyColumnException("Primary key for table '%s' was not found" % table)
-            if len(primary_key_column) > 1:
-                raise McPrimaryKeyColumnException(
-                    "More than one primary key column was found for table '%(table)s': %(primary_key_columns)s" % {
-                        'table': table,
-                        'primary_key_columns': str(primary_key_column)
-                    })
-            primary_key_column = primary_key_column[0]
-
-            self.__primary_key_columns[table] = primary_key_column
-
-        return self.__primary_key_columns[table]
+        metadata = self.__table_metadata(table)
+        if metadata is None:
+            raise McPrimaryKeyColumnException("Table '%s' was not found" % table)
+
+        primary_key_column = metadata.primary_key_columns(table)
+        if primary_key_column is None or len(primary_key_column) == 0:
+            raise McPrimaryKeyColumnException("Primary key for table '%s' was not found" % table)
+        if len(primary_key_column) > 1:
+            raise McPrimaryKeyColumnException(
+                "More than one primary key column was found for table '%(table)s': %(primary_key_columns)s" % {
+                    'table': table,
+                    'primary_key_columns': str(primary_key_column)
+                })
+
+        return primary_key_column[0]
+
+    def table_columns(self, table: str) -> Dict[str, str]:
+        """Return ordered dictionary of table's columns and their types."""
+
+        table = decode_object_from_bytes_if_needed(table)
+
+        metadata = self.__table_metadata(table)
+        if metadata is None:
+            raise McDatabaseHandlerException("Table '%s' was not found" % table)
+
+        return metadata.column_types(table)
+
+    def foreign_keys(self, table: str) -> List[Dict[str, Any]]:
+        """Return list of table's foreign keys; each foreign key is a dictionary with "constraint_name", "columns",
+        "foreign_table_schema", "foreign_table_name" and "foreign_columns" keys."""
+
+        table = decode_object_from_bytes_if_needed(table)
+
+        metadata = self.__table_metadata(table)
+        if metadata is None:
+            raise McDatabaseHandlerException("Table '%s' was not found" % table)
+
+        return metadata.foreign_keys(table)
 
     def find_by_id(self, table: str, object_id: int) -> Union[Dict[str, Any], None]:
         """Do an ID lookup on the table and return a single row match if found."""
@@ -473,16 +806,20 @@ class DatabaseHandler(object):
         sql = "UPDATE %s " % table
         sql += "SET %s " % ", ".join(keys)
         sql += "WHERE %s = " % primary_key_column
-        sql += "%(__object_id)s"  # "%(__object_id)s" to be resolved by psycopg2, not Python
+        sql += "%(__object_id)s "  # "%(__object_id)s" to be resolved by psycopg2, not Python
+        sql += "RETURNING *"
 
         try:
-            self.query(sql, update_hash)
+            updated_rows = self.query(sql, update_hash).hashes()
         except Exception as ex:
             raise McUpdateByIDException("Update to UPDATE hash '%s': %s" % (str(update_hash), str(ex)))
 
-        updated_row = self.find_by_id(table=table, object_id=object_id)
-
-        return updated_row
+        if len(updated_rows) > 1:
+            raise McUpdateByIDException("More than one row was updated for ID '%d' in table '%s'" % (object_id, table))
+        elif len(updated_rows) == 1:
+            return updated_rows[0]
+        else:
+            return None
 
     def delete_by_id(self, table: str, object_id: int) -> None:
         """Delete the row in the table with the given ID."""
@@ -545,10 +882,10 @@ class DatabaseHandler(object):
         sql = "INSERT INTO %s " % table
         sql += "(%s) " % ", ".join(keys)
         sql += "VALUES (%s) " % ", ".join(values)
-        sql += "RETURNING %s" % primary_key_column
+        sql += "RETURNING *"
 
         try:
-            last_inserted_id = self.query(sql, insert_hash).flat()
+            inserted_row = self.query(sql, insert_hash).hash()
         except Exception as ex:
             raise McCreateException("Unable to INSERT into '%(table)s' data '%(data)s': %(exception)s" % {
                 'table': table,
@@ -556,16 +893,236 @@ class DatabaseHandler(object):
                 'exception': str(ex),
             })
 
-        if last_inserted_id is None or len(last_inserted_id) == 0:
-            raise McCreateException("Last inserted ID was not found")
-        last_inserted_id = last_inserted_id[0]
-
-        inserted_row = self.find_by_id(table=table, object_id=last_inserted_id)
-        if inserted_row is None:
-            raise McCreateException("Could not find new ID %d in table '%s'" % (last_inserted_id, table))
+        if inserted_row is None or primary_key_column not in inserted_row:
+            raise McCreateException("Inserted row was not returned from table '%s'" % table)
 
         return inserted_row
 
+    def __bulk_rows(self, rows: List[dict], exception_class: type) -> tuple:
+        """Return column names and a list of value tuples for rows (dicts) to be inserted in bulk."""
+
+        rows = decode_object_from_bytes_if_needed(rows)
+        if not isinstance(rows, list):
+            raise exception_class("Rows to INSERT is not a list.")
+
+        columns = sorted(rows[0].keys())
+        if len(columns) == 0:
+            raise exception_class("Hash to INSERT is empty")
+
+        values = []
+        for row in rows:
+            if sorted(row.keys()) != columns:
+                raise exception_class("All rows must have the same keys (%s), got: %s" % (str(columns), str(row)))
+
+            row_values = []
+            for column in columns:
+                value = row[column]
+
+                # Cast Inline::Python's booleans to Python's booleans
+                # MC_REWRITE_TO_PYTHON: remove after porting
+                if type(value).__name__ == '_perl_obj':
+                    value = bool(value)
+
+                row_values.append(value)
+
+            values.append(tuple(row_values))
+
+        return columns, values
+
+    def __insert_values(self, sql_prefix: str, sql_suffix: str, values: List[tuple]) -> List[int]:
+        """Run multi-row "<sql_prefix> VALUES (...), (...) <sql_suffix>" in pages, return first column of RETURNING."""
+
+        returned = []
+
+        for page_start in range(0, len(values), self.__BULK_INSERT_PAGE_SIZE):
+            page = values[page_start:page_start + self.__BULK_INSERT_PAGE_SIZE]
+
+            row_placeholder = "(%s)" % ", ".join(["%s"] * len(page[0]))
+            sql = "%s VALUES %s %s" % (sql_prefix, ", ".join([row_placeholder] * len(page)), sql_suffix)
+
+            params = tuple(value for row_values in page for value in row_values)
+            returned.extend(self.query(sql, params).flat())
+
+        return returned
+
+    def __copy_values(self, table: str, columns: List[str], values: List[tuple]) -> None:
+        """COPY values into the table."""
+        copy = self.copy_from("COPY %(table)s (%(columns)s) FROM STDIN" % {
+            'table': table,
+            'columns': ", ".join(columns),
+        })
+        copy.put_rows(values)
+        copy.end()
+
+    def create_many(self, table: str, rows: List[dict]) -> List[int]:
+        """Insert multiple rows (dicts with identical keys) into the table, return their primary keys in input order.
+
+        Small batches get inserted with multi-row INSERTs; for large batches, primary keys get preallocated from the
+        primary key's sequence and rows get loaded with COPY."""
+
+        table = decode_object_from_bytes_if_needed(table)
+
+        if rows is None or len(rows) == 0:
+            return []
+
+        columns, values = self.__bulk_rows(rows=rows, exception_class=McCreateManyException)
+
+        primary_key_column = self.primary_key_column(table)
+        if not primary_key_column:
+            raise McCreateManyException("Primary key for table '%s' was not found" % table)
+
+        try:
+
+            if len(values) >= self.__BULK_COPY_THRESHOLD:
+
+                if primary_key_column in columns:
+                    primary_key_index = columns.index(primary_key_column)
+                    ids = [row_values[primary_key_index] for row_values in values]
+                    self.__copy_values(table=table, columns=columns, values=values)
+                    return ids
+
+                sequence = self.query(
+                    "SELECT pg_get_serial_sequence(%(table)s, %(column)s)",
+                    {'table': table, 'column': primary_key_column}
+                ).flat()[0]
+
+                if sequence is not None:
+                    ids = sorted(self.query(
+                        "SELECT nextval(%(sequence)s) FROM generate_series(1, %(count)s)",
+                        {'sequence': sequence, 'count': len(values)}
+                    ).flat())
+
+                    self.__copy_values(
+                        table=table,
+                        columns=[primary_key_column] + columns,
+                        values=[(ids[x],) + values[x] for x in range(len(values))],
+                    )
+                    return ids
+
+                log.debug("Primary key of table '%s' has no sequence, not using COPY" % table)
+
+            # RETURNING yields rows in the order of VALUES
+            return self.__insert_values(
+                sql_prefix="INSERT INTO %s (%s)" % (table, ", ".join(columns)),
+                sql_suffix="RETURNING %s" % primary_key_column,
+                values=values,
+            )
+
+        except Exception as ex:
+            raise McCreateManyException("Unable to INSERT %(count)d rows into '%(table)s': %(exception)s" % {
+                'count': len(values),
+                'table': table,
+                'exception': str(ex),
+            })
+
+    def upsert_many(self, table: str, rows: List[dict], conflict_columns: List[str]) -> List[int]:
+        """Insert multiple rows (dicts with identical keys) into the table, updating existing rows that conflict on
+        "conflict_columns" (which must be covered by a unique index); return primary keys in input order.
+
+        Small batches get upserted with multi-row INSERT ... ON CONFLICT; large batches get loaded with COPY into a
+        temporary table first."""
+
+        table = decode_object_from_bytes_if_needed(table)
+        conflict_columns = decode_object_from_bytes_if_needed(conflict_columns)
+
+        if rows is None or len(rows) == 0:
+            return []
+
+        if conflict_columns is None or len(conflict_columns) == 0:
+            raise McUpsertManyException("Conflict columns are unset.")
+
+        columns, values = self.__bulk_rows(rows=rows, exception_class=McUpsertManyException)
+
+        conflict_indexes = []
+        for conflict_column in conflict_columns:
+            if conflict_column not in columns:
+                raise McUpsertManyException("Conflict column '%s' is not present in rows." % conflict_column)
+            conflict_indexes.append(columns.index(conflict_column))
+
+        for row_values in values:
+            if any(row_values[x] is None for x in conflict_indexes):
+                raise McUpsertManyException("Conflict column values can't be NULL: %s" % str(row_values))
+
+        primary_key_column = self.primary_key_column(table)
+        if not primary_key_column:
+            raise McUpsertManyException("Primary key for table '%s' was not found" % table)
+
+        update_columns = [column for column in columns if column not in conflict_columns]
+        if len(update_columns) == 0:
+            # No-op update so that RETURNING returns conflicting rows too
+            update_columns = [conflict_columns[0]]
+
+        on_conflict = "ON CONFLICT (%(conflict_columns)s) DO UPDATE SET %(update)s" % {
+            'conflict_columns': ", ".join(conflict_columns),
+            'update': ", ".join(["%s = EXCLUDED.%s" % (column, column) for column in update_columns]),
+        }
+
+        try:
+
+            if len(values) < self.__BULK_COPY_THRESHOLD:
+                # RETURNING yields rows in the order of VALUES
+                return self.__insert_values(
+                    sql_prefix="INSERT INTO %s (%s)" % (table, ", ".join(columns)),
+                    sql_suffix="%s RETURNING %s" % (on_conflict, primary_key_column),
+                    values=values,
+                )
+
+            staging_table = '_tmp_upsert_%s' % random_string(length=16)
+            self.query("""
+                CREATE TEMPORARY TABLE %(staging_table)s AS
+                    SELECT 0::BIGINT AS mc_ordinal, %(columns)s
+                    FROM %(table)s
+                WITH NO DATA
+            """ % {'staging_table': staging_table, 'columns': ", ".join(columns), 'table': table})
+
+            try:
+                self.__copy_values(
+                    table=staging_table,
+                    columns=['mc_ordinal'] + columns,
+                    values=[(x,) + values[x] for x in range(len(values))],
+                )
+
+                ids = self.query("""
+                    WITH upserted AS (
+                        INSERT INTO %(table)s (%(columns)s)
+                            SELECT %(columns)s
+                            FROM %(staging_table)s
+                            ORDER BY mc_ordinal
+                        %(on_conflict)s
+                        RETURNING %(primary_key_column)s, %(conflict_columns)s
+                    )
+                    SELECT upserted.%(primary_key_column)s
+                    FROM %(staging_table)s AS staging
+                        INNER JOIN upserted
+                            ON %(join_condition)s
+                    ORDER BY staging.mc_ordinal
+                """ % {
+                    'table': table,
+                    'columns': ", ".join(columns),
+                    'staging_table': staging_table,
+                    'on_conflict': on_conflict,
+                    'primary_key_column': primary_key_column,
+                    'conflict_columns': ", ".join(conflict_columns),
+                    'join_condition': " AND ".join(
+                        ["staging.%s = upserted.%s" % (column, column) for column in conflict_columns]
+                    ),
+                }).flat()
+            finally:
+                try:
+                    self.query("DROP TABLE IF EXISTS %s" % staging_table)
+                except Exception as ex:
+                    # Transaction might have been aborted, temporary table will go away with it
+                    log.debug("Unable to drop staging table '%s': %s" % (staging_table, str(ex)))
+
+            return ids
+
+        except Exception as ex:
+            raise McUpsertManyException("Unable to upsert %(count)d rows into '%(table)s': %(exception)s" % {
+                'count': len(values),
+                'table': table,
+                'exception': str(ex),
+            })
+
     def select(self, table: str, what_to_select: str, condition_hash: dict = None) -> DatabaseResult:
         """SELECT chosen columns from the table that match given conditions."""
 
@@ -618,11 +1175,67 @@ class DatabaseHandler(object):
         if "submit" in insert_hash:
             del insert_hash["submit"]
 
-        row = self.select(table=table, what_to_select='*', condition_hash=insert_hash)
-        if row is not None and row.rows() > 0:
-            return row.hash()
-        else:
-            return self.create(table=table, insert_hash=insert_hash)
+        keys = []
+        values = []
+        conditions = []
+        for key, value in insert_hash.items():
+            keys.append(key)
+            values.append("%(" + key + ")s")  # "%(key)s" to be resolved by psycopg2, not Python
+            conditions.append(key + " = %(" + key + ")s")
+
+            # Cast Inline::Python's booleans to Python's booleans
+            # MC_REWRITE_TO_PYTHON: remove after porting
+            if type(value).__name__ == '_perl_obj':
+                value = bool(value)
+                insert_hash[key] = value
+
+        # Return either the existing row or the inserted one in a single statement; the INSERT won't create a duplicate
+        # for tables without unique constraints either, and ON CONFLICT handles a concurrent INSERT of the same row
+        sql = """
+            WITH existing_row AS (
+                SELECT *
+                FROM %(table)s
+                WHERE %(conditions)s
+                LIMIT 1
+            ),
+            inserted_row AS (
+                INSERT INTO %(table)s (%(keys)s)
+                    SELECT %(values)s
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_row)
+                ON CONFLICT DO NOTHING
+                RETURNING *
+            )
+            SELECT * FROM existing_row
+            UNION ALL
+            SELECT * FROM inserted_row
+        """ % {
+            'table': table,
+            'conditions': " AND ".join(conditions),
+            'keys': ", ".join(keys),
+            'values': ", ".join(values),
+        }
+
+        try:
+            row = self.query(sql, insert_hash).hash()
+        except Exception as ex:
+            raise McFindOrCreateException("Unable to find or create row in '%(table)s' with data '%(data)s': %(ex)s" % {
+                'table': table,
+                'data': str(insert_hash),
+                'ex': str(ex),
+            })
+
+        if row is not None:
+            return row
+
+        # Row got inserted by a concurrent transaction after this statement's snapshot was taken
+        row = self.select(table=table, what_to_select='*', condition_hash=insert_hash).hash()
+        if row is None:
+            raise McFindOrCreateException(
+                "Row with data '%s' conflicts with an existing row in '%s' but doesn't match it" % (
+                    str(insert_hash), table,
+                ))
+
+        return row
 
     # noinspection PyMethodMayBeStatic
     def show_error_statement(self) -> bool:
@@ -655,18 +1268,84 @@ class DatabaseHandler(object):
             log.warning("Setting self.__in_manual_transaction to the same value (%s)" % str(in_transaction))
         self.__in_manual_transaction = in_transaction
 
-    def begin(self) -> None:
-        """Begin a transaction."""
+        # Temporary tables from the previous transaction are either gone (ROLLBACK) or might have changed since
+        self.__temporary_ids_tables = {}
+        self.__savepoints = []
+
+        self.__schema_changed_in_transaction = False
+
+    def begin(self, isolation: str = None) -> None:
+        """Begin a transaction, optionally with the isolation level, e.g. "serializable"."""
+        isolation = decode_object_from_bytes_if_needed(isolation)
+
         if self.in_transaction():
             raise McBeginException("Already in transaction, can't BEGIN.")
 
-        self.query('BEGIN')
+        if isolation is None:
+            self.query('BEGIN')
+        else:
+            isolation = isolation.upper().replace('_', ' ').strip()
+            if isolation not in self.__ISOLATION_LEVELS:
+                raise McBeginException("Invalid isolation level '%s'." % isolation)
+            self.query('BEGIN ISOLATION LEVEL %s' % isolation)
+
         self.__set_in_transaction(True)
 
     def begin_work(self) -> None:
         """Begin a transaction."""
         return self.begin()
 
+    def transaction(self, retries: int = 0, isolation: str = None) -> DatabaseTransaction:
+        """Return transaction to be used as a context manager or a decorator, e.g.:
+
+            @db.transaction(retries=5, isolation='serializable')
+            def __add_story():
+                ...
+
+        Nested transactions become savepoints; decorated functions get rerun up to "retries" times on serialization
+        failures and deadlocks. See DatabaseTransaction for details."""
+        isolation = decode_object_from_bytes_if_needed(isolation)
+        return DatabaseTransaction(db=self, retries=retries, isolation=isolation)
+
+    def savepoint(self, name: str) -> None:
+        """Create a savepoint within the current transaction."""
+        name = decode_object_from_bytes_if_needed(name)
+
+        if not self.in_transaction():
+            raise McTransactionException("Not in transaction, can't create savepoint '%s'." % name)
+
+        self.query('SAVEPOINT %s' % name)
+        self.__savepoints.append((name, frozenset(self.__temporary_ids_tables.keys()),))
+
+    def __savepoint_index(self, name: str) -> int:
+        for index in range(len(self.__savepoints) - 1, -1, -1):
+            if self.__savepoints[index][0] == name:
+                return index
+        raise McTransactionException("Savepoint '%s' was not found." % name)
+
+    def rollback_to_savepoint(self, name: str) -> None:
+        """Roll back to the savepoint, forgetting temporary IDs tables that got dropped by the rollback."""
+        name = decode_object_from_bytes_if_needed(name)
+
+        index = self.__savepoint_index(name)
+        self.query('ROLLBACK TO SAVEPOINT %s' % name)
+
+        # Savepoint itself stays, savepoints created after it are gone
+        del self.__savepoints[index + 1:]
+
+        tables_at_savepoint = self.__savepoints[index][1]
+        for cache_key in list(self.__temporary_ids_tables.keys()):
+            if cache_key not in tables_at_savepoint:
+                del self.__temporary_ids_tables[cache_key]
+
+    def release_savepoint(self, name: str) -> None:
+        """Release the savepoint (and the ones created after it)."""
+        name = decode_object_from_bytes_if_needed(name)
+
+        index = self.__savepoint_index(name)
+        self.query('RELEASE SAVEPOINT %s' % name)
+        del self.__savepoints[index:]
+
     def commit(self) -> None:
         """Commit a transaction."""
         if not self.in_transaction():
@@ -773,23 +1452,61 @@ class DatabaseHandler(object):
 
         return '%s::timestamp' % self.quote(value=value)
 
-    def copy_from(self, sql: str) -> CopyFrom:
-        """Return COPY FROM helper object."""
+    def copy_from(self, sql: str, binary_types: List[str] = None) -> CopyFrom:
+        """Return COPY FROM helper object.
+
+        If "binary_types" (list of column types) is set, the COPY is expected to be in BINARY format."""
         sql = decode_object_from_bytes_if_needed(sql)
 
-        return CopyFrom(cursor=self.__db, sql=sql)
+        return CopyFrom(cursor=self.__db, sql=sql, binary_types=binary_types)
 
-    def copy_to(self, sql: str) -> CopyTo:
-        """Return COPY TO helper object."""
+    def copy_to(self, sql: str, binary_types: List[str] = None) -> CopyTo:
+        """Return COPY TO helper object.
+
+        If "binary_types" (a list of column types, e.g. ['int8', 'timestamp']) is set, COPY is to be run in BINARY
+        format and rows are to be read with iter_rows()."""
         sql = decode_object_from_bytes_if_needed(sql)
+        binary_types = decode_object_from_bytes_if_needed(binary_types)
 
-        return CopyTo(cursor=self.__db, sql=sql)
+        return CopyTo(cursor=self.__db, sql=sql, binary_types=binary_types)
 
-    def get_temporary_ids_table(self, ids: List[int], ordered: bool = False) -> str:
+    def copy_to_file(self, sql: str, file: Any) -> int:
+        """Run "COPY ... TO STDOUT" SQL, writing its output straight to a file-like object (e.g. a compressor) without
+        buffering it; return the number of rows copied."""
+        sql = decode_object_from_bytes_if_needed(sql)
+
+        return stream_copy_to(cursor=self.__db, sql=sql, file=file)
+
+    def get_temporary_ids_table(self, ids: List[int], ordered: bool = False, analyze: bool = None) -> str:
         """Get the name of a temporary table that contains all of the IDs in "ids" as an "id BIGINT" field.
 
         The database connection must be within a transaction. The temporary table is setup to be dropped at the end of
-        the current transaction. If "ordered" is True, include an "<...>_id SERIAL PRIMARY KEY" field in the table."""
+        the current transaction. If "ordered" is True, include an "<...>_id SERIAL PRIMARY KEY" field in the table.
+
+        IDs are loaded with a single COPY. The table gets ANALYZEd if "analyze" is True; if "analyze" is unset, only
+        tables with at least __TEMPORARY_IDS_TABLE_ANALYZE_THRESHOLD IDs get ANALYZEd.
+
+        Within a transaction, the same table gets returned for identical "ids" and "ordered" arguments (as long as it
+        still exists, e.g. hasn't been rolled back to a savepoint), so the table is shared with other callers and
+        must be treated as read-only: callers that want to change (INSERT into, DELETE from, ALTER, DROP, ...) the
+        table should create their own one instead."""
+
+        ids = decode_object_from_bytes_if_needed(ids)
+        ids = [int(single_id) for single_id in ids]
+        ordered = bool(ordered)
+
+        cache_key = None
+        if self.in_transaction():
+            cache_key = (ordered, tuple(ids),)
+            if cache_key in self.__temporary_ids_tables:
+                table_name = self.__temporary_ids_tables[cache_key]
+
+                # Table might have been dropped by rolling back to a savepoint
+                if self.query('SELECT to_regclass(%(table_name)s) IS NOT NULL', {'table_name': table_name}).flat()[0]:
+                    log.debug("Reusing temporary IDs table: %s" % table_name)
+                    return table_name
+
+                del self.__temporary_ids_tables[cache_key]
 
         table_name = '_tmp_ids_%s' % random_string(length=16)
 
@@ -805,11 +1522,16 @@ class DatabaseHandler(object):
         self.query(sql)
 
         copy = self.copy_from("COPY %s (id) FROM STDIN" % table_name)
-        for single_id in ids:
-            copy.put_line("%d\n" % single_id)
+        copy.put_rows([(single_id,) for single_id in ids])
         copy.end()
 
-        self.query("ANALYZE %s" % table_name)
+        if analyze is None:
+            analyze = len(ids) >= self.__TEMPORARY_IDS_TABLE_ANALYZE_THRESHOLD
+        if analyze:
+            self.query("ANALYZE %s" % table_name)
+
+        if cache_key is not None:
+            self.__temporary_ids_tables[cache_key] = table_name
 
         return table_name
 
@@ -851,20 +1573,36 @@ class DatabaseHandler(object):
             parent_lookup[parent_id] = parent
             ids.append(parent_id)
 
-        ids_table = self.get_temporary_ids_table(ids=ids)
-        sql = """
-            -- noinspection SqlResolve
-            SELECT q.*
-            FROM ( %(child_query)s ) AS q
-                -- Limit rows returned by "child_query" to only IDs from "ids"
-                INNER JOIN %(ids_table)s AS ids
-                    ON q.%(id_column)s = ids.id
-        """ % {
-            'child_query': child_query,
-            'ids_table': ids_table,
-            'id_column': id_column,
-        }
-        children = self.query(sql).hashes()
+        if len(ids) <= self.__ATTACH_CHILD_QUERY_ARRAY_THRESHOLD:
+            # Not worth creating (and ANALYZEing) a temporary table for a handful of IDs
+            sql = """
+                -- noinspection SqlResolve
+                SELECT q.*
+                FROM ( %(child_query)s ) AS q
+                    -- Limit rows returned by "child_query" to only IDs from "ids"
+                    INNER JOIN UNNEST(%%(_attach_child_query_ids)s::BIGINT[]) AS ids (id)
+                        ON q.%(id_column)s = ids.id
+            """ % {
+                'child_query': child_query,
+                'id_column': id_column,
+            }
+            children = self.query(sql, {'_attach_child_query_ids': ids}).hashes()
+
+        else:
+            ids_table = self.get_temporary_ids_table(ids=ids)
+            sql = """
+                -- noinspection SqlResolve
+                SELECT q.*
+                FROM ( %(child_query)s ) AS q
+                    -- Limit rows returned by "child_query" to only IDs from "ids"
+                    INNER JOIN %(ids_table)s AS ids
+                        ON q.%(id_column)s = ids.id
+            """ % {
+                'child_query': child_query,
+                'ids_table': ids_table,
+                'id_column': id_column,
+            }
+            children = self.query(sql).hashes()
 
         for child in children:
             child_id = child[id_column]
@@ -879,8 +1617,21 @@ class DatabaseHandler(object):
 
         return data
 
-    def query_paged_hashes(self, query: str, page: int, rows_per_page: int) -> DatabasePages:
-        """Execute the query and return a list of pages hashes."""
+    def query_paged_hashes(self,
+                           query: str,
+                           page: int,
+                           rows_per_page: int,
+                           order_by: List[str] = None,
+                           descending: bool = False,
+                           continuation_token: str = None) -> DatabasePages:
+        """Execute the query and return a list of pages hashes.
+
+        By default, the page gets fetched with LIMIT / OFFSET, so the time it takes grows with the page number.
+
+        If "order_by" (list of result columns which uniquely identify a row and are never NULL) is set, keyset
+        pagination is used instead: rows get ordered by "order_by" columns (descending if "descending" is True) and the
+        returned object's continuation_token() is to be passed as "continuation_token" together with the next "page"
+        number to seek directly past the last row of the previous page."""
 
         # MC_REWRITE_TO_PYTHON: some IDs get passed as 'str' / 'bytes'; remove after getting rid of Catalyst
         # noinspection PyTypeChecker
@@ -888,9 +1639,17 @@ class DatabaseHandler(object):
         page = int(page)
 
         query = decode_object_from_bytes_if_needed(query)
+        order_by = decode_object_from_bytes_if_needed(order_by)
+        continuation_token = decode_object_from_bytes_if_needed(continuation_token)
+
+        if isinstance(order_by, str):
+            order_by = [order_by]
 
         return DatabasePages(cursor=self.__db,
                              query=query,
                              page=page,
                              rows_per_page=rows_per_page,
-                             double_percentage_sign_marker=self.__double_percentage_sign_marker)
+                             double_percentage_sign_marker=self.__double_percentage_sign_marker,
+                             order_by=order_by,
+                             descending=bool(descending),
+                             continuation_token=continuation_token)
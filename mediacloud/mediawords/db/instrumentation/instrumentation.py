@@ -0,0 +1,235 @@
+import atexit
+import functools
+import os
+import re
+import signal
+import sys
+import threading
+from typing import Dict, List, Any, Union
+
+from mediawords.util.log import create_logger
+
+log = create_logger(__name__)
+
+# Max. number of distinct queries for which fingerprints are to be cached
+_FINGERPRINT_CACHE_SIZE = 1024
+
+# Max. number of calling sites to keep track of per fingerprint
+_MAX_CALLING_SITES = 10
+
+# Directory of "mediawords.db" package; frames from this directory are skipped when looking for the calling site
+_DB_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+_FINGERPRINT_COMMENT_REGEX = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_FINGERPRINT_STRING_REGEX = re.compile(r"[eE]?'(?:[^']|'')*'")
+_FINGERPRINT_PLACEHOLDER_REGEX = re.compile(r'%\([^)]*\)s|%s|\$\d+|\?')
+_FINGERPRINT_NUMBER_REGEX = re.compile(r'(?<![\w$.])-?\d+(?:\.\d+)?(?:[eE][+\-]?\d+)?\b')
+_FINGERPRINT_LIST_REGEX = re.compile(r'\?(?:\s*,\s*\?)+')
+_FINGERPRINT_WHITESPACE_REGEX = re.compile(r'\s+')
+
+# Instrumentation state, guarded by __lock
+__lock = threading.Lock()
+__enabled = False
+__slow_query_threshold = None
+__stats = {}
+
+# Transaction retry stats, guarded by __lock; counted even if query instrumentation is disabled as retries are rare
+__transaction_stats = {
+    'transactions': 0,
+    'retried_transactions': 0,
+    'failed_transactions': 0,
+    'retries': 0,
+    'retries_by_sqlstate': {},
+}
+
+
+@functools.lru_cache(maxsize=_FINGERPRINT_CACHE_SIZE)
+def query_fingerprint(query: str) -> str:
+    """Normalize query into a fingerprint: strip comments, replace literals and bind parameters with "?", collapse
+    lists of values and whitespace."""
+    fingerprint = _FINGERPRINT_COMMENT_REGEX.sub(' ', query)
+    fingerprint = _FINGERPRINT_STRING_REGEX.sub('?', fingerprint)
+    fingerprint = _FINGERPRINT_PLACEHOLDER_REGEX.sub('?', fingerprint)
+    fingerprint = _FINGERPRINT_NUMBER_REGEX.sub('?', fingerprint)
+    fingerprint = _FINGERPRINT_LIST_REGEX.sub('?', fingerprint)
+    fingerprint = _FINGERPRINT_WHITESPACE_REGEX.sub(' ', fingerprint)
+    return fingerprint.strip()
+
+
+def __calling_site() -> str:
+    """Return "file:line (function)" of the innermost frame outside of "mediawords.db" package."""
+    # noinspection PyProtectedMember
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_DB_PACKAGE_DIR) or os.path.basename(filename).startswith('test_'):
+            return '%s:%d (%s)' % (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+
+    # Called directly from Perl through Inline::Python
+    return '<unknown>'
+
+
+def enable_query_instrumentation(slow_query_threshold: Union[float, None] = None) -> None:
+    """Start timing queries run through DatabaseResult.
+
+    Queries get aggregated by their fingerprint (see query_fingerprint()) and calling site. Queries that take
+    "slow_query_threshold" seconds or longer (if set) get logged as fingerprints, so bind values never end up in the
+    log."""
+    global __enabled, __slow_query_threshold
+
+    with __lock:
+        __slow_query_threshold = slow_query_threshold
+        __enabled = True
+
+
+def disable_query_instrumentation() -> None:
+    """Stop timing queries; collected stats are kept until reset_query_stats()."""
+    global __enabled
+
+    with __lock:
+        __enabled = False
+
+
+def query_instrumentation_enabled() -> bool:
+    """Return True if queries are to be timed."""
+    return __enabled
+
+
+def record_query(query: str, duration: float, rows: int) -> None:
+    """Record a single query execution which took "duration" seconds and returned (or affected) "rows" rows."""
+    if not __enabled:
+        return
+
+    fingerprint = query_fingerprint(query)
+    calling_site = __calling_site()
+
+    with __lock:
+        stats = __stats.get(fingerprint, None)
+        if stats is None:
+            stats = {
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+                'rows': 0,
+                'calling_sites': {},
+            }
+            __stats[fingerprint] = stats
+
+        stats['count'] += 1
+        stats['total_time'] += duration
+        if duration > stats['max_time']:
+            stats['max_time'] = duration
+        if rows > 0:
+            stats['rows'] += rows
+
+        calling_sites = stats['calling_sites']
+        if calling_site in calling_sites or len(calling_sites) < _MAX_CALLING_SITES:
+            calling_sites[calling_site] = calling_sites.get(calling_site, 0) + 1
+
+        slow_query_threshold = __slow_query_threshold
+
+    if slow_query_threshold is not None and duration >= slow_query_threshold:
+        log.warning("Slow query (%.3f s, %d rows) at %s: %s" % (duration, rows, calling_site, fingerprint))
+
+
+def query_stats(top_n: int = 20) -> List[Dict[str, Any]]:
+    """Return aggregated stats of "top_n" query fingerprints with the biggest total time, slowest first."""
+    with __lock:
+        stats = [dict(fingerprint=fingerprint,
+                      count=fingerprint_stats['count'],
+                      total_time=fingerprint_stats['total_time'],
+                      avg_time=fingerprint_stats['total_time'] / fingerprint_stats['count'],
+                      max_time=fingerprint_stats['max_time'],
+                      rows=fingerprint_stats['rows'],
+                      calling_sites=dict(fingerprint_stats['calling_sites']))
+                 for fingerprint, fingerprint_stats in __stats.items()]
+
+    stats.sort(key=lambda s: s['total_time'], reverse=True)
+
+    return stats[:top_n]
+
+
+def reset_query_stats() -> None:
+    """Forget collected query stats."""
+    with __lock:
+        __stats.clear()
+
+
+def dump_query_stats(top_n: int = 20) -> None:
+    """Log aggregated stats of "top_n" query fingerprints with the biggest total time."""
+    stats = query_stats(top_n=top_n)
+    if len(stats) == 0:
+        log.info("No query stats have been collected.")
+        return
+
+    lines = ["Top %d queries by total time (PID %d):" % (len(stats), os.getpid())]
+    for fingerprint_stats in stats:
+        lines.append("%9.3f s total, %6d calls, %8.3f s avg, %8.3f s max, %9d rows: %s" % (
+            fingerprint_stats['total_time'],
+            fingerprint_stats['count'],
+            fingerprint_stats['avg_time'],
+            fingerprint_stats['max_time'],
+            fingerprint_stats['rows'],
+            fingerprint_stats['fingerprint'],
+        ))
+        for calling_site, count in sorted(fingerprint_stats['calling_sites'].items(), key=lambda s: -s[1]):
+            lines.append("        %6d calls from %s" % (count, calling_site))
+
+    log.info("\n".join(lines))
+
+
+def install_query_stats_dump_handlers(top_n: int = 20) -> None:
+    """Dump query stats on SIGUSR1 and at exit."""
+
+    def __dump_on_signal(signum, frame):
+        # Signal handler runs on the main thread in between any two bytecodes, possibly while record_query() is holding
+        # the lock, so dump from a separate thread which waits for the lock to get released
+        thread = threading.Thread(target=dump_query_stats, kwargs={'top_n': top_n}, name='dump_query_stats')
+        thread.daemon = True
+        thread.start()
+
+    atexit.register(dump_query_stats, top_n=top_n)
+
+    try:
+        signal.signal(signal.SIGUSR1, __dump_on_signal)
+    except ValueError as ex:
+        # Not in the main thread
+        log.warning("Unable to install SIGUSR1 handler for dumping query stats: %s" % str(ex))
+
+
+def record_transaction(retries: int, succeeded: bool) -> None:
+    """Record a (retryable) transaction which got retried "retries" times and then either succeeded or failed."""
+    with __lock:
+        __transaction_stats['transactions'] += 1
+        if retries > 0:
+            __transaction_stats['retried_transactions'] += 1
+        if not succeeded:
+            __transaction_stats['failed_transactions'] += 1
+
+
+def record_transaction_retry(sqlstate: str) -> None:
+    """Record a transaction retry caused by an error with the SQLSTATE code (e.g. '40001' for serialization failure)."""
+    with __lock:
+        __transaction_stats['retries'] += 1
+        retries_by_sqlstate = __transaction_stats['retries_by_sqlstate']
+        retries_by_sqlstate[sqlstate] = retries_by_sqlstate.get(sqlstate, 0) + 1
+
+
+def transaction_stats() -> Dict[str, Any]:
+    """Return transaction retry stats: number of "transactions", "retried_transactions" and "failed_transactions", and
+    number of "retries" in total and per SQLSTATE code ("retries_by_sqlstate")."""
+    with __lock:
+        stats = dict(__transaction_stats)
+        stats['retries_by_sqlstate'] = dict(__transaction_stats['retries_by_sqlstate'])
+    return stats
+
+
+def reset_transaction_stats() -> None:
+    """Forget collected transaction retry stats."""
+    with __lock:
+        __transaction_stats['transactions'] = 0
+        __transaction_stats['retried_transactions'] = 0
+        __transaction_stats['failed_transactions'] = 0
+        __transaction_stats['retries'] = 0
+        __transaction_stats['retries_by_sqlstate'].clear()
@@ -0,0 +1,122 @@
+import atexit
+import logging
+import os
+import signal
+import time
+
+from mediawords.db import connect_to_db
+import mediawords.db.instrumentation.instrumentation as instrumentation
+from mediawords.db.instrumentation.instrumentation import *
+
+
+def test_query_fingerprint():
+    assert query_fingerprint("SELECT * FROM stories WHERE stories_id = 123") == \
+        "SELECT * FROM stories WHERE stories_id = ?"
+
+    assert query_fingerprint("""
+        -- Comment
+        SELECT *
+        FROM stories
+        WHERE title = 'Foo''s bar' /* inline comment */
+          AND stories_id IN (1, 2, 3)
+          AND media_id = %(media_id)s
+          AND feeds_id = %s
+          AND url = ?
+          AND guid = $1
+    """) == "SELECT * FROM stories WHERE title = ? AND stories_id IN (?) AND media_id = ? AND feeds_id = ? " \
+            "AND url = ? AND guid = ?"
+
+    # Numbers in identifiers stay intact
+    assert query_fingerprint("SELECT md5(title) FROM _tmp_ids_1a2b") == "SELECT md5(title) FROM _tmp_ids_1a2b"
+
+
+def test_record_query(caplog):
+    reset_query_stats()
+
+    # Nothing gets recorded while disabled
+    record_query(query="SELECT 1", duration=1.0, rows=1)
+    assert query_stats() == []
+
+    enable_query_instrumentation(slow_query_threshold=0.5)
+    try:
+        record_query(query="SELECT * FROM foo WHERE bar = 'secret'", duration=0.1, rows=2)
+        record_query(query="SELECT * FROM foo WHERE bar = 'another secret'", duration=0.2, rows=3)
+        assert 'secret' not in caplog.text
+
+        with caplog.at_level(logging.WARNING):
+            record_query(query="SELECT * FROM baz WHERE password = 'secret'", duration=1.5, rows=0)
+        assert 'Slow query' in caplog.text
+        assert 'SELECT * FROM baz WHERE password = ?' in caplog.text
+        assert 'secret' not in caplog.text
+
+        stats = query_stats()
+        assert len(stats) == 2
+        assert stats[0]['fingerprint'] == 'SELECT * FROM baz WHERE password = ?'
+        assert stats[1]['fingerprint'] == 'SELECT * FROM foo WHERE bar = ?'
+        assert stats[1]['count'] == 2
+        assert stats[1]['rows'] == 5
+        assert abs(stats[1]['total_time'] - 0.3) < 0.0001
+        assert stats[1]['max_time'] == 0.2
+
+        # Calling site is this test
+        assert list(stats[1]['calling_sites'].keys())[0].endswith('(test_record_query)')
+
+        assert len(query_stats(top_n=1)) == 1
+
+        dump_query_stats()
+
+    finally:
+        disable_query_instrumentation()
+        reset_query_stats()
+
+
+def test_query_stats_dump_on_signal(caplog):
+    reset_query_stats()
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+
+    enable_query_instrumentation()
+    install_query_stats_dump_handlers()
+    try:
+        record_query(query="SELECT * FROM signal_test", duration=0.1, rows=1)
+
+        with caplog.at_level(logging.INFO):
+
+            # Signal that arrives while the lock is being held doesn't deadlock the process
+            with getattr(instrumentation, '__lock'):
+                os.kill(os.getpid(), signal.SIGUSR1)
+                time.sleep(0.1)
+                assert 'SELECT * FROM signal_test' not in caplog.text
+
+            for _ in range(100):
+                if 'SELECT * FROM signal_test' in caplog.text:
+                    break
+                time.sleep(0.05)
+            assert 'SELECT * FROM signal_test' in caplog.text
+
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+        atexit.unregister(dump_query_stats)
+        disable_query_instrumentation()
+        reset_query_stats()
+
+
+def test_database_queries_get_recorded():
+    db = connect_to_db(label='test')
+
+    reset_query_stats()
+    enable_query_instrumentation()
+    try:
+        db.query("SELECT * FROM generate_series(1, %(count)s)", {'count': 10}).hashes()
+        db.query("SELECT * FROM generate_series(1, %(count)s)", {'count': 5}).hashes()
+
+        stats = query_stats()
+        assert len(stats) == 1
+        assert stats[0]['fingerprint'] == 'SELECT * FROM generate_series(?)'
+        assert stats[0]['count'] == 2
+        assert stats[0]['rows'] == 15
+        assert list(stats[0]['calling_sites'].keys())[0].endswith('(test_database_queries_get_recorded)')
+
+    finally:
+        disable_query_instrumentation()
+        reset_query_stats()
+        db.disconnect()
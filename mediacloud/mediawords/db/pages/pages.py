@@ -1,27 +1,68 @@
+import base64
+import json
+import re
+
 from psycopg2.extras import DictCursor
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Union
 
 from mediawords.db.exceptions.handler import McQueryPagedHashesException
 from mediawords.db.result.result import DatabaseResult
 from mediawords.util.pages import Pages
 from mediawords.util.perl import convert_dbd_pg_arguments_to_psycopg2_format, decode_object_from_bytes_if_needed
 
+# Ordering column names that are allowed to be used in keyset pagination
+_KEYSET_COLUMN_REGEX = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+def _encode_continuation_token(key: List[Any]) -> str:
+    """Encode last seen row's key into an opaque, URL-safe continuation token."""
+    # Values that JSON doesn't know about (dates, timestamps, decimals) get compared as literals by PostgreSQL
+    key_json = json.dumps(key, default=str)
+    return base64.urlsafe_b64encode(key_json.encode('utf-8')).decode('utf-8')
+
+
+def _decode_continuation_token(token: str, key_size: int) -> List[Any]:
+    """Decode continuation token into last seen row's key."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')).decode('utf-8'))
+    except Exception as ex:
+        raise McQueryPagedHashesException("Invalid continuation token '%s': %s" % (token, str(ex)))
+
+    if not isinstance(key, list) or len(key) != key_size:
+        raise McQueryPagedHashesException(
+            "Continuation token '%s' doesn't match %d ordering columns." % (token, key_size)
+        )
+
+    return key
+
 
 class DatabasePages(object):
     __list = None
     __pager = None
+    __continuation_token = None
 
     def __init__(self, cursor: DictCursor, query: str, page: int, rows_per_page: int,
-                 double_percentage_sign_marker: str):
+                 double_percentage_sign_marker: str, order_by: List[str] = None, descending: bool = False,
+                 continuation_token: str = None):
 
         query = decode_object_from_bytes_if_needed(query)
 
-        self.__execute(cursor=cursor,
-                       query=query,
-                       page=page,
-                       rows_per_page=rows_per_page,
-                       double_percentage_sign_marker=double_percentage_sign_marker)
+        if order_by is None:
+            self.__execute(cursor=cursor,
+                           query=query,
+                           page=page,
+                           rows_per_page=rows_per_page,
+                           double_percentage_sign_marker=double_percentage_sign_marker)
+        else:
+            self.__execute_keyset(cursor=cursor,
+                                  query=query,
+                                  page=page,
+                                  rows_per_page=rows_per_page,
+                                  double_percentage_sign_marker=double_percentage_sign_marker,
+                                  order_by=order_by,
+                                  descending=descending,
+                                  continuation_token=continuation_token)
 
     def __execute(self, cursor: DictCursor, query: str, page: int, rows_per_page: int,
                   double_percentage_sign_marker: str) -> None:
@@ -49,12 +90,87 @@ class DatabasePages(object):
 
         hashes = rs.hashes()
 
+        self.__set_page(hashes=hashes, page=page, rows_per_page=rows_per_page)
+
+    def __execute_keyset(self, cursor: DictCursor, query: str, page: int, rows_per_page: int,
+                         double_percentage_sign_marker: str, order_by: List[str], descending: bool,
+                         continuation_token: Union[str, None]) -> None:
+        """Fetch the page by seeking past the last seen key instead of skipping over rows with OFFSET.
+
+        If "continuation_token" is unset, "page" gets fetched with OFFSET (e.g. when jumping to an arbitrary page in
+        page number UIs), but rows still get ordered by "order_by" so that the returned token stays valid."""
+
+        if page < 1:
+            raise McQueryPagedHashesException('Page must be 1 or bigger.')
+        if len(order_by) == 0:
+            raise McQueryPagedHashesException('At least one ordering column is required.')
+        for column in order_by:
+            if not _KEYSET_COLUMN_REGEX.match(column):
+                raise McQueryPagedHashesException("Invalid ordering column '%s'." % column)
+
+        direction = 'DESC' if descending else 'ASC'
+        comparison = '<' if descending else '>'
+
+        key_columns = ', '.join(['q.%s' % column for column in order_by])
+        params = {}
+
+        where_clause = ''
+        offset = 0
+        if continuation_token is not None:
+            last_key = _decode_continuation_token(token=continuation_token, key_size=len(order_by))
+            key_placeholders = []
+            for index, value in enumerate(last_key):
+                params['_keyset_%d' % index] = value
+                key_placeholders.append('%%(_keyset_%d)s' % index)
+
+            # Row-wise comparison lets PostgreSQL use a multicolumn index on the ordering columns
+            where_clause = 'WHERE ( %s ) %s ( %s )' % (key_columns, comparison, ', '.join(key_placeholders))
+        else:
+            offset = (page - 1) * rows_per_page
+
+        query = """
+            SELECT q.*
+            FROM ( %(original_query)s ) AS q
+            %(where_clause)s
+            ORDER BY %(order_by)s
+            LIMIT ( %(rows_per_page)d + 1 ) OFFSET %(offset)d
+        """ % {
+            'original_query': query,
+            'where_clause': where_clause,
+            'order_by': ', '.join(['q.%s %s' % (column, direction) for column in order_by]),
+            'rows_per_page': rows_per_page,
+            'offset': offset,
+        }
+
+        rs = DatabaseResult(cursor=cursor,
+                            query_args=(query, params,),
+                            double_percentage_sign_marker=double_percentage_sign_marker)
+
+        hashes = rs.hashes()
+
+        one_more_page = self.__set_page(hashes=hashes, page=page, rows_per_page=rows_per_page)
+
+        if one_more_page:
+            last_row = hashes[-1]
+            last_key = []
+            for column in order_by:
+                if column not in last_row:
+                    raise McQueryPagedHashesException("Ordering column '%s' is not in the query's result." % column)
+                if last_row[column] is None:
+                    raise McQueryPagedHashesException("Ordering column '%s' is NULL." % column)
+                last_key.append(last_row[column])
+            self.__continuation_token = _encode_continuation_token(last_key)
+
+    def __set_page(self, hashes: List[Dict[str, Any]], page: int, rows_per_page: int) -> bool:
+        """Truncate fetched "rows_per_page + 1" rows, set up the pager; return True if there's one more page."""
+
         # Truncate
         one_more_page = False
         if len(hashes) > rows_per_page:
             one_more_page = True
             del hashes[rows_per_page:]
 
+        offset = (page - 1) * rows_per_page
         hashes_size = offset + len(hashes)
         if one_more_page:
             hashes_size += 1
@@ -64,8 +180,14 @@ class DatabasePages(object):
         self.__list = hashes
         self.__pager = pager
 
+        return one_more_page
+
     def list(self) -> List[Dict[str, Any]]:
         return self.__list
 
     def pager(self) -> Pages:
         return self.__pager
+
+    def continuation_token(self) -> Union[str, None]:
+        """Return token for fetching the next page in keyset pagination mode, or None if this is the last page."""
+        return self.__continuation_token
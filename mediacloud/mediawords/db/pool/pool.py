@@ -0,0 +1,323 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Any
+
+from mediawords.db.exceptions.handler import McDatabaseHandlerException
+from mediawords.db.handler import DatabaseHandler
+from mediawords.util.log import create_logger
+
+log = create_logger(__name__)
+
+
+class McDatabaseHandlerPoolException(McDatabaseHandlerException):
+    """Connection pool exception."""
+    pass
+
+
+class McDatabaseHandlerPoolTimeoutException(McDatabaseHandlerPoolException):
+    """checkout() timed out while waiting for a free handler."""
+    pass
+
+
+class PooledDatabaseHandler(object):
+    """Database handler checked out from the pool.
+
+    Forwards everything to the pooled handler until it gets disconnect()ed. Every checkout gets its own instance, so
+    once the holder returns the handler to the pool, its further disconnect()s are no-ops and can't return the handler
+    (which by then might have been checked out by someone else) to the pool for the second time; any other use of the
+    released instance raises an exception."""
+
+    # Pooled database handler, None after disconnect()
+    __db = None
+
+    def __init__(self, db: DatabaseHandler):
+        self.__db = db
+
+    def __getattr__(self, name: str) -> Any:
+        if self.__db is None:
+            raise McDatabaseHandlerPoolException("Database handler has already been returned to the pool.")
+        return getattr(self.__db, name)
+
+    def disconnect(self) -> None:
+        """Return the handler to the pool; do nothing if it has already been returned."""
+        if self.__db is None:
+            log.debug("Handler is already back in the pool")
+            return
+
+        db = self.__db
+        self.__db = None
+        db.disconnect()
+
+
+class DatabaseHandlerPool(object):
+    """Bounded pool of database handlers.
+
+    Handlers get created by the "connect" callback, so they arrive fully set up (schema version checked, session
+    variables set). Checked out handlers return to the pool on disconnect(); after a fork(), the child process starts
+    with an empty pool instead of sharing the parent's sockets."""
+
+    # Callback which creates a new, fully set up database handler
+    __connect = None
+
+    # Callback which resets session state of a handler that is being returned to the pool
+    __reset = None
+
+    # Max. number of handlers (both idle and checked out) at any given time
+    __max_size = None
+
+    # Max. age of a handler (in seconds) after which it gets closed instead of reused
+    __max_age = None
+
+    # Max. time (in seconds) to wait for a free handler
+    __checkout_timeout = None
+
+    # Idle handler time (in seconds) after which the handler gets pinged before handing it out
+    __health_check_interval = None
+
+    # PID that has created the handlers currently in the pool
+    __pid = None
+
+    # Lock + condition for waiting on handlers to become available
+    __condition = None
+
+    # Idle handlers; list of (handler, created_at, released_at) tuples, most recently released at the end
+    __idle = None
+
+    # Checked out handlers; id(handler) -> created_at
+    __in_use = None
+
+    # Statistics counters
+    __stats = None
+
+    def __init__(self,
+                 connect: Callable[[], DatabaseHandler],
+                 max_size: int = 8,
+                 max_age: int = 60 * 60,
+                 checkout_timeout: int = 60,
+                 health_check_interval: int = 30,
+                 reset: Callable[[DatabaseHandler], None] = None):
+
+        if max_size < 1:
+            raise McDatabaseHandlerPoolException("Pool size must be 1 or bigger.")
+
+        self.__connect = connect
+        self.__reset = reset
+        self.__max_size = max_size
+        self.__max_age = max_age
+        self.__checkout_timeout = checkout_timeout
+        self.__health_check_interval = health_check_interval
+
+        self.__condition = threading.Condition()
+        self.__reset_state()
+
+    def __reset_state(self) -> None:
+        """(Re)initialize pool state for the current PID."""
+        self.__pid = os.getpid()
+        self.__idle = []
+        self.__in_use = {}
+        self.__stats = {
+            'created': 0,
+            'checkouts': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'last_wait_time': 0.0,
+        }
+
+    def __reset_if_forked(self) -> None:
+        """Forget handlers inherited from the parent process.
+
+        Handlers don't get disconnect()ed because that would terminate the parent's sessions too."""
+        if self.__pid != os.getpid():
+            log.debug("PID changed from %d to %d, resetting connection pool" % (self.__pid, os.getpid()))
+            self.__condition = threading.Condition()
+            self.__reset_state()
+
+    def __size(self) -> int:
+        return len(self.__idle) + len(self.__in_use)
+
+    @staticmethod
+    def __close(db: DatabaseHandler) -> None:
+        """Actually close the handler's connection."""
+        db.set_release_callback(None)
+        try:
+            db.disconnect()
+        except Exception as ex:
+            log.debug("Error while closing pooled database handler: %s" % str(ex))
+
+    def __is_healthy(self, db: DatabaseHandler, released_at: float) -> bool:
+        """Ping the handler if it has been sitting idle for a while."""
+        if time.time() - released_at < self.__health_check_interval:
+            return True
+        try:
+            db.query('SELECT 1')
+        except Exception as ex:
+            log.warning("Pooled database handler failed health check: %s" % str(ex))
+            return False
+        return True
+
+    def checkout(self) -> 'PooledDatabaseHandler':
+        """Return a database handler from the pool, creating one if needed.
+
+        Blocks up to "checkout_timeout" seconds if the pool is exhausted. Idle handlers get health checked outside of
+        the lock so that a slow connection doesn't hold up other checkouts."""
+
+        start_time = time.time()
+
+        while True:
+
+            with self.__condition:
+                self.__reset_if_forked()
+
+                idle = None
+                while True:
+
+                    # Reuse the most recently released handler
+                    if len(self.__idle) > 0:
+                        idle = self.__idle.pop()
+                        break
+
+                    if self.__size() < self.__max_size:
+                        break
+
+                    remaining = self.__checkout_timeout - (time.time() - start_time)
+                    if remaining <= 0:
+                        self.__stats['timeouts'] += 1
+                        raise McDatabaseHandlerPoolTimeoutException(
+                            "Timed out after %d seconds while waiting for a database handler (pool size: %d)" % (
+                                self.__checkout_timeout, self.__max_size,
+                            ))
+                    self.__condition.wait(timeout=remaining)
+
+                if idle is not None:
+                    # Keep the handler counted towards the pool size while checking it outside of the lock
+                    db, created_at, released_at = idle
+                    self.__in_use[id(db)] = created_at
+                else:
+                    # Reserve the slot while connecting outside of the lock
+                    placeholder = object()
+                    self.__in_use[id(placeholder)] = time.time()
+
+            if idle is None:
+                break
+
+            if time.time() - created_at >= self.__max_age:
+                stat = 'recycled'
+            elif not self.__is_healthy(db=db, released_at=released_at):
+                stat = 'discarded'
+            else:
+                with self.__condition:
+                    return self.__hand_out(db=db, created_at=created_at, start_time=start_time)
+
+            self.__close(db)
+
+            with self.__condition:
+                self.__in_use.pop(id(db), None)
+                self.__stats[stat] += 1
+                self.__condition.notify()
+
+        try:
+            db = self.__connect()
+        except Exception:
+            with self.__condition:
+                del self.__in_use[id(placeholder)]
+                self.__condition.notify()
+            raise
+
+        with self.__condition:
+            del self.__in_use[id(placeholder)]
+            self.__stats['created'] += 1
+            return self.__hand_out(db=db, created_at=time.time(), start_time=start_time)
+
+    def __hand_out(self, db: DatabaseHandler, created_at: float, start_time: float) -> 'PooledDatabaseHandler':
+        """Mark handler as checked out and record wait time; must be called with the lock held."""
+        self.__in_use[id(db)] = created_at
+
+        wait_time = time.time() - start_time
+        self.__stats['checkouts'] += 1
+        self.__stats['total_wait_time'] += wait_time
+        self.__stats['last_wait_time'] = wait_time
+        if wait_time > self.__stats['max_wait_time']:
+            self.__stats['max_wait_time'] = wait_time
+
+        db.set_release_callback(self.checkin)
+
+        return PooledDatabaseHandler(db=db)
+
+    def checkin(self, db: DatabaseHandler) -> None:
+        """Return the handler back to the pool (called by handler's disconnect())."""
+
+        with self.__condition:
+            if self.__pid == os.getpid() and any(idle_db is db for idle_db, _, _ in self.__idle):
+                log.debug("Handler is already back in the pool")
+                return
+
+            if self.__pid != os.getpid():
+                # Handler from before fork(); closing it would terminate the parent's session too
+                log.debug("Handler was checked out before fork(), dropping it without closing")
+                db.set_release_callback(None)
+                return
+
+            if id(db) not in self.__in_use:
+                # Handler from some other pool
+                log.debug("Handler is not checked out from this pool, closing it")
+                self.__close(db)
+                return
+
+            created_at = self.__in_use.pop(id(db))
+
+        keep = True
+        if time.time() - created_at >= self.__max_age:
+            keep = False
+            recycled = True
+        else:
+            recycled = False
+            try:
+                if db.in_transaction():
+                    log.warning("Handler returned to the pool while in transaction, rolling back")
+                    db.rollback()
+                if self.__reset is not None:
+                    self.__reset(db)
+            except Exception as ex:
+                log.warning("Unable to reset pooled database handler: %s" % str(ex))
+                keep = False
+
+        if not keep:
+            self.__close(db)
+
+        with self.__condition:
+            if keep:
+                self.__idle.append((db, created_at, time.time(),))
+            elif recycled:
+                self.__stats['recycled'] += 1
+            else:
+                self.__stats['discarded'] += 1
+            self.__condition.notify()
+
+    def close(self) -> None:
+        """Close all idle handlers; handlers that are checked out get closed when they get returned."""
+        with self.__condition:
+            self.__reset_if_forked()
+            idle = self.__idle
+            self.__idle = []
+            for db, _, _ in idle:
+                self.__close(db)
+            self.__condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool size and checkout wait time metrics."""
+        with self.__condition:
+            self.__reset_if_forked()
+            stats = self.__stats.copy()
+            stats['max_size'] = self.__max_size
+            stats['size'] = self.__size()
+            stats['idle'] = len(self.__idle)
+            stats['in_use'] = len(self.__in_use)
+            if stats['checkouts'] > 0:
+                stats['avg_wait_time'] = stats['total_wait_time'] / stats['checkouts']
+            else:
+                stats['avg_wait_time'] = 0.0
+        return stats
@@ -0,0 +1,155 @@
+import os
+import time
+
+import pytest
+
+from mediawords.db import connect_to_db, connection_pool
+from mediawords.db.pool.pool import *
+
+
+def test_connect_to_db_pooled():
+    pool = connection_pool(label='test')
+    pool.close()
+
+    db = connect_to_db(label='test', pooled=True)
+    database_name = db.query('SELECT current_database()').hash()
+    assert database_name['current_database'] == 'mediacloud_test'
+    backend_pid = db.query('SELECT pg_backend_pid()').flat()[0]
+    db.disconnect()
+
+    # Same connection gets reused
+    db = connect_to_db(label='test', pooled=True)
+    assert db.query('SELECT pg_backend_pid()').flat()[0] == backend_pid
+
+    stats = pool.stats()
+    assert stats['in_use'] == 1
+    assert stats['idle'] == 0
+    assert stats['checkouts'] >= 2
+
+    db.disconnect()
+    assert pool.stats()['idle'] == 1
+
+    # Disconnecting twice doesn't put the handler into the pool twice
+    db.disconnect()
+    assert pool.stats()['idle'] == 1
+
+    pool.close()
+    assert pool.stats()['size'] == 0
+
+
+def test_pool_rollback_on_checkin():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=1)
+
+    db = pool.checkout()
+    db.begin()
+    db.query('CREATE TEMPORARY TABLE pool_test (id INT)')
+    db.disconnect()
+
+    db = pool.checkout()
+    assert db.in_transaction() is False
+    assert len(db.query("SELECT 1 FROM pg_class WHERE relname = 'pool_test'").flat()) == 0
+    db.disconnect()
+
+    pool.close()
+
+
+def test_pool_max_size():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=1, checkout_timeout=1)
+
+    db = pool.checkout()
+    with pytest.raises(McDatabaseHandlerPoolTimeoutException):
+        pool.checkout()
+    assert pool.stats()['timeouts'] == 1
+
+    db.disconnect()
+    db = pool.checkout()
+    db.disconnect()
+
+    pool.close()
+
+
+def test_pool_max_age():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=2, max_age=0)
+
+    db = pool.checkout()
+    db.disconnect()
+
+    stats = pool.stats()
+    assert stats['idle'] == 0
+    assert stats['recycled'] == 1
+
+    pool.close()
+
+
+def test_pool_stale_disconnect():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=1)
+
+    old_db = pool.checkout()
+    backend_pid = old_db.query('SELECT pg_backend_pid()').flat()[0]
+    old_db.disconnect()
+
+    new_db = pool.checkout()
+    assert new_db.query('SELECT pg_backend_pid()').flat()[0] == backend_pid
+
+    # Previous holder's disconnect() doesn't return the handler that's now checked out by someone else
+    old_db.disconnect()
+    assert pool.stats()['in_use'] == 1
+    assert pool.stats()['idle'] == 0
+    with pytest.raises(McDatabaseHandlerPoolException):
+        old_db.query('SELECT 1')
+
+    new_db.disconnect()
+    assert pool.stats()['idle'] == 1
+
+    pool.close()
+
+
+def test_pool_health_check():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=1, health_check_interval=0)
+
+    db = pool.checkout()
+    backend_pid = db.query('SELECT pg_backend_pid()').flat()[0]
+    db.disconnect()
+
+    # Idle handler whose connection has been terminated gets replaced
+    admin_db = connect_to_db(label='test')
+    admin_db.query('SELECT pg_terminate_backend(%(pid)s)', {'pid': backend_pid})
+    for _ in range(100):
+        if len(admin_db.query('SELECT 1 FROM pg_stat_activity WHERE pid = %(pid)s', {'pid': backend_pid}).flat()) == 0:
+            break
+        time.sleep(0.05)
+    admin_db.disconnect()
+
+    db = pool.checkout()
+    assert db.query('SELECT pg_backend_pid()').flat()[0] != backend_pid
+    assert pool.stats()['discarded'] == 1
+    assert pool.stats()['size'] == 1
+    db.disconnect()
+
+    pool.close()
+
+
+def test_pool_disconnect_after_fork():
+    pool = DatabaseHandlerPool(connect=lambda: connect_to_db(label='test'), max_size=1)
+
+    db = pool.checkout()
+    backend_pid = db.query('SELECT pg_backend_pid()').flat()[0]
+
+    pid = os.fork()
+    if pid == 0:
+        # Child's disconnect() of the inherited handler mustn't close the parent's session
+        exit_code = 0
+        try:
+            db.disconnect()
+        except Exception:
+            exit_code = 1
+        os._exit(exit_code)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    assert db.query('SELECT pg_backend_pid()').flat()[0] == backend_pid
+    db.disconnect()
+    assert pool.stats()['idle'] == 1
+
+    pool.close()
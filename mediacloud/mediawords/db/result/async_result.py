@@ -0,0 +1,94 @@
+import itertools
+import pprint
+import re
+from typing import Any, Dict, List, Union
+
+from mediawords.db.exceptions.result import McDatabaseResultTextException
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+# Command status tag ("INSERT 0 5", "UPDATE 3", "SELECT 2", ...) with the number of affected rows at the end
+_STATUS_ROW_COUNT_REGEX = re.compile(r'^\w+(?: \d+)? (\d+)$')
+
+
+class AsyncDatabaseResult(object):
+    """Wrapper around SQL query result fetched by AsyncDatabaseHandler.
+
+    Mirrors DatabaseResult's interface; all rows are fetched by the time the result gets returned, so none of the
+    methods have to be awaited."""
+
+    # asyncpg's Record objects which haven't been read yet
+    __records = None
+
+    # Index of the next record to be read
+    __position = 0
+
+    # Column names
+    __columns = None
+
+    # Number of affected rows
+    __row_count = -1
+
+    def __init__(self, records: List[Any], columns: List[str], status: Union[str, None]):
+        self.__records = records
+        self.__position = 0
+        self.__columns = columns
+
+        self.__row_count = -1
+        if status is not None:
+            match = _STATUS_ROW_COUNT_REGEX.match(status)
+            if match:
+                self.__row_count = int(match.group(1))
+
+    def columns(self) -> List[str]:
+        """Return a list of column names."""
+        return list(self.__columns)
+
+    def rows(self) -> int:
+        """Return the number of rows affected by the command, or -1 if the number of rows is not known or not
+        available."""
+        return self.__row_count
+
+    def __fetchone(self) -> Any:
+        if self.__position >= len(self.__records):
+            return None
+        record = self.__records[self.__position]
+        self.__position += 1
+        return record
+
+    def __fetchall(self) -> List[Any]:
+        records = self.__records[self.__position:]
+        self.__position = len(self.__records)
+        return records
+
+    def array(self) -> List[Any]:
+        """Return a list of a single row."""
+        record = self.__fetchone()
+        if record is not None:
+            return list(record.values())
+        else:
+            return None
+
+    def hash(self) -> Dict[str, Any]:
+        """Return a dict of a single row, keyed by column name"""
+        record = self.__fetchone()
+        if record is not None:
+            return dict(record.items())
+        else:
+            return None
+
+    def flat(self) -> List[Any]:
+        """Return a flattened list of all returned (remaining) rows."""
+        return list(itertools.chain.from_iterable(record.values() for record in self.__fetchall()))
+
+    def hashes(self) -> List[Dict[str, Any]]:
+        """Return a list of dicts of all returned (remaining) rows, keyed by column name."""
+        return [dict(record.items()) for record in self.__fetchall()]
+
+    def text(self, text_type: str = 'neat') -> str:
+        """Return a string of all returned (remaining) rows with a simple text representation of the data."""
+
+        text_type = decode_object_from_bytes_if_needed(text_type)
+
+        if text_type != 'neat':
+            raise McDatabaseResultTextException("Formatting types other than 'neat' are not supported.")
+        return pprint.pformat(self.hashes(), indent=4)
@@ -0,0 +1,247 @@
+import array
+import math
+import struct
+from typing import Any, Dict, Iterable, List, Sequence, Union
+
+from mediawords.db.exceptions.result import McDatabaseResultException
+
+# PostgreSQL type OID -> (array.array's typecode, native NumPy dtype of the same size, binary COPY struct format,
+# binary COPY NumPy dtype)
+_TYPED_COLUMNS = {
+    16: ('B', 'u1', '?', 'u1'),  # bool
+    20: ('q', 'i8', 'q', '>i8'),  # int8
+    21: ('h', 'i2', 'h', '>i2'),  # int2
+    23: ('i', 'i4', 'i', '>i4'),  # int4
+    26: ('I', 'u4', 'I', '>u4'),  # oid
+    700: ('f', 'f4', 'f', '>f4'),  # float4
+    701: ('d', 'f8', 'd', '>f8'),  # float8
+}
+
+# PostgreSQL type OIDs of strings which binary COPY sends as UTF-8
+_TEXT_COLUMNS = {
+    18,  # char
+    19,  # name
+    25,  # text
+    1042,  # bpchar
+    1043,  # varchar
+}
+
+# Binary COPY signature
+_BINARY_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+
+def binary_copy_supported_types(type_oids: List[int]) -> bool:
+    """Return True if columns of the types can be decoded from binary COPY by binary_copy_to_columns()."""
+    return all(type_oid in _TYPED_COLUMNS or type_oid in _TEXT_COLUMNS for type_oid in type_oids)
+
+
+class ColumnarResultBuilder(object):
+    """Accumulates rows into per-column arrays.
+
+    Columns of integer, floating point and boolean types go into typed array.array objects (or NumPy arrays);
+    columns of other types are kept as lists of Python values. Floating point NULLs become NaNs; NULLs in integer and
+    boolean columns are not representable and raise an exception."""
+
+    # Column names
+    __names = None
+
+    # Column type OIDs
+    __type_oids = None
+
+    # Column values; array.array objects for typed columns, lists for others
+    __columns = None
+
+    def __init__(self, names: List[str], type_oids: List[int]):
+        if len(names) != len(type_oids):
+            raise McDatabaseResultException("Column names and types don't match.")
+        self.__names = names
+        self.__type_oids = type_oids
+        self.__columns = []
+        for type_oid in type_oids:
+            if type_oid in _TYPED_COLUMNS:
+                self.__columns.append(array.array(_TYPED_COLUMNS[type_oid][0]))
+            else:
+                self.__columns.append([])
+
+    def __len__(self) -> int:
+        return len(self.__columns[0]) if len(self.__columns) > 0 else 0
+
+    def add_rows(self, rows: Sequence[Sequence[Any]]) -> None:
+        """Add rows (sequences of values in column order)."""
+        if len(rows) == 0:
+            return
+
+        for index, values in enumerate(zip(*rows)):
+            self.add_column_values(index, values)
+
+    def add_column_values(self, index: int, values: Sequence[Any]) -> None:
+        """Add values of a single column; all columns are to get the same number of values."""
+        column = self.__columns[index]
+        if isinstance(column, list):
+            column.extend(values)
+            return
+
+        # array.array accepts only numbers
+        if None in values:
+            if column.typecode in {'f', 'd'}:
+                values = [math.nan if value is None else value for value in values]
+            else:
+                raise McDatabaseResultException(
+                    "Column '%s' contains NULLs which can't be stored in an integer / boolean array; "
+                    "use COALESCE() to replace them." % self.__names[index]
+                )
+
+        column.extend(values)
+
+    def add_typed_array(self, index: int, values: array.array) -> None:
+        """Add array of values of a single typed column."""
+        self.__columns[index].extend(values)
+
+    def columns(self, use_numpy: bool = False) -> Dict[str, Union[array.array, List[Any], Any]]:
+        """Return dictionary of column names and column values; if "use_numpy" is True, values are NumPy arrays (typed
+        ones for typed columns, "object" arrays for others)."""
+
+        if not use_numpy:
+            return dict(zip(self.__names, self.__columns))
+
+        # NumPy is slow to import and only needed by analytics code
+        import numpy
+
+        columns = {}
+        for name, type_oid, values in zip(self.__names, self.__type_oids, self.__columns):
+            if type_oid in _TYPED_COLUMNS:
+                dtype = numpy.dtype(_TYPED_COLUMNS[type_oid][1])
+                column = numpy.frombuffer(values, dtype=dtype) if len(values) > 0 else numpy.array([], dtype=dtype)
+                if type_oid == 16:
+                    column = column.astype(numpy.bool_)
+            else:
+                column = numpy.empty(len(values), dtype=object)
+                column[:] = values
+            columns[name] = column
+        return columns
+
+
+def __binary_header_length(data: Union[bytes, memoryview]) -> int:
+    """Return length of the binary COPY header."""
+    if bytes(data[:len(_BINARY_COPY_SIGNATURE)]) != _BINARY_COPY_SIGNATURE:
+        raise McDatabaseResultException("Invalid binary COPY signature.")
+    (_, extension_length) = struct.unpack_from('!ii', data, len(_BINARY_COPY_SIGNATURE))
+    return len(_BINARY_COPY_SIGNATURE) + 8 + extension_length
+
+
+def __decode_fixed_width_tuples(builder: ColumnarResultBuilder,
+                                body: memoryview,
+                                type_oids: List[int],
+                                row_count: int) -> bool:
+    """Decode tuples of fixed width columns with no NULLs in a single vectorized pass; return False if that's not
+    possible (some of the values are NULLs)."""
+
+    if not all(type_oid in _TYPED_COLUMNS for type_oid in type_oids):
+        return False
+
+    tuple_format = '!h' + ''.join('i' + _TYPED_COLUMNS[type_oid][2] for type_oid in type_oids)
+    tuple_size = struct.calcsize(tuple_format)
+
+    # NULLs don't have any data so every NULL makes the body shorter
+    if len(body) != tuple_size * row_count:
+        return False
+
+    # NumPy is slow to import and only needed by analytics code
+    import numpy
+
+    fields = [('field_count', '>i2')]
+    for index, type_oid in enumerate(type_oids):
+        fields.append(('length_%d' % index, '>i4'))
+        fields.append(('value_%d' % index, _TYPED_COLUMNS[type_oid][3]))
+
+    tuples = numpy.frombuffer(body, dtype=numpy.dtype(fields), count=row_count)
+
+    if not (tuples['field_count'] == len(type_oids)).all():
+        raise McDatabaseResultException("Unexpected field count in binary COPY data.")
+
+    for index, type_oid in enumerate(type_oids):
+        typecode, native_dtype, value_format, _ = _TYPED_COLUMNS[type_oid]
+
+        if not (tuples['length_%d' % index] == struct.calcsize('!' + value_format)).all():
+            raise McDatabaseResultException("Unexpected field length in binary COPY data.")
+
+        values = array.array(typecode)
+        values.frombytes(tuples['value_%d' % index].astype(native_dtype).tobytes())
+        builder.add_typed_array(index, values)
+
+    return True
+
+
+def __decode_tuples(builder: ColumnarResultBuilder, body: memoryview, type_oids: List[int]) -> None:
+    """Decode tuples one by one (slow path for text columns and NULLs)."""
+
+    decoders = []
+    for type_oid in type_oids:
+        if type_oid in _TYPED_COLUMNS:
+            decoders.append(struct.Struct('!' + _TYPED_COLUMNS[type_oid][2]).unpack_from)
+        else:
+            decoders.append(None)
+
+    column_values = [[] for _ in type_oids]
+    offset = 0
+    body_length = len(body)
+    while offset < body_length:
+        (field_count,) = struct.unpack_from('!h', body, offset)
+        offset += 2
+        if field_count != len(type_oids):
+            raise McDatabaseResultException("Unexpected field count %d in binary COPY data." % field_count)
+
+        for index in range(field_count):
+            (length,) = struct.unpack_from('!i', body, offset)
+            offset += 4
+            if length == -1:
+                column_values[index].append(None)
+                continue
+
+            decoder = decoders[index]
+            if decoder is None:
+                column_values[index].append(str(body[offset:offset + length], 'utf-8'))
+            else:
+                column_values[index].append(decoder(body, offset)[0])
+            offset += length
+
+    for index, values in enumerate(column_values):
+        if type_oids[index] == 16:
+            values = [None if value is None else int(value) for value in values]
+        builder.add_column_values(index, values)
+
+
+def binary_copy_to_columns(data: Union[bytes, memoryview],
+                           names: List[str],
+                           type_oids: List[int],
+                           row_count: int = None) -> ColumnarResultBuilder:
+    """Decode output of "COPY ... TO STDOUT WITH (FORMAT binary)" into columns.
+
+    If "row_count" is known and none of the values are NULL, fixed width columns get decoded in a single vectorized
+    pass instead of tuple by tuple."""
+
+    if not binary_copy_supported_types(type_oids):
+        raise McDatabaseResultException("Some of the column types are not supported: %s" % str(type_oids))
+
+    data = memoryview(data)
+    header_length = __binary_header_length(data)
+
+    # Trailer is a field count of -1
+    if len(data) < header_length + 2 or bytes(data[-2:]) != b'\xff\xff':
+        raise McDatabaseResultException("Binary COPY data is truncated.")
+    body = data[header_length:-2]
+
+    builder = ColumnarResultBuilder(names=names, type_oids=type_oids)
+
+    if row_count is None or row_count < 0 or \
+            not __decode_fixed_width_tuples(builder=builder, body=body, type_oids=type_oids, row_count=row_count):
+        __decode_tuples(builder=builder, body=body, type_oids=type_oids)
+
+    return builder
+
+
+def rows_to_columns(rows: Iterable[Sequence[Any]], names: List[str], type_oids: List[int]) -> ColumnarResultBuilder:
+    """Accumulate rows into columns."""
+    builder = ColumnarResultBuilder(names=names, type_oids=type_oids)
+    builder.add_rows(list(rows))
+    return builder
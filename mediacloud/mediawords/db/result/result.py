@@ -1,42 +1,91 @@
+import functools
 import itertools
 import pprint
 import re
-from typing import Dict, List, Any
+import time
+from typing import Dict, List, Any, Iterator
 
 import psycopg2
 from psycopg2.extras import DictCursor
 
 from mediawords.db.exceptions.result import *
+from mediawords.db.instrumentation.instrumentation import query_instrumentation_enabled, record_query
+from mediawords.db.result.columnar import ColumnarResultBuilder
+from mediawords.db.statement.cache import DatabasePreparedStatementCache
 from mediawords.util.log import create_logger
 from mediawords.util.perl import decode_object_from_bytes_if_needed
 
 log = create_logger(__name__)
 
+# Max. number of distinct queries for which percentage sign-escaped versions are to be cached
+_PERCENTAGE_SIGN_CACHE_SIZE = 1024
+
+# Number of rows to fetch at a time when building columns
+_COLUMNS_FETCH_SIZE = 10000
+
+# '%' everywhere except for psycopg2 parameter placeholders ('%s' and '%(...)s')
+_PERCENTAGE_SIGN_REGEX = re.compile(r'%(?!(s|\(.*?\)s?))')
+
+
+@functools.lru_cache(maxsize=_PERCENTAGE_SIGN_CACHE_SIZE)
+def _double_percentage_signs(query: str, double_percentage_sign_marker: str) -> str:
+    """Duplicate percentage signs in the query for psycopg2 to treat them literally."""
+
+    # Duplicate '%' everywhere except for psycopg2 parameter placeholders ('%s' and '%(...)s')
+    query = _PERCENTAGE_SIGN_REGEX.sub('%%', query)
+
+    # Replace percentage signs coming from quote()d strings with double percentage signs
+    query = query.replace(double_percentage_sign_marker, '%%')
+
+    return query
+
+
+def percentage_sign_cache_stats() -> Dict[str, int]:
+    """Return hit / miss counters of the percentage sign-escaped query cache."""
+    cache_info = _double_percentage_signs.cache_info()
+    return {
+        'hits': cache_info.hits,
+        'misses': cache_info.misses,
+        'size': cache_info.currsize,
+        'max_size': cache_info.maxsize,
+    }
+
 
 class DatabaseResult(object):
     """Wrapper around SQL query result."""
 
     __cursor = None  # psycopg2 cursor
 
+    # Whether the cursor belongs to this result (server-side cursor) and has to be closed after reading
+    __owns_cursor = False
+
     def __init__(self,
                  cursor: DictCursor,
                  query_args: tuple,
                  double_percentage_sign_marker: str,
-                 print_warnings: bool = True):
+                 print_warnings: bool = True,
+                 owns_cursor: bool = False,
+                 statement_cache: DatabasePreparedStatementCache = None):
 
         # MC_REWRITE_TO_PYTHON: 'query_args' should be decoded from 'bytes' at this point
 
+        self.__owns_cursor = owns_cursor
+
         self.__execute(cursor=cursor,
                        query_args=query_args,
                        double_percentage_sign_marker=double_percentage_sign_marker,
-                       print_warnings=print_warnings)
+                       print_warnings=print_warnings,
+                       statement_cache=statement_cache)
 
     def __execute(self,
                   cursor: DictCursor,
                   query_args: tuple,
                   double_percentage_sign_marker: str,
-                  print_warnings: bool) -> None:
-        """Execute statement, set up cursor to results."""
+                  print_warnings: bool,
+                  statement_cache: DatabasePreparedStatementCache = None) -> None:
+        """Execute statement, set up cursor to results.
+
+        If "statement_cache" is set, hot parameterized queries get executed as server-side prepared statements."""
 
         # MC_REWRITE_TO_PYTHON: 'query_args' should be decoded from 'bytes' at this point
 
@@ -55,13 +104,7 @@ class DatabaseResult(object):
                 # to execute().
                 query_args = (query_args[0], {},)
 
-            query = query_args[0]
-
-            # Duplicate '%' everywhere except for psycopg2 parameter placeholders ('%s' and '%(...)s')
-            query = re.sub('%(?!(s|\(.*?\)s?))', '%%', query)
-
-            # Replace percentage signs coming from quote()d strings with double percentage signs
-            query = query.replace(double_percentage_sign_marker, '%%')
+            query = _double_percentage_signs(query_args[0], double_percentage_sign_marker)
 
             query_args_list = list(query_args)
             query_args_list[0] = query
@@ -69,7 +112,12 @@ class DatabaseResult(object):
 
             log.debug("Running query: %s" % str(query_args))
 
-            cursor.execute(*query_args)
+            if query_instrumentation_enabled():
+                start_time = time.time()
+                self.__cursor_execute(cursor=cursor, query_args=query_args, statement_cache=statement_cache)
+                record_query(query=query, duration=time.time() - start_time, rows=cursor.rowcount)
+            else:
+                self.__cursor_execute(cursor=cursor, query_args=query_args, statement_cache=statement_cache)
 
         except psycopg2.Warning as ex:
             if print_warnings:
@@ -112,6 +160,15 @@ class DatabaseResult(object):
 
         self.__cursor = cursor  # Cursor now holds results
 
+    @staticmethod
+    def __cursor_execute(cursor: DictCursor,
+                         query_args: tuple,
+                         statement_cache: DatabasePreparedStatementCache = None) -> None:
+        if statement_cache is not None and len(query_args) == 2:
+            statement_cache.execute(cursor=cursor, query=query_args[0], params=query_args[1])
+        else:
+            cursor.execute(*query_args)
+
     def columns(self) -> List[str]:
         """Return a list of column names."""
         column_names = [desc[0] for desc in self.__cursor.description]
@@ -160,3 +217,83 @@ class DatabaseResult(object):
         if text_type != 'neat':
             raise McDatabaseResultTextException("Formatting types other than 'neat' are not supported.")
         return pprint.pformat(self.hashes(), indent=4)
+
+    def __iterate_rows(self) -> Iterator[Any]:
+        """Yield remaining rows one by one, close the cursor (if owned) when done."""
+        try:
+            # Named (server-side) cursors fetch "itersize" rows per network round trip while iterating
+            for row in self.__cursor:
+                yield row
+        finally:
+            self.close()
+
+    def iter_arrays(self) -> Iterator[List[Any]]:
+        """Yield all returned (remaining) rows one by one as lists.
+
+        Unlike flat() / hashes(), doesn't build a list of all the rows; combined with a server-side cursor (see
+        handler's query_stream()), the whole result never has to be held in memory."""
+        for row in self.__iterate_rows():
+            yield list(row)
+
+    def iter_hashes(self) -> Iterator[Dict[str, Any]]:
+        """Yield all returned (remaining) rows one by one as dicts, keyed by column name.
+
+        See iter_arrays() for memory usage notes."""
+        for row in self.__iterate_rows():
+            yield dict(row)
+
+    def __columnar_builder(self) -> ColumnarResultBuilder:
+        return ColumnarResultBuilder(names=self.columns(), type_oids=[desc[1] for desc in self.__cursor.description])
+
+    def columns_as_arrays(self, use_numpy: bool = False) -> Dict[str, Any]:
+        """Return all returned (remaining) rows as a dictionary of column names and column values.
+
+        Integer, floating point and boolean columns are returned as typed array.array objects (or NumPy arrays if
+        "use_numpy" is True), so large numeric results don't have to be held as a dictionary per row; other columns are
+        returned as lists (or NumPy "object" arrays). NULLs in floating point columns become NaNs, and NULLs in integer
+        or boolean columns raise an exception.
+
+        See handler's query_columns_as_arrays() for a faster way to fetch numeric results."""
+        builder = self.__columnar_builder()
+        while True:
+            rows = self.__cursor.fetchmany(_COLUMNS_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            builder.add_rows(rows)
+        return builder.columns(use_numpy=use_numpy)
+
+    def iter_columns_as_arrays(self, chunk_size: int = 100000, use_numpy: bool = False) -> Iterator[Dict[str, Any]]:
+        """Yield all returned (remaining) rows as dictionaries of columns (see columns_as_arrays()) of up to
+        "chunk_size" rows each.
+
+        Combined with a server-side cursor (see handler's query_stream()), the whole result never has to be held in
+        memory."""
+        if chunk_size < 1:
+            raise McDatabaseResultException("'chunk_size' must be 1 or bigger.")
+        try:
+            while True:
+                rows = self.__cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                builder = self.__columnar_builder()
+                builder.add_rows(rows)
+                yield builder.columns(use_numpy=use_numpy)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Close the server-side cursor (if any); reading from the result afterwards is not possible.
+
+        Cursors of regular query() results are shared with the handler and are left open."""
+        if self.__owns_cursor and self.__cursor is not None and not self.__cursor.closed:
+            try:
+                self.__cursor.close()
+            except psycopg2.Error as ex:
+                log.warning("Unable to close cursor: %s" % str(ex))
+
+    def __del__(self):
+        # Server-side cursors are held WITH HOLD so they would outlive the transaction otherwise
+        try:
+            self.close()
+        except Exception as ex:
+            log.debug("Unable to close cursor on garbage collection: %s" % str(ex))
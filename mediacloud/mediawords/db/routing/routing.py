@@ -0,0 +1,371 @@
+import random
+import re
+import time
+from typing import Any, Callable, Dict, List, Union
+
+import psycopg2
+
+from mediawords.db.copy.copy_from import CopyFrom
+from mediawords.db.handler import DatabaseHandler
+from mediawords.db.pages.pages import DatabasePages
+from mediawords.db.result.result import DatabaseResult
+from mediawords.db.statement.statement import DatabaseStatement
+from mediawords.util.log import create_logger
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+# Queries that don't mark the handler as having written something
+_READ_QUERY_REGEX = re.compile(r'^\s*(?:SELECT|SHOW|EXPLAIN|VALUES|TABLE)\b', re.IGNORECASE)
+
+# First PostgreSQL version (server_version_num) in which "xlog" functions got renamed to "wal"
+_WAL_FUNCTIONS_VERSION = 100000
+
+
+def _wal_position(lsn: Union[str, None]) -> Union[int, None]:
+    """Convert WAL position ("16/B374D848") into an integer."""
+    if lsn is None:
+        return None
+    (high, low) = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def _is_connection_error(exception: BaseException) -> bool:
+    """Return True if the exception (or any of the exceptions it was raised from) is a lost connection."""
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        if isinstance(exception, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return True
+        exception = exception.__cause__ if exception.__cause__ is not None else exception.__context__
+    return False
+
+
+def _wal_functions(db: DatabaseHandler) -> Dict[str, str]:
+    """Return names of the WAL position functions for the server's version."""
+    (server_version_num,) = db.query("SHOW server_version_num").flat()
+    if int(server_version_num) >= _WAL_FUNCTIONS_VERSION:
+        return {
+            'current': 'pg_current_wal_lsn',
+            'receive': 'pg_last_wal_receive_lsn',
+            'replay': 'pg_last_wal_replay_lsn',
+        }
+    else:
+        return {
+            'current': 'pg_current_xlog_location',
+            'receive': 'pg_last_xlog_receive_location',
+            'replay': 'pg_last_xlog_replay_location',
+        }
+
+
+class DatabaseReplica(object):
+    """Read replica's connection together with its last known replication lag and replayed WAL position."""
+
+    # Function to connect to the replica
+    __connect = None
+
+    # Replica's name for logging
+    __name = None
+
+    # Connection (None if not connected)
+    __db = None
+
+    # Names of the WAL position functions for the replica's server version
+    __wal_functions = None
+
+    # Replication lag in seconds, replayed WAL position, and time of the check
+    __lag = None
+    __position = None
+    __checked_at = None
+
+    # Time until which the replica is not to be used after a failure
+    __unavailable_until = 0
+
+    # Number of reads routed to the replica
+    __reads = 0
+
+    def __init__(self, connect: Callable[[], DatabaseHandler], name: str):
+        self.__connect = connect
+        self.__name = name
+        self.__db = None
+        self.__wal_functions = None
+        self.__lag = None
+        self.__position = None
+        self.__checked_at = None
+        self.__unavailable_until = 0
+        self.__reads = 0
+
+    def name(self) -> str:
+        return self.__name
+
+    def handler(self) -> DatabaseHandler:
+        """Return replica's connection, connecting if needed."""
+        if self.__db is None:
+            self.__db = self.__connect()
+            self.__wal_functions = _wal_functions(self.__db)
+        return self.__db
+
+    def available(self) -> bool:
+        return time.time() >= self.__unavailable_until
+
+    def lag(self) -> Union[float, None]:
+        return self.__lag
+
+    def position(self) -> Union[int, None]:
+        return self.__position
+
+    def check(self, max_age: float) -> None:
+        """Update replication lag and replayed WAL position if they're older than "max_age" seconds."""
+        if self.__checked_at is not None and time.time() - self.__checked_at < max_age:
+            return
+
+        db = self.handler()
+
+        # Idle primary doesn't send any transactions to replay, so replay timestamp gets old even if the replica has
+        # replayed everything it has received
+        status = db.query("""
+            SELECT
+                CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN %(receive)s() = %(replay)s() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                END AS lag,
+                (
+                    CASE WHEN pg_is_in_recovery() THEN %(replay)s() ELSE %(current)s() END
+                )::TEXT AS position
+        """ % self.__wal_functions).hash()
+
+        self.__lag = float(status['lag'])
+        self.__position = _wal_position(status['position'])
+        self.__checked_at = time.time()
+
+    def record_read(self) -> None:
+        self.__reads += 1
+
+    def fail(self, exception: Exception, retry_after: float) -> None:
+        """Disconnect and don't use the replica for "retry_after" seconds."""
+        log.warning("Read replica %s has failed, not using it for %.1f s: %s" % (
+            self.__name, retry_after, str(exception),
+        ))
+        self.__unavailable_until = time.time() + retry_after
+        self.__checked_at = None
+        self.disconnect()
+
+    def disconnect(self) -> None:
+        if self.__db is not None:
+            try:
+                self.__db.disconnect()
+            except Exception as ex:
+                log.debug("Unable to disconnect from read replica %s: %s" % (self.__name, str(ex)))
+            self.__db = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.__name,
+            'available': self.available(),
+            'lag': self.__lag,
+            'reads': self.__reads,
+        }
+
+
+class RoutingDatabaseHandler(DatabaseHandler):
+    """Database handler which sends reads to read replicas.
+
+    select(), find_by_id(), query_paged_hashes() and read_only_query() get sent to the replica with the smallest
+    replication lag (if it's no more than "max_lag" seconds); everything else, including anything run in a transaction,
+    goes to the primary, i.e. the handler itself. Replicas' lag gets rechecked every "lag_check_interval" seconds.
+
+    After something gets written through the handler (with query(), prepare()'d statements or copy_from(), which
+    create_many() uses for large batches too), reads only get sent to replicas which have replayed the primary's WAL up
+    to the point of the write, so the handler always reads its own writes. Replicas that fail get skipped for
+    "lag_check_interval" seconds, and reads get retried on the primary."""
+
+    # Replicas
+    __replicas = None
+
+    # Max. replication lag (in seconds) of the replica to send reads to
+    __max_lag = None
+
+    # Interval (in seconds) between replication lag checks
+    __lag_check_interval = None
+
+    # True if something has been written since __min_position was last updated
+    __wrote = False
+
+    # Primary's WAL position after the last write; replicas have to have replayed up to it
+    __min_position = None
+
+    # Names of the primary's WAL position functions
+    __primary_wal_functions = None
+
+    # True if the handler has been checked out from a connection pool
+    __pooled = False
+
+    # Number of reads sent to the primary
+    __primary_reads = 0
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 username: str,
+                 password: str,
+                 database: str,
+                 replicas: List[DatabaseReplica],
+                 max_lag: float = 30,
+                 lag_check_interval: float = 5,
+                 do_not_check_schema_version: bool = False):
+        """Routing database handler constructor; connects to the primary (replicas get connected to on first use)."""
+
+        super().__init__(host=host,
+                         port=port,
+                         username=username,
+                         password=password,
+                         database=database,
+                         do_not_check_schema_version=do_not_check_schema_version)
+
+        self.__replicas = replicas
+        self.__max_lag = max_lag
+        self.__lag_check_interval = lag_check_interval
+        self.__wrote = False
+        self.__min_position = None
+        self.__primary_wal_functions = None
+        self.__pooled = False
+        self.__primary_reads = 0
+
+    def replica_stats(self) -> Dict[str, Any]:
+        """Return number of reads sent to the primary and replicas' lag and number of reads."""
+        return {
+            'primary_reads': self.__primary_reads,
+            'replicas': [replica.stats() for replica in self.__replicas],
+        }
+
+    def __update_min_position(self) -> None:
+        """Fetch primary's WAL position if something has been written since the last read."""
+        if not self.__wrote:
+            return
+
+        if self.__primary_wal_functions is None:
+            self.__primary_wal_functions = _wal_functions(self)
+
+        (position,) = super().query("SELECT %s()::TEXT" % self.__primary_wal_functions['current']).flat()
+        self.__min_position = _wal_position(position)
+        self.__wrote = False
+
+    def __replica_is_usable(self, replica: DatabaseReplica, max_age: float) -> bool:
+        replica.check(max_age=max_age)
+        if replica.lag() > self.__max_lag:
+            return False
+        if self.__min_position is not None and (replica.position() is None or
+                                                replica.position() < self.__min_position):
+            return False
+        return True
+
+    def __choose_replica(self) -> Union[DatabaseReplica, None]:
+        """Return replica to read from; None if reads are to be sent to the primary."""
+
+        if len(self.__replicas) == 0 or self.in_transaction():
+            return None
+
+        self.__update_min_position()
+
+        candidates = []
+        for replica in self.__replicas:
+            if not replica.available():
+                continue
+            try:
+                if self.__replica_is_usable(replica, max_age=self.__lag_check_interval):
+                    candidates.append(replica)
+                elif self.__min_position is not None:
+                    # Replica might have caught up with the write since the last check
+                    if self.__replica_is_usable(replica, max_age=0):
+                        candidates.append(replica)
+            except Exception as ex:
+                replica.fail(exception=ex, retry_after=self.__lag_check_interval)
+
+        if len(candidates) == 0:
+            return None
+
+        # Replicas that are equally (un)lagged share the load
+        min_lag = min(replica.lag() for replica in candidates)
+        return random.choice([replica for replica in candidates if replica.lag() == min_lag])
+
+    def __read(self, method_name: str, *args, **kwargs) -> Any:
+        """Call handler's method on the chosen replica, fall back to the primary."""
+
+        replica = self.__choose_replica()
+        if replica is not None:
+            try:
+                result = getattr(replica.handler(), method_name)(*args, **kwargs)
+                replica.record_read()
+                return result
+            except Exception as ex:
+                if not _is_connection_error(ex):
+                    raise
+                replica.fail(exception=ex, retry_after=self.__lag_check_interval)
+
+        self.__primary_reads += 1
+        return getattr(super(), method_name)(*args, **kwargs)
+
+    def __track_write(self, sql: Any) -> None:
+        """Remember that something got written if the SQL is not a read."""
+        sql = decode_object_from_bytes_if_needed(sql)
+        if not (isinstance(sql, str) and _READ_QUERY_REGEX.match(sql)):
+            self.__wrote = True
+
+    def query(self, *query_params) -> DatabaseResult:
+        """Run the query on the primary."""
+        if len(query_params) > 0:
+            self.__track_write(query_params[0])
+
+        return super().query(*query_params)
+
+    def prepare(self, sql: str) -> DatabaseStatement:
+        """Return a prepared statement to be run on the primary."""
+        self.__track_write(sql)
+        return super().prepare(sql=sql)
+
+    def copy_from(self, sql: str, binary_types: List[str] = None) -> CopyFrom:
+        """Return COPY FROM helper object for copying to the primary."""
+        self.__wrote = True
+        return super().copy_from(sql=sql, binary_types=binary_types)
+
+    def read_only_query(self, *query_params) -> DatabaseResult:
+        """Run the read-only query on a read replica."""
+        return self.__read('read_only_query', *query_params)
+
+    def select(self, table: str, what_to_select: str, condition_hash: dict = None) -> DatabaseResult:
+        """SELECT chosen columns from the table on a read replica."""
+        return self.__read('select', table=table, what_to_select=what_to_select, condition_hash=condition_hash)
+
+    def find_by_id(self, table: str, object_id: int) -> Union[Dict[str, Any], None]:
+        """Do an ID lookup on the table on a read replica."""
+        return self.__read('find_by_id', table=table, object_id=object_id)
+
+    def query_paged_hashes(self,
+                           query: str,
+                           page: int,
+                           rows_per_page: int,
+                           order_by: List[str] = None,
+                           descending: bool = False,
+                           continuation_token: str = None) -> DatabasePages:
+        """Execute the query on a read replica and return a list of pages hashes."""
+        return self.__read('query_paged_hashes',
+                           query=query,
+                           page=page,
+                           rows_per_page=rows_per_page,
+                           order_by=order_by,
+                           descending=descending,
+                           continuation_token=continuation_token)
+
+    def set_release_callback(self, release_callback: Union[Callable[['DatabaseHandler'], None], None]) -> None:
+        """Set callback to be called by disconnect() instead of closing the connection; None to reset."""
+        self.__pooled = release_callback is not None
+        super().set_release_callback(release_callback)
+
+    def disconnect(self) -> None:
+        """Disconnect from the primary and replicas (or return the handler to the connection pool if it came from
+        one)."""
+        if not self.__pooled:
+            for replica in self.__replicas:
+                replica.disconnect()
+        super().disconnect()
@@ -0,0 +1,154 @@
+import psycopg2
+import pytest
+
+from mediawords.db import connect_to_db
+from mediawords.db.exceptions.result import McDatabaseResultException
+from mediawords.db.routing.routing import *
+from mediawords.db.routing.routing import _wal_position
+from mediawords.util.config import get_config as py_get_config
+
+
+def __routing_handler(replicas: List[DatabaseReplica], max_lag: float = 30) -> RoutingDatabaseHandler:
+    settings = [s for s in py_get_config()['database'] if s['label'] == 'test'][0]
+    return RoutingDatabaseHandler(host=settings['host'],
+                                  port=int(settings['port']),
+                                  username=settings['user'],
+                                  password=settings['pass'],
+                                  database=settings['db'],
+                                  replicas=replicas,
+                                  max_lag=max_lag,
+                                  lag_check_interval=60,
+                                  do_not_check_schema_version=True)
+
+
+def __backend_pid(db: DatabaseHandler, read_only: bool = True) -> int:
+    if read_only:
+        return db.read_only_query("SELECT pg_backend_pid()").flat()[0]
+    else:
+        return db.query("SELECT pg_backend_pid()").flat()[0]
+
+
+def test_wal_position():
+    assert _wal_position(None) is None
+    assert _wal_position('0/0') == 0
+    assert _wal_position('16/B374D848') == (0x16 << 32) + 0xB374D848
+    assert _wal_position('1/0') > _wal_position('0/FFFFFFFF')
+
+
+def test_routing():
+    # Test database is not in recovery so it acts as a replica without any lag
+    replica = DatabaseReplica(connect=lambda: connect_to_db(label='test'), name='test')
+    db = __routing_handler(replicas=[replica])
+
+    db.query("DROP TABLE IF EXISTS test_routing")
+    db.query("CREATE TABLE test_routing (test_routing_id SERIAL PRIMARY KEY, name TEXT NOT NULL)")
+    db.create('test_routing', {'name': 'foo'})
+
+    primary_pid = __backend_pid(db, read_only=False)
+    replica_pid = __backend_pid(db)
+    assert replica_pid != primary_pid
+    assert replica.stats()['lag'] == 0
+
+    # Replica reads the primary's writes
+    assert db.find_by_id('test_routing', 1)['name'] == 'foo'
+    assert db.select('test_routing', 'name', {'test_routing_id': 1}).flat() == ['foo']
+    pages = db.query_paged_hashes("SELECT * FROM test_routing", page=1, rows_per_page=10)
+    assert [row['name'] for row in pages.list()] == ['foo']
+    assert replica.stats()['reads'] == 4
+
+    # Transactions stay on the primary
+    db.begin()
+    db.create('test_routing', {'name': 'bar'})
+    assert __backend_pid(db) == primary_pid
+    assert db.find_by_id('test_routing', 2)['name'] == 'bar'
+    db.rollback()
+
+    assert __backend_pid(db) == replica_pid
+
+    # SQL errors don't make the replica fail
+    with pytest.raises(McDatabaseResultException):
+        db.read_only_query("SELECT * FROM nonexistent_table")
+    assert replica.available()
+
+    stats = db.replica_stats()
+    assert stats['primary_reads'] == 2
+    assert stats['replicas'][0]['reads'] == 5
+
+    db.query("DROP TABLE test_routing")
+    db.disconnect()
+
+
+class _StaleReplica(DatabaseReplica):
+    """Replica which doesn't replay anything after its first lag check."""
+
+    def check(self, max_age: float) -> None:
+        if self.position() is None:
+            super().check(max_age=max_age)
+
+
+def test_routing_writes_without_query():
+    replica = _StaleReplica(connect=lambda: connect_to_db(label='test'), name='stale')
+    db = __routing_handler(replicas=[replica])
+
+    db.query("DROP TABLE IF EXISTS test_routing")
+    db.query("CREATE TABLE test_routing (test_routing_id SERIAL PRIMARY KEY, name TEXT NOT NULL)")
+
+    # Replica's position gets checked once after the table gets created
+    assert db.find_by_id('test_routing', 1) is None
+    assert db.replica_stats()['primary_reads'] == 0
+
+    copy = db.copy_from("COPY test_routing (name) FROM STDIN")
+    copy.put_line("foo\n")
+    copy.end()
+    assert db.find_by_id('test_routing', 1)['name'] == 'foo'
+    assert db.replica_stats()['primary_reads'] == 1
+
+    statement = db.prepare("INSERT INTO test_routing (name) VALUES (?)")
+    statement.bind(1, 'bar')
+    statement.execute()
+    assert db.find_by_id('test_routing', 2)['name'] == 'bar'
+    assert db.replica_stats()['primary_reads'] == 2
+
+    # Large batches get loaded with COPY
+    ids = db.create_many('test_routing', [{'name': 'baz %d' % x} for x in range(1000)])
+    assert db.find_by_id('test_routing', ids[-1])['name'] == 'baz 999'
+    assert db.replica_stats()['primary_reads'] == 3
+
+    db.query("DROP TABLE test_routing")
+    db.disconnect()
+
+
+def test_routing_lagging_replica():
+    replica = DatabaseReplica(connect=lambda: connect_to_db(label='test'), name='test')
+    db = __routing_handler(replicas=[replica], max_lag=-1)
+
+    assert __backend_pid(db) == __backend_pid(db, read_only=False)
+    assert replica.available()
+    assert replica.stats()['reads'] == 0
+
+    db.disconnect()
+
+
+def test_routing_failed_replica():
+    def __connect_to_unavailable_replica():
+        raise psycopg2.OperationalError("Connection refused")
+
+    unavailable_replica = DatabaseReplica(connect=__connect_to_unavailable_replica, name='unavailable')
+    db = __routing_handler(replicas=[unavailable_replica])
+
+    assert __backend_pid(db) == __backend_pid(db, read_only=False)
+    assert not unavailable_replica.available()
+    db.disconnect()
+
+    # Replica's connection gets lost after a lag check
+    replica = DatabaseReplica(connect=lambda: connect_to_db(label='test'), name='test')
+    db = __routing_handler(replicas=[replica])
+
+    replica_pid = __backend_pid(db)
+    db.query("SELECT pg_terminate_backend(%(pid)s)", {'pid': replica_pid})
+
+    assert __backend_pid(db) == __backend_pid(db, read_only=False)
+    assert not replica.available()
+    assert db.replica_stats()['primary_reads'] == 1
+
+    db.disconnect()
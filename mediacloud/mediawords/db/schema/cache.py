@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Union
+
+from mediawords.db.schema.version import schema_version_from_lines
+from mediawords.util.log import create_logger
+from mediawords.util.paths import mkdir_p
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+log = create_logger(__name__)
+
+# File (in cache directory) with target schema version parsed out of mediawords.sql
+__TARGET_SCHEMA_VERSION_FILE = 'target_schema_version.json'
+
+# File (in cache directory) with last successful schema version checks of databases
+__SCHEMA_VERSION_CHECKS_FILE = 'schema_version_checks.json'
+
+# File (in cache directory) with database's schema metadata; "%s" gets replaced with hash of the database identifier
+__SCHEMA_METADATA_FILE = 'schema_metadata-%s.json'
+
+
+def __read_json(path: str) -> Union[dict, None]:
+    """Read JSON dictionary from cache file; return None if file is missing or broken."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def __write_json(path: str, data: dict) -> None:
+    """Atomically write JSON dictionary to cache file; failing to write cache is not fatal."""
+    try:
+        directory = os.path.dirname(path)
+        mkdir_p(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except OSError as ex:
+        log.warning("Unable to write schema version cache file '%s': %s" % (path, str(ex)))
+
+
+def __schema_file_key(schema_path: str) -> dict:
+    """Return key identifying the current revision of the schema file without reading it."""
+    stat = os.stat(schema_path)
+    return {
+        'path': os.path.abspath(schema_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+
+
+def cached_target_schema_version(schema_path: str, cache_dir: str) -> int:
+    """Return schema version from mediawords.sql at "schema_path".
+
+    The version gets cached in "cache_dir" keyed on schema file's path, modification time and size, so the
+    multi-megabyte schema file gets read and parsed only after it changes."""
+
+    schema_path = decode_object_from_bytes_if_needed(schema_path)
+    cache_dir = decode_object_from_bytes_if_needed(cache_dir)
+
+    file_key = __schema_file_key(schema_path)
+    cache_path = os.path.join(cache_dir, __TARGET_SCHEMA_VERSION_FILE)
+
+    cached = __read_json(cache_path)
+    if cached is not None and cached.get('file') == file_key and isinstance(cached.get('version'), int):
+        return cached['version']
+
+    log.debug("Parsing target schema version from '%s'..." % schema_path)
+    with open(schema_path, 'r') as f:
+        target_schema_version = schema_version_from_lines(f.read())
+
+    __write_json(cache_path, {'file': file_key, 'version': target_schema_version})
+
+    return target_schema_version
+
+
+def schema_version_check_is_cached(cache_dir: str, database: str, target_schema_version: int, max_age: int) -> bool:
+    """Return True if schema of "database" was found to be at "target_schema_version" less than "max_age" seconds ago.
+
+    "database" is an arbitrary string identifying the database, e.g. "host:port/name"."""
+
+    cache_dir = decode_object_from_bytes_if_needed(cache_dir)
+    database = decode_object_from_bytes_if_needed(database)
+
+    checks = __read_json(os.path.join(cache_dir, __SCHEMA_VERSION_CHECKS_FILE))
+    if checks is None or database not in checks:
+        return False
+
+    check = checks[database]
+    if not isinstance(check, dict):
+        return False
+    if check.get('version') != target_schema_version:
+        return False
+
+    checked_at = check.get('checked_at', 0)
+    if not isinstance(checked_at, (int, float)):
+        return False
+
+    return 0 <= time.time() - checked_at < max_age
+
+
+def cache_schema_version_check(cache_dir: str, database: str, target_schema_version: int) -> None:
+    """Record that schema of "database" was found to be at "target_schema_version"."""
+
+    cache_dir = decode_object_from_bytes_if_needed(cache_dir)
+    database = decode_object_from_bytes_if_needed(database)
+
+    cache_path = os.path.join(cache_dir, __SCHEMA_VERSION_CHECKS_FILE)
+
+    # Concurrent writers might overwrite each other's checks, but that only results in an extra check later
+    checks = __read_json(cache_path)
+    if checks is None:
+        checks = {}
+
+    checks[database] = {
+        'version': target_schema_version,
+        'checked_at': time.time(),
+    }
+
+    __write_json(cache_path, checks)
+
+
+def __schema_metadata_path(cache_dir: str, database: str) -> str:
+    database_hash = hashlib.sha1(database.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, __SCHEMA_METADATA_FILE % database_hash)
+
+
+def cached_schema_metadata(cache_dir: str, database: str, schema_version: int) -> Union[dict, None]:
+    """Return schema metadata dictionary of "database" at "schema_version", or None if it's not cached."""
+
+    cache_dir = decode_object_from_bytes_if_needed(cache_dir)
+    database = decode_object_from_bytes_if_needed(database)
+
+    cached = __read_json(__schema_metadata_path(cache_dir=cache_dir, database=database))
+    if cached is None:
+        return None
+    if cached.get('database') != database or cached.get('version') != schema_version:
+        return None
+    if not isinstance(cached.get('metadata'), dict):
+        return None
+
+    return cached['metadata']
+
+
+def cache_schema_metadata(cache_dir: str, database: str, schema_version: int, metadata: dict) -> None:
+    """Store schema metadata dictionary of "database" at "schema_version"."""
+
+    cache_dir = decode_object_from_bytes_if_needed(cache_dir)
+    database = decode_object_from_bytes_if_needed(database)
+
+    __write_json(__schema_metadata_path(cache_dir=cache_dir, database=database), {
+        'database': database,
+        'version': schema_version,
+        'metadata': metadata,
+    })
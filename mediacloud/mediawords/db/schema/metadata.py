@@ -0,0 +1,167 @@
+import collections
+import copy
+import json
+from typing import Dict, List, Any, Union
+
+
+# Query that fetches metadata of all tables (or a single table if "table_name" parameter is set) from pg_catalog
+_SCHEMA_METADATA_QUERY = """
+    SELECT
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        c.relpersistence = 't' AS is_temporary,
+
+        (
+            SELECT json_agg(json_build_array(a.attname, format_type(a.atttypid, a.atttypmod)) ORDER BY a.attnum)
+            FROM pg_attribute AS a
+            WHERE a.attrelid = c.oid
+              AND a.attnum > 0
+              AND NOT a.attisdropped
+        ) AS columns,
+
+        (
+            SELECT json_agg(a.attname ORDER BY k.position)
+            FROM pg_constraint AS con
+                CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k (attnum, position)
+                INNER JOIN pg_attribute AS a
+                    ON a.attrelid = con.conrelid
+                   AND a.attnum = k.attnum
+            WHERE con.conrelid = c.oid
+              AND con.contype = 'p'
+        ) AS primary_key,
+
+        (
+            SELECT json_agg(json_build_object(
+                'constraint_name', con.conname,
+                'columns', (
+                    SELECT json_agg(a.attname ORDER BY k.position)
+                    FROM unnest(con.conkey) WITH ORDINALITY AS k (attnum, position)
+                        INNER JOIN pg_attribute AS a
+                            ON a.attrelid = con.conrelid
+                           AND a.attnum = k.attnum
+                ),
+                'foreign_table_schema', fn.nspname,
+                'foreign_table_name', fc.relname,
+                'foreign_columns', (
+                    SELECT json_agg(a.attname ORDER BY k.position)
+                    FROM unnest(con.confkey) WITH ORDINALITY AS k (attnum, position)
+                        INNER JOIN pg_attribute AS a
+                            ON a.attrelid = con.confrelid
+                           AND a.attnum = k.attnum
+                )
+            ) ORDER BY con.conname)
+            FROM pg_constraint AS con
+                INNER JOIN pg_class AS fc
+                    ON fc.oid = con.confrelid
+                INNER JOIN pg_namespace AS fn
+                    ON fn.oid = fc.relnamespace
+            WHERE con.conrelid = c.oid
+              AND con.contype = 'f'
+        ) AS foreign_keys
+
+    FROM pg_class AS c
+        INNER JOIN pg_namespace AS n
+            ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f')
+      AND %(condition)s
+"""
+
+
+def schema_metadata_query(single_table: bool = False) -> str:
+    """Return query for fetching rows to be passed to DatabaseSchemaMetadata.add_tables().
+
+    If "single_table" is True, the query expects "table_name" parameter, resolved using the current "search_path" (so
+    temporary tables are found too)."""
+    if single_table:
+        condition = "c.oid = to_regclass(%(table_name)s)"
+    else:
+        # Temporary tables are specific to a session and don't get cached
+        condition = """
+            n.nspname NOT IN ('pg_catalog', 'information_schema')
+            AND n.nspname NOT LIKE 'pg\\_toast%'
+            AND n.nspname NOT LIKE 'pg\\_temp\\_%'
+        """
+    return _SCHEMA_METADATA_QUERY % {'condition': condition}
+
+
+def _decode_json_column(value: Union[str, list, None]) -> list:
+    """JSON values don't get decoded automatically (see handler's connect())."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+class DatabaseSchemaMetadata(object):
+    """Primary keys, columns with their types and foreign keys of database tables.
+
+    Tables are looked up by their name, optionally prefixed with schema ("public.stories"); unqualified names refer to
+    tables in "public" schema if there's more than one table with the same name."""
+
+    # Table name (both qualified and unqualified) -> table metadata dictionary
+    __tables = None
+
+    def __init__(self):
+        self.__tables = {}
+
+    def add_tables(self, rows: List[Dict[str, Any]]) -> None:
+        """Add metadata of tables from rows returned by schema_metadata_query()."""
+        for row in rows:
+            table = {
+                'schema': row['table_schema'],
+                'name': row['table_name'],
+                'columns': _decode_json_column(row['columns']),
+                'primary_key': _decode_json_column(row['primary_key']),
+                'foreign_keys': _decode_json_column(row['foreign_keys']),
+            }
+            self.__add_table(table)
+
+    def __add_table(self, table: Dict[str, Any]) -> None:
+        qualified_name = '%s.%s' % (table['schema'], table['name'])
+        self.__tables[qualified_name] = table
+
+        existing_table = self.__tables.get(table['name'], None)
+        if existing_table is None or existing_table['schema'] != 'public':
+            self.__tables[table['name']] = table
+
+    def has_table(self, table: str) -> bool:
+        """Return True if metadata of the table is known."""
+        return table in self.__tables
+
+    def __table(self, table: str) -> Dict[str, Any]:
+        if table not in self.__tables:
+            raise KeyError("Table '%s' was not found in schema metadata" % table)
+        return self.__tables[table]
+
+    def primary_key_columns(self, table: str) -> List[str]:
+        """Return list of table's primary key columns (empty list if table doesn't have a primary key)."""
+        return list(self.__table(table)['primary_key'])
+
+    def columns(self, table: str) -> List[str]:
+        """Return list of table's columns."""
+        return [column[0] for column in self.__table(table)['columns']]
+
+    def column_types(self, table: str) -> Dict[str, str]:
+        """Return ordered dictionary of table's columns and their types (e.g. "character varying(255)")."""
+        return collections.OrderedDict([(column[0], column[1]) for column in self.__table(table)['columns']])
+
+    def foreign_keys(self, table: str) -> List[Dict[str, Any]]:
+        """Return list of table's foreign keys; each foreign key is a dictionary with "constraint_name", "columns",
+        "foreign_table_schema", "foreign_table_name" and "foreign_columns" keys."""
+        return copy.deepcopy(self.__table(table)['foreign_keys'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return metadata as a JSON-serializable dictionary."""
+        tables = {}
+        for table in self.__tables.values():
+            tables['%s.%s' % (table['schema'], table['name'])] = table
+        return {'tables': list(tables.values())}
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'DatabaseSchemaMetadata':
+        """Create metadata object from the dictionary returned by to_dict()."""
+        metadata = DatabaseSchemaMetadata()
+        for table in data['tables']:
+            metadata.__add_table(table)
+        return metadata
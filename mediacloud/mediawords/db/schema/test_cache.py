@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+from mediawords.db.schema.cache import (cached_target_schema_version, schema_version_check_is_cached,
+                                        cache_schema_version_check, cached_schema_metadata, cache_schema_metadata)
+from mediawords.db.schema.metadata import DatabaseSchemaMetadata
+
+
+def __write_schema(path: str, version: int) -> None:
+    with open(path, 'w') as f:
+        f.write("MEDIACLOUD_DATABASE_SCHEMA_VERSION CONSTANT INT := %d;\n" % version)
+
+
+def test_cached_target_schema_version():
+    temp_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(temp_dir, 'cache')
+    schema_path = os.path.join(temp_dir, 'mediawords.sql')
+
+    __write_schema(path=schema_path, version=4588)
+    assert cached_target_schema_version(schema_path=schema_path, cache_dir=cache_dir) == 4588
+    assert os.path.isdir(cache_dir)
+
+    # Cached version gets returned without reading the schema file
+    os.chmod(schema_path, 0o000)
+    try:
+        if not os.access(schema_path, os.R_OK):
+            assert cached_target_schema_version(schema_path=schema_path, cache_dir=cache_dir) == 4588
+    finally:
+        os.chmod(schema_path, 0o644)
+
+    # Changed schema file invalidates the cache
+    __write_schema(path=schema_path, version=45890)
+    assert cached_target_schema_version(schema_path=schema_path, cache_dir=cache_dir) == 45890
+
+
+def test_schema_version_check_cache():
+    cache_dir = tempfile.mkdtemp()
+
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud',
+                                          target_schema_version=4588, max_age=60) is False
+
+    cache_schema_version_check(cache_dir=cache_dir, database='localhost:5432/mediacloud', target_schema_version=4588)
+
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud',
+                                          target_schema_version=4588, max_age=60) is True
+
+    # Different target version, different database, expired check
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud',
+                                          target_schema_version=4589, max_age=60) is False
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud_test',
+                                          target_schema_version=4588, max_age=60) is False
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud',
+                                          target_schema_version=4588, max_age=0) is False
+
+    # Broken cache file
+    with open(os.path.join(cache_dir, 'schema_version_checks.json'), 'w') as f:
+        f.write('{')
+    assert schema_version_check_is_cached(cache_dir=cache_dir, database='localhost:5432/mediacloud',
+                                          target_schema_version=4588, max_age=60) is False
+
+
+def test_schema_metadata_cache():
+    cache_dir = tempfile.mkdtemp()
+
+    metadata = DatabaseSchemaMetadata()
+    metadata.add_tables([{
+        'table_schema': 'public',
+        'table_name': 'stories',
+        'columns': '[["stories_id", "integer"], ["title", "text"]]',
+        'primary_key': '["stories_id"]',
+        'foreign_keys': None,
+    }])
+
+    assert cached_schema_metadata(cache_dir=cache_dir,
+                                  database='localhost:5432/mediacloud',
+                                  schema_version=4588) is None
+
+    cache_schema_metadata(cache_dir=cache_dir,
+                          database='localhost:5432/mediacloud',
+                          schema_version=4588,
+                          metadata=metadata.to_dict())
+
+    assert cached_schema_metadata(cache_dir=cache_dir,
+                                  database='localhost:5432/mediacloud',
+                                  schema_version=4589) is None
+    assert cached_schema_metadata(cache_dir=cache_dir, database='localhost:5432/other', schema_version=4588) is None
+
+    cached = cached_schema_metadata(cache_dir=cache_dir, database='localhost:5432/mediacloud', schema_version=4588)
+    cached_metadata = DatabaseSchemaMetadata.from_dict(cached)
+    assert cached_metadata.primary_key_columns('stories') == ['stories_id']
+    assert cached_metadata.primary_key_columns('public.stories') == ['stories_id']
+    assert cached_metadata.columns('stories') == ['stories_id', 'title']
+    assert cached_metadata.column_types('stories') == {'stories_id': 'integer', 'title': 'text'}
+    assert cached_metadata.foreign_keys('stories') == []
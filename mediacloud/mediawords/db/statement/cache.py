@@ -0,0 +1,254 @@
+import collections
+import re
+from typing import Dict, Union, List
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import DictCursor
+
+from mediawords.db.statement.placeholders import (psycopg2_to_numbered_placeholders, numbered_placeholder_values,
+                                                   McNumberedPlaceholdersException)
+from mediawords.util.log import create_logger
+
+log = create_logger(__name__)
+
+# Statements that PostgreSQL is able to PREPARE
+_PREPARABLE_QUERY_REGEX = re.compile(
+    r'^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(?:SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b',
+    re.IGNORECASE | re.DOTALL
+)
+
+# Parameter types which get inferred for placeholders PostgreSQL can't figure out a better type for
+_TEXT_PARAMETER_TYPES = {'text', 'unknown', 'character varying', 'character'}
+
+# Error codes after which the prepared statement can't be used anymore
+_INVALIDATED_STATEMENT_PGCODES = {
+    '0A000',  # feature_not_supported, e.g. "cached plan must not change result type" after schema change
+    '26000',  # invalid_sql_statement_name, e.g. after DISCARD ALL
+}
+
+
+class _PreparedStatement(object):
+    """Server-side prepared statement."""
+
+    __slots__ = ['name', 'execute_sql', 'param_names', 'text_params']
+
+    def __init__(self, name: str, execute_sql: str, param_names: Union[List[str], None]):
+        self.name = name
+        self.execute_sql = execute_sql
+        self.param_names = param_names  # None for positional ("%s") parameters
+        self.text_params = set()  # indexes of parameters which PostgreSQL has inferred to be strings
+
+
+class DatabasePreparedStatementCache(object):
+    """Per-connection cache of server-side prepared statements.
+
+    Counts executions of each parameterized query, and once a query gets executed "threshold" times, PREPAREs it and
+    runs further executions with EXECUTE so that PostgreSQL doesn't have to parse and plan it again. At most "max_size"
+    statements get kept prepared; least recently used ones get DEALLOCATEd."""
+
+    # Number of executions after which the query gets prepared
+    __threshold = None
+
+    # Max. number of prepared statements
+    __max_size = None
+
+    # Query -> number of executions so far (None if query can't be prepared); least recently used first
+    __counts = None
+
+    # Query -> _PreparedStatement; least recently used first
+    __statements = None
+
+    # Counter for generating statement names
+    __statement_counter = 0
+
+    # Statistics counters
+    __stats = None
+
+    def __init__(self, threshold: int = 5, max_size: int = 100):
+        self.__threshold = max(1, threshold)
+        self.__max_size = max(1, max_size)
+        self.__counts = collections.OrderedDict()
+        self.__statements = collections.OrderedDict()
+        self.__stats = {
+            'prepared': 0,
+            'executed': 0,
+            'evicted': 0,
+            'unpreparable': 0,
+            'invalidated': 0,
+        }
+
+    def stats(self) -> Dict[str, int]:
+        """Return prepared statement counters."""
+        stats = self.__stats.copy()
+        stats['size'] = len(self.__statements)
+        stats['max_size'] = self.__max_size
+        return stats
+
+    def execute(self, cursor: DictCursor, query: str, params: Union[dict, tuple, list]) -> None:
+        """Execute (percentage sign-escaped) psycopg2 query, using prepared statement if the query is hot enough."""
+
+        statement = self.__statement(cursor=cursor, query=query, params=params)
+        if statement is None:
+            cursor.execute(query, params)
+            return
+
+        try:
+            cursor.execute(statement.execute_sql, params)
+            self.__stats['executed'] += 1
+
+        except psycopg2.Error as ex:
+            if ex.pgcode not in _INVALIDATED_STATEMENT_PGCODES:
+                raise
+
+            log.debug("Prepared statement %s got invalidated: %s" % (statement.name, str(ex)))
+            self.__stats['invalidated'] += 1
+            del self.__statements[query]
+            self.__counts.pop(query, None)
+
+            # Within a transaction, the transaction is aborted already
+            if cursor.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raise
+
+            self.__deallocate(cursor=cursor, name=statement.name)
+            cursor.execute(query, params)
+
+    def deallocate_all(self, cursor: DictCursor) -> None:
+        """DEALLOCATE all prepared statements and forget execution counts."""
+        for statement in self.__statements.values():
+            self.__deallocate(cursor=cursor, name=statement.name)
+        self.__statements.clear()
+        self.__counts.clear()
+
+    @staticmethod
+    def __deallocate(cursor: DictCursor, name: str) -> None:
+        try:
+            cursor.execute('DEALLOCATE %s' % name)
+        except psycopg2.Error as ex:
+            log.debug("Unable to deallocate prepared statement %s: %s" % (name, str(ex)))
+
+    def __statement(self, cursor: DictCursor, query: str, params: Union[dict, tuple, list]) \
+            -> Union[_PreparedStatement, None]:
+        """Return prepared statement to execute the query with, or None if the query is to be executed directly."""
+
+        if len(params) == 0:
+            return None
+
+        statement = self.__statements.get(query, None)
+        if statement is not None:
+            self.__statements.move_to_end(query)
+
+            # Parameter which PostgreSQL treats as text got passed something that's not a string this time
+            values = numbered_placeholder_values(params=params, param_names=statement.param_names)
+            for index, value in enumerate(values):
+                if index in statement.text_params and not (value is None or isinstance(value, str)):
+                    return None
+
+            return statement
+
+        count = self.__counts.pop(query, 0)
+        if count is None:
+            # Query is known to be unpreparable
+            self.__counts[query] = None
+            return None
+
+        count += 1
+        self.__counts[query] = count
+        while len(self.__counts) > self.__max_size * 10:
+            self.__counts.popitem(last=False)
+
+        if count < self.__threshold:
+            return None
+
+        transaction_status = cursor.connection.get_transaction_status()
+        if transaction_status not in {psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+                                      psycopg2.extensions.TRANSACTION_STATUS_INTRANS}:
+            return None
+
+        in_transaction = transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        statement = self.__prepare(cursor=cursor, query=query, params=params, in_transaction=in_transaction)
+        if statement is None:
+            self.__stats['unpreparable'] += 1
+            self.__counts[query] = None
+            return None
+
+        self.__statements[query] = statement
+        self.__stats['prepared'] += 1
+
+        while len(self.__statements) > self.__max_size:
+            _, evicted_statement = self.__statements.popitem(last=False)
+            self.__deallocate(cursor=cursor, name=evicted_statement.name)
+            self.__stats['evicted'] += 1
+
+        return statement
+
+    def __prepare(self, cursor: DictCursor, query: str, params: Union[dict, tuple, list], in_transaction: bool) \
+            -> Union[_PreparedStatement, None]:
+        """PREPARE the query; return None if the query can't (or shouldn't) be prepared."""
+
+        if not _PREPARABLE_QUERY_REGEX.match(query):
+            return None
+
+        # Multiple statements
+        if ';' in query.rstrip().rstrip(';'):
+            return None
+
+        try:
+            prepare_sql, param_names, placeholder_count = psycopg2_to_numbered_placeholders(query=query, params=params)
+        except McNumberedPlaceholdersException:
+            return None
+
+        if isinstance(params, dict):
+            if placeholder_count == 0:
+                return None
+            execute_params = ', '.join(['%%(%s)s' % name for name in param_names])
+        else:
+            if placeholder_count != len(params):
+                return None
+            execute_params = ', '.join(['%s'] * placeholder_count)
+            param_names = None
+
+        values = numbered_placeholder_values(params=params, param_names=param_names)
+
+        # IN %(tuple)s lists get interpolated into a varying number of values which can't be a single parameter
+        if any(isinstance(value, tuple) for value in values):
+            return None
+
+        self.__statement_counter += 1
+        name = 'mc_stmt_%d' % self.__statement_counter
+
+        if in_transaction:
+            cursor.execute('SAVEPOINT mc_prepare')
+
+        try:
+            # No parameters are passed so that psycopg2 doesn't try to interpolate anything
+            cursor.execute('PREPARE %s AS %s' % (name, prepare_sql))
+        except psycopg2.Error as ex:
+            log.debug("Unable to prepare query: %s; query: %s" % (str(ex), query))
+            if in_transaction:
+                cursor.execute('ROLLBACK TO SAVEPOINT mc_prepare')
+                cursor.execute('RELEASE SAVEPOINT mc_prepare')
+            return None
+
+        if in_transaction:
+            cursor.execute('RELEASE SAVEPOINT mc_prepare')
+
+        statement = _PreparedStatement(name=name,
+                                       execute_sql='EXECUTE %s (%s)' % (name, execute_params),
+                                       param_names=param_names)
+
+        cursor.execute('SELECT parameter_types::TEXT[] FROM pg_prepared_statements WHERE name = %(name)s',
+                       {'name': name})
+        parameter_types = cursor.fetchone()[0]
+
+        for index, parameter_type in enumerate(parameter_types):
+            if parameter_type in _TEXT_PARAMETER_TYPES:
+                if not (values[index] is None or isinstance(values[index], str)):
+                    # PostgreSQL would return / compare the value as a string instead of whatever it is
+                    self.__deallocate(cursor=cursor, name=name)
+                    return None
+                statement.text_params.add(index)
+
+        log.debug("Prepared statement %s: %s" % (name, query))
+
+        return statement
@@ -0,0 +1,164 @@
+import re
+from typing import Any, List, Tuple, Union
+
+# psycopg2 placeholders and escaped percentage signs
+_PLACEHOLDER_REGEX = re.compile(r'%%|%\(([^)]*)\)s|%s')
+
+
+class McNumberedPlaceholdersException(Exception):
+    """psycopg2_to_numbered_placeholders() exception."""
+    pass
+
+
+def psycopg2_to_numbered_placeholders(query: str,
+                                      params: Union[dict, tuple, list],
+                                      unescape_percentage_signs: bool = True) -> Tuple[str, List[str], int]:
+    """Convert psycopg2-style query ("%(name)s" or "%s" placeholders) to PostgreSQL's numbered placeholders ("$1").
+
+    Returns tuple of converted query, list of parameter names in placeholder number order (for dictionary parameters;
+    empty list for positional ones) and number of placeholders. If "unescape_percentage_signs" is True, "%%" gets
+    converted to "%" as psycopg2 would do; otherwise it's left as is."""
+
+    param_names = []
+    placeholder_numbers = {}
+    positional_count = 0
+    named = isinstance(params, dict)
+
+    def __replace_placeholder(match) -> str:
+        nonlocal positional_count
+
+        if match.group(0) == '%%':
+            return '%' if unescape_percentage_signs else '%%'
+
+        name = match.group(1)
+        if name is None:
+            if named:
+                raise McNumberedPlaceholdersException("Positional placeholder with dictionary parameters")
+            positional_count += 1
+            return '$%d' % positional_count
+
+        if not named:
+            raise McNumberedPlaceholdersException("Named placeholder with positional parameters")
+        if name not in placeholder_numbers:
+            param_names.append(name)
+            placeholder_numbers[name] = len(param_names)
+        return '$%d' % placeholder_numbers[name]
+
+    numbered_query = _PLACEHOLDER_REGEX.sub(__replace_placeholder, query)
+
+    placeholder_count = len(param_names) if named else positional_count
+
+    return numbered_query, param_names, placeholder_count
+
+
+def expand_tuple_parameters(query: str, params: Union[dict, tuple, list]) -> Tuple[str, Union[dict, tuple, list]]:
+    """Expand tuple parameter values (e.g. "IN %(ids)s" with {'ids': (1, 2, 3)}) into a list of placeholders, one for
+    each tuple item, just like psycopg2 does when it interpolates a tuple."""
+
+    if isinstance(params, dict):
+        if not any(isinstance(value, tuple) for value in params.values()):
+            return query, params
+    else:
+        if not any(isinstance(value, tuple) for value in params):
+            return query, params
+
+    expanded_params = {} if isinstance(params, dict) else []
+    positional_index = 0
+
+    def __expand_placeholder(match) -> str:
+        nonlocal positional_index
+
+        if match.group(0) == '%%':
+            return match.group(0)
+
+        name = match.group(1)
+        if name is None:
+            if isinstance(params, dict) or positional_index >= len(params):
+                raise McNumberedPlaceholdersException("Placeholder doesn't match parameters: %s" % query)
+            value = params[positional_index]
+            positional_index += 1
+        else:
+            if not isinstance(params, dict) or name not in params:
+                raise McNumberedPlaceholdersException("Placeholder doesn't match parameters: %s" % query)
+            value = params[name]
+
+        if not isinstance(value, tuple):
+            if name is None:
+                expanded_params.append(value)
+            else:
+                expanded_params[name] = value
+            return match.group(0)
+
+        if len(value) == 0:
+            raise McNumberedPlaceholdersException("Tuple parameter is empty: %s" % query)
+
+        placeholders = []
+        for index, item in enumerate(value):
+            if name is None:
+                expanded_params.append(item)
+                placeholders.append('%s')
+            else:
+                item_name = '%s__%d' % (name, index)
+                expanded_params[item_name] = item
+                placeholders.append('%%(%s)s' % item_name)
+
+        return '(%s)' % ', '.join(placeholders)
+
+    expanded_query = _PLACEHOLDER_REGEX.sub(__expand_placeholder, query)
+
+    if isinstance(params, dict):
+        # Parameters which are not referenced by any placeholder
+        for name, value in params.items():
+            if name not in expanded_params and not isinstance(value, tuple):
+                expanded_params[name] = value
+    else:
+        expanded_params = tuple(expanded_params)
+
+    return expanded_query, expanded_params
+
+
+def prefix_placeholders(query: str, params: Union[dict, tuple, list, None], prefix: str) -> Tuple[str, dict]:
+    """Rename query's placeholders (both "%(name)s" and "%s") to "%(<prefix><name>)s" / "%(<prefix><index>)s", return
+    the query and dictionary parameters; used to merge queries with their own parameters into a single query."""
+
+    if params is None:
+        params = ()
+
+    prefixed_params = {}
+    positional_index = 0
+
+    def __prefix_placeholder(match) -> str:
+        nonlocal positional_index
+
+        if match.group(0) == '%%':
+            return match.group(0)
+
+        name = match.group(1)
+        if name is None:
+            if isinstance(params, dict) or positional_index >= len(params):
+                raise McNumberedPlaceholdersException("Placeholder doesn't match parameters: %s" % query)
+            value = params[positional_index]
+            name = str(positional_index)
+            positional_index += 1
+        else:
+            if not isinstance(params, dict) or name not in params:
+                raise McNumberedPlaceholdersException("Placeholder doesn't match parameters: %s" % query)
+            value = params[name]
+
+        prefixed_params[prefix + name] = value
+        return '%%(%s%s)s' % (prefix, name)
+
+    prefixed_query = _PLACEHOLDER_REGEX.sub(__prefix_placeholder, query)
+
+    if not isinstance(params, dict) and positional_index != len(params):
+        raise McNumberedPlaceholdersException("Parameters don't match placeholders: %s" % query)
+
+    return prefixed_query, prefixed_params
+
+
+def numbered_placeholder_values(params: Union[dict, tuple, list], param_names: Union[List[str], None]) -> List[Any]:
+    """Return parameter values in numbered placeholder order."""
+    if isinstance(params, dict):
+        return [params[name] for name in param_names]
+    else:
+        return list(params)
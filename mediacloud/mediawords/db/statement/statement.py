@@ -4,6 +4,7 @@ from typing import Any
 
 from mediawords.db.exceptions.handler import McPrepareException
 from mediawords.db.result.result import DatabaseResult
+from mediawords.db.statement.cache import DatabasePreparedStatementCache
 from mediawords.util.log import create_logger
 from mediawords.util.perl import convert_dbd_pg_arguments_to_psycopg2_format, decode_object_from_bytes_if_needed
 
@@ -25,10 +26,16 @@ class DatabaseStatement(object):
     # "Double percentage sign" marker (see handler's quote() for explanation)
     __double_percentage_sign_marker = None
 
-    def __init__(self, cursor: DictCursor, sql: str, double_percentage_sign_marker: str):
+    # Handler's prepared statement cache (None if disabled)
+    __statement_cache = None
+
+    def __init__(self, cursor: DictCursor, sql: str, double_percentage_sign_marker: str,
+                 statement_cache: DatabasePreparedStatementCache = None):
 
         sql = decode_object_from_bytes_if_needed(sql)
 
+        self.__statement_cache = statement_cache
+
         self.__prepare(cursor=cursor, sql=sql, double_percentage_sign_marker=double_percentage_sign_marker)
 
     def __prepare(self, cursor: DictCursor, sql: str, double_percentage_sign_marker: str) -> None:
@@ -83,4 +90,5 @@ class DatabaseStatement(object):
 
         return DatabaseResult(cursor=self.__cursor,
                               query_args=query_args,
-                              double_percentage_sign_marker=self.__double_percentage_sign_marker)
+                              double_percentage_sign_marker=self.__double_percentage_sign_marker,
+                              statement_cache=self.__statement_cache)
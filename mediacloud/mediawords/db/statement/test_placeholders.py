@@ -0,0 +1,56 @@
+import pytest
+
+from mediawords.db.statement.placeholders import (psycopg2_to_numbered_placeholders, numbered_placeholder_values,
+                                                   expand_tuple_parameters, prefix_placeholders,
+                                                   McNumberedPlaceholdersException)
+
+
+def test_psycopg2_to_numbered_placeholders():
+    params = {'a': 1, 'b': 'x'}
+    query, names, count = psycopg2_to_numbered_placeholders("SELECT %(a)s, %(b)s, %(a)s, '%%'", params)
+    assert query == "SELECT $1, $2, $1, '%'"
+    assert names == ['a', 'b']
+    assert count == 2
+    assert numbered_placeholder_values(params=params, param_names=names) == [1, 'x']
+
+    query, names, count = psycopg2_to_numbered_placeholders("SELECT %s, %s LIKE 'a%%'", (1, 2),
+                                                            unescape_percentage_signs=False)
+    assert query == "SELECT $1, $2 LIKE 'a%%'"
+    assert count == 2
+    assert numbered_placeholder_values(params=(1, 2), param_names=names) == [1, 2]
+
+    with pytest.raises(McNumberedPlaceholdersException):
+        psycopg2_to_numbered_placeholders("SELECT %s", {'a': 1})
+    with pytest.raises(McNumberedPlaceholdersException):
+        psycopg2_to_numbered_placeholders("SELECT %(a)s", (1,))
+
+
+def test_expand_tuple_parameters():
+    query, params = expand_tuple_parameters("SELECT %(a)s WHERE id IN %(ids)s", {'a': 1, 'ids': (2, 3)})
+    assert query == "SELECT %(a)s WHERE id IN (%(ids__0)s, %(ids__1)s)"
+    assert params == {'a': 1, 'ids__0': 2, 'ids__1': 3}
+
+    query, params = expand_tuple_parameters("SELECT %s WHERE id IN %s", (1, (2, 3)))
+    assert query == "SELECT %s WHERE id IN (%s, %s)"
+    assert params == (1, 2, 3)
+
+    # Nothing to expand
+    assert expand_tuple_parameters("SELECT %s", (1,)) == ("SELECT %s", (1,))
+
+    with pytest.raises(McNumberedPlaceholdersException):
+        expand_tuple_parameters("SELECT %(ids)s", {'ids': ()})
+
+
+def test_prefix_placeholders():
+    query, params = prefix_placeholders("SELECT %(a)s, %(a)s LIKE 'x%%'", {'a': 1, 'unused': 2}, prefix='p_')
+    assert query == "SELECT %(p_a)s, %(p_a)s LIKE 'x%%'"
+    assert params == {'p_a': 1}
+
+    query, params = prefix_placeholders("SELECT %s, %s", (1, 2), prefix='p_')
+    assert query == "SELECT %(p_0)s, %(p_1)s"
+    assert params == {'p_0': 1, 'p_1': 2}
+
+    assert prefix_placeholders("SELECT 1", None, prefix='p_') == ("SELECT 1", {})
+
+    with pytest.raises(McNumberedPlaceholdersException):
+        prefix_placeholders("SELECT %s", (1, 2), prefix='p_')
@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import os
+import subprocess
+import sys
+
+import pytest
+
+from mediawords.db import connect_to_db_async
+from mediawords.db.async_handler import AsyncDatabaseHandler
+from mediawords.db.copy.copy_from import McCopyFromException
+from mediawords.db.exceptions.handler import McFindOrCreateException, McBeginException
+from mediawords.db.exceptions.result import McDatabaseResultException
+from mediawords.test.test_database import TestDatabaseTestCase
+from mediawords.util.log import create_logger
+
+log = create_logger(__name__)
+
+
+# noinspection SqlResolve,SpellCheckingInspection
+class TestAsyncDatabaseHandler(TestDatabaseTestCase):
+    __loop = None
+    __async_db = None
+
+    def setUp(self):
+
+        TestDatabaseTestCase.setUp(self)
+
+        log.info("Preparing test table 'kardashians'...")
+        self.db().query("DROP TABLE IF EXISTS kardashians")
+        self.db().query("""
+            CREATE TABLE kardashians (
+                id SERIAL PRIMARY KEY NOT NULL,
+                name VARCHAR UNIQUE NOT NULL,   -- UNIQUE to test find_or_create()
+                surname TEXT NOT NULL,
+                dob DATE NOT NULL,
+                married_to_kanye BOOL NOT NULL DEFAULT 'f'
+            )
+        """)
+        self.db().query("""
+            INSERT INTO kardashians (name, surname, dob, married_to_kanye) VALUES
+            ('Kris', 'Jenner', '1955-11-05'::DATE, 'f'),          -- id=1
+            ('Caitlyn', 'Jenner', '1949-10-28'::DATE, 'f'),       -- id=2
+            ('Kourtney', 'Kardashian', '1979-04-18'::DATE, 'f'),  -- id=3
+            ('Kim', 'Kardashian', '1980-10-21'::DATE, 't'),       -- id=4
+            ('Khloé', 'Kardashian', '1984-06-27'::DATE, 'f'),     -- id=5; also, UTF-8
+            ('Rob', 'Kardashian', '1987-03-17'::DATE, 'f'),       -- id=6
+            ('Kendall', 'Jenner', '1995-11-03'::DATE, 'f'),       -- id=7
+            ('Kylie', 'Jenner', '1997-08-10'::DATE, 'f')          -- id=8
+        """)
+
+        self.__loop = asyncio.new_event_loop()
+        self.__async_db = self.__run(connect_to_db_async(label='test', max_size=4))
+
+    def tearDown(self):
+        log.info("Tearing down...")
+        self.__run(self.__async_db.disconnect())
+        self.__loop.close()
+
+        self.db().query("DROP TABLE IF EXISTS kardashians")
+
+        super(TestDatabaseTestCase, self).tearDown()
+
+    def __run(self, coroutine):
+        return self.__loop.run_until_complete(coroutine)
+
+    def async_db(self) -> AsyncDatabaseHandler:
+        return self.__async_db
+
+    def test_query(self):
+
+        # psycopg2 style + UTF-8
+        result = self.__run(self.async_db().query(
+            "SELECT * FROM kardashians WHERE name = %(name)s", {'name': 'Khloé'}
+        ))
+        assert result.columns() == ['id', 'name', 'surname', 'dob', 'married_to_kanye']
+        assert result.rows() == 1
+        row = result.hash()
+        assert row['surname'] == 'Kardashian'
+        assert row['dob'] == datetime.date(1984, 6, 27)
+        assert result.hash() is None
+
+        # DBD::Pg style
+        result = self.__run(self.async_db().query("SELECT name FROM kardashians WHERE id IN (?, ?) ORDER BY id", 1, 2))
+        assert result.flat() == ['Kris', 'Caitlyn']
+
+        # Tuple parameter
+        result = self.__run(self.async_db().query(
+            "SELECT name FROM kardashians WHERE id IN %(ids)s ORDER BY id", {'ids': (3, 4)}
+        ))
+        assert result.flat() == ['Kourtney', 'Kim']
+
+        # Literal percentage signs
+        result = self.__run(self.async_db().query(
+            "SELECT COUNT(*) FROM kardashians WHERE name LIKE 'K%' AND surname = %(surname)s", {'surname': 'Jenner'}
+        ))
+        assert result.flat() == [3]
+
+        # Number of affected rows
+        result = self.__run(self.async_db().query("UPDATE kardashians SET married_to_kanye = 'f'"))
+        assert result.rows() == 8
+
+        # Multiple statements
+        self.__run(self.async_db().query("""
+            UPDATE kardashians SET married_to_kanye = 't' WHERE id = 4;
+            UPDATE kardashians SET surname = surname WHERE id = 4;
+        """))
+        assert self.db().find_by_id('kardashians', 4)['married_to_kanye'] is True
+
+        with pytest.raises(McDatabaseResultException):
+            self.__run(self.async_db().query("SELECT * FROM nonexistent_table"))
+
+    def test_concurrent_queries(self):
+
+        async def __find_all():
+            return await asyncio.gather(*[self.async_db().find_by_id('kardashians', i) for i in range(1, 9)] * 10)
+
+        rows = self.__run(__find_all())
+        assert len(rows) == 80
+        assert [row['id'] for row in rows[:8]] == list(range(1, 9))
+        assert rows[4]['name'] == 'Khloé'
+
+    def test_crud(self):
+        db = self.async_db()
+
+        assert self.__run(db.primary_key_column('kardashians')) == 'id'
+
+        assert self.__run(db.find_by_id('kardashians', 100)) is None
+        assert self.__run(db.require_by_id('kardashians', 4))['name'] == 'Kim'
+
+        created = self.__run(db.create('kardashians', {
+            'name': 'North',
+            'surname': 'West',
+            'dob': datetime.date(2013, 6, 15),
+        }))
+        assert created['id'] == 9
+        assert created['married_to_kanye'] is False
+
+        updated = self.__run(db.update_by_id('kardashians', created['id'], {'surname': 'Kardashian West'}))
+        assert updated['surname'] == 'Kardashian West'
+        assert self.__run(db.update_by_id('kardashians', 100, {'surname': 'Nobody'})) is None
+
+        jenners = self.__run(db.select('kardashians', 'name', {'surname': 'Jenner'})).flat()
+        assert sorted(jenners) == ['Caitlyn', 'Kendall', 'Kris', 'Kylie']
+
+        found = self.__run(db.find_or_create('kardashians', {'name': 'Kim', 'surname': 'Kardashian'}))
+        assert found['id'] == 4
+
+        created = self.__run(db.find_or_create('kardashians', {
+            'name': 'Saint',
+            'surname': 'West',
+            'dob': datetime.date(2015, 12, 5),
+        }))
+        assert created['id'] == 10
+
+        with pytest.raises(McFindOrCreateException):
+            self.__run(db.find_or_create('kardashians', {'name': 'Kim', 'surname': 'West'}))
+
+        self.__run(db.delete_by_id('kardashians', created['id']))
+        assert self.db().find_by_id('kardashians', created['id']) is None
+
+    def test_transaction(self):
+        db = self.async_db()
+
+        with pytest.raises(McBeginException):
+            self.__run(db.begin())
+
+        async def __commit():
+            async with db.transaction() as tx_db:
+                assert tx_db.in_transaction()
+                await tx_db.update_by_id('kardashians', 1, {'surname': 'Jenner-Kardashian'})
+
+                # Not visible outside of the transaction yet
+                assert (await db.find_by_id('kardashians', 1))['surname'] == 'Jenner'
+
+        self.__run(__commit())
+        assert self.db().find_by_id('kardashians', 1)['surname'] == 'Jenner-Kardashian'
+
+        async def __rollback():
+            async with db.transaction() as tx_db:
+                await tx_db.delete_by_id('kardashians', 1)
+                raise ValueError("Roll back")
+
+        with pytest.raises(ValueError):
+            self.__run(__rollback())
+        assert self.db().find_by_id('kardashians', 1) is not None
+
+        async def __acquired():
+            tx_db = await db.acquire()
+            try:
+                await tx_db.begin()
+                await tx_db.delete_by_id('kardashians', 2)
+                await tx_db.rollback()
+            finally:
+                await tx_db.release()
+
+        self.__run(__acquired())
+        assert self.db().find_by_id('kardashians', 2) is not None
+
+    def test_copy_from(self):
+        db = self.async_db()
+
+        async def __copy():
+            copy = await db.copy_from("COPY kardashians (name, surname, dob, married_to_kanye) FROM STDIN")
+            await copy.put_line("Lamar\tOdom\t1979-11-06\tf\n")
+            await copy.put_rows([['Scott', 'Disick', '1983-05-26', False]])
+            await copy.end()
+
+            copy = await db.copy_from("COPY kardashians (name, surname, dob) FROM STDIN WITH (FORMAT csv)")
+            for i in range(5000):
+                await copy.put_line("Name %d,Surname,2000-01-01" % i)
+            await copy.end()
+
+        self.__run(__copy())
+
+        assert self.db().query("SELECT surname FROM kardashians WHERE name = 'Lamar'").flat() == ['Odom']
+        assert self.db().query("SELECT married_to_kanye FROM kardashians WHERE name = 'Scott'").flat() == [False]
+        assert self.db().query("SELECT COUNT(*) FROM kardashians WHERE surname = 'Surname'").flat() == [5000]
+
+        async def __copy_duplicate():
+            copy = await db.copy_from("COPY kardashians (name, surname, dob) FROM STDIN")
+            await copy.put_line("Kim\tKardashian\t1980-10-21")
+            await copy.end()
+
+        with pytest.raises(McCopyFromException):
+            self.__run(__copy_duplicate())
+
+        with pytest.raises(McCopyFromException):
+            self.__run(db.copy_from("COPY kardashians TO STDOUT"))
+
+        # Connections got released after COPY
+        assert self.__run(db.query("SELECT 1")).flat() == [1]
+
+
+def test_db_import_does_not_load_asyncpg():
+    # Perl code imports "mediawords.db" through Inline::Python and shouldn't have to load asyncpg
+    output = subprocess.check_output([
+        sys.executable, '-c', "import sys, mediawords.db; print('asyncpg' in sys.modules)",
+    ], cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    assert output.decode('utf-8').strip() == 'False'
@@ -1,5 +1,9 @@
+import datetime
+
 import pytest
 
+from mediawords.db.copy.copy_from import McCopyFromException
+from mediawords.db.copy.copy_to import McCopyToException
 from mediawords.db.exceptions.result import McDatabaseResultException
 from mediawords.db.handler import *
 from mediawords.test.test_database import TestDatabaseTestCase
@@ -287,6 +291,87 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         assert len(hashes[1]) == 5
         assert hashes[1]['name'] == 'Kris'
 
+    def test_query_stream(self):
+        sql = "SELECT * FROM kardashians WHERE surname = ? ORDER BY id"
+
+        # Outside of transaction
+        names = [row['name'] for row in self.db().query_stream(sql, 'Jenner', itersize=2).iter_hashes()]
+        assert names == ['Kris', 'Caitlyn', 'Kendall', 'Kylie']
+
+        # Within transaction
+        self.db().begin()
+        rows = list(self.db().query_stream(sql, 'Kardashian', itersize=1).iter_arrays())
+        self.db().commit()
+        assert len(rows) == 4
+        assert rows[0][1] == 'Kourtney'
+
+        # Cursor gets closed after abandoning the iterator
+        result = self.db().query_stream("SELECT * FROM generate_series(1, 100)", itersize=10)
+        iterator = result.iter_arrays()
+        assert next(iterator) == [1]
+        iterator.close()
+        open_cursors = self.db().query("SELECT COUNT(*) FROM pg_cursors WHERE name LIKE 'mc_stream_%'").flat()[0]
+        assert open_cursors == 0
+
+        # Invalid query
+        with pytest.raises(McDatabaseResultException):
+            self.db().query_stream("SELECT * FROM nonexistent_table")
+
+    def test_columns_as_arrays(self):
+        import array
+        import numpy
+
+        sql = "SELECT id, name, married_to_kanye, id * 1.5::FLOAT AS score FROM kardashians WHERE surname = %(surname)s"
+
+        # Regular cursor
+        columns = self.db().query(sql + " ORDER BY id", {'surname': 'Jenner'}).columns_as_arrays()
+        assert isinstance(columns['id'], array.array)
+        assert list(columns['id']) == [1, 2, 7, 8]
+        assert columns['name'] == ['Kris', 'Caitlyn', 'Kendall', 'Kylie']
+        assert list(columns['married_to_kanye']) == [0, 0, 0, 0]
+        assert list(columns['score']) == [1.5, 3.0, 10.5, 12.0]
+
+        # Server-side cursor in chunks
+        chunks = list(self.db().query_stream(sql + " ORDER BY id", {'surname': 'Kardashian'}).iter_columns_as_arrays(
+            chunk_size=3, use_numpy=True,
+        ))
+        assert [list(chunk['id']) for chunk in chunks] == [[3, 4, 5], [6]]
+        assert chunks[0]['married_to_kanye'].dtype == numpy.bool_
+        assert list(chunks[0]['married_to_kanye']) == [False, True, False]
+
+        # Binary COPY TO, vectorized
+        columns = self.db().query_columns_as_arrays(
+            "SELECT id, id::SMALLINT AS small_id, married_to_kanye, id * 1.5::FLOAT AS score, 100 AS percent "
+            "FROM kardashians WHERE name LIKE 'K%' ORDER BY id",
+            use_numpy=True,
+        )
+        assert columns['id'].dtype == numpy.int32
+        assert columns['small_id'].dtype == numpy.int16
+        assert list(columns['id']) == [1, 3, 4, 5, 7, 8]
+        assert list(columns['small_id']) == [1, 3, 4, 5, 7, 8]
+        assert list(columns['married_to_kanye']) == [False, False, True, False, False, False]
+        assert list(columns['score']) == [1.5, 4.5, 6.0, 7.5, 10.5, 12.0]
+
+        # Binary COPY TO, with strings and NULLs
+        columns = self.db().query_columns_as_arrays(
+            "SELECT id::BIGINT, name, NULLIF(id, 4)::FLOAT8 AS score FROM kardashians WHERE surname = ? ORDER BY id",
+            'Kardashian',
+        )
+        assert columns['id'].typecode == 'q'
+        assert list(columns['id']) == [3, 4, 5, 6]
+        assert columns['name'] == ['Kourtney', 'Kim', 'Khloé', 'Rob']
+        assert numpy.isnan(columns['score'][1])
+        assert columns['score'][2] == 5.0
+
+        # Unsupported types get fetched with a regular cursor
+        columns = self.db().query_columns_as_arrays("SELECT id, dob FROM kardashians WHERE id = 1")
+        assert list(columns['id']) == [1]
+        assert columns['dob'][0].year == 1955
+
+        # NULLs in integer columns
+        with pytest.raises(McDatabaseResultException):
+            self.db().query_columns_as_arrays("SELECT NULLIF(id, 1) FROM kardashians")
+
     def test_prepare(self):
 
         # Basic
@@ -428,6 +513,93 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         primary_key = self.db().primary_key_column('kardashians')
         assert primary_key == 'id'
 
+    def test_schema_metadata(self):
+        assert self.db().primary_key_column(table='kardashians') == 'id'
+        assert self.db().primary_key_column(table='public.kardashians') == 'id'
+
+        # Shared between handlers
+        other_db = self._create_database_handler()
+        assert other_db.schema_metadata() is self.db().schema_metadata()
+        other_db.disconnect()
+
+        columns = self.db().table_columns(table='kardashians')
+        assert list(columns.keys()) == ['id', 'name', 'surname', 'dob', 'married_to_kanye']
+        assert columns['dob'] == 'date'
+
+        # Temporary tables
+        self.db().query("""
+            CREATE TEMPORARY TABLE metadata_parents (
+                parent_id BIGSERIAL PRIMARY KEY,
+                parent_code TEXT NOT NULL,
+                UNIQUE (parent_id, parent_code)
+            )
+        """)
+        self.db().query("""
+            CREATE TEMPORARY TABLE metadata_children (
+                child_id SERIAL PRIMARY KEY,
+                parent_id BIGINT NOT NULL REFERENCES metadata_parents (parent_id),
+                parent_code TEXT NOT NULL,
+                CONSTRAINT metadata_children_parent_fkey_2 FOREIGN KEY (parent_id, parent_code)
+                    REFERENCES metadata_parents (parent_id, parent_code)
+            )
+        """)
+        assert self.db().primary_key_column(table='metadata_children') == 'child_id'
+        assert self.db().schema_metadata().has_table('metadata_children') is False
+
+        foreign_keys = {fk['constraint_name']: fk for fk in self.db().foreign_keys(table='metadata_children')}
+        assert len(foreign_keys) == 2
+        assert foreign_keys['metadata_children_parent_id_fkey']['columns'] == ['parent_id']
+        assert foreign_keys['metadata_children_parent_id_fkey']['foreign_table_name'] == 'metadata_parents'
+        assert foreign_keys['metadata_children_parent_id_fkey']['foreign_columns'] == ['parent_id']
+        assert foreign_keys['metadata_children_parent_fkey_2']['columns'] == ['parent_id', 'parent_code']
+        assert foreign_keys['metadata_children_parent_fkey_2']['foreign_columns'] == ['parent_id', 'parent_code']
+
+        with pytest.raises(McPrimaryKeyColumnException):
+            self.db().primary_key_column(table='nonexistent_table')
+
+        # Returned metadata is a copy
+        foreign_keys = self.db().foreign_keys(table='metadata_children')
+        foreign_keys[0]['columns'].append('nonexistent_column')
+        assert 'nonexistent_column' not in self.db().foreign_keys(table='metadata_children')[0]['columns']
+
+    def test_schema_metadata_ddl(self):
+        other_db = self._create_database_handler()
+        other_db.schema_metadata()
+
+        # Dropping handler's own temporary tables (e.g. upsert_many()'s staging ones) doesn't change the schema
+        metadata = self.db().schema_metadata()
+        self.db().query("DROP TABLE IF EXISTS _tmp_upsert_test")
+        assert self.db().schema_metadata() is metadata
+
+        # DDL run through any handler invalidates metadata shared between handlers
+        self.db().query("CREATE TABLE metadata_changes (metadata_changes_id SERIAL PRIMARY KEY, name TEXT)")
+        try:
+            assert list(other_db.table_columns(table='metadata_changes').keys()) == ['metadata_changes_id', 'name']
+
+            self.db().query("ALTER TABLE metadata_changes ADD COLUMN surname TEXT")
+            assert list(other_db.table_columns(table='metadata_changes').keys()) == [
+                'metadata_changes_id', 'name', 'surname',
+            ]
+
+            self.db().query("DROP TABLE metadata_changes")
+            self.db().query("CREATE TABLE metadata_changes (other_id SERIAL PRIMARY KEY)")
+            assert other_db.primary_key_column(table='metadata_changes') == 'other_id'
+
+            # Rolled back DDL
+            self.db().begin()
+            self.db().query("ALTER TABLE metadata_changes ADD COLUMN rolled_back TEXT")
+            assert 'rolled_back' in self.db().table_columns(table='metadata_changes')
+            self.db().rollback()
+            assert 'rolled_back' not in self.db().table_columns(table='metadata_changes')
+            assert 'rolled_back' not in other_db.table_columns(table='metadata_changes')
+
+        finally:
+            self.db().query("DROP TABLE IF EXISTS metadata_changes")
+            other_db.disconnect()
+
+        with pytest.raises(McDatabaseHandlerException):
+            self.db().table_columns(table='metadata_changes')
+
     def test_find_by_id(self):
         row_hash = self.db().find_by_id(table='kardashians', object_id=4)
         assert row_hash['name'] == 'Kim'
@@ -485,6 +657,85 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         with pytest.raises(McCreateException):
             self.db().create('kardashians', {'does_not': 'exist'})
 
+    def test_create_many(self):
+
+        # Multi-row INSERT
+        ids = self.db().create_many(table='kardashians', rows=[
+            {'name': 'Lamar', 'surname': 'Odom', 'dob': '1979-11-06'},
+            {'name': 'Sam Brody', 'surname': 'Jenner', 'dob': '1983-08-21'},
+        ])
+        assert len(ids) == 2
+        assert self.db().find_by_id(table='kardashians', object_id=ids[0])['name'] == 'Lamar'
+        assert self.db().find_by_id(table='kardashians', object_id=ids[1])['name'] == 'Sam Brody'
+
+        # COPY
+        rows = [
+            {'name': 'Clone %d' % x, 'surname': "Kardashian\t\\%d\n" % x, 'dob': '2000-01-01'} for x in range(1500)
+        ]
+        ids = self.db().create_many(table='kardashians', rows=rows)
+        assert len(ids) == len(rows)
+        for x in [0, 777, 1499]:
+            row = self.db().find_by_id(table='kardashians', object_id=ids[x])
+            assert row['name'] == rows[x]['name']
+            assert row['surname'] == rows[x]['surname']
+
+        # New rows should still get IDs from the sequence
+        row = self.db().create(table='kardashians', insert_hash={
+            'name': 'Scott',
+            'surname': 'Disick',
+            'dob': '1983-05-26',
+        })
+        assert row['id'] > max(ids)
+
+        assert self.db().create_many(table='kardashians', rows=[]) == []
+
+        # Different keys
+        with pytest.raises(McCreateManyException):
+            self.db().create_many(table='kardashians', rows=[
+                {'name': 'Foo', 'surname': 'Bar', 'dob': '2000-01-01'},
+                {'name': 'Baz', 'surname': 'Bar'},
+            ])
+
+        # Nonexistent column
+        with pytest.raises(McCreateManyException):
+            self.db().create_many('kardashians', [{'does_not': 'exist'}])
+
+    def test_upsert_many(self):
+
+        # Multi-row INSERT ... ON CONFLICT
+        ids = self.db().upsert_many(table='kardashians', rows=[
+            {'name': 'Lamar', 'surname': 'Odom', 'dob': '1979-11-06'},
+            {'name': 'Kim', 'surname': 'Kardashian-West', 'dob': '1980-10-21'},
+        ], conflict_columns=['name'])
+        assert len(ids) == 2
+        assert ids[1] == 4
+        assert self.db().find_by_id(table='kardashians', object_id=ids[0])['name'] == 'Lamar'
+        assert self.db().find_by_id(table='kardashians', object_id=4)['surname'] == 'Kardashian-West'
+
+        # COPY
+        rows = [{'name': 'Clone %d' % x, 'surname': 'Kardashian', 'dob': '2000-01-01'} for x in range(1500)]
+        rows[1000] = {'name': 'Kris', 'surname': 'Kardashian-Jenner', 'dob': '1955-11-05'}
+        ids = self.db().upsert_many(table='kardashians', rows=rows, conflict_columns=['name'])
+        assert len(ids) == len(rows)
+        assert ids[1000] == 1
+        assert self.db().find_by_id(table='kardashians', object_id=1)['surname'] == 'Kardashian-Jenner'
+        for x in [0, 999, 1499]:
+            assert self.db().find_by_id(table='kardashians', object_id=ids[x])['name'] == rows[x]['name']
+
+        # Same values
+        ids = self.db().upsert_many(table='kardashians', rows=[
+            {'name': 'Kim', 'surname': 'Kardashian-West', 'dob': '1980-10-21'},
+        ], conflict_columns=['name'])
+        assert ids == [4]
+
+        # NULL in conflict column
+        with pytest.raises(McUpsertManyException):
+            self.db().upsert_many(table='kardashians', rows=[{'name': None}], conflict_columns=['name'])
+
+        # Conflict column not in rows
+        with pytest.raises(McUpsertManyException):
+            self.db().upsert_many(table='kardashians', rows=[{'name': 'Kim'}], conflict_columns=['surname'])
+
     def test_select(self):
         # One condition
         row = self.db().select(table='kardashians', what_to_select='*', condition_hash={
@@ -522,6 +773,22 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         })
         assert row_hash is not None
         assert row_hash['surname'] == 'Odom'
+        assert len(self.db().query("SELECT * FROM kardashians WHERE name = 'Lamar'").hashes()) == 1
+
+        # Conflicts with existing row on a unique column, but doesn't match it
+        with pytest.raises(McFindOrCreateException):
+            self.db().find_or_create(table='kardashians', insert_hash={
+                'name': 'Lamar',
+                'surname': 'Not Odom',
+                'dob': '1979-11-06',
+            })
+
+        # Table without unique constraints doesn't get duplicates
+        self.db().query("CREATE TEMPORARY TABLE no_unique (no_unique_id SERIAL PRIMARY KEY, name TEXT NOT NULL)")
+        first_row = self.db().find_or_create(table='no_unique', insert_hash={'name': 'foo'})
+        second_row = self.db().find_or_create(table='no_unique', insert_hash={'name': 'foo'})
+        assert first_row == second_row
+        assert len(self.db().query("SELECT * FROM no_unique").hashes()) == 1
 
     def test_begin_commit(self):
 
@@ -603,6 +870,88 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         assert row['surname'] == 'Jenner'
         assert str(row['dob']) == '1983-08-21'
 
+    def test_copy_from_streaming(self):
+        # Enough data for multiple chunks to be streamed from a background thread
+        copy = self.db().copy_from(sql="COPY kardashians (name, surname, dob) FROM STDIN WITH CSV")
+        for x in range(20000):
+            copy.put_line("Clone %d,Kardashian,2000-01-01\n" % x)
+        copy.end()
+
+        count = self.db().query("SELECT COUNT(*) FROM kardashians WHERE name LIKE 'Clone %'").flat()[0]
+        assert count == 20000
+
+        # Invalid data in the middle of the stream
+        with pytest.raises(McCopyFromException):
+            copy = self.db().copy_from(sql="COPY kardashians (name, surname, dob) FROM STDIN WITH CSV")
+            for x in range(20000):
+                copy.put_line("Clone 2-%d,Kardashian,%s\n" % (x, 'not a date' if x == 10 else '2000-01-01'))
+            copy.end()
+
+        # Handler is still usable
+        assert self.db().query("SELECT COUNT(*) FROM kardashians").flat()[0] == 20008
+
+    def test_copy_from_put_rows(self):
+        copy = self.db().copy_from(sql="COPY kardashians (name, surname, dob, married_to_kanye) FROM STDIN")
+        copy.put_rows([
+            ('Lamar', "Odom\twith\\special\ncharacters", '1979-11-06', False),
+            ('Sam Brody', 'Jenner', '1983-08-21', None),
+        ])
+        with pytest.raises(McCopyFromException):
+            copy.end()
+
+        copy = self.db().copy_from(sql="COPY kardashians (name, surname, dob, married_to_kanye) FROM STDIN")
+        copy.put_rows([('Lamar', "Odom\twith\\special\ncharacters", '1979-11-06', True)])
+        copy.end()
+
+        row = self.db().query("SELECT * FROM kardashians WHERE name = 'Lamar'").hash()
+        assert row['surname'] == "Odom\twith\\special\ncharacters"
+        assert row['married_to_kanye'] is True
+
+    def test_copy_from_binary(self):
+        self.db().query("""
+            CREATE TEMPORARY TABLE binary_copy (
+                id BIGINT NOT NULL,
+                small SMALLINT NULL,
+                score DOUBLE PRECISION NULL,
+                ratio REAL NULL,
+                flag BOOL NULL,
+                label TEXT NULL,
+                data BYTEA NULL
+            )
+        """)
+
+        copy = self.db().copy_from(
+            sql="COPY binary_copy (id, small, score, ratio, flag, label, data) FROM STDIN WITH (FORMAT binary)",
+            binary_types=['bigint', 'int2', 'float8', 'real', 'bool', 'text', 'bytea'],
+        )
+        copy.put_rows([
+            (2 ** 40, 7, 1.5, 0.25, True, 'Kim', b'\x00\x01'),
+            (2, None, None, None, None, None, None),
+        ])
+        copy.end()
+
+        rows = self.db().query("SELECT * FROM binary_copy ORDER BY id").hashes()
+        assert len(rows) == 2
+        assert rows[0]['id'] == 2
+        assert rows[0]['label'] is None
+        assert rows[1]['id'] == 2 ** 40
+        assert rows[1]['small'] == 7
+        assert rows[1]['score'] == 1.5
+        assert rows[1]['ratio'] == 0.25
+        assert rows[1]['flag'] is True
+        assert rows[1]['label'] == 'Kim'
+        assert bytes(rows[1]['data']) == b'\x00\x01'
+
+        # Text lines in binary mode
+        copy = self.db().copy_from(sql="COPY binary_copy (id) FROM STDIN WITH (FORMAT binary)", binary_types=['int8'])
+        with pytest.raises(McCopyFromException):
+            copy.put_line("1")
+        copy.end()
+
+        # Unsupported type
+        with pytest.raises(McCopyFromException):
+            self.db().copy_from(sql="COPY binary_copy (id) FROM STDIN WITH (FORMAT binary)", binary_types=['xml'])
+
     def test_copy_to(self):
         sql = """
             COPY (
@@ -625,6 +974,122 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         copy.end()
         assert count == 8
 
+        # Decoded rows with NULLs and escaped characters
+        copy = self.db().copy_to(sql="""
+            COPY (
+                SELECT id, name, NULLIF(surname, 'Jenner') AS surname, E'a\\tb\\nc\\\\' AS escaped
+                FROM kardashians
+                ORDER BY id
+            ) TO STDOUT
+        """)
+        rows = list(copy.iter_rows())
+        copy.end()
+        assert len(rows) == 8
+        assert rows[0] == ('1', 'Kris', None, 'a\tb\nc\\')
+        assert rows[4] == ('5', 'Khloé', 'Kardashian', 'a\tb\nc\\')
+        assert copy.rows() == 8
+
+        # Binary rows
+        copy = self.db().copy_to(
+            sql="""
+                COPY (
+                    SELECT id, name, dob, dob::TIMESTAMP AS ts, married_to_kanye, id / 2.0::FLOAT8 AS half, NULL::INT
+                    FROM kardashians
+                    ORDER BY id
+                ) TO STDOUT WITH (FORMAT binary)
+            """,
+            binary_types=['int4', 'varchar', 'date', 'timestamp', 'bool', 'float8', 'int4'],
+        )
+        with pytest.raises(McCopyToException):
+            copy.get_line()
+        rows = list(copy.iter_rows())
+        copy.end()
+        assert len(rows) == 8
+        assert rows[3] == (4, 'Kim', datetime.date(1980, 10, 21), datetime.datetime(1980, 10, 21), True, 2.0, None)
+        assert rows[4][1] == 'Khloé'
+
+        with pytest.raises(McCopyToException):
+            self.db().copy_to(sql="COPY kardashians TO STDOUT WITH (FORMAT binary)", binary_types=['xml'])
+
+        # Large output gets streamed, and reading can stop early
+        copy = self.db().copy_to(sql="COPY (SELECT x, md5(x::TEXT) FROM generate_series(1, 200000) AS x) TO STDOUT")
+        assert copy.get_line() == "1\tc4ca4238a0b923820dcc509a6f75849b\n"
+        copy.end()
+        assert self.db().query("SELECT COUNT(*) FROM kardashians").flat() == [8]
+
+        copy = self.db().copy_to(sql="COPY (SELECT x FROM generate_series(1, 200000) AS x) TO STDOUT")
+        assert sum(int(row[0]) for row in copy.iter_rows()) == 200000 * 200001 // 2
+        copy.end()
+
+        # Invalid SQL fails right away
+        with pytest.raises(McCopyToException):
+            self.db().copy_to(sql="COPY nonexistent_table TO STDOUT")
+        assert self.db().query("SELECT 1").flat() == [1]
+
+    def test_prepared_statements(self):
+        db = self.db()
+        assert db.prepared_statement_stats() is None
+
+        db.enable_prepared_statements(threshold=2, max_size=2)
+
+        for _ in range(4):
+            name = db.query("SELECT name FROM kardashians WHERE name = %(name)s", {'name': 'Kim'}).flat()[0]
+            assert name == 'Kim'
+            count = db.query("SELECT COUNT(*) FROM kardashians WHERE name LIKE 'K%%' AND id > ?", 0).flat()[0]
+            assert count == 6
+
+        stats = db.prepared_statement_stats()
+        assert stats['prepared'] == 2
+        assert stats['executed'] == 6
+        assert stats['size'] == 2
+        assert len(db.query("SELECT name FROM pg_prepared_statements").flat()) == 2
+
+        # Would return a string instead of an integer if prepared
+        for _ in range(3):
+            assert db.query("SELECT %(number)s AS number", {'number': 42}).flat()[0] == 42
+
+        # Tuple parameters
+        for _ in range(3):
+            names = db.query("SELECT name FROM kardashians WHERE name IN %(names)s ORDER BY name",
+                             {'names': ('Kim', 'Rob',)}).flat()
+            assert names == ['Kim', 'Rob']
+
+        assert db.prepared_statement_stats()['unpreparable'] == 2
+
+        # Least recently used statement gets evicted
+        for _ in range(2):
+            db.query("SELECT * FROM kardashians WHERE id = %(id)s", {'id': 1})
+        stats = db.prepared_statement_stats()
+        assert stats['evicted'] == 1
+        assert stats['size'] == 2
+
+        # Statement gets re-run unprepared after its result type changes
+        db.query("CREATE TEMPORARY TABLE prepared_test (a INT)")
+        db.query("INSERT INTO prepared_test (a) VALUES (1)")
+        for _ in range(2):
+            assert db.query("SELECT * FROM prepared_test WHERE a = %(a)s", {'a': 1}).hashes() == [{'a': 1}]
+        db.query("ALTER TABLE prepared_test ADD COLUMN b INT")
+        assert db.query("SELECT * FROM prepared_test WHERE a = %(a)s", {'a': 1}).hashes() == [{'a': 1, 'b': None}]
+        assert db.prepared_statement_stats()['invalidated'] == 1
+
+        # Preparing within a transaction
+        db.begin()
+        for _ in range(3):
+            assert db.query("SELECT id FROM kardashians WHERE name = ?", 'Kris').flat() == [1]
+        db.commit()
+
+        # Failed PREPARE within a transaction doesn't leave a savepoint behind
+        db.begin()
+        for _ in range(3):
+            assert db.query("SELECT ? IS NULL AS is_null", None).flat() == [True]
+        with pytest.raises(McDatabaseResultException):
+            db.query("RELEASE SAVEPOINT mc_prepare")
+        db.rollback()
+
+        db.disable_prepared_statements()
+        assert db.prepared_statement_stats() is None
+        assert len(db.query("SELECT name FROM pg_prepared_statements").flat()) == 0
+
     def test_get_temporary_ids_table(self):
         ints = [1, 2, 3, 4, 5]
 
@@ -640,6 +1105,61 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         ).flat()
         assert returned_ints == ints
 
+        # Same IDs within a transaction reuse the table
+        self.db().begin()
+        table_name = self.db().get_temporary_ids_table(ids=ints)
+        assert self.db().get_temporary_ids_table(ids=ints) == table_name
+        assert self.db().get_temporary_ids_table(ids=ints, ordered=True) != table_name
+        assert self.db().get_temporary_ids_table(ids=[1, 2]) != table_name
+        self.db().rollback()
+
+        self.db().begin()
+        assert self.db().get_temporary_ids_table(ids=ints) != table_name
+        self.db().commit()
+
+        # Table that got dropped by rolling back to a savepoint doesn't get reused
+        self.db().begin()
+        self.db().query('SAVEPOINT temporary_ids_table')
+        table_name = self.db().get_temporary_ids_table(ids=ints)
+        self.db().query('ROLLBACK TO SAVEPOINT temporary_ids_table')
+        new_table_name = self.db().get_temporary_ids_table(ids=ints)
+        assert new_table_name != table_name
+        assert self.db().query("SELECT COUNT(*) FROM %s" % new_table_name).flat()[0] == len(ints)
+        assert self.db().get_temporary_ids_table(ids=ints) == new_table_name
+        self.db().commit()
+
+        # Outside of a transaction, new table gets created every time
+        table_name = self.db().get_temporary_ids_table(ids=ints)
+        assert self.db().get_temporary_ids_table(ids=ints) != table_name
+
+        # ANALYZE
+        table_name = self.db().get_temporary_ids_table(ids=ints, analyze=True)
+        reltuples = self.db().query("SELECT reltuples FROM pg_class WHERE oid = '%s'::regclass" % table_name).flat()
+        assert reltuples[0] == len(ints)
+
+    def test_attach_child_query_large(self):
+        self.db().query("""
+            CREATE TEMPORARY TABLE numbers (
+               id INT NOT NULL,
+               square INT NOT NULL
+            );
+            INSERT INTO numbers (id, square)
+                SELECT n, n * n FROM generate_series(1, 3000) AS n;
+        """)
+
+        # More IDs than the array threshold, so a temporary table gets used
+        data = [{'id': n} for n in range(1, 2501)]
+        data = self.db().attach_child_query(
+            data=data,
+            child_query='SELECT id, square FROM numbers WHERE id % 2 = 0',
+            child_field='square',
+            id_column='id',
+            single=True
+        )
+        assert len(data) == 2500
+        assert data[1] == {'id': 2, 'square': 4}
+        assert data[2] == {'id': 3}
+
     def test_attach_child_query(self):
 
         # Single
@@ -787,3 +1307,46 @@ class TestDatabaseHandler(TestDatabaseTestCase):
         assert pager.next_page() is None
         assert pager.first() == 11
         assert pager.last() == 15
+
+    def test_query_paged_hashes_keyset(self):
+
+        sql = """SELECT number, number % 2 AS parity FROM generate_series(1, 25) AS number"""
+        rows_per_page = 10
+
+        # First page
+        qph = self.db().query_paged_hashes(query=sql, page=1, rows_per_page=rows_per_page, order_by=['number'])
+        assert [row['number'] for row in qph.list()] == list(range(1, 11))
+        assert qph.pager().next_page() == 2
+        token = qph.continuation_token()
+        assert token is not None
+
+        # Second page, seeking past the token
+        qph = self.db().query_paged_hashes(query=sql, page=2, rows_per_page=rows_per_page, order_by=['number'],
+                                           continuation_token=token)
+        assert [row['number'] for row in qph.list()] == list(range(11, 21))
+        assert qph.pager().previous_page() == 1
+        assert qph.pager().first() == 11
+        token = qph.continuation_token()
+
+        # Last page
+        qph = self.db().query_paged_hashes(query=sql, page=3, rows_per_page=rows_per_page, order_by=['number'],
+                                           continuation_token=token)
+        assert [row['number'] for row in qph.list()] == list(range(21, 26))
+        assert qph.pager().next_page() is None
+        assert qph.continuation_token() is None
+
+        # Jumping to a page without a token, multiple descending ordering columns
+        qph = self.db().query_paged_hashes(query=sql, page=2, rows_per_page=rows_per_page,
+                                           order_by=['parity', 'number'], descending=True)
+        assert [row['number'] for row in qph.list()] == [5, 3, 1, 24, 22, 20, 18, 16, 14, 12]
+        qph = self.db().query_paged_hashes(query=sql, page=3, rows_per_page=rows_per_page,
+                                           order_by=['parity', 'number'], descending=True,
+                                           continuation_token=qph.continuation_token())
+        assert [row['number'] for row in qph.list()] == [10, 8, 6, 4, 2]
+
+        with pytest.raises(McQueryPagedHashesException):
+            self.db().query_paged_hashes(query=sql, page=1, rows_per_page=rows_per_page, order_by=['number; --'])
+
+        with pytest.raises(McQueryPagedHashesException):
+            self.db().query_paged_hashes(query=sql, page=2, rows_per_page=rows_per_page, order_by=['number'],
+                                         continuation_token='foo')
@@ -0,0 +1,175 @@
+import pytest
+
+from mediawords.db import connect_to_db
+from mediawords.db.exceptions.handler import McTransactionException
+from mediawords.db.exceptions.result import McDatabaseResultException
+from mediawords.db.instrumentation.instrumentation import reset_transaction_stats, transaction_stats
+from mediawords.db.transaction.transaction import *
+
+
+class _FakeDeadlockError(Exception):
+    pgcode = '40P01'
+
+
+def __create_test_table(db) -> None:
+    db.query("DROP TABLE IF EXISTS test_transaction")
+    db.query("CREATE TABLE test_transaction (test_transaction_id INT PRIMARY KEY, value INT NOT NULL)")
+    db.query("INSERT INTO test_transaction (test_transaction_id, value) VALUES (1, 0), (2, 0)")
+
+
+def __value(db, test_transaction_id: int) -> int:
+    return db.find_by_id('test_transaction', test_transaction_id)['value']
+
+
+def test_retryable_sqlstate():
+    assert retryable_sqlstate(_FakeDeadlockError()) == '40P01'
+    assert retryable_sqlstate(ValueError()) is None
+
+    # SQLSTATE of the exception that was being handled
+    try:
+        try:
+            raise _FakeDeadlockError()
+        except _FakeDeadlockError:
+            raise McDatabaseResultException("Query failed")
+    except McDatabaseResultException as ex:
+        assert retryable_sqlstate(ex) == '40P01'
+
+
+def test_transaction_savepoints():
+    db = connect_to_db(label='test')
+    __create_test_table(db)
+
+    with db.transaction() as tx_db:
+        assert tx_db.in_transaction()
+        db.update_by_id('test_transaction', 1, {'value': 1})
+
+        # Failed nested transaction gets rolled back to the savepoint
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.update_by_id('test_transaction', 1, {'value': 2})
+                raise ValueError("Roll back to savepoint")
+        assert __value(db, 1) == 1
+
+        with db.transaction():
+            db.update_by_id('test_transaction', 2, {'value': 2})
+
+            with pytest.raises(McTransactionException):
+                with db.transaction(isolation='serializable'):
+                    pass
+
+    assert not db.in_transaction()
+    assert __value(db, 1) == 1
+    assert __value(db, 2) == 2
+
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.update_by_id('test_transaction', 1, {'value': 3})
+            raise ValueError("Roll back")
+    assert not db.in_transaction()
+    assert __value(db, 1) == 1
+
+    with db.transaction(isolation='serializable'):
+        assert db.query("SHOW transaction_isolation").flat() == ['serializable']
+
+    db.query("DROP TABLE test_transaction")
+    db.disconnect()
+
+
+def test_transaction_savepoint_temporary_ids_table():
+    db = connect_to_db(label='test')
+
+    with db.transaction():
+        outer_table = db.get_temporary_ids_table([4, 5, 6])
+
+        # Temporary IDs table created within a rolled back nested transaction is gone
+        with pytest.raises(ValueError):
+            with db.transaction():
+                nested_table = db.get_temporary_ids_table([1, 2, 3])
+                assert db.get_temporary_ids_table([4, 5, 6]) == outer_table
+                raise ValueError("Roll back to savepoint")
+
+        table = db.get_temporary_ids_table([1, 2, 3])
+        assert table != nested_table
+        assert db.query("SELECT id FROM %s ORDER BY id" % table).flat() == [1, 2, 3]
+
+        # Ones created before the savepoint are still there
+        assert db.get_temporary_ids_table([4, 5, 6]) == outer_table
+
+        # Released savepoint keeps the table
+        with db.transaction():
+            released_table = db.get_temporary_ids_table([7, 8, 9])
+        assert db.get_temporary_ids_table([7, 8, 9]) == released_table
+
+    with pytest.raises(McTransactionException):
+        db.savepoint('not_in_transaction')
+
+    db.disconnect()
+
+
+def test_transaction_retries():
+    db = connect_to_db(label='test')
+    other_db = connect_to_db(label='test')
+    __create_test_table(db)
+    reset_transaction_stats()
+
+    attempts = []
+
+    @db.transaction(retries=3, isolation='repeatable read')
+    def __increment() -> int:
+        attempts.append(True)
+        value = __value(db, 1)
+
+        # Concurrent update makes the first attempt fail with serialization failure
+        if len(attempts) == 1:
+            other_db.update_by_id('test_transaction', 1, {'value': 10})
+
+        db.update_by_id('test_transaction', 1, {'value': value + 1})
+        return value + 1
+
+    assert __increment() == 11
+    assert len(attempts) == 2
+    assert __value(db, 1) == 11
+    assert not db.in_transaction()
+
+    stats = transaction_stats()
+    assert stats['transactions'] == 1
+    assert stats['retried_transactions'] == 1
+    assert stats['retries'] == 1
+    assert stats['retries_by_sqlstate'] == {'40001': 1}
+
+    # Retries run out
+    attempts = []
+
+    def __deadlock():
+        attempts.append(True)
+        db.update_by_id('test_transaction', 2, {'value': 1})
+        raise _FakeDeadlockError()
+
+    with pytest.raises(_FakeDeadlockError):
+        db.transaction(retries=2).run(__deadlock)
+    assert len(attempts) == 3
+    assert __value(db, 2) == 0
+    assert transaction_stats()['failed_transactions'] == 1
+
+    # Other errors don't get retried
+    attempts = []
+
+    def __fail():
+        attempts.append(True)
+        db.query("SELECT * FROM nonexistent_table")
+
+    with pytest.raises(McDatabaseResultException):
+        db.transaction(retries=2).run(__fail)
+    assert len(attempts) == 1
+    assert not db.in_transaction()
+
+    # Nested transactions don't get retried
+    attempts = []
+    with pytest.raises(_FakeDeadlockError):
+        with db.transaction():
+            db.transaction(retries=2).run(__deadlock)
+    assert len(attempts) == 1
+
+    db.query("DROP TABLE test_transaction")
+    other_db.disconnect()
+    db.disconnect()
@@ -0,0 +1,190 @@
+import functools
+import itertools
+import random
+import time
+from typing import Any, Callable, Union
+
+from mediawords.db.exceptions.handler import McTransactionException
+from mediawords.db.instrumentation.instrumentation import record_transaction, record_transaction_retry
+from mediawords.util.log import create_logger
+
+log = create_logger(__name__)
+
+# SQLSTATE codes of errors after which the transaction can be retried
+_RETRYABLE_SQLSTATES = {
+    '40001',  # serialization_failure
+    '40P01',  # deadlock_detected
+}
+
+# Savepoint name counter
+_SAVEPOINT_COUNTER = itertools.count(1)
+
+
+def retryable_sqlstate(exception: BaseException) -> Union[str, None]:
+    """Return SQLSTATE code if the exception (or any of the exceptions it was raised from) is a serialization failure
+    or a deadlock; None otherwise."""
+
+    # McDatabaseResultException gets raised while handling psycopg2's exception which has the SQLSTATE code
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        sqlstate = getattr(exception, 'pgcode', None)
+        if sqlstate in _RETRYABLE_SQLSTATES:
+            return sqlstate
+        exception = exception.__cause__ if exception.__cause__ is not None else exception.__context__
+    return None
+
+
+class _TransactionScope(object):
+    """Single entry into a transaction: either the transaction itself or a savepoint within an outer transaction."""
+
+    # Database handler
+    __db = None
+
+    # Savepoint name if the scope is nested in an outer transaction, None otherwise
+    __savepoint = None
+
+    def __init__(self, db: 'DatabaseHandler', isolation: Union[str, None]):
+        self.__db = db
+
+        if db.in_transaction():
+            if isolation is not None:
+                raise McTransactionException("Isolation level can't be set for a nested transaction.")
+            self.__savepoint = 'mc_savepoint_%d' % next(_SAVEPOINT_COUNTER)
+            db.savepoint(self.__savepoint)
+        else:
+            self.__savepoint = None
+            db.begin(isolation=isolation)
+
+    def commit(self) -> None:
+        if self.__savepoint is not None:
+            self.__db.release_savepoint(self.__savepoint)
+            return
+
+        try:
+            self.__db.commit()
+        except Exception:
+            # Failed COMMIT ends the transaction anyway; reset handler's state
+            self.__rollback_quietly()
+            raise
+
+    def rollback(self) -> None:
+        if self.__savepoint is not None:
+            self.__db.rollback_to_savepoint(self.__savepoint)
+            self.__db.release_savepoint(self.__savepoint)
+        else:
+            self.__rollback_quietly()
+
+    def __rollback_quietly(self) -> None:
+        try:
+            self.__db.rollback()
+        except Exception as ex:
+            log.warning("Unable to roll back transaction: %s" % str(ex))
+
+
+class DatabaseTransaction(object):
+    """Transaction usable as a context manager or a decorator, e.g.:
+
+        with db.transaction():
+            db.create('stories', story)
+            db.create('story_sentences', sentence)
+
+        @db.transaction(retries=5, isolation='serializable')
+        def __add_story():
+            ...
+
+    A transaction entered while the handler is already in a transaction becomes a savepoint which gets released at
+    the end of the block, or rolled back to (without affecting the outer transaction) if the block raises.
+
+    When used as a decorator (or with run()), the outermost transaction gets rerun up to "retries" times after a
+    serialization failure or a deadlock (SQLSTATE 40001 / 40P01), sleeping for a random ("full jitter") time up to an
+    exponentially growing backoff in between; nested transactions don't get retried as the whole transaction has to be
+    rerun. Retries are counted in mediawords.db.instrumentation's transaction_stats(). A "with" block can't be rerun,
+    so context manager transactions don't get retried."""
+
+    # Database handler
+    __db = None
+
+    # Max. number of retries
+    __retries = 0
+
+    # Isolation level (None for the default one)
+    __isolation = None
+
+    # Backoff before the first retry and max. backoff, in seconds
+    __backoff = None
+    __max_backoff = None
+
+    # Stack of entered scopes
+    __scopes = None
+
+    def __init__(self,
+                 db: 'DatabaseHandler',
+                 retries: int = 0,
+                 isolation: str = None,
+                 backoff: float = 0.05,
+                 max_backoff: float = 2.0):
+        if retries < 0:
+            raise McTransactionException("Number of retries can't be negative.")
+
+        self.__db = db
+        self.__retries = retries
+        self.__isolation = isolation
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__scopes = []
+
+    def __enter__(self) -> 'DatabaseHandler':
+        self.__scopes.append(_TransactionScope(db=self.__db, isolation=self.__isolation))
+        return self.__db
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        scope = self.__scopes.pop()
+        if exc_type is None:
+            scope.commit()
+        else:
+            scope.rollback()
+
+        # Don't suppress the exception
+        return False
+
+    def __call__(self, function: Callable) -> Callable:
+        @functools.wraps(function)
+        def __run_in_transaction(*args, **kwargs):
+            return self.run(function, *args, **kwargs)
+
+        return __run_in_transaction
+
+    def __sleep_before_retry(self, retry: int) -> None:
+        backoff = min(self.__max_backoff, self.__backoff * (2 ** (retry - 1)))
+        time.sleep(random.uniform(0, backoff))
+
+    def run(self, function: Callable, *args, **kwargs) -> Any:
+        """Run function in the transaction, retrying it on serialization failures and deadlocks; return its result."""
+
+        nested = self.__db.in_transaction()
+        retry = 0
+
+        while True:
+            try:
+                with self:
+                    result = function(*args, **kwargs)
+
+            except Exception as ex:
+                sqlstate = retryable_sqlstate(ex)
+                if nested or sqlstate is None or retry >= self.__retries:
+                    if not nested:
+                        record_transaction(retries=retry, succeeded=False)
+                    raise
+
+                retry += 1
+                record_transaction_retry(sqlstate=sqlstate)
+                log.info("Transaction failed with SQLSTATE %s, retrying (%d of %d)..." % (
+                    sqlstate, retry, self.__retries,
+                ))
+                self.__sleep_before_retry(retry)
+
+            else:
+                if not nested:
+                    record_transaction(retries=retry, succeeded=True)
+                return result
@@ -0,0 +1,285 @@
+"""In-process matching of texts against parsed Solr queries."""
+
+import re
+import shlex
+from typing import Any, Dict, List, Set, Union
+
+from mediawords.solr.prefilter import QueryPrefilter
+from mediawords.solr.query import (
+    AndNode,
+    FieldNode,
+    McSolrImplementationException,
+    McSolrQueryParseSyntaxException,
+    NoopNode,
+    NotNode,
+    OrNode,
+    ParseNode,
+    TermNode,
+)
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+# Words of the text; same as the characters that postgres' [[:<:]] treats as ones that words consist of
+_WORD_REGEX = re.compile(r'\w+')
+
+# Field which gets matched against the text
+_TEXT_FIELD = 'sentence'
+
+
+class TokenizedText(object):
+    """Lowercased text split into words, indexed for matching against QueryMatcher.
+
+    Every index gets built on first use in a single pass over the text's (distinct) words, so matching a query against
+    the text takes time linear in the size of the text (for a given query)."""
+
+    # Lowercased text
+    __text = None
+
+    # Words of the text
+    __words = None
+
+    # Set of words
+    __word_set = None
+
+    # Prefix length -> set of prefixes of the words
+    __prefixes = None
+
+    def __init__(self, text: str):
+        text = decode_object_from_bytes_if_needed(text)
+
+        self.__text = text.lower()
+        self.__words = _WORD_REGEX.findall(self.__text)
+        self.__word_set = None
+        self.__prefixes = {}
+
+    def text(self) -> str:
+        """Return lowercased text."""
+        return self.__text
+
+    def words(self) -> List[str]:
+        """Return words of the text."""
+        return self.__words
+
+    def __all_words(self) -> Set[str]:
+        if self.__word_set is None:
+            self.__word_set = set(self.__words)
+        return self.__word_set
+
+    def has_word(self, word: str) -> bool:
+        """Return True if the text has the word."""
+        return word in self.__all_words()
+
+    def has_prefix(self, prefix: str) -> bool:
+        """Return True if the text has a word starting with the prefix."""
+        prefix_length = len(prefix)
+        if prefix_length not in self.__prefixes:
+            # Shorter words' "prefixes" are shorter than any of the looked up prefixes so they never match
+            self.__prefixes[prefix_length] = {word[:prefix_length] for word in self.__all_words()}
+        return prefix in self.__prefixes[prefix_length]
+
+    def has_phrase(self, words: List[str], last_word_is_prefix: bool) -> bool:
+        """Return True if the text has the words one after another; the last one might be just a prefix of a word."""
+
+        if len(words) == 1:
+            return self.has_prefix(words[0]) if last_word_is_prefix else self.has_word(words[0])
+
+        if not self.has_word(words[0]):
+            return False
+
+        last_index = len(words) - 1
+        position = -1
+        while True:
+            try:
+                position = self.__words.index(words[0], position + 1, len(self.__words) - last_index)
+            except ValueError:
+                return False
+
+            for index in range(1, len(words)):
+                word = self.__words[position + index]
+                if index == last_index and last_word_is_prefix:
+                    if not word.startswith(words[index]):
+                        break
+                elif word != words[index]:
+                    break
+            else:
+                return True
+
+
+class QueryMatcher(object):
+    """Matcher of texts against a parsed Solr query, evaluated in-process.
+
+    Unlike the single regex of ParseNode.re() which has to be run by PostgreSQL's regex engine so that complex queries
+    wouldn't hang, the query gets compiled into a tree of lookups of terms, prefixes and phrases in the text's
+    TokenizedText, so matching takes time linear in the size of the text and the query.
+
+    By default, terms match like they do in re(), i.e. words that start with them ("protest" matches "protesters"); if
+    "whole_words" is True, only wildcard terms ("protest*") do. For logogram languages ("is_logogram" is True), terms
+    and phrases match anywhere in the text, not just at word starts, as in re(is_logogram=True).
+
+    Unlike re(), NOT clauses get evaluated too. "sentence" field's clauses get matched against the text, and clauses of
+    other fields against the values passed in "fields" to matches(); clauses of fields that are not passed, and ranges,
+    get ignored as in re().
+
+    Unless "prefilter" is False, texts first get scanned by QueryPrefilter, so texts that have none of the terms that
+    the query requires get rejected without being tokenized."""
+
+    # Compiled query: ('term', term, matches word prefixes, is wildcard), ('phrase', [words], last_word_is_prefix),
+    # ('and', [subqueries]), ('or', [subqueries]), ('not', subquery), ('field', field name, subquery) or ('noop',)
+    __query = None
+
+    # True if the text is in a logogram language
+    __is_logogram = False
+
+    # QueryPrefilter of the texts, or None if texts are not to be prefiltered
+    __prefilter = None
+
+    def __init__(self, tree: ParseNode, is_logogram: bool = False, whole_words: bool = False, prefilter: bool = True):
+        self.__is_logogram = bool(is_logogram)
+        self.__query = self.__compile(node=tree, whole_words=bool(whole_words))
+
+        self.__prefilter = None
+        if prefilter:
+            query_prefilter = QueryPrefilter(tree=tree, is_logogram=is_logogram)
+            if query_prefilter.can_filter():
+                self.__prefilter = query_prefilter
+
+    def __compile(self, node: ParseNode, whole_words: bool) -> tuple:
+        """Compile parse tree into a tree of tuples."""
+
+        if type(node) is TermNode:
+            if node.phrase:
+                words = _WORD_REGEX.findall(shlex.split(node.term)[0].lower())
+                if len(words) == 0:
+                    raise McSolrQueryParseSyntaxException("empty phrase not allowed")
+                return 'phrase', words, not whole_words,
+            else:
+                return 'term', node.term.lower(), node.wildcard or not whole_words, bool(node.wildcard),
+
+        elif type(node) in (AndNode, OrNode):
+            operator = 'and' if type(node) is AndNode else 'or'
+            return operator, [self.__compile(node=operand, whole_words=whole_words) for operand in node.operands],
+
+        elif type(node) is NotNode:
+            return 'not', self.__compile(node=node.operand, whole_words=whole_words),
+
+        elif type(node) is FieldNode:
+            return 'field', node.field, self.__compile(node=node.operand, whole_words=whole_words),
+
+        elif type(node) is NoopNode:
+            return 'noop',
+
+        else:
+            raise McSolrImplementationException("Unknown parse node type: %s" % str(type(node)))
+
+    def __text_matches(self, query: tuple, text: TokenizedText) -> bool:
+        if self.__is_logogram:
+            if query[0] == 'term':
+                return query[1] in text.text()
+            else:
+                return re.search(r'\s+'.join(re.escape(word) for word in query[1]), text.text()) is not None
+
+        if query[0] == 'term':
+            return text.has_prefix(query[1]) if query[2] else text.has_word(query[1])
+        else:
+            return text.has_phrase(words=query[1], last_word_is_prefix=query[2])
+
+    @staticmethod
+    def __value_matches(query: tuple, values: Set[str]) -> bool:
+        # Values (IDs, dates, ...) are matched whole unless the term is a wildcard one
+        if query[0] == 'term':
+            if query[3]:
+                return any(value.startswith(query[1]) for value in values)
+            else:
+                return query[1] in values
+        else:
+            return ' '.join(query[1]) in values
+
+    def __evaluate(self,
+                   query: tuple,
+                   text: Union[TokenizedText, Set[str]],
+                   fields: Dict[str, Union[TokenizedText, Set[str]]]) -> Union[bool, None]:
+        """Evaluate compiled query against the text (or a set of field's values); return None if it's to be ignored."""
+
+        operator = query[0]
+
+        if operator in ('term', 'phrase'):
+            if isinstance(text, TokenizedText):
+                return self.__text_matches(query=query, text=text)
+            else:
+                return self.__value_matches(query=query, values=text)
+
+        elif operator == 'and':
+            result = None
+            for subquery in query[1]:
+                subquery_result = self.__evaluate(query=subquery, text=text, fields=fields)
+                if subquery_result is False:
+                    return False
+                elif subquery_result is True:
+                    result = True
+            return result
+
+        elif operator == 'or':
+            result = None
+            for subquery in query[1]:
+                subquery_result = self.__evaluate(query=subquery, text=text, fields=fields)
+                if subquery_result is True:
+                    return True
+                elif subquery_result is False:
+                    result = False
+            return result
+
+        elif operator == 'not':
+            result = self.__evaluate(query=query[1], text=text, fields=fields)
+            return None if result is None else not result
+
+        elif operator == 'field':
+            field = query[1]
+            if field in fields:
+                return self.__evaluate(query=query[2], text=fields[field], fields=fields)
+            elif field == _TEXT_FIELD:
+                return self.__evaluate(query=query[2], text=text, fields=fields)
+            else:
+                return None
+
+        else:
+            return None
+
+    @staticmethod
+    def __field_values(fields: Union[Dict[str, Any], None]) -> Dict[str, Union[TokenizedText, Set[str]]]:
+        """Tokenize string field values, convert other ones to sets of values."""
+        field_values = {}
+        for field, value in (fields or {}).items():
+            if isinstance(value, TokenizedText):
+                field_values[field] = value
+            elif isinstance(value, str):
+                field_values[field] = TokenizedText(text=value)
+            else:
+                if not isinstance(value, (list, tuple, set)):
+                    value = [value]
+                field_values[field] = set(str(item).lower() for item in value)
+        return field_values
+
+    def matches(self, text: Union[str, TokenizedText], fields: Dict[str, Any] = None) -> bool:
+        """Return True if the text (string or TokenizedText) matches the query.
+
+        "fields" are values of non-text fields (e.g. {'media_id': 1, 'tags_id_media': [1, 2, 3]}); string values get
+        tokenized and matched as text, others as lists of values."""
+        return self.matches_any(texts=[text], fields=fields)
+
+    def matches_any(self, texts: List[Union[str, TokenizedText]], fields: Dict[str, Any] = None) -> bool:
+        """Return True if any of the texts (e.g. story's sentences) matches the query."""
+
+        field_values = self.__field_values(fields)
+
+        # "sentence" clauses get matched against the field's value instead of the texts if it's passed
+        prefilter = self.__prefilter if _TEXT_FIELD not in field_values else None
+
+        for text in texts:
+            if prefilter is not None:
+                if not prefilter.may_match(text=text.text() if isinstance(text, TokenizedText) else text):
+                    continue
+            if not isinstance(text, TokenizedText):
+                text = TokenizedText(text=text)
+            if self.__evaluate(query=self.__query, text=text, fields=field_values) is True:
+                return True
+
+        return False
@@ -0,0 +1,126 @@
+"""Multi-term prefiltering of texts to be matched against parsed Solr queries."""
+
+import re
+from typing import List, Set
+
+import ahocorasick
+
+from mediawords.solr.query import AndNode, FieldNode, OrNode, ParseNode, TermNode
+from mediawords.util.perl import decode_object_from_bytes_if_needed
+
+# Character that is a part of a word
+_WORD_CHARACTER_REGEX = re.compile(r'\w')
+
+# Words of a phrase
+_WORD_REGEX = re.compile(r'\w+')
+
+# Field which gets matched against the text
+_TEXT_FIELD = 'sentence'
+
+
+def _required_term_groups(node: ParseNode) -> List[Set[str]]:
+    """Return groups of terms such that a text matching the tree has to contain at least one term of every group.
+
+    Terms are word prefixes; phrases are represented by their longest word. Subtrees that don't require any terms to be
+    present in the text (NOT clauses, non-text fields, ranges) return no groups."""
+
+    if type(node) is TermNode:
+        if node.phrase:
+            # Quotes (and anything else that's not a word) don't make it into the phrase's words
+            words = _WORD_REGEX.findall(node.term.lower())
+            if len(words) == 0:
+                return []
+            return [{max(words, key=len)}]
+        else:
+            return [{node.term.lower()}]
+
+    elif type(node) is AndNode:
+        groups = []
+        for operand in node.operands:
+            groups.extend(_required_term_groups(operand))
+        return groups
+
+    elif type(node) is OrNode:
+        # Text has to contain a term of (any) one group of any of the operands
+        terms = set()
+        for operand in node.operands:
+            operand_groups = _required_term_groups(operand)
+            if len(operand_groups) == 0:
+                return []
+            terms |= min(operand_groups, key=len)
+        return [terms]
+
+    elif type(node) is FieldNode and node.field == _TEXT_FIELD:
+        return _required_term_groups(node.operand)
+
+    else:
+        return []
+
+
+class QueryPrefilter(object):
+    """Prefilter which rejects texts that can't match the query in a single scan of the text.
+
+    Terms (and the longest words of phrases) of the parse tree get compiled into an Aho-Corasick automaton that finds
+    all of their occurrences in the text in one pass; a text may match the query only if it contains a term of every
+    clause that the query requires, e.g. a text may match 'foo and ( bar or "baz qux" )' only if it has both "foo" and
+    either "bar" or "baz" in it. Texts that pass still have to be matched against the full query; texts that don't
+    can't match either QueryMatcher or re().
+
+    The automaton gets built once, so the prefilter is to be reused for every text matched against the query."""
+
+    # Aho-Corasick automaton; term -> (term's length, [indexes of groups that the term belongs to])
+    __automaton = None
+
+    # Number of groups of which the text has to contain a term
+    __group_count = 0
+
+    # True if terms are to match anywhere in the text, not just at word starts
+    __is_logogram = False
+
+    def __init__(self, tree: ParseNode, is_logogram: bool = False):
+        self.__is_logogram = bool(is_logogram)
+
+        groups = _required_term_groups(tree)
+        self.__group_count = len(groups)
+
+        term_groups = {}
+        for group_index, group in enumerate(groups):
+            for term in group:
+                term_groups.setdefault(term, []).append(group_index)
+
+        self.__automaton = None
+        if len(term_groups) > 0:
+            self.__automaton = ahocorasick.Automaton()
+            for term, group_indexes in term_groups.items():
+                self.__automaton.add_word(term, (len(term), group_indexes,))
+            self.__automaton.make_automaton()
+
+    def can_filter(self) -> bool:
+        """Return False if the query doesn't require any terms to be present in the text so all texts pass."""
+        return self.__automaton is not None
+
+    def may_match(self, text: str) -> bool:
+        """Return True if the text might match the query, i.e. has a term of every group of required terms."""
+
+        if self.__automaton is None:
+            return True
+
+        text = decode_object_from_bytes_if_needed(text).lower()
+
+        found_groups = set()
+        for end_index, (term_length, group_indexes) in self.__automaton.iter(text):
+            start_index = end_index - term_length + 1
+
+            # Terms match at word starts only
+            if not self.__is_logogram and start_index > 0 and _WORD_CHARACTER_REGEX.match(text[start_index - 1]):
+                continue
+
+            found_groups.update(group_indexes)
+            if len(found_groups) == self.__group_count:
+                return True
+
+        return False
+
+    def may_match_any(self, texts: List[str]) -> bool:
+        """Return True if any of the texts might match the query."""
+        return any(self.may_match(text=text) for text in texts)
@@ -1,14 +1,13 @@
 """Functions for manipulating Solr queries."""
 
 import abc
+import collections
 import enum
-import inspect
-import io
+import functools
 import shlex
 import re
 
-from tokenize import generate_tokens
-from typing import List, Callable, Union
+from typing import Callable, Dict, List, Set, Union
 
 from mediawords.util.log import create_logger
 from mediawords.util.perl import decode_object_from_bytes_if_needed
@@ -49,11 +48,31 @@ class TokenType(enum.Enum):
 # this text will be considered a noop token
 NOOP_PLACEHOLDER = '__NOOP__'
 
-# replace ':' with this before tokenization so that it gets included with the field name
-FIELD_PLACEHOLDER = '__FIELD__'
+# Solr query tokens; the first group that matches determines the token's type
+_TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<phrase>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<range>\w+:[\[{][^\]}]*[\]}])               # field:[from TO to], field:{from TO to}, ...
+    | (?P<field>(?P<field_name>\w+):)
+    | (?P<term>\w+\*?)
+    | (?P<not>[!-])
+    | (?P<plus>\+)
+    | (?P<other>.)
+""", flags=re.X | re.S)
 
-# replace '*' with this before tokenization so that it gets included with the term
-WILD_PLACEHOLDER = '__WILD__'
+# Character that is a part of a term
+_TERM_CHARACTER_REGEX = re.compile(r'\w')
+
+# Max. number of distinct queries for which parse trees are to be cached
+_PARSE_CACHE_SIZE = 1024
+
+# Regex that AndNode.get_re() combines two operands' regexes with
+_AND_RE_TEMPLATE = '(?: (?: %(a)s .* %(b)s ) | (?: %(b)s .* %(a)s ) )'
+
+# Max. length of a regex in a regex match plan; re() gets used as the only regex of the plan if it's not longer
+_MAX_PLAN_REGEX_LENGTH = 16 * 1024
 
 
 class Token(object):
@@ -61,13 +80,53 @@ class Token(object):
 
     token_type = None
     token_value = None
+    wildcard = False
 
-    def __init__(self, token_value, token_type):
+    def __init__(self, token_value, token_type, wildcard=False):
         self.token_value = token_value
         self.token_type = token_type
+        self.wildcard = wildcard
+
+    def __repr__(self):
+        return "[ %s: %s%s ]" % (self.token_type, self.token_value, '*' if self.wildcard else '')
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class RegexMatchPlan(object):
+    """Plan for matching a parse tree with a number of linear size posix regexes instead of a single one.
+
+    re() of an AND of n operands grows exponentially with n as every order of the operands has to be spelled out. A plan
+    instead consists of regexes() of the AND's operands (ORs of terms and phrases, which are linear in size), and a
+    boolean AND / OR tree of those regexes. A string matches the plan if the tree evaluates to true given which of the
+    regexes match the string, e.g. 'a and ( b or c )' matches a string that both '[[:<:]]a' and
+    '(?: [[:<:]]b | [[:<:]]c )' match. Unlike with re(), operands of an AND may overlap in the string."""
+
+    # Regexes to be matched against the strings
+    __regexes = None
+
+    # ('regex', index of the regex), ('and', [subplans]) or ('or', [subplans])
+    __plan = None
+
+    def __init__(self, regexes: List[str], plan: tuple):
+        self.__regexes = regexes
+        self.__plan = plan
+
+    def regexes(self) -> List[str]:
+        """Return regexes to be matched against the strings."""
+        return self.__regexes
+
+    def is_single_regex(self) -> bool:
+        """Return True if the plan consists of just the tree's single regex."""
+        return self.__plan[0] == 'regex'
+
+    def matches(self, matched_regex_indexes: Set[int]) -> bool:
+        """Return True if a string that regexes() with "matched_regex_indexes" indexes match matches the plan."""
+        return _regex_plan_matches(plan=self.__plan, matched_regex_indexes=matched_regex_indexes)
 
     def __repr__(self):
-        return "[ %s: %s ]" % (self.token_type, self.token_value)
+        return _regex_plan_repr(plan=self.__plan)
 
     def __str__(self):
         return self.__repr__()
@@ -98,6 +157,11 @@ class AbstractParseNode(object):
 class ParseNode(AbstractParseNode):
     """Parent class for universal methods for *Node classes."""
 
+    # Memoized tsquery(), re() (is_logogram -> regex) and re_plan() ((is_logogram, max_regex_length) -> plan) outputs
+    _tsquery = None
+    _re = None
+    _re_plan = None
+
     @abc.abstractmethod
     def _filter_node_children(self, filter_function):
         raise NotImplementedError("Abstract method")
@@ -169,28 +233,82 @@ class ParseNode(AbstractParseNode):
     def tsquery(self) -> str:
         """Return a postgres tsquery that represents the parse tree."""
 
-        filtered_tree = self.filter_tree(filter_function=self.__node_is_field_or_noop)
+        # Parse trees don't change after parsing, so the tsquery gets generated once
+        if self._tsquery is None:
+            filtered_tree = self.filter_tree(filter_function=self.__node_is_field_or_noop)
+
+            if filtered_tree is None:
+                raise McSolrQueryParseSyntaxException("query is empty without fields or ranges")
 
-        if filtered_tree is None:
-            raise McSolrQueryParseSyntaxException("query is empty without fields or ranges")
+            self._tsquery = filtered_tree.get_tsquery()
 
-        return filtered_tree.get_tsquery()
+        return self._tsquery
 
     def re(self, is_logogram=False) -> str:
         """Return a posix regex that represents the parse tree."""
 
-        filtered_tree = self.filter_tree(filter_function=self.__node_is_field_or_noop_or_not)
+        is_logogram = bool(is_logogram)
+
+        if self._re is None:
+            self._re = {}
+
+        if is_logogram not in self._re:
+            filtered_tree = self.filter_tree(filter_function=self.__node_is_field_or_noop_or_not)
+
+            if filtered_tree is None:
+                raise McSolrQueryParseSyntaxException("query is empty without fields or ranges")
+
+            regexp = filtered_tree.get_re()
+
+            # for logogram languages, remove the beginning word boundary because it breaks the re
+            if is_logogram:
+                regexp = regexp.replace('[[:<:]]', '')
+
+            self._re[is_logogram] = regexp
+
+        return self._re[is_logogram]
 
-        if filtered_tree is None:
-            raise McSolrQueryParseSyntaxException("query is empty without fields or ranges")
+    def re_plan(self, is_logogram=False, max_regex_length: int = _MAX_PLAN_REGEX_LENGTH) -> RegexMatchPlan:
+        """Return a plan for matching the parse tree with a number of posix regexes no longer than "max_regex_length".
 
-        regexp = filtered_tree.get_re()
+        If re() would be no longer than "max_regex_length", the plan consists of just that regex; otherwise, the
+        plan's regexes are OR'd terms and phrases, so the plan's size is linear in the number of terms."""
 
-        # for logogram languages, remove the beginning word boundary because it breaks the re
-        if is_logogram:
-            regexp = regexp.replace('[[:<:]]', '')
+        plan_key = (bool(is_logogram), max_regex_length,)
 
-        return regexp
+        if self._re_plan is None:
+            self._re_plan = {}
+
+        if plan_key not in self._re_plan:
+            filtered_tree = self.filter_tree(filter_function=self.__node_is_field_or_noop_or_not)
+
+            if filtered_tree is None:
+                raise McSolrQueryParseSyntaxException("query is empty without fields or ranges")
+
+            # Don't generate re() before making sure that it's not huge
+            if _estimated_re_length(filtered_tree) <= max_regex_length:
+                plan = RegexMatchPlan(regexes=[self.re(is_logogram=is_logogram)], plan=('regex', 0,))
+            else:
+                regexes = []
+
+                def __add_regex(regex: str) -> int:
+                    # for logogram languages, remove the beginning word boundary because it breaks the re
+                    if is_logogram:
+                        regex = regex.replace('[[:<:]]', '')
+                    if regex not in regexes:
+                        regexes.append(regex)
+                    return regexes.index(regex)
+
+                plan = RegexMatchPlan(
+                    regexes=regexes,
+                    plan=_build_regex_plan(node=filtered_tree,
+                                           max_regex_length=max_regex_length,
+                                           add_regex=__add_regex),
+                )
+
+            self._re_plan[plan_key] = plan
+
+        return self._re_plan[plan_key]
 
 
 class TermNode(ParseNode):
@@ -302,7 +420,7 @@ class AndNode(BooleanNode):
         else:
             a = operands[0].get_re()
             b = self.get_re(operands=operands[1:])
-            return '(?: (?: %s .* %s ) | (?: %s .* %s ) )' % (a, b, b, a)
+            return _AND_RE_TEMPLATE % {'a': a, 'b': b}
 
 
 class OrNode(BooleanNode):
@@ -392,7 +510,103 @@ class NoopNode(ParseNode):
         return NoopNode()
 
 
-def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> ParseNode:
+def _has_and_operands(node: AbstractParseNode) -> bool:
+    """Return True if re() of the (filtered) tree would have to combine operands of an AND."""
+    if type(node) is AndNode and len(node.operands) > 1:
+        return True
+    elif type(node) in (AndNode, OrNode):
+        return any(_has_and_operands(operand) for operand in node.operands)
+    elif type(node) is FieldNode:
+        return _has_and_operands(node.operand)
+    else:
+        return False
+
+
+def _estimated_re_length(node: AbstractParseNode) -> int:
+    """Return length of re() of the (filtered) tree without generating it."""
+    if not _has_and_operands(node):
+        return len(node.get_re())
+    elif type(node) is AndNode:
+        and_template_length = len(_AND_RE_TEMPLATE % {'a': '', 'b': ''})
+        operand_lengths = [_estimated_re_length(operand) for operand in node.operands]
+        length = operand_lengths[-1]
+        for operand_length in reversed(operand_lengths[:-1]):
+            length = 2 * (operand_length + length) + and_template_length
+        return length
+    elif type(node) is OrNode:
+        return sum(_estimated_re_length(operand) for operand in node.operands) + len('(?:  )') + \
+            len(' | ') * (len(node.operands) - 1)
+    else:
+        return _estimated_re_length(node.operand)
+
+
+def _build_regex_plan(node: AbstractParseNode, max_regex_length: int, add_regex: Callable[[str], int]) -> tuple:
+    """Build regex match plan for the (filtered) tree; "add_regex" adds the regex to the plan and returns its index."""
+
+    if type(node) is FieldNode:
+        return _build_regex_plan(node=node.operand, max_regex_length=max_regex_length, add_regex=add_regex)
+
+    if not _has_and_operands(node):
+        regex = node.get_re()
+        if len(regex) <= max_regex_length or type(node) is not OrNode:
+            return 'regex', add_regex(regex),
+
+    if type(node) is AndNode:
+        subplans = [_build_regex_plan(node=operand, max_regex_length=max_regex_length, add_regex=add_regex)
+                    for operand in node.operands]
+        return ('and', subplans,) if len(subplans) > 1 else subplans[0]
+
+    # OR: operands which don't have ANDs get OR'd into as few regexes no longer than "max_regex_length" as possible
+    subplans = []
+    alternatives = []
+
+    def __add_alternatives() -> None:
+        if len(alternatives) > 0:
+            regex = alternatives[0] if len(alternatives) == 1 else '(?: ' + ' | '.join(alternatives) + ' )'
+            subplans.append(('regex', add_regex(regex),))
+            alternatives.clear()
+
+    alternatives_length = 0
+    for operand in node.operands:
+        if _has_and_operands(operand):
+            subplans.append(_build_regex_plan(node=operand, max_regex_length=max_regex_length, add_regex=add_regex))
+            continue
+
+        operand_regex = operand.get_re()
+        if alternatives_length + len(' | ') + len(operand_regex) > max_regex_length:
+            __add_alternatives()
+        if len(alternatives) == 0:
+            alternatives_length = len('(?:  )')
+        alternatives.append(operand_regex)
+        alternatives_length += len(' | ') + len(operand_regex)
+
+    __add_alternatives()
+
+    return ('or', subplans,) if len(subplans) > 1 else subplans[0]
+
+
+def _regex_plan_matches(plan: tuple, matched_regex_indexes: Set[int]) -> bool:
+    """Evaluate regex match plan given indexes of the plan's regexes that have matched the string."""
+    if plan[0] == 'regex':
+        return plan[1] in matched_regex_indexes
+    elif plan[0] == 'and':
+        return all(_regex_plan_matches(plan=subplan, matched_regex_indexes=matched_regex_indexes)
+                   for subplan in plan[1])
+    else:
+        return any(_regex_plan_matches(plan=subplan, matched_regex_indexes=matched_regex_indexes)
+                   for subplan in plan[1])
+
+
+def _regex_plan_repr(plan: tuple) -> str:
+    """Return regex match plan's string representation with regexes referred to by their indexes."""
+    if plan[0] == 'regex':
+        return '$%d' % plan[1]
+    else:
+        connector = ' ' + plan[0] + ' '
+        return '( ' + connector.join(_regex_plan_repr(plan=subplan) for subplan in plan[1]) + ' )'
+
+
+def __parse_tokens(tokens: collections.deque, want_type: List[TokenType] = None) -> ParseNode:
     """Given a flat list of tokens, generate a boolean logic tree."""
 
     def __check_type(checked_token: Token, checked_want_type: List[TokenType]) -> None:
@@ -403,8 +617,6 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
                     str(checked_token), str(checked_want_type))
             )
 
-    log.debug("parse tree: " + str(tokens))
-
     if want_type is None:
         want_type = [TokenType.OPEN, TokenType.PHRASE, TokenType.NOT, TokenType.TERM]
 
@@ -414,11 +626,7 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
 
     while len(tokens) > 0:
 
-        frame_depth = len(inspect.getouterframes(inspect.currentframe()))
-        log.debug("clause: %s [%s] [frame_depth: %s]" % (clause, type(clause), frame_depth))
-
-        token = tokens.pop(0)
-        log.debug("parse token: " + str(token))
+        token = tokens.popleft()
 
         if (token.token_type == TokenType.PLUS) and (not clause or (type(clause) in (AndNode, OrNode))):
             continue
@@ -431,12 +639,10 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
                                               TokenType.TERM,
                                               TokenType.NOOP,
                                               TokenType.FIELD]):
-            log.debug("INSERT OR")
-            tokens.insert(0, token)
+            tokens.appendleft(token)
             token = Token(token_type=TokenType.OR, token_value='or')
         elif clause and (token.token_type in [TokenType.NOT]):
-            log.debug("INSERT AND")
-            tokens.insert(0, token)
+            tokens.appendleft(token)
             token = Token(token_type=TokenType.AND, token_value='and')
 
         __check_type(token, want_type)
@@ -476,12 +682,7 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
 
         elif token.token_type == TokenType.TERM:
             want_type = [TokenType.CLOSE, TokenType.AND, TokenType.OR, TokenType.PLUS]
-            wildcard = False
-            if token.token_value.endswith(WILD_PLACEHOLDER):
-                token.token_value = token.token_value.replace(WILD_PLACEHOLDER, '')
-                wildcard = True
-
-            clause = TermNode(token.token_value, wildcard=wildcard)
+            clause = TermNode(token.token_value, wildcard=token.wildcard)
 
         elif token.token_type == TokenType.PHRASE:
             want_type = [TokenType.CLOSE, TokenType.AND, TokenType.OR, TokenType.PLUS]
@@ -502,17 +703,15 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
 
             node_type = OrNode if (token.token_type == TokenType.OR) else AndNode
 
-            if type(clause) is node_type:
-                clause = node_type(clause.operands)
-            else:
+            if type(clause) is not node_type:
                 clause = node_type([clause])
 
             hanging_boolean = True
 
         elif token.token_type == TokenType.FIELD:
             want_type = [TokenType.CLOSE, TokenType.AND, TokenType.OR, TokenType.PLUS]
-            field_name = re.sub(FIELD_PLACEHOLDER, '', token.token_value)
-            next_token = tokens.pop(0)
+            field_name = token.token_value
+            next_token = tokens.popleft()
             if next_token.token_type == TokenType.OPEN:
                 field_clause = __parse_tokens(
                     tokens=tokens,
@@ -526,20 +725,18 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
                     ]
                 )
             else:
-                field_clause = __parse_tokens(tokens=[next_token], want_type=[
+                field_clause = __parse_tokens(tokens=collections.deque([next_token]), want_type=[
                     TokenType.PHRASE,
                     TokenType.TERM,
                     TokenType.NOOP
                 ])
 
-            log.debug("field operand for %s: %s" % (field_name, field_clause))
-
             clause = FieldNode(field_name, field_clause)
 
         elif token.token_type == TokenType.NOT:
             want_type = [TokenType.CLOSE, TokenType.AND, TokenType.OR, TokenType.PLUS]
             # operand = None
-            next_token = tokens.pop(0)
+            next_token = tokens.popleft()
             if next_token.token_type == TokenType.OPEN:
                 operand = __parse_tokens(tokens=tokens, want_type=[
                     TokenType.FIELD,
@@ -551,10 +748,10 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
                     TokenType.PLUS
                 ])
             elif next_token.token_type == TokenType.FIELD:
-                tokens.insert(0, next_token)
+                tokens.appendleft(next_token)
                 operand = __parse_tokens(tokens=tokens, want_type=[TokenType.FIELD])
             else:
-                operand = __parse_tokens(tokens=[next_token], want_type=[
+                operand = __parse_tokens(tokens=collections.deque([next_token]), want_type=[
                     TokenType.PHRASE,
                     TokenType.TERM,
                     TokenType.NOOP,
@@ -568,7 +765,6 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
         want_type += [TokenType.CLOSE]
 
         if boolean_clause:
-            log.debug("boolean append: %s <- %s" % (boolean_clause, clause))
             if type(boolean_clause) is type(clause):
                 boolean_clause.operands += clause.operands
             else:
@@ -586,83 +782,130 @@ def __parse_tokens(tokens: List[Token], want_type: List[TokenType] = None) -> Pa
 
 
 def __get_tokens(query: str) -> List[Token]:
-    """Get a list of Token objects from the query."""
-
-    def __get_token_type(token: str) -> TokenType:
-        """Given some token text, return one of T_* as the type for that token."""
-
-        if token == '(':
-            return TokenType.OPEN
-        elif token == ')':
-            return TokenType.CLOSE
-        elif token[0] in "'\"":
-            return TokenType.PHRASE
-        elif token.lower() == 'and':
-            return TokenType.AND
-        elif token.lower() == 'or':
-            return TokenType.OR
-        elif token.lower() in ('not', '!', '-'):
-            return TokenType.NOT
-        elif token == '+':
-            return TokenType.PLUS
-        elif token == '~':
-            raise McSolrQueryParseSyntaxException("proximity searches not supported")
-        elif token == '/':
-            raise McSolrQueryParseSyntaxException("regular expression searches not supported")
-        elif (WILD_PLACEHOLDER in token) and not re.match(r'^\w+' + WILD_PLACEHOLDER + '$', token):
-            raise McSolrQueryParseSyntaxException("* can only appear the end of a term: " + token)
-        elif token == NOOP_PLACEHOLDER:
-            return TokenType.NOOP
-        elif token.endswith(FIELD_PLACEHOLDER):
-            return TokenType.FIELD
-        elif re.match('^\w+$', token):
-            return TokenType.TERM
-        else:
-            raise McSolrQueryParseSyntaxException("unrecognized token '%s'" % str(token))
+    """Get a list of Token objects from the query in a single pass over it."""
 
     tokens = []
 
-    # normalize everything to lower case and make sure nothing conflicts with placeholders below
+    # Number of parens that are open at the current token
+    depth = 0
+
+    # normalize everything to lower case
     query = query.lower()
 
-    # the tokenizer interprets as ! as a special character, which results in the ! and subsequent text disappearing.
-    # we just replace it with the equivalent - to avoid this.
-    query = query.replace('!', '-')
+    for match in _TOKEN_REGEX.finditer(query):
+        token_kind = match.lastgroup
 
-    # also the tokenizer treats newlines as tokens, so we replace them
-    query = query.replace("\n", " ")
-    query = query.replace("\r", " ")
+        if token_kind == 'space':
+            continue
 
-    # we can't support solr range searches, and they break the tokenizer, so just regexp them away
-    query = re.sub('\w+:\[[^\]]*\]', NOOP_PLACEHOLDER, query)
+        elif token_kind == 'open':
+            depth += 1
+            tokens.append(Token(token_value='(', token_type=TokenType.OPEN))
+
+        elif token_kind == 'close':
+            if depth == 0:
+                raise McSolrQueryParseSyntaxException("unbalanced ')'")
+            depth -= 1
+            tokens.append(Token(token_value=')', token_type=TokenType.CLOSE))
+
+        elif token_kind == 'phrase':
+            tokens.append(Token(token_value=match.group('phrase'), token_type=TokenType.PHRASE))
+
+        elif token_kind == 'range':
+            # we can't support solr range searches, so they're noops
+            tokens.append(Token(token_value=match.group('range'), token_type=TokenType.NOOP))
+
+        elif token_kind == 'field':
+            tokens.append(Token(token_value=match.group('field_name'), token_type=TokenType.FIELD))
+
+        elif token_kind == 'term':
+            term = match.group('term')
+            if term == 'and':
+                tokens.append(Token(token_value=term, token_type=TokenType.AND))
+            elif term == 'or':
+                tokens.append(Token(token_value=term, token_type=TokenType.OR))
+            elif term == 'not':
+                tokens.append(Token(token_value=term, token_type=TokenType.NOT))
+            else:
+                wildcard = term.endswith('*')
+                if wildcard:
+                    term = term[:-1]
+                if wildcard and match.end() < len(query) and (query[match.end()] == '*' or
+                                                              _TERM_CHARACTER_REGEX.match(query[match.end()])):
+                    raise McSolrQueryParseSyntaxException(
+                        "* can only appear the end of a term: " + query[match.start():match.end() + 1]
+                    )
+                tokens.append(Token(token_value=term, token_type=TokenType.TERM, wildcard=wildcard))
+
+        elif token_kind == 'not':
+            tokens.append(Token(token_value=match.group('not'), token_type=TokenType.NOT))
+
+        elif token_kind == 'plus':
+            tokens.append(Token(token_value='+', token_type=TokenType.PLUS))
 
-    # we want to include ':' at the end of field names, but tokenizer wants to make it a separate token
-    query = re.sub(':', FIELD_PLACEHOLDER + ' ', query)
+        else:
+            character = match.group('other')
+            if character == '~':
+                raise McSolrQueryParseSyntaxException("proximity searches not supported")
+            elif character == '/':
+                raise McSolrQueryParseSyntaxException("regular expression searches not supported")
+            elif character == '*':
+                raise McSolrQueryParseSyntaxException("* can only appear the end of a term: " + query[match.start():])
+            elif character in "'\"":
+                raise McSolrQueryParseSyntaxException("unterminated phrase: " + query[match.start():])
+            elif character == ':':
+                raise McSolrQueryParseSyntaxException("field name expected before ':'")
+            else:
+                raise McSolrQueryParseSyntaxException("unrecognized token '%s'" % character)
 
-    # we want to include '*' at the end of field names, but tokenizer wants to make it a separate token
-    query = re.sub(r'\*', WILD_PLACEHOLDER, query)
+    if depth > 0:
+        raise McSolrQueryParseSyntaxException("unbalanced '('")
 
-    log.debug("filtered query: " + query)
+    return tokens
 
-    raw_tokens = generate_tokens(readline=io.StringIO(query).readline)
 
-    for raw_token in raw_tokens:
-        token_value = raw_token[1]
-        log.debug("raw token '%s'" % token_value)
-        if len(token_value) > 0:
-            token_type = __get_token_type(token=token_value)
-            tokens.append(Token(token_value=token_value, token_type=token_type))
+def __normalize_query(solr_query: str) -> str:
+    """Normalize query's case and whitespace which don't affect the parse tree."""
+    return ' '.join(solr_query.lower().split())
 
-    return tokens
+
+@functools.lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def __parse_normalized_query(solr_query: str) -> ParseNode:
+    """Parse normalized solr query.
+
+    Result depends on the query only, so it gets cached together with its memoized tsquery() and re() outputs."""
+
+    tokens = __get_tokens(query=solr_query)
+
+    # Parens get checked for balance before the whole query gets wrapped in them
+    tokens = [Token(token_value='(', token_type=TokenType.OPEN)] + tokens + [
+        Token(token_value=')', token_type=TokenType.CLOSE)
+    ]
+
+    return __parse_tokens(tokens=collections.deque(tokens))
 
 
 def parse(solr_query: str) -> ParseNode:
-    """ Parse a solr query and return a set of *Node objects that encapsulate the query in structured form."""
+    """ Parse a solr query and return a set of *Node objects that encapsulate the query in structured form.
 
-    solr_query = "( " + decode_object_from_bytes_if_needed(solr_query) + " )"
+    Parse trees of recently parsed queries get reused, so the returned tree is not to be modified."""
 
-    tokens = __get_tokens(query=solr_query)
+    solr_query = decode_object_from_bytes_if_needed(solr_query)
+
+    return __parse_normalized_query(__normalize_query(solr_query))
+
+
+def parse_cache_stats() -> Dict[str, int]:
+    """Return hit / miss counters of the parse tree cache used by parse()."""
+    cache_info = __parse_normalized_query.cache_info()
+    return {
+        'hits': cache_info.hits,
+        'misses': cache_info.misses,
+        'size': cache_info.currsize,
+        'max_size': cache_info.maxsize,
+    }
 
-    log.debug("Tokens: %s" % str(tokens))
 
-    return __parse_tokens(tokens=tokens)
+def clear_parse_cache() -> None:
+    """Empty the parse tree cache used by parse()."""
+    __parse_normalized_query.cache_clear()
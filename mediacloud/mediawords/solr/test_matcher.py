@@ -0,0 +1,90 @@
+import pytest
+
+from mediawords.solr.matcher import QueryMatcher, TokenizedText
+from mediawords.solr.query import parse, McSolrQueryParseSyntaxException
+
+
+def __matches(query: str, text: str, **kwargs) -> bool:
+    fields = kwargs.pop('fields', None)
+    return QueryMatcher(tree=parse(query), **kwargs).matches(text=text, fields=fields)
+
+
+def test_tokenized_text():
+    text = TokenizedText(text="Climate-change PROTESTERS, climate  protests!")
+    assert text.text() == "climate-change protesters, climate  protests!"
+    assert text.words() == ['climate', 'change', 'protesters', 'climate', 'protests']
+
+    assert text.has_word('climate')
+    assert not text.has_word('protest')
+    assert text.has_prefix('protest')
+    assert not text.has_prefix('protestants')
+
+    assert text.has_phrase(['climate', 'change'], last_word_is_prefix=False)
+    assert text.has_phrase(['climate', 'protest'], last_word_is_prefix=True)
+    assert not text.has_phrase(['climate', 'protest'], last_word_is_prefix=False)
+    assert not text.has_phrase(['change', 'climate'], last_word_is_prefix=False)
+    assert not text.has_phrase(['protests', 'climate'], last_word_is_prefix=True)
+
+
+def test_query_matcher():
+    # terms match word prefixes like in re()
+    assert __matches('protest', 'Protesters gathered')
+    assert __matches('protest', 'anti-protest')
+    assert not __matches('testers', 'protesters')
+
+    # whole words
+    assert not __matches('protest', 'Protesters gathered', whole_words=True)
+    assert __matches('protest*', 'Protesters gathered', whole_words=True)
+    assert __matches('protest', 'The protest', whole_words=True)
+
+    # phrases
+    assert __matches('"climate change"', 'Climate\n changes')
+    assert not __matches('"climate change"', 'change climate')
+    assert not __matches('"climate change"', 'Climate changes', whole_words=True)
+    assert __matches("'alt-right'", 'Alt right')
+
+    # boolean
+    assert __matches('foo and ( bar baz )', 'baz and foo')
+    assert not __matches('foo and ( bar baz )', 'foo only')
+    assert __matches('foo or bar', 'bar')
+    assert __matches('foo and not bar', 'foo')
+    assert not __matches('foo -bar', 'foo bar')
+    assert __matches('-bar foo', 'foo')
+    assert not __matches('baz -( foo or bar )', 'baz foo')
+    assert __matches('baz -( foo or bar )', 'baz qux')
+
+    # fields
+    assert __matches('sentence:foo', 'foo')
+    assert __matches('foo and media_id:1', 'foo')
+    assert __matches('foo and media_id:1', 'foo', fields={'media_id': 1})
+    assert not __matches('foo and media_id:1', 'foo', fields={'media_id': 10})
+    assert __matches('foo and media_id:1*', 'foo', fields={'media_id': 10})
+    assert __matches('foo and tags_id_media:( 1 2 )', 'foo', fields={'tags_id_media': [3, 2]})
+    assert not __matches('foo and -tags_id_media:( 1 2 )', 'foo', fields={'tags_id_media': [3, 2]})
+    assert __matches('foo and title:"bar baz"', 'foo', fields={'title': 'Bar baz!'})
+    assert not __matches('foo and title:bar', 'foo bar', fields={'title': 'baz'})
+    assert __matches('foo and publish_date:[2016-01-01T00:00:00Z TO *]', 'foo')
+    assert not __matches('media_id:1', 'foo')
+
+    # logograms
+    assert __matches('中文', '我说中文', is_logogram=True)
+    assert not __matches('中文', '我说中文')
+    assert __matches('"说 中文"', '我说 中文', is_logogram=True)
+
+    # any of the texts
+    matcher = QueryMatcher(tree=parse('foo and bar'))
+    assert matcher.matches_any(['foo', 'foo bar'])
+    assert not matcher.matches_any(['foo', 'bar'])
+    assert not matcher.matches_any([])
+
+    with pytest.raises(McSolrQueryParseSyntaxException):
+        QueryMatcher(tree=parse('"!"'))
+
+
+def test_query_matcher_linear():
+    # AND of 1000 ORs would make an exponentially large regex
+    matcher = QueryMatcher(tree=parse(' and '.join('( foo%d or "bar %d" )' % (i, i) for i in range(1000))))
+
+    text = TokenizedText(text=' '.join('foo%d' % i for i in range(999)) + ' bar 999' * 100000)
+    assert matcher.matches(text=text)
+    assert not matcher.matches(text=TokenizedText(text='bar ' * 100000))
@@ -0,0 +1,88 @@
+from mediawords.solr.matcher import QueryMatcher
+from mediawords.solr.prefilter import QueryPrefilter
+from mediawords.solr.query import parse
+
+
+def __may_match(query: str, text: str, **kwargs) -> bool:
+    return QueryPrefilter(tree=parse(query), **kwargs).may_match(text=text)
+
+
+def test_query_prefilter():
+    # terms match word prefixes
+    assert __may_match('protest', 'Protesters gathered')
+    assert __may_match('protest', 'anti-protest')
+    assert not __may_match('testers', 'protesters')
+    assert not __may_match('protest', 'nothing to see here')
+
+    # AND requires every operand's terms
+    assert __may_match('foo and bar', 'bar, foo')
+    assert not __may_match('foo and bar', 'foo only')
+
+    # OR requires any operand's terms
+    assert __may_match('foo or bar', 'bar only')
+    assert not __may_match('foo or bar', 'baz only')
+    assert __may_match('climate and ( protest or strike )', 'Climate strike')
+    assert not __may_match('climate and ( protest or strike )', 'Climate change')
+    assert not __may_match('climate and ( protest or strike )', 'Protesters strike')
+
+    # phrases require their longest word only
+    assert __may_match('"global warming"', 'warming globally')
+    assert not __may_match('"global warming"', 'global cooling')
+
+    # NOT clauses and other fields don't require any terms
+    assert __may_match('not foo', 'anything')
+    assert __may_match('foo or not bar', 'anything')
+    assert __may_match('foo or media_id:1', 'anything')
+    assert __may_match('foo and media_id:1', 'foo')
+    assert not __may_match('foo and media_id:1', 'bar')
+    assert not __may_match('sentence:foo', 'bar')
+    assert not QueryPrefilter(tree=parse('foo or media_id:1')).can_filter()
+    assert QueryPrefilter(tree=parse('foo and not bar')).can_filter()
+
+    # logogram languages
+    assert not __may_match('中国', '在中國')
+    assert __may_match('中国', '在中国', is_logogram=True)
+    assert not __may_match('oo', 'foo')
+    assert __may_match('oo', 'foo', is_logogram=True)
+
+    prefilter = QueryPrefilter(tree=parse('foo and bar'))
+    assert prefilter.may_match_any(['foo', 'foo bar'])
+    assert not prefilter.may_match_any(['foo', 'bar'])
+    assert not prefilter.may_match_any([])
+
+
+def test_query_prefilter_matcher_parity():
+    queries = [
+        'alt* or "alternative right"',
+        'protest* and ( climate or "global warming" )',
+        '( foo and bar ) or baz and media_id:1',
+        'foo and not ( bar or baz )',
+        '( foo or bar ) and ( baz or "qux quux" ) and -corge',
+    ]
+    texts = [
+        'This is a string describing alt-right and something else.',
+        'Alternative\n right',
+        'Protesters demand action on climate change',
+        'Global warming protest',
+        'Global protest warming',
+        'foo, bar',
+        'bazaar foo',
+        'bar qux quux',
+        'foo baz corge',
+        'something else',
+    ]
+
+    # prefilter never rejects a text that matches the query
+    for query in queries:
+        tree = parse(query)
+        prefilter = QueryPrefilter(tree=tree)
+        matcher = QueryMatcher(tree=tree, prefilter=False)
+        prefiltered_matcher = QueryMatcher(tree=tree)
+        for text in texts:
+            if matcher.matches(text=text):
+                assert prefilter.may_match(text=text), "Query: %s; text: %s" % (query, text)
+            assert prefiltered_matcher.matches(text=text) == matcher.matches(text=text)
+
+    # "sentence" field's value gets matched instead of the text
+    matcher = QueryMatcher(tree=parse('sentence:foo'))
+    assert matcher.matches(text='bar', fields={'sentence': 'foo'})
@@ -2,7 +2,7 @@ import re
 
 import pytest
 
-from mediawords.solr.query import parse, McSolrQueryParseSyntaxException
+from mediawords.solr.query import parse, parse_cache_stats, clear_parse_cache, McSolrQueryParseSyntaxException
 
 
 # noinspection SpellCheckingInspection
@@ -590,3 +590,100 @@ def test_re():
 
         True
     )
+
+
+def test_re_plan():
+    # re() within the budget is the only regex of the plan
+    tree = parse('foo and ( bar baz )')
+    plan = tree.re_plan()
+    assert plan.is_single_regex()
+    assert plan.regexes() == [tree.re()]
+    assert plan.matches({0})
+    assert not plan.matches(set())
+    assert tree.re_plan() is plan
+
+    # ORs of terms and phrases become regexes no longer than the budget
+    plan = tree.re_plan(max_regex_length=30)
+    assert str(plan) == '( $0 and $1 )'
+    assert plan.regexes() == ['[[:<:]]foo', '(?: [[:<:]]bar | [[:<:]]baz )']
+
+    plan = tree.re_plan(max_regex_length=1)
+    assert str(plan) == '( $0 and ( $1 or $2 ) )'
+    assert plan.regexes() == ['[[:<:]]foo', '[[:<:]]bar', '[[:<:]]baz']
+    assert plan.matches({0, 2})
+    assert not plan.matches({1, 2})
+
+    plan = parse('( a and b ) or c or d or !e or media_id:1').re_plan(max_regex_length=1)
+    assert str(plan) == '( ( $0 and $1 ) or $2 or $3 )'
+    assert plan.matches({3})
+    assert plan.matches({0, 1})
+    assert not plan.matches({0})
+
+    plan = parse('foo and "bar baz"').re_plan(is_logogram=True, max_regex_length=1)
+    assert plan.regexes() == ['foo', 'bar[[:space:]]+baz']
+
+    # plan stays linear in the number of AND operands
+    query = ' and '.join('( foo%d or "bar %d" )' % (i, i) for i in range(1000))
+    plan = parse(query).re_plan()
+    assert len(plan.regexes()) == 1000
+    assert plan.matches(set(range(1000)))
+    assert not plan.matches(set(range(999)))
+
+    with pytest.raises(McSolrQueryParseSyntaxException):
+        parse('media_id:1').re_plan()
+
+
+def test_parse_tokens():
+    # ranges (inclusive, exclusive and mixed) are noops
+    for range_query in ('publish_date:[2016-01-01T00:00:00Z TO *]', 'publish_date:{2016-01-01 TO 2017-01-01}',
+                        'media_id:[1 TO 10}'):
+        assert parse('foo and %s' % range_query).tsquery() == '( foo )'
+
+    # operators that are not separated by whitespace
+    assert parse('foo-bar').tsquery() == '( foo & !bar )'
+    assert parse('+foo +title:(bar)').tsquery() == '( foo )'
+    assert parse('!foo\nOR\r\n(bar)').tsquery() == '( !foo | bar )'
+
+    # escaped quotes in phrases
+    assert parse('"foo \\"bar\\""').re() == '[[:<:]]foo[[:space:]]+\\"bar\\"'
+
+    for query in ('"foo bar', "don't", 'foo*bar', 'foo**', 'foo : bar', '[1 TO 2]', 'foo && bar', 'foo/'):
+        with pytest.raises(McSolrQueryParseSyntaxException):
+            parse(query)
+
+    # unbalanced parens
+    for query in ('(', ')', 'bar (', '(foo', '-q ( not foo', 'foo )', '( foo ) )', 'foo ) and ( bar', 'title:(foo'):
+        with pytest.raises(McSolrQueryParseSyntaxException):
+            parse(query)
+    assert parse('((foo) and (bar or baz))').tsquery() == '( foo & ( bar | baz ) )'
+
+    # thousands of OR'd terms
+    terms = ['term%d' % i for i in range(5000)]
+    assert parse(' OR '.join(terms)).tsquery() == '( ' + ' | '.join(terms) + ' )'
+
+
+def test_parse_cache():
+    clear_parse_cache()
+
+    tree = parse('foo and ( bar baz )')
+    assert parse_cache_stats()['misses'] == 1
+
+    # Case and whitespace don't matter
+    assert parse('FOO  and\n( bar baz )') is tree
+    assert parse_cache_stats()['hits'] == 1
+    assert parse_cache_stats()['size'] == 1
+
+    assert tree.tsquery() == '( foo & ( bar | baz ) )'
+    assert tree.re() == '(?: (?: [[:<:]]foo .* (?: [[:<:]]bar | [[:<:]]baz ) ) | ' \
+                        '(?: (?: [[:<:]]bar | [[:<:]]baz ) .* [[:<:]]foo ) )'
+    assert tree.re(is_logogram=True) == '(?: (?: foo .* (?: bar | baz ) ) | (?: (?: bar | baz ) .* foo ) )'
+    assert tree.re() is parse('foo and ( bar baz )').re()
+
+    # Failed parses don't get cached
+    for _ in range(2):
+        with pytest.raises(McSolrQueryParseSyntaxException):
+            parse('*foo')
+    assert parse_cache_stats()['size'] == 1
+
+    clear_parse_cache()
+    assert parse_cache_stats()['size'] == 0
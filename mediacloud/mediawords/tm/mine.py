@@ -1,6 +1,9 @@
 from typing import List
 
 from mediawords.db.handler import DatabaseHandler
+from mediawords.solr.matcher import QueryMatcher
+from mediawords.solr.prefilter import QueryPrefilter
+from mediawords.solr.query import RegexMatchPlan
 from mediawords.util.log import create_logger
 from mediawords.util.perl import decode_object_from_bytes_if_needed
 
@@ -12,24 +15,14 @@ class McPostgresRegexMatch(Exception):
     pass
 
 
-def postgres_regex_match(db: DatabaseHandler, strings: List[str], regex: str) -> bool:
-    """Run the regex through the PostgreSQL engine against a given list of strings.
-
-    Return True if any string matches the given regex.
-
-    Only try to match against the first megabyte of each string.  Don't try to match on any string that has a null char.
-
-    This is necessary because very occasionally the wrong combination of text and complex boolean regex will cause Perl
-    (Python too?) to hang."""
-
-    strings = decode_object_from_bytes_if_needed(strings)
-    regex = decode_object_from_bytes_if_needed(regex)
+def __strings_to_match(strings: List[str]) -> List[str]:
+    """Validate strings to be matched against a regex, truncate them to 1 MB and blank out the ones with null chars."""
 
     if not isinstance(strings, list):
         raise McPostgresRegexMatch("Strings must be a list, but is: %s" % str(strings))
 
     if len(strings) == 0:
-        return False
+        return strings
 
     max_len = 1024 * 1024
     filter_strings = False
@@ -53,6 +46,40 @@ def postgres_regex_match(db: DatabaseHandler, strings: List[str], regex: str) ->
     if not isinstance(strings[0], str):
         raise McPostgresRegexMatch("Strings must be a list of strings, but is: %s" % str(strings))
 
+    return strings
+
+
+def __prefiltered_strings(strings: List[str], prefilter: QueryPrefilter = None) -> List[str]:
+    """Return strings that might match the query according to the prefilter (all of them if it's None)."""
+    if prefilter is None or not prefilter.can_filter():
+        return strings
+    return [s for s in strings if prefilter.may_match(text=s)]
+
+
+def postgres_regex_match(db: DatabaseHandler,
+                         strings: List[str],
+                         regex: str,
+                         prefilter: QueryPrefilter = None) -> bool:
+    """Run the regex through the PostgreSQL engine against a given list of strings.
+
+    Return True if any string matches the given regex.
+
+    Only try to match against the first megabyte of each string.  Don't try to match on any string that has a null char.
+
+    This is necessary because very occasionally the wrong combination of text and complex boolean regex will cause Perl
+    (Python too?) to hang.
+
+    If "prefilter" (QueryPrefilter built from the same parse tree as the regex) is passed, strings that it rejects don't
+    get sent to PostgreSQL at all."""
+
+    strings = decode_object_from_bytes_if_needed(strings)
+    regex = decode_object_from_bytes_if_needed(regex)
+
+    strings = __strings_to_match(strings)
+    strings = __prefiltered_strings(strings=strings, prefilter=prefilter)
+    if len(strings) == 0:
+        return False
+
     full_regex = '(?isx)%s' % regex
     match = db.query("""
         SELECT 1
@@ -68,3 +95,65 @@ def postgres_regex_match(db: DatabaseHandler, strings: List[str], regex: str) ->
         return True
     else:
         return False
+
+
+def postgres_regex_plan_match(db: DatabaseHandler,
+                              strings: List[str],
+                              plan: RegexMatchPlan,
+                              prefilter: QueryPrefilter = None) -> bool:
+    """Run regexes of the regex match plan (ParseNode.re_plan()) through the PostgreSQL engine against a given list of
+    strings.
+
+    Return True if any string matches the plan.
+
+    All of plan's regexes get matched against all strings in a single query, and then plan's AND / OR tree gets
+    evaluated for every string, so the work grows linearly with the number of the query's terms, unlike with a single
+    regex which grows exponentially with the number of AND operands. Strings get truncated (and prefiltered) like in
+    postgres_regex_match()."""
+
+    strings = decode_object_from_bytes_if_needed(strings)
+
+    if plan.is_single_regex():
+        return postgres_regex_match(db=db, strings=strings, regex=plan.regexes()[0], prefilter=prefilter)
+
+    strings = __strings_to_match(strings)
+    strings = __prefiltered_strings(strings=strings, prefilter=prefilter)
+    if len(strings) == 0:
+        return False
+
+    matches = db.query("""
+        SELECT strings.string_index, ARRAY_AGG(regexes.regex_index) AS regex_indexes
+        FROM UNNEST(%(strings)s::TEXT[]) WITH ORDINALITY AS strings (string, string_index)
+            CROSS JOIN UNNEST(%(regexes)s::TEXT[]) WITH ORDINALITY AS regexes (regex, regex_index)
+        WHERE strings.string ~ ('(?isx)' || regexes.regex)
+        GROUP BY strings.string_index
+    """, {
+        'strings': strings,  # list gets converted to PostgreSQL's ARRAY[]
+        'regexes': plan.regexes(),
+    }).hashes()
+
+    for string_matches in matches:
+        # WITH ORDINALITY numbers elements starting with 1
+        matched_regex_indexes = set(regex_index - 1 for regex_index in string_matches['regex_indexes'])
+        if plan.matches(matched_regex_indexes=matched_regex_indexes):
+            return True
+
+    return False
+
+
+def query_match(strings: List[str], matcher: QueryMatcher) -> bool:
+    """Match a given list of strings against the query matcher in-process.
+
+    Return True if any string matches the query.
+
+    In-process alternative to postgres_regex_match() with topic's regex: QueryMatcher takes time linear in the size of
+    the strings and the query, so there's no need for a database round trip to have PostgreSQL's regex engine do the
+    matching, nor to match only the first megabyte of each string. Matcher (built once per topic from the parsed
+    solr_seed_query) evaluates NOT clauses too, which the topic's regex leaves out."""
+
+    strings = decode_object_from_bytes_if_needed(strings)
+
+    if not isinstance(strings, list):
+        raise McPostgresRegexMatch("Strings must be a list, but is: %s" % str(strings))
+
+    return matcher.matches_any(texts=strings)
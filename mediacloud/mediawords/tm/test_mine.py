@@ -1,5 +1,8 @@
+from mediawords.solr.matcher import QueryMatcher
+from mediawords.solr.prefilter import QueryPrefilter
+from mediawords.solr.query import parse
 from mediawords.test.test_database import TestDatabaseTestCase
-from mediawords.tm.mine import postgres_regex_match
+from mediawords.tm.mine import postgres_regex_match, postgres_regex_plan_match, query_match
 
 
 class TestTMMine(TestDatabaseTestCase):
@@ -45,3 +48,111 @@ class TestTMMine(TestDatabaseTestCase):
             "alt-right alt-right \x00 alt-right"
         ]
         assert postgres_regex_match(db=self.db(), strings=strings, regex=regex) is False
+
+    def test_postgres_regex_plan_match(self):
+        # AND of 30 ORs would make a regex with 2^30 permutations of the operands
+        query = ' and '.join('( foo%d or "bar %d" )' % (i, i) for i in range(30))
+        plan = parse(query).re_plan()
+        assert not plan.is_single_regex()
+
+        all_terms = ' '.join('foo%d' % i for i in range(29)) + ' bar 29'
+
+        # Match
+        strings = ['This is a string with all terms: %s.' % all_terms]
+        assert postgres_regex_plan_match(db=self.db(), strings=strings, plan=plan) is True
+
+        # No match (one of AND operands is missing)
+        strings = ['This is a string with almost all terms: %s.' % all_terms.replace('foo7 ', '')]
+        assert postgres_regex_plan_match(db=self.db(), strings=strings, plan=plan) is False
+
+        # AND operands have to match in the same string
+        strings = [
+            ' '.join('foo%d' % i for i in range(15)),
+            ' '.join('foo%d' % i for i in range(15, 30)),
+        ]
+        assert postgres_regex_plan_match(db=self.db(), strings=strings, plan=plan) is False
+
+        # One matching string
+        strings = ['Nothing here.', all_terms.upper()]
+        assert postgres_regex_plan_match(db=self.db(), strings=strings, plan=plan) is True
+
+        # String with a null char
+        strings = [all_terms + ' \x00']
+        assert postgres_regex_plan_match(db=self.db(), strings=strings, plan=plan) is False
+
+        assert postgres_regex_plan_match(db=self.db(), strings=[], plan=plan) is False
+
+        # Single regex plan
+        plan = parse('foo or "alternative right"').re_plan()
+        assert plan.is_single_regex()
+        assert postgres_regex_plan_match(db=self.db(), strings=['Alternative  right'], plan=plan) is True
+        assert postgres_regex_plan_match(db=self.db(), strings=['Alternative left'], plan=plan) is False
+
+    def test_query_match(self):
+        queries = [
+            'alt* or "alternative right"',
+            'protest* and ( climate or "global warming" )',
+            '( foo and bar ) or baz and media_id:1',
+        ]
+        strings = [
+            'This is a string describing alt-right and something else.',
+            'Alternative\n right',
+            'Alternative left',
+            'Protesters demand action on climate change',
+            'Global warming protest',
+            'Global protest warming',
+            'foo, bar',
+            'bazaar',
+            'something else',
+        ]
+
+        # Same results as PostgreSQL's matching of topic's regex
+        for query in queries:
+            tree = parse(query)
+            matcher = QueryMatcher(tree=tree)
+            for string in strings:
+                assert query_match(strings=[string], matcher=matcher) == postgres_regex_match(
+                    db=self.db(), strings=[string], regex=tree.re()
+                ), "Query: %s; string: %s" % (query, string)
+
+        matcher = QueryMatcher(tree=parse('foo and bar'))
+        assert query_match(strings=['foo', 'foo bar'], matcher=matcher) is True
+        assert query_match(strings=['foo', 'bar'], matcher=matcher) is False
+        assert query_match(strings=[], matcher=matcher) is False
+
+    def test_postgres_regex_match_prefilter(self):
+        queries = [
+            'alt* or "alternative right"',
+            'protest* and ( climate or "global warming" )',
+            '( foo and bar ) or baz and media_id:1',
+            '( foo or bar ) and ( baz or qux ) and ( quux or corge )',
+        ]
+        strings = [
+            'This is a string describing alt-right and something else.',
+            'Alternative\n right',
+            'Protesters demand action on climate change',
+            'Global protest warming',
+            'foo, bar',
+            'bazaar',
+            'bar qux corge',
+            'something else',
+        ]
+
+        # Prefiltering doesn't change the results
+        for query in queries:
+            tree = parse(query)
+            prefilter = QueryPrefilter(tree=tree)
+            for string in strings:
+                assert postgres_regex_match(
+                    db=self.db(), strings=[string], regex=tree.re(), prefilter=prefilter
+                ) == postgres_regex_match(
+                    db=self.db(), strings=[string], regex=tree.re()
+                ), "Query: %s; string: %s" % (query, string)
+                assert postgres_regex_plan_match(
+                    db=self.db(), strings=[string], plan=tree.re_plan(), prefilter=prefilter
+                ) == postgres_regex_plan_match(
+                    db=self.db(), strings=[string], plan=tree.re_plan()
+                ), "Query: %s; string: %s" % (query, string)
+
+        prefilter = QueryPrefilter(tree=parse('foo and bar'))
+        assert postgres_regex_match(db=self.db(), strings=['foo', 'bar'], regex='foo', prefilter=prefilter) is False
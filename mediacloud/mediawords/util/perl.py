@@ -2,8 +2,9 @@
 # Perl (Inline::Perl) helpers
 #
 from enum import Enum
+import functools
 import re
-from typing import Union
+from typing import Dict, Tuple, Union
 
 from mediawords.util.log import create_logger
 
@@ -56,96 +57,111 @@ class McConvertDBDPgArgumentsToPsycopg2FormatException(Exception):
     pass
 
 
-# MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
-def convert_dbd_pg_arguments_to_psycopg2_format(*query_parameters: Union[list, tuple], skip_decoding=False) -> tuple:
-    """Convert DBD::Pg's question mark-style SQL query parameters to psycopg2's syntax."""
-
-    def __replace_double_question_marks_or_return_none(q: str, q_args: list) -> Union[tuple, None]:
-        """Replace "??" parameters with psycopg2's "%s" and tuple parameter, or return None if not found."""
-
-        double_question_mark_regex = re.compile("""
-            (?P<in_statement>\sIN\s)    # "(WHERE) column IN"
-            \(\s*\?\?\s*\)              # "(??)" with optional spaces around
-        """, flags=re.I | re.X)
-        double_question_mark_replacement = r'\g<in_statement>%s'
-
-        double_question_mark_count = len(re.findall(double_question_mark_regex, q))
-        if double_question_mark_count > 0:
-            if double_question_mark_count > 1:
-                raise McConvertDBDPgArgumentsToPsycopg2FormatException("""
-                    More than one double question mark found
-                    in query "%(query)s" (arguments: %(query_args)s)
-                """ % {
-                    'query': q,
-                    'query_args': q_args,
-                })
-
-            q = re.sub(double_question_mark_regex, double_question_mark_replacement, q)
-
-            if not isinstance(q_args, tuple):  # might have been converted previously
-                # Convert arguments to first (and only) psycopg2's query parameter
-                # (which should be a tuple: http://stackoverflow.com/a/28117658/200603)
-                q_args = tuple(q_args)
-                q_args = (q_args,)
-
-            return q, q_args
+class DBDPgPlaceholderType(Enum):
+    """DBD::Pg placeholder type found in a query."""
+    double_question_mark = 1
+    question_mark = 2
+    dollar_signs = 3
 
-        else:
-            return None
 
-    def __replace_question_marks_or_return_none(q: str, q_args: list) -> Union[tuple, None]:
-        """Replace "?" parameters with psycopg2's "%s", or return None if not found."""
+# Max. number of distinct queries for which converted placeholders are to be cached
+__DBD_PG_QUERY_CACHE_SIZE = 1024
 
-        question_mark_regex = re.compile("""
-            (?P<char_before_question_mark>\s|,|\()      # Question mark preceded by whitespace, comma or bracket
-            \?                                          # Question mark
-            (?=(\s|,|\)|(::)|$))                        # Lookahead and make sure question mark is singled out
-        """, flags=re.I | re.X)
-        question_mark_replacement = r'\g<char_before_question_mark>%s'
+# Matches 'PostgreSQL''s quoted literals'
+__QUOTED_LITERAL_REGEX = re.compile(r"('(?:[^']+|'')+')")
+__QUOTED_LITERAL_FULL_REGEX = re.compile(r"^('(?:[^']+|'')+')$")
 
-        question_mark_count = len(re.findall(question_mark_regex, q))
-        if question_mark_count > 0:
+# "(??)" placeholder
+__DOUBLE_QUESTION_MARK_REGEX = re.compile(r"""
+    (?P<in_statement>\sIN\s)    # "(WHERE) column IN"
+    \(\s*\?\?\s*\)              # "(??)" with optional spaces around
+""", flags=re.I | re.X)
+__DOUBLE_QUESTION_MARK_REPLACEMENT = r'\g<in_statement>%s'
 
-            q = re.sub(question_mark_regex, question_mark_replacement, q)
+# "?" placeholder
+__QUESTION_MARK_REGEX = re.compile(r"""
+    (?P<char_before_question_mark>\s|,|\()      # Question mark preceded by whitespace, comma or bracket
+    \?                                          # Question mark
+    (?=(\s|,|\)|(::)|$))                        # Lookahead and make sure question mark is singled out
+""", flags=re.I | re.X)
+__QUESTION_MARK_REPLACEMENT = r'\g<char_before_question_mark>%s'
+
+# "$1" placeholder
+__DOLLAR_SIGN_REGEX = re.compile(r"""
+    (?P<char_before_dollar_sign>\s|,|\()    # Dollar sign preceded by whitespace, comma or bracket
+    \$(?P<param_index>\d)                   # Dollar sign with a single-digit index ("$1", "$2", ...)
+    (?=(\s|,|\)|(::)|$))                    # Lookahead and make sure dollar sign is singled out
+""", flags=re.I | re.X)
+__DOLLAR_SIGN_REPLACEMENT = r'\g<char_before_dollar_sign>%(param_\g<param_index>)s'
 
-            # Convert arguments to psycopg2's argument tuple
-            if not isinstance(q_args, tuple):  # might have been converted previously
-                q_args = tuple(q_args)
 
-            return q, q_args
+@functools.lru_cache(maxsize=__DBD_PG_QUERY_CACHE_SIZE)
+def __convert_dbd_pg_placeholders(query: str) -> Tuple[str, Union[DBDPgPlaceholderType, None]]:
+    """Replace DBD::Pg's placeholders with psycopg2's ones; return converted query and placeholder type found.
 
+    Result depends on the query only (not on the arguments), so it gets cached."""
+
+    # Split SQL query into literals and not literals, iterate over all of them, replace parameters to psycopg2-style
+    # only for the non-literals parts
+    split_query = __QUOTED_LITERAL_REGEX.split(query)
+    converted_query = ""
+
+    placeholder_type = None
+
+    for query_part in split_query:
+        if __QUOTED_LITERAL_FULL_REGEX.match(query_part):
+            # Don't touch quoted literals
+            pass
         else:
-            return None
 
-    def __replace_dollar_signs_or_return_none(q: str, q_args: list) -> Union[tuple, None]:
-        """Replace "$1" parameters with psycopg2's "%(param_1)s", or return None if not found."""
+            part_placeholder_type = None
 
-        dollar_sign_regex = re.compile("""
-            (?P<char_before_dollar_sign>\s|,|\()    # Dollar sign preceded by whitespace, comma or bracket
-            \$(?P<param_index>\d)                   # Dollar sign with a single-digit index ("$1", "$2", ...)
-            (?=(\s|,|\)|(::)|$))                    # Lookahead and make sure dollar sign is singled out
-        """, flags=re.I | re.X)
-        dollar_sign_replacement = r'\g<char_before_dollar_sign>%(param_\g<param_index>)s'
+            double_question_mark_count = len(__DOUBLE_QUESTION_MARK_REGEX.findall(query_part))
+            if double_question_mark_count > 0:
+                if double_question_mark_count > 1:
+                    raise McConvertDBDPgArgumentsToPsycopg2FormatException(
+                        'More than one double question mark found in query "%s"' % query
+                    )
+                query_part = __DOUBLE_QUESTION_MARK_REGEX.sub(__DOUBLE_QUESTION_MARK_REPLACEMENT, query_part)
+                part_placeholder_type = DBDPgPlaceholderType.double_question_mark
 
-        dollar_sign_unique_indexes = set([x[1] for x in re.findall(dollar_sign_regex, q)])
-        dollar_sign_unique_count = len(dollar_sign_unique_indexes)
-        if dollar_sign_unique_count > 0:
+            elif __QUESTION_MARK_REGEX.search(query_part):
+                query_part = __QUESTION_MARK_REGEX.sub(__QUESTION_MARK_REPLACEMENT, query_part)
+                part_placeholder_type = DBDPgPlaceholderType.question_mark
 
-            q = re.sub(dollar_sign_regex, dollar_sign_replacement, q)
+            elif __DOLLAR_SIGN_REGEX.search(query_part):
+                query_part = __DOLLAR_SIGN_REGEX.sub(__DOLLAR_SIGN_REPLACEMENT, query_part)
+                part_placeholder_type = DBDPgPlaceholderType.dollar_signs
 
-            # Convert arguments to psycopg2's argument dictionary
-            if not isinstance(q_args, dict):  # might have been converted previously
-                q_args_dict = {}
-                for i in range(0, len(q_args)):
-                    q_args_dict['param_%d' % (i + 1)] = q_args[i]
-                q_args = q_args_dict
+            if part_placeholder_type is not None:
+                if placeholder_type is not None and placeholder_type != part_placeholder_type:
+                    raise McConvertDBDPgArgumentsToPsycopg2FormatException(
+                        'Mixed placeholder types? Query: %s' % query
+                    )
+                placeholder_type = part_placeholder_type
 
-            return q, q_args
+        converted_query += query_part
 
-        else:
-            return None
+    return converted_query, placeholder_type
 
-    # ---
+
+def dbd_pg_query_cache_stats() -> Dict[str, int]:
+    """Return hit / miss counters of the converted query cache used by convert_dbd_pg_arguments_to_psycopg2_format()."""
+    cache_info = __convert_dbd_pg_placeholders.cache_info()
+    return {
+        'hits': cache_info.hits,
+        'misses': cache_info.misses,
+        'size': cache_info.currsize,
+        'max_size': cache_info.maxsize,
+    }
+
+
+# MC_REWRITE_TO_PYTHON: remove after porting queries to named parameter style
+def convert_dbd_pg_arguments_to_psycopg2_format(*query_parameters: Union[list, tuple], skip_decoding=False) -> tuple:
+    """Convert DBD::Pg's question mark-style SQL query parameters to psycopg2's syntax.
+
+    Converted queries are cached (see dbd_pg_query_cache_stats()), so only arguments get rearranged for queries that
+    have been seen before."""
 
     if len(query_parameters) == 0:
         raise McConvertDBDPgArgumentsToPsycopg2FormatException('No query or its parameters.')
@@ -177,71 +193,7 @@ def convert_dbd_pg_arguments_to_psycopg2_format(*query_parameters: Union[list, t
 
     else:
 
-        # Matches 'PostgreSQL''s quoted literals'
-        quoted_literal_regex = r"('(?:[^']+|'')+')"
-
-        # Split SQL query into literals and not literals, iterate over all of them, replace parameters to psycopg2-style
-        # only for the non-literals parts
-        split_query = re.split(quoted_literal_regex, query)
-        converted_query = ""
-
-        class PlaceholderType(Enum):
-            double_question_mark = 1
-            question_mark = 2
-            dollar_signs = 3
-
-        placeholder_type = None
-
-        for query_part in split_query:
-            if re.match("^" + quoted_literal_regex + "$", query_part):
-                # Don't touch quoted literals
-                pass
-            else:
-
-                double_question_mark = __replace_double_question_marks_or_return_none(q=query_part, q_args=query_args)
-                if double_question_mark is not None:
-
-                    if placeholder_type is not None:
-                        if placeholder_type != PlaceholderType.double_question_mark:
-                            raise McConvertDBDPgArgumentsToPsycopg2FormatException("""
-                                Mixed placeholder types? Query: %(query)s, arguments: %(query_args)s
-                            """ % {'query': query, 'query_args': query_args})
-                    placeholder_type = PlaceholderType.double_question_mark
-
-                    query_part = double_question_mark[0]
-                    query_args = double_question_mark[1]
-
-                else:
-
-                    question_mark = __replace_question_marks_or_return_none(q=query_part, q_args=query_args)
-                    if question_mark is not None:
-
-                        if placeholder_type is not None:
-                            if placeholder_type != PlaceholderType.question_mark:
-                                raise McConvertDBDPgArgumentsToPsycopg2FormatException("""
-                                    Mixed placeholder types? Query: %(query)s, arguments: %(query_args)s
-                                """ % {'query': query, 'query_args': query_args})
-                        placeholder_type = PlaceholderType.question_mark
-
-                        query_part = question_mark[0]
-                        query_args = question_mark[1]
-
-                    else:
-
-                        dollar_signs = __replace_dollar_signs_or_return_none(q=query_part, q_args=query_args)
-                        if dollar_signs is not None:
-
-                            if placeholder_type is not None:
-                                if placeholder_type != PlaceholderType.dollar_signs:
-                                    raise McConvertDBDPgArgumentsToPsycopg2FormatException("""
-                                        Mixed placeholder types? Query: %(query)s, arguments: %(query_args)s
-                                    """ % {'query': query, 'query_args': query_args})
-                            placeholder_type = PlaceholderType.dollar_signs
-
-                            query_part = dollar_signs[0]
-                            query_args = dollar_signs[1]
-
-            converted_query += query_part
+        query, placeholder_type = __convert_dbd_pg_placeholders(query)
 
         if placeholder_type is None:
             raise McConvertDBDPgArgumentsToPsycopg2FormatException("""
@@ -249,7 +201,18 @@ def convert_dbd_pg_arguments_to_psycopg2_format(*query_parameters: Union[list, t
                 were found. Query: %(query)s; arguments: %(query_args)s
             """ % {'query': query, 'query_args': query_args})
 
-        query = converted_query
+        if placeholder_type == DBDPgPlaceholderType.double_question_mark:
+            # Convert arguments to first (and only) psycopg2's query parameter
+            # (which should be a tuple: http://stackoverflow.com/a/28117658/200603)
+            query_args = (tuple(query_args),)
+
+        elif placeholder_type == DBDPgPlaceholderType.question_mark:
+            # Convert arguments to psycopg2's argument tuple
+            query_args = tuple(query_args)
+
+        else:
+            # Convert arguments to psycopg2's argument dictionary
+            query_args = {'param_%d' % (i + 1): query_args[i] for i in range(0, len(query_args))}
 
     if query_args is None:
         query_parameters = (query,)
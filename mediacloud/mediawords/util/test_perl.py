@@ -1,4 +1,7 @@
+import pytest
+
 from mediawords.util.perl import *
+from mediawords.util.text import random_string
 
 
 def test_decode_object_from_bytes_if_needed():
@@ -192,3 +195,59 @@ def test_convert_dbd_pg_arguments_to_psycopg2_format_ignore_literals():
     expected_parameters = ("""INSERT INTO foo VALUES ('LIKE ''''bar%s', %s, %s)""", ('foo', 'bar',))
     actual_parameters = convert_dbd_pg_arguments_to_psycopg2_format(*input_parameters)
     assert expected_parameters == actual_parameters
+
+
+# noinspection SqlResolve
+def test_convert_dbd_pg_arguments_to_psycopg2_format_cache():
+    sql = "SELECT * FROM foo WHERE name = ? AND surname = ? AND 'literal ?' IS NOT NULL"
+
+    convert_dbd_pg_arguments_to_psycopg2_format(sql, 'Kim', 'Kardashian')
+    stats_before = dbd_pg_query_cache_stats()
+
+    # Same query with different arguments should be served from cache
+    expected_parameters = (
+        "SELECT * FROM foo WHERE name = %s AND surname = %s AND 'literal ?' IS NOT NULL", ('Kris', 'Jenner',)
+    )
+    actual_parameters = convert_dbd_pg_arguments_to_psycopg2_format(sql, 'Kris', 'Jenner')
+    assert expected_parameters == actual_parameters
+
+    stats_after = dbd_pg_query_cache_stats()
+    assert stats_after['hits'] == stats_before['hits'] + 1
+    assert stats_after['misses'] == stats_before['misses']
+    assert stats_after['size'] <= stats_after['max_size']
+
+    # Errors don't get cached
+    for _ in range(2):
+        with pytest.raises(McConvertDBDPgArgumentsToPsycopg2FormatException):
+            convert_dbd_pg_arguments_to_psycopg2_format("SELECT * FROM foo WHERE bar = ? AND 'baz' = $1", 1)
+
+
+# noinspection SqlResolve
+def test_convert_dbd_pg_arguments_to_psycopg2_format_cache_repeated():
+    """Repeatedly converted query gets served from cache and converts to the same query as the uncached conversion."""
+    sql = """
+        SELECT *
+        FROM stories
+        WHERE media_id = ?
+          AND publish_date > ?
+          AND title NOT LIKE 'The %% story ?'
+          AND language = ?
+          AND %s IS NOT NULL
+    """ % random_string(length=16)
+    iterations = 100
+
+    stats_before = dbd_pg_query_cache_stats()
+    uncached_parameters = convert_dbd_pg_arguments_to_psycopg2_format(sql, 1, '2017-01-01', 'en')
+    stats_after = dbd_pg_query_cache_stats()
+    assert stats_after['misses'] == stats_before['misses'] + 1
+
+    assert uncached_parameters[0].count('%s') == 3
+    assert uncached_parameters[1] == (1, '2017-01-01', 'en',)
+
+    for x in range(iterations):
+        cached_parameters = convert_dbd_pg_arguments_to_psycopg2_format(sql, x, '2017-01-01', 'en')
+        assert cached_parameters == (uncached_parameters[0], (x, '2017-01-01', 'en',),)
+
+    stats_after_repeated = dbd_pg_query_cache_stats()
+    assert stats_after_repeated['hits'] == stats_after['hits'] + iterations
+    assert stats_after_repeated['misses'] == stats_after['misses']
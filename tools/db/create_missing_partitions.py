@@ -22,7 +22,7 @@ def create_missing_partitions():
     while True:
         log.info("Creating missing partitions...")
 
-        db = connect_to_db()
+        db = connect_to_db(pooled=True)
         db.query('SELECT create_missing_partitions()')
         db.disconnect()
 
@@ -9,6 +9,10 @@
 #     # Export table data to "mediacloud-dump.sql"
 #     ./tools/export_import/export_tables_to_backup_crawler.py > mediacloud-dump.sql
 #
+#     # ...or export tables in parallel into a directory of compressed per-table COPY files and "manifest.json"
+#     # (rerun with --resume to continue an interrupted export)
+#     ./tools/export_import/export_tables_to_backup_crawler.py --directory mediacloud-dump/ --jobs 4
+#
 # 2) On target machine (e.g. a backup crawler), run:
 #
 #     # Create database
@@ -20,10 +24,40 @@
 #     # Import tables from "mediacloud-dump.sql"
 #     psql -v ON_ERROR_STOP=1 -f mediacloud-dump.sql mediacloud
 #
+#     # ...or, from the directory, import every table in manifest's "table_order" with its "columns":
+#     zstd -dc mediacloud-dump/media.copy.zst | psql -c "COPY media (media_id, ...) FROM STDIN" mediacloud
+#
+
+import argparse
 
 from mediawords.db import connect_to_db
-from mediawords.db.export.export_tables import print_exported_tables_to_backup_crawler
+from mediawords.db.export.export_tables import (
+    export_tables_to_backup_crawler_directory,
+    print_exported_tables_to_backup_crawler,
+)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export table data needed to run a backup crawler.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-d", "--directory", type=str, required=False, default=None,
+                        help="Export tables in parallel into compressed files in a directory instead of printing "
+                             "a SQL dump to STDOUT.")
+    parser.add_argument("-j", "--jobs", type=int, required=False, default=4,
+                        help="Number of tables to export in parallel (with --directory).")
+    parser.add_argument("-c", "--compression", type=str, required=False, default='zstd', choices=['zstd', 'gzip'],
+                        help="Compression of exported tables (with --directory).")
+    parser.add_argument("-r", "--resume", action='store_true',
+                        help="Skip tables which have already been exported into the directory (with --directory).")
+
+    args = parser.parse_args()
+
     db = connect_to_db()
-    print_exported_tables_to_backup_crawler(db=db)
+
+    if args.directory is None:
+        print_exported_tables_to_backup_crawler(db=db)
+    else:
+        export_tables_to_backup_crawler_directory(db=db,
+                                                  directory=args.directory,
+                                                  compression=args.compression,
+                                                  jobs=args.jobs,
+                                                  resume=args.resume)
@@ -22,7 +22,7 @@ def purge_object_caches():
     while True:
         log.info("Purging object caches...")
 
-        db = connect_to_db()
+        db = connect_to_db(pooled=True)
         db.query('SELECT cache.purge_object_caches()')
         db.disconnect()
 
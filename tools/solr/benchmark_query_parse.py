@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Benchmark parsing of large boolean Solr queries (such as the topic seed queries that users paste) by
+# mediawords.solr.query, e.g.:
+#
+#     ./tools/solr/benchmark_query_parse.py --terms 100 1000 5000 --repeat 5
+#
+
+import argparse
+import random
+import statistics
+import time
+
+from mediawords.solr.query import clear_parse_cache, parse
+
+
+def __benchmark_query(term_count: int) -> str:
+    """Return query of "term_count" OR'd terms, wildcards and phrases AND'ed with media tag and date clauses."""
+    random.seed(term_count)
+    words = ['term%d' % i for i in range(term_count)]
+
+    clauses = []
+    for i, word in enumerate(words):
+        if i % 10 == 0:
+            clauses.append('"%s %s"' % (word, random.choice(words)))
+        elif i % 7 == 0:
+            clauses.append(word + '*')
+        else:
+            clauses.append(word)
+
+    return (
+        '+( %(terms)s ) AND +tags_id_media:( %(tags)s )'
+        ' AND +publish_date:[2016-01-01T00:00:00Z TO 2016-12-31T00:00:00Z]'
+        ' AND -( spam OR title:junk )'
+    ) % {
+        'terms': ' OR '.join(clauses),
+        'tags': ' '.join(str(8875000 + i) for i in range(100)),
+    }
+
+
+def __time(function, repeat: int) -> float:
+    """Return median time (in seconds) of running the function "repeat" times."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def __parse_uncached(query: str):
+    clear_parse_cache()
+    return parse(query)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark parsing of large boolean Solr queries.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-t", "--terms", type=int, nargs='+', required=False, default=[100, 1000, 5000],
+                        help="Numbers of OR'd terms in the benchmarked queries.")
+    parser.add_argument("-r", "--repeat", type=int, required=False, default=5,
+                        help="Number of times to run every benchmark (median time is reported).")
+
+    args = parser.parse_args()
+
+    print("%8s %10s %12s %12s %16s %12s" % ('terms', 'query KB', 'parse ms', 'cached ms', 'parse+tsquery ms',
+                                           'parse+re ms'))
+
+    for terms in args.terms:
+        query = __benchmark_query(term_count=terms)
+
+        parse_time = __time(lambda: __parse_uncached(query), repeat=args.repeat)
+        cached_parse_time = __time(lambda: parse(query), repeat=args.repeat)
+        tsquery_time = __time(lambda: __parse_uncached(query).tsquery(), repeat=args.repeat)
+        re_time = __time(lambda: __parse_uncached(query).re(), repeat=args.repeat)
+
+        print("%8d %10.1f %12.2f %12.4f %16.2f %12.2f" % (
+            terms, len(query) / 1024, parse_time * 1000, cached_parse_time * 1000, tsquery_time * 1000, re_time * 1000,
+        ))